@@ -9,8 +9,9 @@ from chatbot.services.conversation_analysis_service import ConversationAnalysisS
 from .models import (
     ImageAnalysisPrompt, Session, Message, Ticket, TicketCategory, TicketComment, TicketImage, User, Company, CompanyInfo, Feedback,
     PolicyAcceptance, PolicyVersion, AudioMessage, UserCompanyInteraction,
-    CompanyAdmin as CompanyAdministrator, LeadStatistics
+    CompanyAdmin as CompanyAdministrator, LeadStatistics, InboundWebhookEvent, DelayedTask, AnalysisBatch
 )
+from .services.dashboard_snapshot_service import DashboardSnapshotService
 from .services.feedback_service import FeedbackService
 
 # Agregar al inicio del archivo
@@ -142,6 +143,7 @@ class CompanyAdmin(admin.ModelAdmin):
                 "phone_number",
                 "whatsapp_phone_number_id",
                 "whatsapp_api_token",
+                "message_debounce_seconds",
             ),
             "description": "Configuración para la API de WhatsApp",
         }),
@@ -183,6 +185,12 @@ class CompanyAdmin(admin.ModelAdmin):
             ),
             "description": "Detalles del plan contratado",
         }),
+        ("Modelos de IA", {
+            "fields": (
+                "model_routes",
+            ),
+            "classes": ("collapse",),
+        }),
     ]
     
     # Solo mostrar estadísticas en modo edición
@@ -670,45 +678,18 @@ class LeadStatisticsPanel(admin.ModelAdmin):
     
     def changelist_view(self, request, extra_context=None):
         extra_context = extra_context or {}
+        service = DashboardSnapshotService()
         
-        # Obtener estadísticas de intenciones para PostgreSQL
-        from django.db import connection
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                SELECT 
-                    analysis_results_json::json->>'primary_intent' as intent,
-                    COUNT(*) as count
-                FROM 
-                    chatbot_session
-                WHERE 
-                    analysis_results_json IS NOT NULL
-                GROUP BY 
-                    intent
-                ORDER BY 
-                    count DESC
-            """)
-            intent_stats = cursor.fetchall()
-            
-        # Obtener estadísticas de nivel de interés para PostgreSQL
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                SELECT 
-                    analysis_results_json::json->>'purchase_interest_level' as interest,
-                    COUNT(*) as count
-                FROM 
-                    chatbot_session
-                WHERE 
-                    analysis_results_json IS NOT NULL
-                GROUP BY 
-                    interest
-                ORDER BY 
-                    count DESC
-            """)
-            interest_stats = cursor.fetchall()
+        # Regenerar a petición (el parámetro no puede llegar al changelist: lo tomaría por un filtro)
+        if request.GET.get('refresh_snapshot'):
+            service.refresh('lead_statistics')
+            return HttpResponseRedirect(request.path)
         
-        # Preparar datos para gráficos
-        extra_context['intent_stats'] = intent_stats
-        extra_context['interest_stats'] = interest_stats
+        # Estadísticas precalculadas (job refresh_dashboard_snapshots)
+        snapshot = service.get('lead_statistics')
+        extra_context.update(snapshot.payload)
+        extra_context['snapshot'] = snapshot
+        extra_context['snapshot_stale'] = service.is_stale(snapshot)
         
         return super().changelist_view(request, extra_context=extra_context)
 
@@ -1251,6 +1232,74 @@ class ImageAnalysisPromptAdmin(admin.ModelAdmin):
             )
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
+@admin.register(InboundWebhookEvent)
+class InboundWebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('received_at', 'conversation_key', 'status', 'attempts', 'available_at', 'locked_by', 'short_error')
+    list_filter = ('status', 'received_at')
+    search_fields = ('conversation_key',)
+    readonly_fields = ('payload_json', 'remote_addr', 'conversation_key', 'status', 'attempts', 'available_at', 'locked_by',
+                       'locked_at', 'last_error', 'received_at', 'processed_at')
+    actions = ['requeue_events']
+    
+    def short_error(self, obj):
+        if obj.last_error:
+            return obj.last_error[:80]
+        return "-"
+    
+    def requeue_events(self, request, queryset):
+        from .services.inbound_queue_service import InboundQueueService
+        count = InboundQueueService().requeue(queryset.exclude(status='processing'))
+        self.message_user(request, f"{count} evento(s) reencolados.")
+    
+    def has_add_permission(self, request):
+        return False
+    
+    short_error.short_description = "Último error"
+    requeue_events.short_description = "Reencolar eventos seleccionados"
+
+@admin.register(DelayedTask)
+class DelayedTaskAdmin(admin.ModelAdmin):
+    list_display = ('run_at', 'task', 'idempotency_key', 'status', 'attempts', 'lag', 'short_error')
+    list_filter = ('status', 'task', 'run_at')
+    search_fields = ('idempotency_key',)
+    readonly_fields = ('task', 'payload_json', 'idempotency_key', 'status', 'attempts', 'run_at', 'available_at',
+                       'locked_by', 'started_at', 'last_error', 'created_at', 'processed_at')
+    actions = ['requeue_tasks']
+    
+    def lag(self, obj):
+        if obj.lag_seconds is None:
+            return "-"
+        return f"{obj.lag_seconds:.1f}s"
+    
+    def short_error(self, obj):
+        if obj.last_error:
+            return obj.last_error[:80]
+        return "-"
+    
+    def requeue_tasks(self, request, queryset):
+        from .services.delayed_task_service import DelayedTaskService
+        count = DelayedTaskService().requeue(queryset.exclude(status='processing'))
+        self.message_user(request, f"{count} tarea(s) reprogramadas.")
+    
+    def has_add_permission(self, request):
+        return False
+    
+    lag.short_description = "Retraso"
+    short_error.short_description = "Último error"
+    requeue_tasks.short_description = "Reprogramar tareas seleccionadas"
+
+@admin.register(AnalysisBatch)
+class AnalysisBatchAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'external_id', 'backend', 'model', 'status', 'session_count', 'analyzed_count',
+                    'lead_count', 'completed_at')
+    list_filter = ('status', 'backend', 'created_at')
+    search_fields = ('external_id',)
+    readonly_fields = ('backend', 'external_id', 'model', 'status', 'session_count', 'analyzed_count', 'lead_count',
+                       'last_error', 'created_at', 'completed_at')
+    
+    def has_add_permission(self, request):
+        return False
+
 
 company_admin_site.register(Session, SessionAdmin)
 company_admin_site.register(Message, MessageAdmin)
@@ -14,6 +14,9 @@ class ChatbotConfig(AppConfig):
         Método que se ejecuta cuando la aplicación está lista.
         Iniciamos el planificador de tareas aquí con consideración para entornos de producción.
         """
+        # Señales que invalidan los prompts en caché al cambiar el contenido de una empresa
+        from . import signals  # noqa: F401
+        
         # Evitar iniciar durante comandos de Django como migrate, collectstatic, etc.
         if 'migrate' in sys.argv or 'collectstatic' in sys.argv:
             return
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatbot.models import AnalysisBatch
+from chatbot.services.analysis_batch_service import AnalysisBatchService
+
+class Command(BaseCommand):
+    help = 'Envía las sesiones cerradas sin análisis en lotes y aplica los lotes completados'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--backend',
+            help='Backend de lotes (por defecto ANALYSIS_BATCH_BACKEND; "local" no llama a OpenAI)'
+        )
+        parser.add_argument(
+            '--poll-only',
+            action='store_true',
+            help='No enviar lotes nuevos, solo consultar los enviados'
+        )
+        parser.add_argument(
+            '--wait',
+            action='store_true',
+            help='Esperar hasta que se completen todos los lotes enviados'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=60.0,
+            help='Segundos entre consultas con --wait'
+        )
+
+    def handle(self, *args, **options):
+        service = AnalysisBatchService(backend=options['backend'])
+
+        if not options['poll_only']:
+            batches = service.submit_pending()
+            sessions = sum(batch.session_count for batch in batches)
+            self.stdout.write(f"Enviados {len(batches)} lotes con {sessions} sesiones ({service.backend_name})")
+
+        analyzed = service.poll()
+        while options['wait'] and AnalysisBatch.objects.filter(status='submitted', backend=service.backend_name).exists():
+            time.sleep(options['poll_interval'])
+            analyzed += service.poll()
+
+        self.stdout.write(self.style.SUCCESS(f"Aplicados {analyzed} análisis de conversaciones"))
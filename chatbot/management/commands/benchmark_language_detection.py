@@ -0,0 +1,90 @@
+import json
+import os
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services.language_detector import LANGUAGE_DATA_DIR, language_detector
+from .load_test import percentile
+
+class Command(BaseCommand):
+    help = 'Mide la precisión y la latencia del detector de idioma local sobre frases etiquetadas'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fixture',
+            default=os.path.join(LANGUAGE_DATA_DIR, 'benchmark.json'),
+            help='JSON con una lista de pares [código, frase]'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=20,
+            help='Pasadas sobre las frases para medir la latencia'
+        )
+        parser.add_argument(
+            '--min-confidence',
+            type=float,
+            default=None,
+            help='Umbral por debajo del cual se consultaría a OpenAI (por defecto LANGUAGE_DETECTION_MIN_CONFIDENCE)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['fixture'], encoding='utf-8') as f:
+                samples = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"No se pudo leer el fixture: {e}")
+
+        threshold = options['min_confidence']
+        if threshold is None:
+            threshold = settings.LANGUAGE_DETECTION_MIN_CONFIDENCE
+
+        per_language = defaultdict(Counter)
+        errors = []
+        for expected, text in samples:
+            code, confidence = language_detector.detect(text)
+            stats = per_language[expected]
+            stats['total'] += 1
+            stats['correct'] += code == expected
+            if confidence >= threshold:
+                stats['local'] += 1
+                stats['local_correct'] += code == expected
+            if code != expected:
+                errors.append((expected, code, confidence, text))
+
+        latencies = []
+        for _ in range(options['repeat']):
+            for _, text in samples:
+                started = time.perf_counter()
+                language_detector.detect(text)
+                latencies.append((time.perf_counter() - started) * 1_000_000)
+        latencies.sort()
+
+        self.stdout.write(f"{'idioma':<8}{'frases':>8}{'acierto':>10}{'local':>8}{'acierto local':>15}")
+        totals = Counter()
+        for language in sorted(per_language):
+            stats = per_language[language]
+            totals.update(stats)
+            self.stdout.write(
+                f"{language:<8}{stats['total']:>8}{stats['correct'] / stats['total']:>10.0%}"
+                f"{stats['local'] / stats['total']:>8.0%}{self._ratio(stats['local_correct'], stats['local']):>15}"
+            )
+
+        self.stdout.write("")
+        self.stdout.write(f"Precisión: {totals['correct'] / totals['total']:.1%} ({totals['correct']}/{totals['total']})")
+        self.stdout.write(
+            f"Resueltas sin OpenAI (confianza >= {threshold}): {totals['local'] / totals['total']:.1%}, "
+            f"precisión {self._ratio(totals['local_correct'], totals['local'])}"
+        )
+        self.stdout.write(
+            f"Latencia: p50 {percentile(latencies, 50):.0f} µs, p99 {percentile(latencies, 99):.0f} µs, "
+            f"máx {latencies[-1]:.0f} µs"
+        )
+        for expected, code, confidence, text in errors:
+            self.stdout.write(self.style.WARNING(f"  {expected} -> {code} ({confidence:.2f}): {text}"))
+
+    def _ratio(self, part, whole):
+        return f"{part / whole:.0%}" if whole else "-"
@@ -3,6 +3,7 @@ from django.core.management.base import BaseCommand
 from django_apscheduler.models import DjangoJob
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.triggers.cron import CronTrigger
+from django.conf import settings
 from django.utils import timezone
 import json
 
@@ -22,10 +23,10 @@ class Command(BaseCommand):
             func_path="chatbot.scheduler:close_inactive_sessions"
         )
         
-        # Verificar y crear job para actualizar resúmenes de OpenAI
+        # Verificar y crear job para conciliar resúmenes de OpenAI
         self.create_or_update_job(
             id="update_openai_monthly_summaries",
-            name="Actualización de resúmenes mensuales de OpenAI",
+            name="Conciliación de resúmenes de OpenAI",
             trigger=CronTrigger(hour=3, minute=0),  # 3:00 AM
             func_path="chatbot.scheduler:update_openai_monthly_summaries"
         )
@@ -38,6 +39,62 @@ class Command(BaseCommand):
             func_path="chatbot.scheduler:cleanup_old_job_executions"
         )
         
+        # Verificar y crear job para purgar la cola de webhooks entrantes
+        self.create_or_update_job(
+            id="purge_processed_inbound_events",
+            name="Limpieza de la cola de webhooks entrantes",
+            trigger=CronTrigger(hour=4, minute=0),
+            func_path="chatbot.scheduler:purge_processed_inbound_events"
+        )
+        
+        # Verificar y crear job para barrer claves de deduplicación caducadas
+        self.create_or_update_job(
+            id="sweep_expired_dedup_keys",
+            name="Limpieza de claves de deduplicación",
+            trigger=IntervalTrigger(hours=1),
+            func_path="chatbot.scheduler:sweep_expired_dedup_keys"
+        )
+        
+        # Verificar y crear job para ejecutar tareas diferidas
+        self.create_or_update_job(
+            id="run_delayed_tasks",
+            name="Ejecución de tareas diferidas",
+            trigger=IntervalTrigger(seconds=settings.DELAYED_TASK_POLL_SECONDS),
+            func_path="chatbot.scheduler:run_delayed_tasks"
+        )
+        
+        # Verificar y crear job para limpiar tareas diferidas completadas
+        self.create_or_update_job(
+            id="purge_delayed_tasks",
+            name="Limpieza de tareas diferidas",
+            trigger=CronTrigger(hour=4, minute=15),
+            func_path="chatbot.scheduler:purge_delayed_tasks"
+        )
+        
+        # Verificar y crear job para enviar los lotes nocturnos de análisis
+        self.create_or_update_job(
+            id="submit_analysis_batches",
+            name="Envío de lotes de análisis de conversaciones",
+            trigger=CronTrigger(hour=2, minute=0),
+            func_path="chatbot.scheduler:submit_analysis_batches"
+        )
+        
+        # Verificar y crear job para aplicar los lotes de análisis completados
+        self.create_or_update_job(
+            id="poll_analysis_batches",
+            name="Consulta de lotes de análisis de conversaciones",
+            trigger=IntervalTrigger(minutes=settings.ANALYSIS_BATCH_POLL_MINUTES),
+            func_path="chatbot.scheduler:poll_analysis_batches"
+        )
+        
+        # Verificar y crear job para regenerar las instantáneas de los dashboards
+        self.create_or_update_job(
+            id="refresh_dashboard_snapshots",
+            name="Regeneración de instantáneas de dashboards",
+            trigger=IntervalTrigger(minutes=settings.DASHBOARD_SNAPSHOT_REFRESH_MINUTES),
+            func_path="chatbot.scheduler:refresh_dashboard_snapshots"
+        )
+        
         self.stdout.write(self.style.SUCCESS("Jobs programados inicializados correctamente"))
 
     def create_or_update_job(self, id, name, trigger, func_path):
@@ -0,0 +1,513 @@
+import asyncio
+import contextvars
+import copy
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+
+logger = logging.getLogger(__name__)
+
+# Métricas del mensaje en curso: se propagan a los hilos de sync_to_async
+# y a las tareas de asyncio, así que las consultas y errores de todo el
+# pipeline se atribuyen al mensaje que los provocó
+_current_stats = contextvars.ContextVar('load_test_stats', default=None)
+
+def parse_latency(spec):
+    """
+    Convierte una distribución de latencia en una función que devuelve segundos
+
+    Formatos: "0.2" o "fixed:0.2", "uniform:0.1,0.5", "normal:media,desviación"
+    y "lognormal:mediana,sigma".
+    """
+    kind, _, params = spec.partition(':')
+    if not params:
+        kind, params = 'fixed', kind
+    try:
+        values = [float(value) for value in params.split(',')]
+    except ValueError:
+        raise CommandError(f"Latencia no válida: {spec}")
+
+    if kind == 'fixed' and len(values) == 1:
+        return lambda: values[0]
+    if kind == 'uniform' and len(values) == 2:
+        return lambda: random.uniform(*values)
+    if kind == 'normal' and len(values) == 2:
+        return lambda: max(0.0, random.gauss(*values))
+    if kind == 'lognormal' and len(values) == 2:
+        median, sigma = values
+        return lambda: random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+    raise CommandError(f"Latencia no válida: {spec}")
+
+def percentile(values, pct):
+    """Percentil por rango más cercano (values ya ordenados)"""
+    if not values:
+        return 0
+    index = max(0, math.ceil(pct / 100 * len(values)) - 1)
+    return values[index]
+
+class StubServer:
+    """
+    Servidor HTTP local que sustituye a graph.facebook.com o a la API de OpenAI
+
+    Cada petición espera la latencia configurada y se contabiliza por endpoint.
+    """
+
+    def __init__(self, name, route, latency, port=0):
+        self.name = name
+        self.route = route
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                endpoint, status, content_type, payload = stub.route(self.command, self.path, body, stub)
+                stub.count(endpoint)
+                time.sleep(stub.latency())
+
+                if not isinstance(payload, bytes):
+                    payload = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def graph_route(method, path, body, stub):
+    """Endpoints de la Graph API usados por WhatsAppService"""
+    path = path.split('?')[0]
+    if method == 'POST' and path.endswith('/messages'):
+        return 'graph.messages', 200, 'application/json', {
+            "messaging_product": "whatsapp",
+            "messages": [{"id": f"wamid.stub.{uuid.uuid4().hex}"}]
+        }
+    if method == 'GET' and path.startswith('/media/'):
+        media_id = path.rsplit('/', 1)[-1]
+        if media_id.startswith('aud-'):
+            return 'graph.media_download', 200, 'audio/ogg', b'OggS' + b'\x00' * 2048
+        return 'graph.media_download', 200, 'image/jpeg', b'\xff\xd8\xff\xe0' + b'\x00' * 2048
+    if method == 'GET':
+        media_id = path.rsplit('/', 1)[-1]
+        return 'graph.media', 200, 'application/json', {
+            "id": media_id,
+            "url": f"{stub.url}/media/{media_id}",
+            "mime_type": "audio/ogg" if media_id.startswith('aud-') else "image/jpeg"
+        }
+    return 'graph.unknown', 404, 'application/json', {"error": {"message": f"Ruta no simulada: {path}"}}
+
+def openai_route(method, path, body, stub):
+    """Endpoints de OpenAI usados por el chatbot (chat, visión y audio)"""
+    path = path.split('?')[0]
+    if method == 'POST' and path.endswith('/chat/completions'):
+        endpoint = 'openai.vision' if b'image_url' in body else 'openai.chat'
+        try:
+            model = json.loads(body).get('model', 'gpt-4o-mini')
+        except ValueError:
+            model = 'gpt-4o-mini'
+        return endpoint, 200, 'application/json', {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "Respuesta simulada para la prueba de carga."},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 400, "completion_tokens": 40, "total_tokens": 440}
+        }
+    if method == 'POST' and path.endswith('/audio/transcriptions'):
+        return 'openai.audio', 200, 'application/json', {"text": "Transcripción simulada del audio"}
+    return 'openai.unknown', 404, 'application/json', {"error": {"message": f"Ruta no simulada: {path}"}}
+
+class StatsLogHandler(logging.Handler):
+    """Cuenta los errores registrados durante el procesamiento de cada mensaje"""
+
+    def emit(self, record):
+        stats = _current_stats.get()
+        if stats is not None:
+            stats['errors'].append(record.getMessage()[:200])
+
+def count_query(execute, sql, params, many, context):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats['queries'] += 1
+    return execute(sql, params, many, context)
+
+def install_query_counter(sender=None, connection=None, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+class Command(BaseCommand):
+    help = (
+        'Prueba de carga del webhook con servidores simulados de la Graph API y de OpenAI. '
+        'Envía payloads generados o grabados a /webhook al ritmo indicado e informa de la '
+        'latencia (p50/p95/p99), consultas a BD y llamadas salientes por mensaje y errores.'
+    )
+    # Los servicios deben crearse después de apuntar los clientes a los
+    # servidores simulados, así que no se cargan las URLs en los checks
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200, help='Número de mensajes a enviar')
+        parser.add_argument('--rate', type=float, default=20.0, help='Mensajes por segundo objetivo')
+        parser.add_argument('--conversations', type=int, default=20, help='Usuarios distintos que envían mensajes')
+        parser.add_argument(
+            '--mix',
+            default='text=0.8,image=0.1,audio=0.1',
+            help='Proporción de tipos de mensaje generados (text, image, audio)'
+        )
+        parser.add_argument('--payloads', help='Fichero JSON/JSONL con payloads de webhook grabados para reproducir')
+        parser.add_argument(
+            '--graph-latency',
+            default='lognormal:0.15,0.4',
+            help='Latencia de la Graph API simulada (fixed:s, uniform:a,b, normal:m,d, lognormal:mediana,sigma)'
+        )
+        parser.add_argument(
+            '--openai-latency',
+            default='lognormal:1.2,0.5',
+            help='Latencia de OpenAI simulada (mismo formato que --graph-latency)'
+        )
+        parser.add_argument('--graph-port', type=int, default=0, help='Puerto del servidor Graph simulado (0 = libre)')
+        parser.add_argument('--openai-port', type=int, default=0, help='Puerto del servidor OpenAI simulado (0 = libre)')
+        parser.add_argument('--concurrency', type=int, default=100, help='Peticiones al webhook en curso como máximo')
+        parser.add_argument(
+            '--url',
+            help='URL de un servidor ya arrancado (p.ej. http://127.0.0.1:8000/webhook). Debe usar '
+                 'WHATSAPP_GRAPH_API_URL y OPENAI_BASE_URL de los servidores simulados; sin consultas por mensaje'
+        )
+        parser.add_argument('--seed', type=int, help='Semilla para reproducir la misma carga')
+        parser.add_argument('--json', dest='json_path', help='Guardar el informe en este fichero JSON')
+        parser.add_argument('--keep-data', action='store_true', help='No borrar la empresa y usuarios de prueba')
+        parser.add_argument('--allow-production', action='store_true', help='Permitir la ejecución con ENVIRONMENT=production')
+
+    def handle(self, *args, **options):
+        if settings.ENVIRONMENT == 'production' and not options['allow_production']:
+            raise CommandError("La prueba de carga crea datos en la BD configurada; usa --allow-production para continuar")
+        if options['seed'] is not None:
+            random.seed(options['seed'])
+
+        # Independiente de --seed: los ids de mensaje deben ser nuevos en cada
+        # ejecución o la deduplicación descartaría los mensajes repetidos
+        self.run_id = f"{uuid.uuid4().int % 1000000:06d}"
+        graph = StubServer('graph', graph_route, parse_latency(options['graph_latency']), options['graph_port']).start()
+        openai_stub = StubServer('openai', openai_route, parse_latency(options['openai_latency']), options['openai_port']).start()
+        self.stdout.write(f"Graph API simulada: {graph.url}")
+        self.stdout.write(f"OpenAI simulado: {openai_stub.url}/v1")
+
+        # El SDK de OpenAI lee OPENAI_BASE_URL al crear cada cliente
+        os.environ['OPENAI_BASE_URL'] = f"{openai_stub.url}/v1"
+        os.environ.setdefault('OPENAI_API_KEY', settings.OPENAI_API_KEY or 'sk-load-test')
+
+        log_handler = StatsLogHandler(level=logging.ERROR)
+        logging.getLogger().addHandler(log_handler)
+        connection_created.connect(install_query_counter)
+        install_query_counter(connection=connection)
+
+        # Las imágenes y audios descargados se guardan en un directorio temporal
+        media_root = tempfile.mkdtemp(prefix='load_test_media_')
+        company, phones = self.create_fixtures(options['conversations'])
+        try:
+            payloads = self.build_payloads(options, company, phones)
+            with override_settings(
+                WHATSAPP_GRAPH_API_URL=graph.url,
+                OPENAI_API_KEY=os.environ['OPENAI_API_KEY'],
+                INBOUND_QUEUE_ENABLED=False,
+                MEDIA_ROOT=media_root
+            ):
+                started = time.monotonic()
+                results = asyncio.run(self.replay(payloads, options))
+                elapsed = time.monotonic() - started
+        finally:
+            logging.getLogger().removeHandler(log_handler)
+            connection_created.disconnect(install_query_counter)
+            graph.stop()
+            openai_stub.stop()
+            shutil.rmtree(media_root, ignore_errors=True)
+            if not options['keep_data']:
+                self.delete_fixtures(company, phones)
+
+        report = self.build_report(results, elapsed, [graph, openai_stub], measured_queries=not options['url'])
+        self.print_report(report)
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Informe guardado en {options['json_path']}")
+
+        failed = sum(1 for item in results if item['status'] != 200)
+        if failed:
+            raise CommandError(f"{failed} de {len(results)} peticiones al webhook no respondieron 200")
+
+    def create_fixtures(self, conversations):
+        """Crea la empresa de prueba y usuarios ya incorporados (políticas e idioma)"""
+        from chatbot.models import Company, PolicyVersion, User
+
+        company = Company.objects.create(
+            name=f"Load test {self.run_id}",
+            phone_number=f"load-{self.run_id}",
+            whatsapp_api_token="load-test-token",
+            whatsapp_phone_number_id=f"loadtest-{self.run_id}"
+        )
+        policy = PolicyVersion.objects.filter(active=True).first()
+        phones = [f"99{self.run_id}{i:05d}" for i in range(conversations)]
+        User.objects.bulk_create([
+            User(
+                whatsapp_number=phone,
+                name=f"Load {i}",
+                policies_accepted=True,
+                policies_version=policy.version if policy else "1.0",
+                language="es",
+                has_messages=True
+            )
+            for i, phone in enumerate(phones)
+        ])
+        return company, phones
+
+    def delete_fixtures(self, company, phones):
+        from chatbot.models import User
+        from chatbot.services.usage_buffer import usage_buffer
+
+        # Guardar antes el uso pendiente: si no, el siguiente flush apuntaría a la empresa borrada
+        usage_buffer.flush()
+        User.objects.filter(whatsapp_number__startswith=f"99{self.run_id}").delete()
+        company.delete()
+
+    def build_payloads(self, options, company, phones):
+        """Genera los payloads del webhook o adapta los grabados a la empresa de prueba"""
+        phone_number_id = company.whatsapp_phone_number_id
+
+        if options['payloads']:
+            with open(options['payloads']) as f:
+                content = f.read().strip()
+            recorded = json.loads(content) if content.startswith('[') else [
+                json.loads(line) for line in content.splitlines() if line.strip()
+            ]
+            if not recorded:
+                raise CommandError(f"No hay payloads en {options['payloads']}")
+
+            payloads = []
+            for i in range(options['messages']):
+                body = copy.deepcopy(recorded[i % len(recorded)])
+                message_type = 'recorded'
+                for entry in body.get('entry', []):
+                    for change in entry.get('changes', []):
+                        value = change.get('value', {})
+                        value.setdefault('metadata', {})['phone_number_id'] = phone_number_id
+                        for message in value.get('messages', []):
+                            # Ids únicos: si no, la deduplicación descartaría las repeticiones
+                            message['id'] = f"{message.get('id', 'wamid')}.{self.run_id}.{i}"
+                            message_type = message.get('type', message_type)
+                payloads.append((message_type, body))
+            return payloads
+
+        mix = {}
+        for part in options['mix'].split(','):
+            name, _, weight = part.partition('=')
+            if name.strip() not in ('text', 'image', 'audio'):
+                raise CommandError(f"Tipo de mensaje no soportado en --mix: {name}")
+            mix[name.strip()] = float(weight or 1)
+
+        payloads = []
+        for i in range(options['messages']):
+            message_type = random.choices(list(mix), weights=list(mix.values()))[0]
+            phone = phones[i % len(phones)]
+            message = {
+                "from": phone,
+                "id": f"wamid.load.{self.run_id}.{i}",
+                "timestamp": str(int(time.time())),
+                "type": message_type
+            }
+            if message_type == 'text':
+                message["text"] = {"body": f"Hola, ¿cuál es el horario de atención? ({i})"}
+            elif message_type == 'image':
+                message["image"] = {"id": f"img-{self.run_id}-{i}", "mime_type": "image/jpeg", "caption": "Se ha roto esta pieza"}
+            else:
+                message["audio"] = {"id": f"aud-{self.run_id}-{i}", "mime_type": "audio/ogg"}
+
+            payloads.append((message_type, {
+                "object": "whatsapp_business_account",
+                "entry": [{
+                    "id": f"loadtest-{self.run_id}",
+                    "changes": [{
+                        "field": "messages",
+                        "value": {
+                            "messaging_product": "whatsapp",
+                            "metadata": {"display_phone_number": company.phone_number, "phone_number_id": phone_number_id},
+                            "contacts": [{"profile": {"name": f"Load {i % len(phones)}"}, "wa_id": phone}],
+                            "messages": [message]
+                        }
+                    }]
+                }]
+            }))
+        return payloads
+
+    async def replay(self, payloads, options):
+        """Envía los payloads al webhook al ritmo objetivo"""
+        if options['url']:
+            import httpx
+            client = httpx.AsyncClient(timeout=300)
+
+            async def post(body):
+                response = await client.post(options['url'], json=body)
+                return response.status_code
+        else:
+            from django.test import AsyncClient
+            # Con ASGI el host sale de la cabecera Host, no de SERVER_NAME
+            hosts = [host for host in settings.ALLOWED_HOSTS if host and host != '*']
+            client = AsyncClient(headers={'host': hosts[0].lstrip('.') if hosts else 'localhost'})
+
+            async def post(body):
+                response = await client.post('/webhook', data=json.dumps(body), content_type='application/json')
+                return response.status_code
+
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        results = []
+
+        async def send(message_type, body):
+            async with semaphore:
+                stats = {'type': message_type, 'queries': 0, 'errors': [], 'status': None}
+                _current_stats.set(stats)
+                started = time.monotonic()
+                try:
+                    status = stats['status'] = await post(body)
+                    if status != 200:
+                        stats['errors'].append(f"HTTP {status}")
+                except Exception as e:
+                    stats['errors'].append(f"{type(e).__name__}: {e}")
+                stats['latency'] = time.monotonic() - started
+                results.append(stats)
+
+        interval = 1.0 / options['rate'] if options['rate'] > 0 else 0
+        start = time.monotonic()
+        tasks = []
+        try:
+            for i, (message_type, body) in enumerate(payloads):
+                delay = start + i * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                # Cada tarea copia el contexto: sus métricas no se mezclan
+                tasks.append(asyncio.create_task(send(message_type, body)))
+            await asyncio.gather(*tasks)
+        finally:
+            if options['url']:
+                await client.aclose()
+            else:
+                from chatbot.services.async_clients import close_async_clients
+                await close_async_clients()
+        return results
+
+    def build_report(self, results, elapsed, stubs, measured_queries=True):
+        """Agrega las métricas por mensaje y por tipo de mensaje"""
+        def summarize(items):
+            latencies = sorted(item['latency'] * 1000 for item in items)
+            queries = sorted(item['queries'] for item in items)
+            summary = {
+                'messages': len(items),
+                'latency_ms': {
+                    'p50': round(percentile(latencies, 50), 1),
+                    'p95': round(percentile(latencies, 95), 1),
+                    'p99': round(percentile(latencies, 99), 1),
+                    'max': round(latencies[-1], 1) if latencies else 0,
+                },
+                'errors': sum(1 for item in items if item['errors']),
+            }
+            if measured_queries:
+                summary['queries_per_message'] = {
+                    'mean': round(sum(queries) / len(queries), 1) if queries else 0,
+                    'p95': percentile(queries, 95),
+                    'max': queries[-1] if queries else 0,
+                }
+            return summary
+
+        by_type = defaultdict(list)
+        for item in results:
+            by_type[item['type']].append(item)
+
+        calls = Counter()
+        for stub in stubs:
+            calls.update(stub.calls)
+        total = len(results) or 1
+
+        error_messages = Counter(error for item in results for error in item['errors'])
+        return {
+            'duration_s': round(elapsed, 2),
+            'throughput_msg_s': round(len(results) / elapsed, 2) if elapsed else 0,
+            'overall': summarize(results),
+            'by_type': {message_type: summarize(items) for message_type, items in sorted(by_type.items())},
+            'outbound_calls_per_message': {
+                'total': round(sum(calls.values()) / total, 2),
+                **{endpoint: round(count / total, 2) for endpoint, count in sorted(calls.items())}
+            },
+            'top_errors': error_messages.most_common(5),
+        }
+
+    def print_report(self, report):
+        overall = report['overall']
+        self.stdout.write("")
+        self.stdout.write(self.style.SUCCESS(
+            f"{overall['messages']} mensajes en {report['duration_s']} s ({report['throughput_msg_s']} msg/s)"
+        ))
+        for name, summary in [('total', overall)] + list(report['by_type'].items()):
+            latency = summary['latency_ms']
+            line = (
+                f"  {name:<9} n={summary['messages']:<5} p50={latency['p50']}ms p95={latency['p95']}ms "
+                f"p99={latency['p99']}ms max={latency['max']}ms errores={summary['errors']}"
+            )
+            if 'queries_per_message' in summary:
+                queries = summary['queries_per_message']
+                line += f" consultas/msg={queries['mean']} (p95 {queries['p95']}, max {queries['max']})"
+            self.stdout.write(line)
+
+        calls = report['outbound_calls_per_message']
+        self.stdout.write(f"  Llamadas salientes por mensaje: {calls['total']}")
+        for endpoint, value in calls.items():
+            if endpoint != 'total':
+                self.stdout.write(f"    {endpoint}: {value}")
+
+        if report['top_errors']:
+            self.stdout.write(self.style.WARNING("  Errores más frecuentes:"))
+            for error, count in report['top_errors']:
+                self.stdout.write(f"    {count} x {error}")
@@ -0,0 +1,61 @@
+import logging
+import os
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chatbot.services.delayed_task_service import DelayedTaskService
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Ejecuta las tareas diferidas persistentes (alternativa al job del scheduler)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Segundos de espera cuando no hay tareas vencidas'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50,
+            help='Número de tareas que se reclaman en cada consulta'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Ejecutar las tareas vencidas una vez y terminar'
+        )
+
+    def handle(self, *args, **options):
+        service = DelayedTaskService()
+        worker_id = f"{socket.gethostname()}-{os.getpid()}-delayed"
+        self.stdout.write(self.style.SUCCESS(f"Ejecutando tareas diferidas ({worker_id})"))
+
+        last_stats = 0
+        try:
+            while True:
+                close_old_connections()
+                done = service.run_due(worker_id, limit=options['batch_size'])
+
+                # Métricas de retraso de la cola cada minuto
+                if time.monotonic() - last_stats >= 60:
+                    stats = service.get_stats()
+                    logger.info(
+                        f"Tareas diferidas: {stats['pending']} pendientes, {stats['dead']} en dead-letter, "
+                        f"vencida más antigua {stats['oldest_due_seconds']:.1f}s, "
+                        f"retraso medio {stats['lag_avg_seconds']:.1f}s (máx. {stats['lag_max_seconds']:.1f}s)"
+                    )
+                    last_stats = time.monotonic()
+
+                if options['once'] and not done:
+                    break
+                if not done:
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            self.stdout.write("Deteniendo ejecución de tareas diferidas...")
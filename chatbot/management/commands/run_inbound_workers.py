@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from chatbot.services.async_clients import close_async_clients, db_sync_to_async
+from chatbot.services.inbound_queue_service import InboundQueueService
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Inicia un pool de workers que procesa la cola de webhooks entrantes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.INBOUND_QUEUE_WORKERS,
+            help='Número de workers (hilos) que procesan la cola en paralelo'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1,
+            help='Número de eventos que reclama cada worker en cada consulta'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Segundos de espera cuando la cola está vacía'
+        )
+        parser.add_argument(
+            '--visibility-timeout',
+            type=int,
+            default=settings.INBOUND_QUEUE_VISIBILITY_TIMEOUT,
+            help='Segundos que un evento reclamado permanece invisible para otros workers'
+        )
+        parser.add_argument(
+            '--max-attempts',
+            type=int,
+            default=settings.INBOUND_QUEUE_MAX_ATTEMPTS,
+            help='Intentos antes de mover un evento a dead-letter'
+        )
+        parser.add_argument(
+            '--async',
+            action='store_true',
+            dest='use_async',
+            help='Procesar en un event loop (AsyncOpenAI/httpx) en lugar de un pool de hilos'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=settings.INBOUND_QUEUE_ASYNC_CONCURRENCY,
+            help='Eventos en curso simultáneamente en modo --async'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Vaciar la cola una vez y terminar (útil para cron o pruebas)'
+        )
+
+    def handle(self, *args, **options):
+        # Importar aquí para no cargar todos los servicios al listar comandos
+        from chatbot.views import process_webhook_payload, process_webhook_payload_async
+        self.process_webhook_payload = process_webhook_payload
+        self.process_webhook_payload_async = process_webhook_payload_async
+
+        self.queue_service = InboundQueueService(
+            visibility_timeout=options['visibility_timeout'],
+            max_attempts=options['max_attempts']
+        )
+        self.batch_size = options['batch_size']
+        self.poll_interval = options['poll_interval']
+        self.once = options['once']
+        self.stop_event = threading.Event()
+
+        worker_count = max(1, options['workers'])
+        base_id = f"{socket.gethostname()}-{os.getpid()}"
+
+        if options['use_async']:
+            self.handle_async(base_id, max(1, options['concurrency']))
+            return
+
+        self.stdout.write(f"Iniciando {worker_count} workers de la cola de entrada...")
+
+        threads = []
+        for index in range(worker_count):
+            thread = threading.Thread(
+                target=self.worker_loop,
+                args=(f"{base_id}-{index}",),
+                name=f"inbound-worker-{index}",
+                daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+
+        try:
+            self.stdout.write(self.style.SUCCESS('Workers iniciados. Presiona Ctrl+C para detener.'))
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Deteniendo workers (terminando eventos en curso)...'))
+            self.stop_event.set()
+            for thread in threads:
+                thread.join(timeout=self.queue_service.visibility_timeout)
+
+        self.stdout.write(self.style.SUCCESS('Workers detenidos'))
+
+    def handle_async(self, worker_id, concurrency):
+        """Ejecuta un único worker asíncrono con hasta `concurrency` eventos en curso"""
+        self.stdout.write(f"Iniciando worker asíncrono de la cola de entrada (concurrencia {concurrency})...")
+        self.concurrency = concurrency
+        try:
+            asyncio.run(self.async_loop(worker_id))
+        except KeyboardInterrupt:
+            # Los eventos interrumpidos vuelven a la cola al expirar su visibilidad
+            self.stdout.write(self.style.WARNING('Worker asíncrono interrumpido'))
+        self.stdout.write(self.style.SUCCESS('Workers detenidos'))
+
+    async def async_loop(self, worker_id):
+        """Bucle asíncrono: reclama eventos mientras haya huecos libres y los procesa como tareas"""
+        claim_batch = db_sync_to_async(self.queue_service.claim_batch)
+        tasks = set()
+        logger.info(f"Worker asíncrono {worker_id} iniciado")
+        try:
+            while not self.stop_event.is_set():
+                free = self.concurrency - len(tasks)
+                events = []
+                if free > 0:
+                    try:
+                        events = await claim_batch(worker_id, limit=free)
+                    except Exception as e:
+                        logger.error(f"Worker {worker_id}: error reclamando eventos: {e}")
+
+                for event in events:
+                    task = asyncio.create_task(self.process_event_async(worker_id, event))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                if not events:
+                    if self.once and not tasks:
+                        break
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            await close_async_clients()
+            logger.info(f"Worker asíncrono {worker_id} detenido")
+
+    async def process_event_async(self, worker_id, event):
+        """Versión asíncrona de process_event"""
+        started = time.monotonic()
+        group = [event] + getattr(event, 'followers', [])
+        error = None
+        try:
+            payload = self.queue_service.combined_payload(group)
+            await self.process_webhook_payload_async(payload, remote_addr=event.remote_addr)
+        except Exception as e:
+            logger.error(f"Worker {worker_id}: error procesando evento {event.id}: {e}", exc_info=True)
+            error = e
+
+        await db_sync_to_async(self.finish_group)(worker_id, group, error)
+        if not error:
+            logger.info(f"Worker {worker_id}: evento {event.id} ({len(group)} en la ráfaga) procesado en {time.monotonic() - started:.2f}s")
+
+    def worker_loop(self, worker_id):
+        """Bucle principal de un worker: reclamar, procesar y confirmar eventos"""
+        logger.info(f"Worker {worker_id} iniciado")
+        try:
+            while not self.stop_event.is_set():
+                # Descartar conexiones caídas o demasiado antiguas entre iteraciones
+                close_old_connections()
+
+                try:
+                    events = self.queue_service.claim_batch(worker_id, limit=self.batch_size)
+                except Exception as e:
+                    logger.error(f"Worker {worker_id}: error reclamando eventos: {e}")
+                    self.stop_event.wait(self.poll_interval)
+                    continue
+
+                if not events:
+                    if self.once:
+                        break
+                    self.stop_event.wait(self.poll_interval)
+                    continue
+
+                for event in events:
+                    self.process_event(worker_id, event)
+        finally:
+            connection.close()
+            logger.info(f"Worker {worker_id} detenido")
+
+    def process_event(self, worker_id, event):
+        """
+        Procesa un evento (y la ráfaga reclamada con él) y lo confirma
+        o lo reprograma según el resultado
+        """
+        started = time.monotonic()
+        group = [event] + getattr(event, 'followers', [])
+        try:
+            payload = self.queue_service.combined_payload(group)
+            self.process_webhook_payload(payload, remote_addr=event.remote_addr)
+        except Exception as e:
+            logger.error(f"Worker {worker_id}: error procesando evento {event.id}: {e}", exc_info=True)
+            self.finish_group(worker_id, group, e)
+            return
+
+        self.finish_group(worker_id, group)
+        logger.info(f"Worker {worker_id}: evento {event.id} ({len(group)} en la ráfaga) procesado en {time.monotonic() - started:.2f}s")
+
+    def finish_group(self, worker_id, group, error=None):
+        """Confirma los eventos procesados o los reprograma si hubo un error"""
+        for item in group:
+            try:
+                if error:
+                    self.queue_service.mark_failed(item, error)
+                else:
+                    self.queue_service.mark_done(item)
+            except Exception as e:
+                # El evento volverá a estar disponible al expirar su plazo de visibilidad
+                logger.error(f"Worker {worker_id}: no se pudo actualizar el evento {item.id}: {e}")
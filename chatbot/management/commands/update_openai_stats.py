@@ -1,29 +1,51 @@
-from django.core.management.base import BaseCommand
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
+from chatbot.models import Company
 from chatbot.services.openai_metrics_service import OpenAIMetricsService
+from chatbot.services.usage_rollup_service import usage_rollup_service
 
 class Command(BaseCommand):
-    help = 'Actualiza los resúmenes mensuales de OpenAI'
+    help = 'Recalcula los resúmenes diarios y mensuales de OpenAI desde los registros de uso'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start',
+            help='Primer día a recalcular (AAAA-MM-DD); sin fechas se recalcula el mes actual'
+        )
+        parser.add_argument(
+            '--end',
+            help='Último día a recalcular (AAAA-MM-DD, por defecto hoy)'
+        )
+        parser.add_argument(
+            '--company',
+            help='ID de la empresa (por defecto todas)'
+        )
 
     def handle(self, *args, **options):
+        company = Company.objects.get(id=options['company']) if options['company'] else None
+
+        if options['start'] or options['end']:
+            try:
+                today = timezone.localdate()
+                start_date = date.fromisoformat(options['start']) if options['start'] else today.replace(day=1)
+                end_date = date.fromisoformat(options['end']) if options['end'] else today
+            except ValueError as e:
+                raise CommandError(f"Fecha no válida: {e}")
+            if start_date > end_date:
+                raise CommandError("--start no puede ser posterior a --end")
+
+            self.stdout.write(self.style.SUCCESS(f'Recalculando resúmenes del {start_date} al {end_date}...'))
+            count = usage_rollup_service.rebuild(start_date, end_date, company=company)
+            self.stdout.write(self.style.SUCCESS(f'{count} resúmenes diarios recalculados'))
+            return
+
         service = OpenAIMetricsService()
-        now = timezone.now()
-        
+        now = timezone.localdate()
+
         self.stdout.write(self.style.SUCCESS(f'Actualizando resumen de {now.month}/{now.year}...'))
-        
-        service.generate_monthly_summary(year=now.year, month=now.month)
-        
+
+        service.generate_monthly_summary(year=now.year, month=now.month, company=company)
+
         self.stdout.write(self.style.SUCCESS('Resumen actualizado correctamente'))
-        
-        # Si estamos en los primeros días del mes, actualizar también el mes anterior
-        if now.day <= 5:
-            previous_month = now.month - 1
-            previous_year = now.year
-            
-            if previous_month == 0:
-                previous_month = 12
-                previous_year -= 1
-                
-            self.stdout.write(self.style.SUCCESS(f'Actualizando resumen del mes anterior {previous_month}/{previous_year}...'))
-            service.generate_monthly_summary(year=previous_year, month=previous_month)
-            self.stdout.write(self.style.SUCCESS('Resumen del mes anterior actualizado correctamente'))
\ No newline at end of file
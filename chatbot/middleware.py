@@ -1,15 +1,48 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.contrib.admin.views.main import ChangeList
 from django.db.models import Q
 from django.urls import resolve
+from django.utils.deprecation import MiddlewareMixin
+from whitenoise.middleware import WhiteNoiseMiddleware
 
-class CompanyFilterMiddleware:
-    def __init__(self, get_response):
-        self.get_response = get_response
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise compatible con ASGI
+
+    Un middleware solo síncrono obliga a Django a ejecutar toda la petición
+    (también la vista asíncrona del webhook) en su único hilo
+    thread-sensitive, así que bajo uvicorn las peticiones se serializaban.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=None):
+        if settings is None:
+            super().__init__(get_response)
+        else:
+            super().__init__(get_response, settings)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
+
+class CompanyFilterMiddleware(MiddlewareMixin):
+    # MiddlewareMixin: compatible con ASGI sin pasar toda la petición a un hilo
+
+    def process_request(self, request):
         if request.user.is_authenticated and hasattr(request.user, 'company_admin'):
             # Guarda la empresa del usuario en la sesión para uso posterior
             request.session['admin_company_id'] = str(request.user.company_admin.company.id)
-        
-        response = self.get_response(request)
-        return response
\ No newline at end of file
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.7 on 2026-10-17 03:43
+
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0029_ticketimage_whatsapp_media_id_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboundWebhookEvent',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('payload_json', models.TextField(help_text='Cuerpo del webhook tal como lo envió Meta (JSON)')),
+                ('remote_addr', models.GenericIPAddressField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pendiente'), ('processing', 'Procesando'), ('done', 'Procesado'), ('dead', 'Fallido definitivamente')], default='pending', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='Número de veces que un worker ha reclamado el evento')),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, help_text='A partir de cuándo puede reclamarse (reintentos y visibilidad)')),
+                ('locked_by', models.CharField(blank=True, help_text='Worker que procesa el evento', max_length=100, null=True)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Webhook entrante',
+                'verbose_name_plural': 'Webhooks entrantes',
+                'ordering': ['received_at'],
+                'indexes': [models.Index(fields=['status', 'available_at'], name='chatbot_inb_status_808278_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.7 on 2026-10-17 03:46
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0030_inboundwebhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='ID del mensaje de WhatsApp (o clave derivada)', max_length=255)),
+                ('kind', models.CharField(choices=[('message', 'Mensaje'), ('status', 'Estado'), ('image', 'Imagen'), ('media', 'Media')], default='message', max_length=20)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Evento procesado',
+                'verbose_name_plural': 'Eventos procesados',
+                'constraints': [models.UniqueConstraint(fields=('kind', 'key'), name='unique_processed_event')],
+            },
+        ),
+    ]
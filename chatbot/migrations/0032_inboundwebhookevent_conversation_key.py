@@ -0,0 +1,22 @@
+# Generated by Django 5.1.7 on 2026-10-17 03:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0031_processedevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inboundwebhookevent',
+            name='conversation_key',
+            field=models.CharField(blank=True, help_text='Buzón de la conversación (phone_number_id:número del usuario); se procesa en orden', max_length=100, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='inboundwebhookevent',
+            index=models.Index(fields=['conversation_key', 'status'], name='chatbot_inb_convers_f2884a_idx'),
+        ),
+    ]
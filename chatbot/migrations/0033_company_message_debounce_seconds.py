@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-17 03:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0032_inboundwebhookevent_conversation_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='message_debounce_seconds',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Los mensajes de texto seguidos de un usuario dentro de esta ventana se responden con una sola respuesta. 0 = desactivado', verbose_name='Ventana de agrupación (segundos)'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-17 03:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0033_company_message_debounce_seconds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='has_messages',
+            field=models.BooleanField(default=False, help_text='Indica si el usuario ya tiene mensajes (deja de ser una conversación nueva)'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.7 on 2026-10-17 03:57
+
+from django.db import migrations
+from django.db.models import Exists, OuterRef
+
+
+def backfill_has_messages(apps, schema_editor):
+    """Marca como onboarded a los usuarios que ya tienen mensajes"""
+    User = apps.get_model('chatbot', 'User')
+    Message = apps.get_model('chatbot', 'Message')
+    User.objects.filter(
+        Exists(Message.objects.filter(user=OuterRef('pk')))
+    ).update(has_messages=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0034_user_has_messages'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_has_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:04
+
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0035_backfill_user_has_messages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DelayedTask',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('task', models.CharField(help_text='Nombre de la tarea registrada en DELAYED_TASK_HANDLERS', max_length=100)),
+                ('payload_json', models.TextField(default='{}', help_text='Argumentos de la tarea (JSON)')),
+                ('idempotency_key', models.CharField(help_text='Evita programar dos veces la misma tarea', max_length=255, unique=True)),
+                ('status', models.CharField(choices=[('pending', 'Pendiente'), ('processing', 'Procesando'), ('done', 'Completada'), ('dead', 'Fallida definitivamente')], default='pending', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('run_at', models.DateTimeField(help_text='Momento para el que se programó la tarea')),
+                ('available_at', models.DateTimeField(help_text='A partir de cuándo puede reclamarse (reintentos y visibilidad)')),
+                ('locked_by', models.CharField(blank=True, max_length=100, null=True)),
+                ('started_at', models.DateTimeField(blank=True, help_text='Primera vez que un worker la reclamó', null=True)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Tarea diferida',
+                'verbose_name_plural': 'Tareas diferidas',
+                'ordering': ['run_at'],
+                'indexes': [models.Index(fields=['status', 'available_at'], name='delayed_task_due_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0036_delayedtask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='context_summary',
+            field=models.TextField(blank=True, help_text='Resumen acumulado de los mensajes que ya no caben en el historial enviado a OpenAI', null=True),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='context_summary_message_count',
+            field=models.PositiveIntegerField(default=0, help_text='Número de mensajes (los más antiguos) incluidos en el resumen'),
+        ),
+    ]
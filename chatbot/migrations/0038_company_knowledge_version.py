@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:10
+
+import chatbot.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0037_session_context_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='knowledge_version',
+            field=models.CharField(default=chatbot.models.new_knowledge_version, editable=False, help_text='Cambia al modificar la empresa, su información o sus categorías de tickets (invalida los prompts en caché)', max_length=32, verbose_name='Versión del contenido'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0038_company_knowledge_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='openaimonthlysummary',
+            name='total_tokens_cached_input',
+            field=models.IntegerField(default=0, verbose_name='Total tokens de entrada cacheados'),
+        ),
+        migrations.AddField(
+            model_name='openaiusagerecord',
+            name='tokens_cached_input',
+            field=models.IntegerField(default=0, help_text='Parte de los tokens de entrada servida desde la caché de prompts de OpenAI (usage.prompt_tokens_details.cached_tokens)', verbose_name='Tokens de entrada cacheados'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0039_openai_usage_cached_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='model_routes',
+            field=models.JSONField(blank=True, default=dict, help_text='Sustituye a OPENAI_MODEL_ROUTES para esta empresa, p. ej. {"chat": ["gpt-4o", "gpt-4o-mini"]}. Vacío = configuración general', verbose_name='Modelos de OpenAI por tarea'),
+        ),
+    ]
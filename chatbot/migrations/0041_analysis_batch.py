@@ -0,0 +1,43 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:25
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0040_company_model_routes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisBatch',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('backend', models.CharField(help_text='Backend de ANALYSIS_BATCH_BACKENDS', max_length=100)),
+                ('external_id', models.CharField(blank=True, help_text='Identificador del lote en el backend', max_length=100, null=True)),
+                ('model', models.CharField(max_length=50)),
+                ('status', models.CharField(choices=[('submitted', 'Enviado'), ('completed', 'Aplicado'), ('failed', 'Fallido')], default='submitted', max_length=20)),
+                ('session_count', models.PositiveIntegerField(default=0)),
+                ('analyzed_count', models.PositiveIntegerField(default=0)),
+                ('lead_count', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Lote de análisis',
+                'verbose_name_plural': 'Lotes de análisis',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='analysis_batch_status_idx')],
+            },
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='analysis_batch',
+            field=models.ForeignKey(blank=True, help_text='Lote de análisis nocturno en el que se envió la sesión', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sessions', to='chatbot.analysisbatch'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:30
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0041_analysis_batch'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='openaimonthlysummary',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=6, default=0, max_digits=14, verbose_name='Coste total ($)'),
+        ),
+        migrations.AlterField(
+            model_name='openaimonthlysummary',
+            name='total_cost_input',
+            field=models.DecimalField(decimal_places=6, default=0, max_digits=14, verbose_name='Coste total entrada ($)'),
+        ),
+        migrations.AlterField(
+            model_name='openaimonthlysummary',
+            name='total_cost_output',
+            field=models.DecimalField(decimal_places=6, default=0, max_digits=14, verbose_name='Coste total salida ($)'),
+        ),
+        migrations.CreateModel(
+            name='OpenAIDailySummary',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('date', models.DateField(verbose_name='Día')),
+                ('model', models.CharField(max_length=50, verbose_name='Modelo')),
+                ('total_requests', models.IntegerField(default=0, verbose_name='Total de solicitudes')),
+                ('cached_requests', models.IntegerField(default=0, verbose_name='Solicitudes cacheadas')),
+                ('total_tokens_input', models.BigIntegerField(default=0, verbose_name='Total tokens de entrada')),
+                ('total_tokens_output', models.BigIntegerField(default=0, verbose_name='Total tokens de salida')),
+                ('total_tokens', models.BigIntegerField(default=0, verbose_name='Total de tokens')),
+                ('total_tokens_cached_input', models.BigIntegerField(default=0, verbose_name='Total tokens de entrada cacheados')),
+                ('total_cost_input', models.DecimalField(decimal_places=6, default=0, max_digits=14, verbose_name='Coste total entrada ($)')),
+                ('total_cost_output', models.DecimalField(decimal_places=6, default=0, max_digits=14, verbose_name='Coste total salida ($)')),
+                ('total_cost', models.DecimalField(decimal_places=6, default=0, max_digits=14, verbose_name='Coste total ($)')),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='openai_daily_summaries', to='chatbot.company')),
+            ],
+            options={
+                'verbose_name': 'Resumen diario de OpenAI',
+                'verbose_name_plural': 'Resúmenes diarios de OpenAI',
+                'ordering': ['-date'],
+                'unique_together': {('company', 'date', 'model')},
+            },
+        ),
+    ]
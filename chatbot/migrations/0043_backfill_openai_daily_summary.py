@@ -0,0 +1,52 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:31
+
+from django.db import migrations
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear, TruncDate
+
+
+def backfill_daily_summaries(apps, schema_editor):
+    """Genera los resúmenes diarios de los registros existentes y recalcula los mensuales desde ellos"""
+    OpenAIUsageRecord = apps.get_model('chatbot', 'OpenAIUsageRecord')
+    OpenAIDailySummary = apps.get_model('chatbot', 'OpenAIDailySummary')
+    OpenAIMonthlySummary = apps.get_model('chatbot', 'OpenAIMonthlySummary')
+
+    rows = OpenAIUsageRecord.objects.annotate(day=TruncDate('timestamp')).values('company_id', 'day', 'model').annotate(
+        total_requests=Count('id'),
+        cached_requests=Count('id', filter=Q(cached_request=True)),
+        total_tokens_input=Sum('tokens_input'),
+        total_tokens_output=Sum('tokens_output'),
+        total_tokens=Sum('tokens_total'),
+        total_tokens_cached_input=Sum('tokens_cached_input'),
+        total_cost_input=Sum('cost_input'),
+        total_cost_output=Sum('cost_output'),
+        total_cost=Sum('cost_total'),
+    ).order_by()
+    OpenAIDailySummary.objects.bulk_create([
+        OpenAIDailySummary(company_id=row.pop('company_id'), date=row.pop('day'), **row)
+        for row in rows
+    ], batch_size=500)
+
+    monthly_fields = [
+        'total_requests', 'total_tokens_input', 'total_tokens_output', 'total_tokens',
+        'total_tokens_cached_input', 'total_cost_input', 'total_cost_output', 'total_cost',
+    ]
+    months = OpenAIDailySummary.objects.annotate(
+        year=ExtractYear('date'), month=ExtractMonth('date')
+    ).values('company_id', 'year', 'month').annotate(**{field: Sum(field) for field in monthly_fields}).order_by()
+    for row in months:
+        OpenAIMonthlySummary.objects.update_or_create(
+            company_id=row['company_id'], year=row['year'], month=row['month'],
+            defaults={field: row[field] or 0 for field in monthly_fields}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0042_openai_daily_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_daily_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:33
+
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0043_backfill_openai_daily_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DashboardSnapshot',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('key', models.CharField(help_text='Página (clave de DASHBOARD_SNAPSHOTS)', max_length=50)),
+                ('version', models.PositiveIntegerField()),
+                ('schema_version', models.PositiveIntegerField(default=1)),
+                ('payload', models.JSONField()),
+                ('generated_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('duration_ms', models.PositiveIntegerField(default=0, help_text='Tiempo de generación')),
+            ],
+            options={
+                'verbose_name': 'Instantánea de dashboard',
+                'verbose_name_plural': 'Instantáneas de dashboard',
+                'ordering': ['key', '-version'],
+                'unique_together': {('key', 'version')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-17 04:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0044_dashboard_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='context_summary_until',
+            field=models.DateTimeField(blank=True, help_text='Fecha del último mensaje guardado incluido en el resumen (la reconstrucción del historial empieza después)', null=True),
+        ),
+    ]
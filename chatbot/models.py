@@ -1,9 +1,14 @@
 import uuid
+from decimal import Decimal
 from django.db import models
 from django.utils import timezone
 import json
 from django.contrib.auth.models import User as DjangoUser
 
+def new_knowledge_version():
+    """Nueva versión del contenido de una empresa (clave de sus prompts en caché)"""
+    return uuid.uuid4().hex
+
 class Company(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=100, verbose_name="Nombre de la empresa")
@@ -12,6 +17,11 @@ class Company(models.Model):
     phone_number = models.CharField(max_length=20, unique=True)
     whatsapp_api_token = models.CharField(max_length=500, blank=True, null=True)
     whatsapp_phone_number_id = models.CharField(max_length=100, blank=True, null=True)
+    message_debounce_seconds = models.PositiveSmallIntegerField(
+        default=0,
+        verbose_name="Ventana de agrupación (segundos)",
+        help_text="Los mensajes de texto seguidos de un usuario dentro de esta ventana se responden con una sola respuesta. 0 = desactivado"
+    )
     
     # Información fiscal y legal
     tax_id = models.CharField(max_length=20, blank=True, null=True, verbose_name="NIF/CIF")
@@ -49,6 +59,19 @@ class Company(models.Model):
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Última actualización")
     subscription_plan = models.CharField(max_length=50, blank=True, null=True, verbose_name="Plan de suscripción", default="standard")
     subscription_end_date = models.DateField(blank=True, null=True, verbose_name="Fecha fin suscripción")
+    model_routes = models.JSONField(
+        default=dict,
+        blank=True,
+        verbose_name="Modelos de OpenAI por tarea",
+        help_text='Sustituye a OPENAI_MODEL_ROUTES para esta empresa, p. ej. {"chat": ["gpt-4o", "gpt-4o-mini"]}. Vacío = configuración general'
+    )
+    knowledge_version = models.CharField(
+        max_length=32,
+        default=new_knowledge_version,
+        editable=False,
+        verbose_name="Versión del contenido",
+        help_text="Cambia al modificar la empresa, su información o sus categorías de tickets (invalida los prompts en caché)"
+    )
     
     # Logo e imágenes
     logo = models.ImageField(upload_to='company_logos/', blank=True, null=True, verbose_name="Logo")
@@ -107,6 +130,12 @@ class User(models.Model):
         help_text="Indica si el usuario está esperando seleccionar un idioma"
     )
     
+    # Onboarding: se marca al guardar su primer mensaje (ver Message.save)
+    has_messages = models.BooleanField(
+        default=False,
+        help_text="Indica si el usuario ya tiene mensajes (deja de ser una conversación nueva)"
+    )
+    
     def __str__(self):
         return self.name or self.whatsapp_number
     
@@ -199,8 +228,30 @@ class Session(models.Model):
         null=True,
         help_text="Resultados del análisis de la conversación (JSON)"
     )
-    
-    
+    context_summary = models.TextField(
+        blank=True,
+        null=True,
+        help_text="Resumen acumulado de los mensajes que ya no caben en el historial enviado a OpenAI"
+    )
+    context_summary_message_count = models.PositiveIntegerField(
+        default=0,
+        help_text="Número de mensajes (los más antiguos) incluidos en el resumen"
+    )
+    context_summary_until = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="Fecha del último mensaje guardado incluido en el resumen (la reconstrucción del historial empieza después)"
+    )
+    analysis_batch = models.ForeignKey(
+        'AnalysisBatch',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='sessions',
+        help_text="Lote de análisis nocturno en el que se envió la sesión"
+    )
+
+
     @property
     def analysis_results(self):
         """Obtiene los resultados del análisis como diccionario"""
@@ -255,6 +306,18 @@ class Message(models.Model):
         default='text'
     )
     
+    def save(self, *args, **kwargs):
+        is_new = self._state.adding
+        super().save(*args, **kwargs)
+        
+        # Mantener el flag de onboarding del usuario sin contar sus mensajes
+        if is_new:
+            user = self.user if Message.user.is_cached(self) else None
+            if user is None or not user.has_messages:
+                User.objects.filter(pk=self.user_id, has_messages=False).update(has_messages=True)
+                if user is not None:
+                    user.has_messages = True
+    
     def get_direction(self):
         return "Usuario → Bot" if self.is_from_user else "Bot → Usuario"
     
@@ -378,6 +441,16 @@ class PolicyAcceptance(models.Model):
         verbose_name_plural = "Policy Acceptances"
         ordering = ['-accepted_at']
 
+# Tarifas de OpenAI en $ por millón de tokens: modelo (prefijo) -> (entrada, salida)
+OPENAI_PRICING = {
+    'gpt-4o-mini': (Decimal('0.15'), Decimal('0.60')),
+    'gpt-4o': (Decimal('5.0'), Decimal('15.0')),
+    'gpt-4': (Decimal('10.0'), Decimal('30.0')),
+}
+OPENAI_DEFAULT_PRICING = OPENAI_PRICING['gpt-4o-mini']
+# Los tokens de entrada servidos por la caché de prompts se cobran a mitad de precio
+OPENAI_CACHED_INPUT_DISCOUNT = Decimal('0.5')
+
 class OpenAIUsageRecord(models.Model):
     """
     Modelo para registrar detalladamente el uso de la API de OpenAI por empresa
@@ -394,9 +467,13 @@ class OpenAIUsageRecord(models.Model):
     tokens_output = models.IntegerField(default=0, verbose_name="Tokens de salida")
     tokens_total = models.IntegerField(default=0, verbose_name="Total de tokens")
     cached_request = models.BooleanField(default=False, verbose_name="Solicitud cacheada")
+    tokens_cached_input = models.IntegerField(
+        default=0,
+        verbose_name="Tokens de entrada cacheados",
+        help_text="Parte de los tokens de entrada servida desde la caché de prompts de OpenAI (usage.prompt_tokens_details.cached_tokens)"
+    )
     
-    # Costes según especificaciones GPT-4o-mini
-    # Input: $0.15/M tokens, Cached Input: $0.075/M tokens, Output: $0.60/M tokens
+    # Costes calculados con OPENAI_PRICING (ver calculate_costs)
     cost_input = models.DecimalField(max_digits=10, decimal_places=6, default=0, verbose_name="Coste de entrada ($)")
     cost_output = models.DecimalField(max_digits=10, decimal_places=6, default=0, verbose_name="Coste de salida ($)")
     cost_total = models.DecimalField(max_digits=10, decimal_places=6, default=0, verbose_name="Coste total ($)")
@@ -417,38 +494,42 @@ class OpenAIUsageRecord(models.Model):
     def __str__(self):
         return f"{self.company.name} - {self.timestamp.strftime('%d/%m/%Y %H:%M')} - {self.tokens_total} tokens"
     
-    def save(self, *args, **kwargs):
-        """Calcular costos antes de guardar"""
-        from decimal import Decimal
-        
-        # Seleccionar tasas según el modelo
-        if self.model == 'gpt-4o-mini':
-            # GPT-4o-mini prices (March 2025)
-            input_rate = Decimal('0.15') / Decimal('1000000')  # $0.15 per 1M tokens
-            output_rate = Decimal('0.60') / Decimal('1000000') # $0.60 per 1M tokens
-        elif self.model == 'gpt-4':
-            # GPT-4 prices
-            input_rate = Decimal('10.0') / Decimal('1000000')  
-            output_rate = Decimal('30.0') / Decimal('1000000') 
-        elif self.model == 'gpt-4o':
-            # GPT-4o prices
-            input_rate = Decimal('5.0') / Decimal('1000000')   
-            output_rate = Decimal('15.0') / Decimal('1000000') 
-        else:
-            # Default/fallback prices
-            input_rate = Decimal('0.15') / Decimal('1000000')  
-            output_rate = Decimal('0.60') / Decimal('1000000') 
+    @staticmethod
+    def get_pricing(model):
+        """
+        Tarifas (entrada, salida) en $ por millón de tokens de un modelo
+
+        Busca el prefijo más largo de OPENAI_PRICING, así que las versiones
+        fechadas ('gpt-4o-mini-2024-07-18') usan la tarifa de su modelo.
+        """
+        for prefix in sorted(OPENAI_PRICING, key=len, reverse=True):
+            if (model or '').startswith(prefix):
+                return OPENAI_PRICING[prefix]
+        return OPENAI_DEFAULT_PRICING
+    
+    def calculate_costs(self):
+        """Calcula los costes del registro (única fuente de precios: OPENAI_PRICING)"""
+        input_price, output_price = self.get_pricing(self.model)
+        input_rate = input_price / Decimal('1000000')
+        output_rate = output_price / Decimal('1000000')
         
-        # Si es una solicitud cacheada, descuento del 50%
+        # Una solicitud cacheada (caché de respuestas) no llega a la API: sin coste
         if self.cached_request:
-            input_rate = input_rate * Decimal('0.5')
-            output_rate = output_rate * Decimal('0.5')
+            input_rate = output_rate = Decimal('0')
+        
+        # Los tokens de entrada servidos por la caché de prompts de OpenAI se cobran con descuento
+        cached_tokens = min(self.tokens_cached_input, self.tokens_input)
+        cached_input_rate = input_rate * OPENAI_CACHED_INPUT_DISCOUNT
             
-        # Calcular costos
-        self.cost_input = (Decimal(self.tokens_input) * input_rate).quantize(Decimal('0.000001'))
+        self.cost_input = (
+            Decimal(self.tokens_input - cached_tokens) * input_rate + Decimal(cached_tokens) * cached_input_rate
+        ).quantize(Decimal('0.000001'))
         self.cost_output = (Decimal(self.tokens_output) * output_rate).quantize(Decimal('0.000001'))
         self.cost_total = self.cost_input + self.cost_output
-        
+    
+    def save(self, *args, **kwargs):
+        """Calcular costos antes de guardar (bulk_create no pasa por aquí: ver usage_buffer)"""
+        self.calculate_costs()
         super().save(*args, **kwargs)
 
 class OpenAIMonthlySummary(models.Model):
@@ -467,11 +548,12 @@ class OpenAIMonthlySummary(models.Model):
     total_tokens_input = models.IntegerField(default=0, verbose_name="Total tokens de entrada")
     total_tokens_output = models.IntegerField(default=0, verbose_name="Total tokens de salida")
     total_tokens = models.IntegerField(default=0, verbose_name="Total de tokens")
+    total_tokens_cached_input = models.IntegerField(default=0, verbose_name="Total tokens de entrada cacheados")
     
-    # Costes
-    total_cost_input = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name="Coste total entrada ($)")
-    total_cost_output = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name="Coste total salida ($)")
-    total_cost = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name="Coste total ($)")
+    # Costes (misma precisión que los registros: se incrementan con cada uno, ver usage_rollup_service)
+    total_cost_input = models.DecimalField(max_digits=14, decimal_places=6, default=0, verbose_name="Coste total entrada ($)")
+    total_cost_output = models.DecimalField(max_digits=14, decimal_places=6, default=0, verbose_name="Coste total salida ($)")
+    total_cost = models.DecimalField(max_digits=14, decimal_places=6, default=0, verbose_name="Coste total ($)")
     
     # Metadatos
     last_updated = models.DateTimeField(auto_now=True)
@@ -486,6 +568,43 @@ class OpenAIMonthlySummary(models.Model):
     def __str__(self):
         return f"{self.company.name} - {self.month}/{self.year} - ${self.total_cost}"
 
+class OpenAIDailySummary(models.Model):
+    """
+    Resumen diario del uso de OpenAI por empresa y modelo
+    
+    Se mantiene de forma incremental al guardar los registros de uso (ver
+    usage_rollup_service); el día es la fecha local (TIME_ZONE) del registro.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    company = models.ForeignKey('Company', on_delete=models.CASCADE, related_name='openai_daily_summaries')
+    date = models.DateField(verbose_name="Día")
+    model = models.CharField(max_length=50, verbose_name="Modelo")
+    
+    # Totales
+    total_requests = models.IntegerField(default=0, verbose_name="Total de solicitudes")
+    cached_requests = models.IntegerField(default=0, verbose_name="Solicitudes cacheadas")
+    total_tokens_input = models.BigIntegerField(default=0, verbose_name="Total tokens de entrada")
+    total_tokens_output = models.BigIntegerField(default=0, verbose_name="Total tokens de salida")
+    total_tokens = models.BigIntegerField(default=0, verbose_name="Total de tokens")
+    total_tokens_cached_input = models.BigIntegerField(default=0, verbose_name="Total tokens de entrada cacheados")
+    
+    # Costes
+    total_cost_input = models.DecimalField(max_digits=14, decimal_places=6, default=0, verbose_name="Coste total entrada ($)")
+    total_cost_output = models.DecimalField(max_digits=14, decimal_places=6, default=0, verbose_name="Coste total salida ($)")
+    total_cost = models.DecimalField(max_digits=14, decimal_places=6, default=0, verbose_name="Coste total ($)")
+    
+    # Metadatos
+    last_updated = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name = "Resumen diario de OpenAI"
+        verbose_name_plural = "Resúmenes diarios de OpenAI"
+        ordering = ['-date']
+        unique_together = ['company', 'date', 'model']
+    
+    def __str__(self):
+        return f"{self.company.name} - {self.date} - {self.model} - ${self.total_cost}"
+
 class LeadStatistics(Session):
     class Meta:
         proxy = True
@@ -655,4 +774,212 @@ class ImageAnalysisPrompt(models.Model):
                 category=self.category,
                 is_default=True
             ).exclude(id=self.id).update(is_default=False)
-        super().save(*args, **kwargs)
\ No newline at end of file
+        super().save(*args, **kwargs)
+
+
+class InboundWebhookEvent(models.Model):
+    """
+    Cola persistente de webhooks entrantes de WhatsApp.
+    
+    El webhook solo guarda el payload y responde a Meta; los workers
+    (manage.py run_inbound_workers) lo procesan después con reintentos.
+    Cada fila contiene los mensajes de una sola conversación, y los eventos
+    de una misma conversación se entregan de uno en uno en orden de llegada.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pendiente'),
+        ('processing', 'Procesando'),
+        ('done', 'Procesado'),
+        ('dead', 'Fallido definitivamente'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    payload_json = models.TextField(help_text="Cuerpo del webhook tal como lo envió Meta (JSON)")
+    remote_addr = models.GenericIPAddressField(null=True, blank=True)
+    conversation_key = models.CharField(max_length=100, blank=True, null=True, help_text="Buzón de la conversación (phone_number_id:número del usuario); se procesa en orden")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0, help_text="Número de veces que un worker ha reclamado el evento")
+    available_at = models.DateTimeField(default=timezone.now, help_text="A partir de cuándo puede reclamarse (reintentos y visibilidad)")
+    locked_by = models.CharField(max_length=100, blank=True, null=True, help_text="Worker que procesa el evento")
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, null=True)
+    received_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    @property
+    def payload(self):
+        """Obtiene el payload como diccionario"""
+        return json.loads(self.payload_json)
+    
+    @payload.setter
+    def payload(self, value):
+        """Guarda el payload como JSON"""
+        self.payload_json = json.dumps(value)
+    
+    def __str__(self):
+        return f"Webhook {self.received_at.strftime('%d/%m/%Y %H:%M:%S')} - {self.get_status_display()}"
+    
+    class Meta:
+        verbose_name = "Webhook entrante"
+        verbose_name_plural = "Webhooks entrantes"
+        ordering = ['received_at']
+        indexes = [
+            models.Index(fields=['status', 'available_at']),
+            models.Index(fields=['conversation_key', 'status']),
+        ]
+
+class ProcessedEvent(models.Model):
+    """
+    Registro compartido de eventos ya procesados (deduplicación entre workers).
+    
+    La clave es única, de modo que insertar es una operación atómica de
+    "procesar si es nuevo": solo el worker cuyo INSERT tiene éxito procesa
+    el mensaje. Los registros caducan y se barren periódicamente.
+    """
+    KIND_CHOICES = [
+        ('message', 'Mensaje'),
+        ('status', 'Estado'),
+        ('image', 'Imagen'),
+        ('media', 'Media'),
+    ]
+    
+    key = models.CharField(max_length=255, help_text="ID del mensaje de WhatsApp (o clave derivada)")
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, default='message')
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(db_index=True)
+    
+    def __str__(self):
+        return f"{self.get_kind_display()}: {self.key}"
+    
+    class Meta:
+        verbose_name = "Evento procesado"
+        verbose_name_plural = "Eventos procesados"
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], name='unique_processed_event'),
+        ]
+
+class DelayedTask(models.Model):
+    """
+    Tarea diferida persistente (p.ej. pedir feedback unos segundos después de
+    cerrar una sesión).
+    
+    La ejecutan el scheduler (job run_delayed_tasks) o manage.py
+    run_delayed_tasks con semántica at-least-once: una tarea reclamada cuyo
+    worker muere vuelve a estar disponible al expirar su plazo de
+    visibilidad. La clave de idempotencia es única, así que programar dos
+    veces la misma tarea (misma sesión) no la duplica.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pendiente'),
+        ('processing', 'Procesando'),
+        ('done', 'Completada'),
+        ('dead', 'Fallida definitivamente'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    task = models.CharField(max_length=100, help_text="Nombre de la tarea registrada en DELAYED_TASK_HANDLERS")
+    payload_json = models.TextField(default='{}', help_text="Argumentos de la tarea (JSON)")
+    idempotency_key = models.CharField(max_length=255, unique=True, help_text="Evita programar dos veces la misma tarea")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    run_at = models.DateTimeField(help_text="Momento para el que se programó la tarea")
+    available_at = models.DateTimeField(help_text="A partir de cuándo puede reclamarse (reintentos y visibilidad)")
+    locked_by = models.CharField(max_length=100, blank=True, null=True)
+    started_at = models.DateTimeField(null=True, blank=True, help_text="Primera vez que un worker la reclamó")
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    @property
+    def payload(self):
+        """Obtiene los argumentos como diccionario"""
+        return json.loads(self.payload_json)
+    
+    @payload.setter
+    def payload(self, value):
+        """Guarda los argumentos como JSON"""
+        self.payload_json = json.dumps(value)
+    
+    @property
+    def lag_seconds(self):
+        """Retraso entre la hora programada y el inicio de la ejecución"""
+        if not self.started_at:
+            return None
+        return max(0.0, (self.started_at - self.run_at).total_seconds())
+    
+    def __str__(self):
+        return f"{self.task} ({self.idempotency_key}) - {self.get_status_display()}"
+    
+    class Meta:
+        verbose_name = "Tarea diferida"
+        verbose_name_plural = "Tareas diferidas"
+        ordering = ['run_at']
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='delayed_task_due_idx'),
+        ]
+
+class AnalysisBatch(models.Model):
+    """
+    Lote nocturno de análisis de conversaciones enviado a un backend tipo
+    Batch API (ver chatbot/services/analysis_batch_service.py).
+    
+    Las sesiones cerradas sin análisis se envían juntas; al completarse el
+    lote sus resultados se aplican en bloque a Session.analysis_results_json
+    y después se envían los emails de leads. Las sesiones sin resultado
+    vuelven a quedar libres para el siguiente lote.
+    """
+    STATUS_CHOICES = [
+        ('submitted', 'Enviado'),
+        ('completed', 'Aplicado'),
+        ('failed', 'Fallido'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    backend = models.CharField(max_length=100, help_text="Backend de ANALYSIS_BATCH_BACKENDS")
+    external_id = models.CharField(max_length=100, blank=True, null=True, help_text="Identificador del lote en el backend")
+    model = models.CharField(max_length=50)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='submitted')
+    session_count = models.PositiveIntegerField(default=0)
+    analyzed_count = models.PositiveIntegerField(default=0)
+    lead_count = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"Lote {self.external_id or self.id} ({self.session_count} sesiones) - {self.get_status_display()}"
+    
+    class Meta:
+        verbose_name = "Lote de análisis"
+        verbose_name_plural = "Lotes de análisis"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='analysis_batch_status_idx'),
+        ]
+
+class DashboardSnapshot(models.Model):
+    """
+    Datos precalculados de una página de estadísticas (ver
+    chatbot/services/dashboard_snapshot_service.py).
+    
+    Cada regeneración crea una fila nueva con la versión siguiente y la
+    página sirve la más reciente con una sola consulta. schema_version es
+    la versión del formato del payload: si cambia el código que lo genera,
+    las instantáneas antiguas se ignoran.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    key = models.CharField(max_length=50, help_text="Página (clave de DASHBOARD_SNAPSHOTS)")
+    version = models.PositiveIntegerField()
+    schema_version = models.PositiveIntegerField(default=1)
+    payload = models.JSONField()
+    generated_at = models.DateTimeField(default=timezone.now)
+    duration_ms = models.PositiveIntegerField(default=0, help_text="Tiempo de generación")
+    
+    def __str__(self):
+        return f"{self.key} v{self.version} ({self.generated_at:%d/%m/%Y %H:%M})"
+    
+    class Meta:
+        verbose_name = "Instantánea de dashboard"
+        verbose_name_plural = "Instantáneas de dashboard"
+        ordering = ['key', '-version']
+        unique_together = ['key', 'version']
@@ -6,6 +6,11 @@ from django.utils import timezone
 from django.conf import settings
 from .services.session_service import SessionService
 from .services.openai_metrics_service import OpenAIMetricsService
+from .services.inbound_queue_service import InboundQueueService
+from .services.deduplication_service import DeduplicationService
+from .services.delayed_task_service import DelayedTaskService
+from .services.analysis_batch_service import AnalysisBatchService
+from .services.dashboard_snapshot_service import DashboardSnapshotService
 from django_apscheduler.models import DjangoJobExecution
 import time
 import threading
@@ -39,28 +44,17 @@ def close_inactive_sessions():
 
 def update_openai_monthly_summaries():
     """
-    Tarea programada para actualizar resúmenes mensuales de OpenAI
+    Tarea programada para conciliar los resúmenes de OpenAI
+    
+    Los resúmenes diarios y mensuales se actualizan al guardar los registros;
+    esta tarea solo recalcula los últimos días completos por si alguno no pasó
+    por el buffer de uso.
     """
-    logger.info("Ejecutando tarea programada para actualizar resúmenes mensuales de OpenAI")
+    logger.info("Ejecutando tarea programada para conciliar resúmenes de OpenAI")
     try:
         service = OpenAIMetricsService()
-        
-        # Actualizar mes actual
-        now = timezone.now()
-        service.generate_monthly_summary(year=now.year, month=now.month)
-        
-        # Si estamos en los primeros días del mes, actualizar también el mes anterior
-        if now.day <= 5:
-            previous_month = now.month - 1
-            previous_year = now.year
-            
-            if previous_month == 0:
-                previous_month = 12
-                previous_year -= 1
-                
-            service.generate_monthly_summary(year=previous_year, month=previous_month)
-        
-        logger.info("Resúmenes mensuales de OpenAI actualizados")
+        count = service.reconcile_recent_usage()
+        logger.info(f"Resúmenes de OpenAI conciliados: {count} resúmenes diarios")
         
         # Actualizar última ejecución exitosa
         update_last_success("update_openai_monthly_summaries")
@@ -105,6 +99,103 @@ def cleanup_old_job_executions():
     )
     logger.info("Registros antiguos de ejecuciones de trabajos eliminados")
 
+def purge_processed_inbound_events():
+    """
+    Elimina de la cola de entrada los webhooks ya procesados
+    y registra el estado de la cola
+    """
+    try:
+        service = InboundQueueService()
+        count = service.purge_processed(days=7)
+        stats = service.get_stats()
+        logger.info(
+            f"Eliminados {count} webhooks procesados. Cola: {stats['pending']} pendientes, "
+            f"{stats['dead']} en dead-letter, retraso máximo {stats['oldest_pending_seconds']:.0f}s"
+        )
+    except Exception as e:
+        logger.error(f"Error purgando la cola de entrada: {e}")
+        raise
+
+def sweep_expired_dedup_keys():
+    """
+    Elimina las claves de deduplicación caducadas
+    """
+    try:
+        count = DeduplicationService().sweep_expired()
+        logger.info(f"Eliminadas {count} claves de deduplicación caducadas")
+    except Exception as e:
+        logger.error(f"Error barriendo claves de deduplicación: {e}")
+        raise
+
+def run_delayed_tasks():
+    """
+    Ejecuta las tareas diferidas vencidas (p.ej. solicitudes de feedback)
+    """
+    try:
+        service = DelayedTaskService()
+        worker_id = f"scheduler-{threading.get_ident()}"
+        # Vaciar lo vencido en esta pasada, en lotes
+        while service.run_due(worker_id, limit=50):
+            pass
+    except Exception as e:
+        logger.error(f"Error ejecutando tareas diferidas: {e}")
+        raise
+
+def purge_delayed_tasks():
+    """
+    Elimina las tareas diferidas completadas y registra el retraso de la cola
+    """
+    try:
+        service = DelayedTaskService()
+        count = service.purge_done(days=7)
+        stats = service.get_stats()
+        logger.info(
+            f"Eliminadas {count} tareas diferidas completadas. Cola: {stats['pending']} pendientes, "
+            f"{stats['dead']} en dead-letter, retraso medio {stats['lag_avg_seconds']:.1f}s "
+            f"(máx. {stats['lag_max_seconds']:.1f}s)"
+        )
+    except Exception as e:
+        logger.error(f"Error purgando tareas diferidas: {e}")
+        raise
+
+def submit_analysis_batches():
+    """
+    Envía en lotes las sesiones cerradas pendientes de análisis (de madrugada)
+    """
+    if not settings.ANALYSIS_BATCH_ENABLED:
+        return
+    try:
+        batches = AnalysisBatchService().submit_pending()
+        logger.info(f"Enviados {len(batches)} lotes de análisis de conversaciones")
+    except Exception as e:
+        logger.error(f"Error enviando lotes de análisis: {e}")
+        raise
+
+def poll_analysis_batches():
+    """
+    Aplica los resultados de los lotes de análisis completados y envía los emails de leads
+    """
+    if not settings.ANALYSIS_BATCH_ENABLED:
+        return
+    try:
+        count = AnalysisBatchService().poll()
+        if count:
+            logger.info(f"Aplicados {count} análisis de conversaciones")
+    except Exception as e:
+        logger.error(f"Error consultando lotes de análisis: {e}")
+        raise
+
+def refresh_dashboard_snapshots():
+    """
+    Regenera las instantáneas del dashboard de OpenAI y de las estadísticas de leads
+    """
+    try:
+        count = DashboardSnapshotService().refresh_all()
+        logger.info(f"Regeneradas {count} instantáneas de dashboards")
+    except Exception as e:
+        logger.error(f"Error regenerando instantáneas de dashboards: {e}")
+        raise
+
 def start_scheduler():
     """
     Configura y arranca el planificador de tareas
@@ -134,7 +225,7 @@ def start_scheduler():
             next_run_time=timezone.now() + timezone.timedelta(seconds=30)  # Pequeño retraso inicial
         )
         
-        # Añadir la tarea de actualización de resúmenes mensuales de OpenAI
+        # Añadir la tarea de conciliación de resúmenes de OpenAI
         scheduler.add_job(
             update_openai_monthly_summaries,
             trigger="cron",
@@ -155,6 +246,79 @@ def start_scheduler():
             max_instances=1
         )
         
+        # Añadir tarea de limpieza de la cola de webhooks entrantes
+        scheduler.add_job(
+            purge_processed_inbound_events,
+            trigger="cron",
+            hour=4, minute=0,  # A las 4 AM
+            id="purge_processed_inbound_events",
+            replace_existing=True,
+            max_instances=1
+        )
+        
+        # Barrer claves de deduplicación caducadas cada hora
+        scheduler.add_job(
+            sweep_expired_dedup_keys,
+            trigger="interval",
+            hours=1,
+            id="sweep_expired_dedup_keys",
+            replace_existing=True,
+            max_instances=1
+        )
+        
+        # Ejecutar tareas diferidas vencidas
+        scheduler.add_job(
+            run_delayed_tasks,
+            trigger="interval",
+            seconds=settings.DELAYED_TASK_POLL_SECONDS,
+            id="run_delayed_tasks",
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True
+        )
+        
+        # Limpiar tareas diferidas completadas
+        scheduler.add_job(
+            purge_delayed_tasks,
+            trigger="cron",
+            hour=4, minute=15,
+            id="purge_delayed_tasks",
+            replace_existing=True,
+            max_instances=1
+        )
+        
+        # Enviar los lotes nocturnos de análisis de conversaciones
+        scheduler.add_job(
+            submit_analysis_batches,
+            trigger="cron",
+            hour=2, minute=0,  # A las 2 AM
+            id="submit_analysis_batches",
+            replace_existing=True,
+            max_instances=1
+        )
+        
+        # Consultar los lotes de análisis enviados y aplicar los completados
+        scheduler.add_job(
+            poll_analysis_batches,
+            trigger="interval",
+            minutes=settings.ANALYSIS_BATCH_POLL_MINUTES,
+            id="poll_analysis_batches",
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True
+        )
+        
+        # Regenerar las instantáneas de los dashboards
+        scheduler.add_job(
+            refresh_dashboard_snapshots,
+            trigger="interval",
+            minutes=settings.DASHBOARD_SNAPSHOT_REFRESH_MINUTES,
+            id="refresh_dashboard_snapshots",
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True
+        )
+        
         # Iniciar el planificador
         # En producción, añadir un pequeño retraso aleatorio para evitar condiciones de carrera
         if settings.ENVIRONMENT == 'production':
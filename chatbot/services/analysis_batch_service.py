@@ -0,0 +1,272 @@
+import json
+import logging
+import re
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from ..models import AnalysisBatch, Session
+from .conversation_analysis_service import MIN_ANALYSIS_MESSAGES, ConversationAnalysisService
+from .model_router import model_router
+from .openai_client import get_openai_client
+
+logger = logging.getLogger(__name__)
+
+class OpenAIBatchBackend:
+    """
+    Lotes de OpenAI Batch API: un fichero JSONL con una petición por sesión,
+    resultados en 24 h como máximo y la mitad de precio que las llamadas directas.
+    """
+
+    endpoint = "/v1/chat/completions"
+
+    def __init__(self):
+        self.client = get_openai_client('analysis')
+
+    def submit(self, requests):
+        """
+        Envía un lote
+
+        Args:
+            requests (list): dicts con 'custom_id' y 'body' (petición a chat completions)
+
+        Returns:
+            str: Identificador del lote
+        """
+        lines = [
+            json.dumps({"custom_id": r['custom_id'], "method": "POST", "url": self.endpoint, "body": r['body']})
+            for r in requests
+        ]
+        batch_file = self.client.files.create(
+            file=("conversation_analysis.jsonl", "\n".join(lines).encode('utf-8')),
+            purpose="batch"
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=self.endpoint,
+            completion_window="24h",
+            metadata={"kind": "conversation_analysis"}
+        )
+        return batch.id
+
+    def retrieve(self, external_id):
+        """
+        Estado de un lote
+
+        Returns:
+            tuple: (estado, resultados). Estado 'in_progress', 'completed' o 'failed';
+                resultados: custom_id -> texto de la respuesta (solo al completarse;
+                un lote caducado o cancelado devuelve lo que llegó a terminar)
+        """
+        batch = self.client.batches.retrieve(external_id)
+        if batch.status in ('completed', 'expired', 'cancelled') and batch.output_file_id:
+            content = self.client.files.content(batch.output_file_id).text
+            return 'completed', self._parse_output(content)
+        if batch.status in ('completed', 'failed', 'expired', 'cancelled'):
+            return 'failed', {}
+        return 'in_progress', None
+
+    def _parse_output(self, content):
+        results = {}
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get('response') or {}
+            if response.get('status_code') != 200:
+                continue
+            try:
+                results[item['custom_id']] = response['body']['choices'][0]['message']['content']
+            except (KeyError, IndexError, TypeError):
+                continue
+        return results
+
+class LocalBatchBackend:
+    """
+    Backend local para pruebas y desarrollo: no llama a OpenAI y resuelve el
+    lote al enviarlo con un análisis por palabras clave. Los lotes viven en
+    memoria del proceso.
+    """
+
+    _batches = {}
+
+    PURCHASE_WORDS = re.compile(r"\b(precio|precios|presupuesto|comprar|contratar|reservar|cu[aá]nto cuesta|tarifa)\b", re.IGNORECASE)
+    COMPLAINT_WORDS = re.compile(r"\b(queja|reclamaci[oó]n|mal servicio|aver[ií]a|no funciona)\b", re.IGNORECASE)
+
+    def submit(self, requests):
+        external_id = f"local-{uuid.uuid4().hex}"
+        self._batches[external_id] = {r['custom_id']: self._analyze(r['body']) for r in requests}
+        return external_id
+
+    def retrieve(self, external_id):
+        results = self._batches.pop(external_id, None)
+        if results is None:
+            return 'failed', {}
+        return 'completed', results
+
+    def _analyze(self, body):
+        conversation = body['messages'][-1]['content']
+        user_text = " ".join(
+            line.split(":", 1)[1] for line in conversation.splitlines() if line.startswith("Cliente:")
+        )
+        interested = bool(self.PURCHASE_WORDS.search(user_text))
+        complaint = bool(self.COMPLAINT_WORDS.search(user_text))
+        return json.dumps({
+            "primary_intent": "queja" if complaint else ("interes_servicio" if interested else "consulta_informacion"),
+            "user_sentiment": "negativo" if complaint else "neutral",
+            "purchase_interest_level": "medio" if interested else "ninguno",
+            "specific_interests": [],
+            "contact_info": {},
+            "follow_up_needed": interested or complaint,
+            "follow_up_reason": "",
+            "summary": user_text.strip()[:300],
+        })
+
+# Backends disponibles por nombre (ANALYSIS_BATCH_BACKEND); también se
+# admite la ruta importable de una clase propia con la misma interfaz
+ANALYSIS_BATCH_BACKENDS = {
+    'openai': OpenAIBatchBackend,
+    'local': LocalBatchBackend,
+}
+
+class AnalysisBatchService:
+    """
+    Análisis nocturno de conversaciones por lotes.
+
+    - submit_pending: agrupa las sesiones cerradas sin análisis en lotes y los
+      envía al backend (job submit_analysis_batches, de madrugada).
+    - poll: consulta los lotes enviados; al completarse aplica los resultados
+      con un bulk_update y después envía los emails de leads
+      (job poll_analysis_batches).
+
+    Todas las peticiones de un lote usan el mismo modelo (requisito de Batch
+    API): el principal de OPENAI_MODEL_ROUTES['analysis'].
+    """
+
+    def __init__(self, backend=None, max_sessions=None, lookback_days=None):
+        self.backend_name = backend or settings.ANALYSIS_BATCH_BACKEND
+        backend_class = ANALYSIS_BATCH_BACKENDS.get(self.backend_name) or import_string(self.backend_name)
+        self.backend = backend_class()
+        self.max_sessions = max_sessions or settings.ANALYSIS_BATCH_MAX_SESSIONS
+        self.lookback_days = lookback_days or settings.ANALYSIS_BATCH_LOOKBACK_DAYS
+        self.analysis_service = ConversationAnalysisService()
+
+    def pending_sessions(self):
+        """Sesiones cerradas recientemente, sin análisis y sin lote"""
+        return Session.objects.filter(
+            ended_at__isnull=False,
+            ended_at__gte=timezone.now() - timedelta(days=self.lookback_days),
+            analysis_results_json__isnull=True,
+            analysis_batch__isnull=True,
+        ).annotate(
+            message_count=Count('messages')
+        ).filter(
+            message_count__gte=MIN_ANALYSIS_MESSAGES
+        ).order_by('ended_at')
+
+    def submit_pending(self):
+        """
+        Envía las sesiones pendientes en lotes de hasta max_sessions
+
+        Returns:
+            list: Lotes creados
+        """
+        model = model_router.routes('analysis')[0]
+        batches = []
+        while True:
+            sessions = list(self.pending_sessions().prefetch_related('messages')[:self.max_sessions])
+            if not sessions:
+                break
+
+            requests = []
+            for session in sessions:
+                messages = self.analysis_service.build_messages(session)
+                if messages:
+                    requests.append({
+                        'custom_id': str(session.id),
+                        'body': self.analysis_service.request_body(messages, model),
+                    })
+
+            batch = AnalysisBatch.objects.create(backend=self.backend_name, model=model, session_count=len(requests))
+            Session.objects.filter(id__in=[session.id for session in sessions]).update(analysis_batch=batch)
+            try:
+                batch.external_id = self.backend.submit(requests)
+            except Exception as e:
+                logger.error(f"Error enviando lote de análisis {batch.id}: {e}")
+                self._fail(batch, str(e))
+                break
+            batch.save(update_fields=['external_id'])
+            logger.info(f"Lote de análisis {batch.external_id} enviado con {len(requests)} sesiones")
+            batches.append(batch)
+
+            if len(sessions) < self.max_sessions:
+                break
+        return batches
+
+    def poll(self):
+        """
+        Consulta los lotes enviados y aplica los completados
+
+        Returns:
+            int: Sesiones analizadas en esta pasada
+        """
+        analyzed = 0
+        for batch in AnalysisBatch.objects.filter(status='submitted', backend=self.backend_name).order_by('created_at'):
+            try:
+                status, results = self.backend.retrieve(batch.external_id)
+            except Exception as e:
+                logger.error(f"Error consultando el lote de análisis {batch.external_id}: {e}")
+                continue
+
+            if status == 'completed':
+                analyzed += self.apply_results(batch, results)
+            elif status == 'failed':
+                logger.error(f"Lote de análisis {batch.external_id} fallido: sus sesiones vuelven a quedar pendientes")
+                self._fail(batch, "El backend marcó el lote como fallido")
+        return analyzed
+
+    def apply_results(self, batch, results):
+        """
+        Guarda en bloque los análisis de un lote y envía los emails de leads
+
+        Returns:
+            int: Sesiones analizadas
+        """
+        sessions = list(batch.sessions.select_related('company', 'user'))
+        analyzed, missing = [], []
+        for session in sessions:
+            analysis = self.analysis_service.parse_analysis(results.get(str(session.id)))
+            if analysis:
+                session.analysis_results = analysis
+                analyzed.append(session)
+            else:
+                missing.append(session.id)
+
+        with transaction.atomic():
+            # Solo un proceso aplica cada lote (evita emails duplicados)
+            claimed = AnalysisBatch.objects.filter(id=batch.id, status='submitted').update(
+                status='completed', completed_at=timezone.now(), analyzed_count=len(analyzed)
+            )
+            if not claimed:
+                return 0
+            Session.objects.bulk_update(analyzed, ['analysis_results_json'], batch_size=500)
+            # Sin resultado: vuelven a quedar libres para el siguiente lote
+            Session.objects.filter(id__in=missing).update(analysis_batch=None)
+
+        leads = sum(1 for session in analyzed if self.analysis_service.notify_lead(session))
+        AnalysisBatch.objects.filter(id=batch.id).update(lead_count=leads)
+        logger.info(
+            f"Lote de análisis {batch.external_id}: {len(analyzed)} sesiones analizadas, "
+            f"{len(missing)} sin resultado, {leads} leads notificados"
+        )
+        return len(analyzed)
+
+    def _fail(self, batch, error):
+        with transaction.atomic():
+            AnalysisBatch.objects.filter(id=batch.id).update(status='failed', last_error=error, completed_at=timezone.now())
+            Session.objects.filter(analysis_batch=batch).update(analysis_batch=None)
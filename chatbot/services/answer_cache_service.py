@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import re
+import time
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .company_service import company_cache_key
+
+logger = logging.getLogger(__name__)
+
+# Solo artículos: el resto de palabras (negaciones, preposiciones, números)
+# puede cambiar la respuesta. Las palabras vacías del índice de conocimiento
+# no sirven aquí: «precio con IVA» y «precio sin IVA» quedarían iguales.
+ARTICLES = frozenset("el la los las lo un una unos unas the an".split())
+
+# Términos que deben coincidir para aceptar una pregunta parecida
+# (además de los números): con uno distinto la respuesta es otra
+STRICT_TERMS = frozenset("""
+no ni nunca tampoco sin con
+not nor never without with dont doesnt isnt arent cant wont
+""".split())
+
+_WORD_RE = re.compile(r"\w+")
+
+def normalize_question(text):
+    """
+    Términos de la pregunta sin orden ni repeticiones
+
+    Minúsculas, sin tildes ni apóstrofos, sin artículos y sin plurales (salvo
+    en números), así que «¿Horarios?» y «el horario» son la misma pregunta,
+    pero «¿No abrís el sábado?», «precio sin IVA» o «2 horas» no se
+    confunden con sus contrarios.
+    """
+    text = unicodedata.normalize('NFKD', str(text or '').lower().replace("'", "").replace("’", ""))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    terms = set()
+    for word in _WORD_RE.findall(text):
+        if word in ARTICLES:
+            continue
+        if not word.isdigit() and word not in STRICT_TERMS:
+            if len(word) > 4 and word.endswith('es'):
+                word = word[:-2]
+            elif len(word) > 3 and word.endswith('s'):
+                word = word[:-1]
+        terms.add(word)
+    return frozenset(terms)
+
+def strict_terms(terms):
+    """Negaciones, preposiciones con/sin y números de una pregunta normalizada"""
+    return {term for term in terms if term.isdigit() or term in STRICT_TERMS}
+
+def similarity(terms_a, terms_b):
+    """Similitud de Jaccard entre dos conjuntos de términos (0 si difieren en STRICT_TERMS o números)"""
+    if not terms_a or not terms_b or strict_terms(terms_a) != strict_terms(terms_b):
+        return 0.0
+    return len(terms_a & terms_b) / len(terms_a | terms_b)
+
+class AnswerCacheService:
+    """
+    Respuestas cacheadas por empresa para preguntas repetidas (horario,
+    precios, dirección...).
+
+    Solo se usa en turnos sin contexto (el primer mensaje del historial y sin
+    resumen de sesión), donde la respuesta depende únicamente de la pregunta,
+    el idioma y la información de la empresa. La clave incluye la versión de
+    contenido de la empresa, así que al cambiar su información las respuestas
+    anteriores dejan de servirse.
+    """
+
+    def __init__(self, cache_alias=None, ttl=None, threshold=None, max_entries=None):
+        self.cache = caches[cache_alias or settings.ANSWER_CACHE]
+        self.ttl = ttl or settings.ANSWER_CACHE_TTL
+        self.threshold = threshold or settings.ANSWER_CACHE_SIMILARITY
+        self.max_entries = max_entries or settings.ANSWER_CACHE_MAX_ENTRIES
+
+    def _bucket_key(self, company, language_code):
+        return company_cache_key(company, "answers", language_code)
+
+    def _exact_key(self, company, language_code, terms):
+        digest = hashlib.sha1(" ".join(sorted(terms)).encode('utf-8')).hexdigest()
+        return company_cache_key(company, "answer", language_code, digest)
+
+    def get(self, company, language_code, question):
+        """
+        Busca una respuesta para la pregunta
+
+        Primero por clave exacta (pregunta normalizada) y después la más
+        parecida del mismo idioma si supera el umbral de similitud.
+
+        Returns:
+            dict: Entrada con 'answer', 'model', 'tokens_input' y 'tokens_output', o None
+        """
+        terms = normalize_question(question)
+        if not terms:
+            return None
+
+        entry = self.cache.get(self._exact_key(company, language_code, terms))
+        if entry is not None:
+            return entry
+
+        now = time.time()
+        best, best_score = None, 0.0
+        for candidate in self.cache.get(self._bucket_key(company, language_code)) or []:
+            if candidate['expires_at'] <= now:
+                continue
+            score = similarity(terms, candidate['terms'])
+            if score > best_score:
+                best, best_score = candidate, score
+
+        if best is not None and best_score >= self.threshold:
+            logger.debug(f"Respuesta cacheada por similitud ({best_score:.2f}) para '{question}'")
+            return best
+        return None
+
+    def set(self, company, language_code, question, answer, tokens_input=0, tokens_output=0, model=None):
+        """Guarda la respuesta a una pregunta sin contexto y el modelo que la generó"""
+        terms = normalize_question(question)
+        if not terms or not answer:
+            return
+
+        entry = {
+            'question': question,
+            'terms': terms,
+            'answer': answer,
+            'model': model,
+            'tokens_input': tokens_input,
+            'tokens_output': tokens_output,
+            'expires_at': time.time() + self.ttl,
+        }
+        self.cache.set(self._exact_key(company, language_code, terms), entry, self.ttl)
+
+        # Lista de preguntas del idioma para la búsqueda por similitud (las más recientes)
+        bucket_key = self._bucket_key(company, language_code)
+        bucket = [e for e in self.cache.get(bucket_key) or [] if e['terms'] != terms and e['expires_at'] > time.time()]
+        bucket.append(entry)
+        self.cache.set(bucket_key, bucket[-self.max_entries:], self.ttl)
@@ -0,0 +1,83 @@
+import asyncio
+import functools
+import logging
+import weakref
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Un cliente por event loop: los clientes httpx asíncronos no pueden
+# compartirse entre loops, pero dentro de un loop se reutiliza el pool
+# de conexiones para todas las conversaciones en curso.
+_http_clients = weakref.WeakKeyDictionary()
+_openai_clients = weakref.WeakKeyDictionary()
+
+def db_sync_to_async(func):
+    """
+    Ejecuta una función síncrona con acceso a BD en el pool de hilos
+
+    A diferencia de sync_to_async(thread_sensitive=True), no serializa
+    todas las llamadas en un único hilo. Como fuera de una petición nadie
+    cierra las conexiones de esos hilos, se descartan las caducadas antes
+    y después de cada llamada (igual que Django al empezar/terminar una petición).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(wrapper, thread_sensitive=False)
+
+def get_async_http_client():
+    """
+    Obtiene el httpx.AsyncClient compartido del event loop actual (Graph API)
+
+    Returns:
+        httpx.AsyncClient: Cliente con pool de conexiones keep-alive
+    """
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.ASYNC_HTTP_TIMEOUT, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=settings.ASYNC_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.ASYNC_HTTP_MAX_CONNECTIONS // 2
+            )
+        )
+        _http_clients[loop] = client
+    return client
+
+def get_async_openai_client():
+    """
+    Obtiene el cliente AsyncOpenAI compartido del event loop actual
+
+    Returns:
+        AsyncOpenAI: Cliente asíncrono de OpenAI
+    """
+    loop = asyncio.get_running_loop()
+    client = _openai_clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, max_retries=0)
+        _openai_clients[loop] = client
+    return client
+
+async def close_async_clients():
+    """Cierra los clientes del event loop actual (al detener un worker)"""
+    loop = asyncio.get_running_loop()
+    http_client = _http_clients.pop(loop, None)
+    openai_client = _openai_clients.pop(loop, None)
+    try:
+        if http_client is not None:
+            await http_client.aclose()
+        if openai_client is not None:
+            await openai_client.close()
+    except Exception as e:
+        logger.error(f"Error cerrando clientes asíncronos: {e}")
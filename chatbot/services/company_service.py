@@ -1,10 +1,23 @@
 import logging
 
+from django.conf import settings
+from django.core.cache import caches
+
 from chatbot.services.whatsapp_service import WhatsAppService
 from ..models import Company, CompanyInfo, User, UserCompanyInteraction
 
 logger = logging.getLogger(__name__)
 
+def company_cache_key(company, kind, *parts):
+    """
+    Clave de caché ligada a la versión de contenido de la empresa
+    
+    Las señales de chatbot/signals.py renuevan Company.knowledge_version al
+    cambiar la empresa, su información o sus categorías de tickets, así que
+    las claves antiguas dejan de usarse sin tener que borrarlas.
+    """
+    return ":".join([kind, str(company.id), company.knowledge_version, *(str(part) for part in parts)])
+
 class CompanyService:
     """Service for fetching and formatting company information."""
     
@@ -37,12 +50,20 @@ class CompanyService:
         Get formatted company information.
         
         Returns a dict with the company name and sections.
+        Se guarda en caché por versión de contenido (sin consultas en régimen estable).
         """
         if not company:
             return None
+        
+        cache = caches[settings.SYSTEM_PROMPT_CACHE]
+        cache_key = company_cache_key(company, "company_info")
+        company_info = cache.get(cache_key)
+        if company_info is not None:
+            return company_info
             
         # Start with basic company info
         company_info = {
+            "id": company.id,
             "name": company.name,
             "sections": []
         }
@@ -59,7 +80,9 @@ class CompanyService:
                 
         except Exception as e:
             logger.error(f"Error fetching company info: {e}")
+            return company_info
         
+        cache.set(cache_key, company_info, settings.SYSTEM_PROMPT_CACHE_TTL)
         return company_info
 
     def get_or_create_user(self, whatsapp_number, name=None):
@@ -126,7 +149,38 @@ class CompanyService:
             logger.error(f"Error recording interaction between {user} and {company}: {e}")
             return None
         
-    def get_company_user_and_whatsapp_service(self, metadata, from_phone, default_whatsapp=None):
+    def prefetch_companies_and_users(self, events):
+        """
+        Carga en bloque las empresas y usuarios de un lote de mensajes
+        
+        Args:
+            events (list): Lista de WebhookMessageEvent del mismo webhook
+            
+        Returns:
+            tuple: (companies, users) diccionarios indexados por phone_number_id y whatsapp_number
+        """
+        phone_number_ids = {e.metadata.get("phone_number_id") for e in events if e.metadata.get("phone_number_id")}
+        from_phones = {e.from_phone for e in events if e.from_phone}
+        
+        companies = {}
+        users = {}
+        try:
+            if phone_number_ids:
+                companies = {
+                    company.whatsapp_phone_number_id: company
+                    for company in Company.objects.filter(whatsapp_phone_number_id__in=phone_number_ids)
+                }
+            if from_phones:
+                users = {
+                    user.whatsapp_number: user
+                    for user in User.objects.filter(whatsapp_number__in=from_phones)
+                }
+        except Exception as e:
+            logger.error(f"Error precargando empresas y usuarios del lote: {e}")
+        
+        return companies, users
+
+    def get_company_user_and_whatsapp_service(self, metadata, from_phone, default_whatsapp=None, companies=None, users=None):
         """
         Extrae la información de empresa, usuario y configura el servicio de WhatsApp
         
@@ -134,6 +188,8 @@ class CompanyService:
             metadata: Diccionario con los metadatos del mensaje de WhatsApp
             from_phone: Número de teléfono del remitente
             default_whatsapp: Instancia por defecto del servicio WhatsApp (opcional)
+            companies: Empresas precargadas por phone_number_id (opcional)
+            users: Usuarios precargados por whatsapp_number (opcional)
             
         Returns:
             tuple: (company, user, contact_name, whatsapp_service)
@@ -149,7 +205,10 @@ class CompanyService:
             contact_name = profile.get("name")
         
         # Obtener la empresa asociada al phone_number_id
-        company = self.get_company_by_phone_number_id(phone_number_id)
+        if companies is not None and phone_number_id in companies:
+            company = companies[phone_number_id]
+        else:
+            company = self.get_company_by_phone_number_id(phone_number_id)
         
         if not company:
             logger.warning(f"No se encontró empresa para phone_number_id: {phone_number_id}")
@@ -165,11 +224,15 @@ class CompanyService:
                 phone_number_id=company.whatsapp_phone_number_id
             )
         
-        # Obtener o crear el usuario
-        user = self.get_or_create_user(
-            whatsapp_number=from_phone,
-            name=contact_name
-        )
+        # Obtener o crear el usuario (reutilizando el precargado si el nombre no cambió)
+        user = users.get(from_phone) if users is not None else None
+        if not user or (contact_name and user.name != contact_name):
+            user = self.get_or_create_user(
+                whatsapp_number=from_phone,
+                name=contact_name
+            )
+            if user and users is not None:
+                users[from_phone] = user
         
         if not user:
             logger.error(f"No se pudo obtener/crear usuario para {from_phone}")
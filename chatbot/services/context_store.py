@@ -0,0 +1,187 @@
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+def session_context_key(session_id):
+    """Clave del historial de una sesión en el almacén de contexto"""
+    return f"session:{session_id}"
+
+def _entry_size(entry):
+    """Tamaño aproximado de una entrada en bytes (serializada en JSON)"""
+    return len(json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+
+class MemoryContextStore:
+    """
+    Historiales de conversación en memoria del proceso, con límite de tamaño.
+
+    LRU acotado por número de entradas y por bytes totales, y con TTL por
+    entrada. Cada worker tiene su propia copia: si una conversación pasa a
+    otro worker, allí se reconstruye desde la tabla Message, y al volver al
+    primero ConversationService comprueba contra la tabla Message que la
+    copia local no se ha quedado atrás (shared = False).
+    """
+
+    shared = False
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None):
+        self.max_entries = max_entries or settings.CONTEXT_STORE_MAX_ENTRIES
+        self.max_bytes = max_bytes or settings.CONTEXT_STORE_MAX_BYTES
+        self.ttl = ttl or settings.CONTEXT_STORE_TTL
+        self._entries = OrderedDict()  # clave -> (mensajes, bytes, caduca)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[0])
+
+    def set(self, key, value):
+        size = _entry_size(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (copy.deepcopy(value), size, time.monotonic() + self.ttl)
+            self._bytes += size
+
+            # Expulsar las entradas menos usadas hasta volver a los límites
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        """
+        Indicadores del almacén en este proceso
+
+        Returns:
+            dict: entries, bytes, límites, hits, misses y evictions
+        """
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'pid': os.getpid(),
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+class CacheContextStore:
+    """
+    Historiales de conversación en la caché de Django (compartida entre workers
+    si CONTEXT_STORE_CACHE apunta a Redis/Memcached).
+
+    Cada entrada caduca a los CONTEXT_STORE_TTL segundos y la caché aplica su
+    propia política de expulsión. Las cifras de entries/bytes son las de las
+    entradas escritas por este proceso que aún no han caducado. Con LocMemCache
+    la caché es del proceso y se trata como MemoryContextStore (shared = False).
+    """
+
+    prefix = "conversation_context:"
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, cache_alias=None):
+        self.cache = caches[cache_alias or settings.CONTEXT_STORE_CACHE]
+        self.shared = not isinstance(self.cache, LocMemCache)
+        self.ttl = ttl or settings.CONTEXT_STORE_TTL
+        self.max_entries = max_entries or settings.CONTEXT_STORE_MAX_ENTRIES
+        self._written = OrderedDict()  # clave -> (bytes, caduca), para los indicadores
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.cache.get(self.prefix + key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.cache.set(self.prefix + key, value, self.ttl)
+        with self._lock:
+            self._written.pop(key, None)
+            self._written[key] = (_entry_size(value), time.monotonic() + self.ttl)
+            while len(self._written) > self.max_entries:
+                self._written.popitem(last=False)
+
+    def delete(self, key):
+        self.cache.delete(self.prefix + key)
+        with self._lock:
+            self._written.pop(key, None)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            for key in [key for key, (_, expires) in self._written.items() if expires <= now]:
+                del self._written[key]
+            return {
+                'backend': 'cache',
+                'pid': os.getpid(),
+                'entries': len(self._written),
+                'bytes': sum(size for size, _ in self._written.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+# Backends disponibles por nombre (CONTEXT_STORE_BACKEND); también se
+# admite la ruta importable de una clase propia con la misma interfaz
+# (sin atributo shared = True sus entradas se comprueban contra la tabla Message)
+CONTEXT_STORE_BACKENDS = {
+    'memory': MemoryContextStore,
+    'cache': CacheContextStore,
+}
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_context_store(backend=None):
+    """
+    Obtiene el almacén de contexto del proceso (uno por backend)
+
+    Args:
+        backend (str): Nombre o ruta del backend (por defecto CONTEXT_STORE_BACKEND)
+    """
+    backend = backend or settings.CONTEXT_STORE_BACKEND
+    with _stores_lock:
+        store = _stores.get(backend)
+        if store is None:
+            store_class = CONTEXT_STORE_BACKENDS.get(backend) or import_string(backend)
+            store = store_class()
+            _stores[backend] = store
+        return store
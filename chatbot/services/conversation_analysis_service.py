@@ -1,44 +1,13 @@
 import logging
 import json
-from openai import OpenAI
-from django.conf import settings
 # Importamos el nuevo servicio de email
 from .email_service import EmailService
+from .openai_client import call_openai
 
 logger = logging.getLogger(__name__)
 
-class ConversationAnalysisService:
-    """Servicio para analizar conversaciones y extraer insights"""
-    
-    def __init__(self):
-        self.client = OpenAI(api_key=settings.OPENAI_API_KEY)
-        self.model = "gpt-4o-mini" if hasattr(settings, 'OPENAI_MODEL_ANALYSIS') else "gpt-4o-mini"
-        # Inicializar servicios necesarios
-        self.email_service = EmailService()
-    
-    def analyze_session(self, session):
-        """
-        Analiza todos los mensajes de una sesión y genera un resumen con insights
-        
-        Args:
-            session: Objeto Session con la conversación completa
-            
-        Returns:
-            dict: Resultados del análisis con insights extraídos
-        """
-        try:
-            # Extraer mensajes de la sesión
-            messages = session.messages.all().order_by('id')
-            
-            if not messages or messages.count() < 3:
-                logger.info(f"Sesión {session.id} tiene muy pocos mensajes para analizar")
-                return None
-                
-            # Formatear la conversación para análisis
-            conversation_text = self._format_conversation(messages)
-            
-            # Crear prompt para análisis
-            system_prompt = """
+# Prompt del análisis (el mismo en la llamada directa y en los lotes nocturnos)
+ANALYSIS_SYSTEM_PROMPT = """
             Eres un analista de conversaciones de chatbot especializado en identificar oportunidades de negocio.
             Analiza la siguiente conversación entre un cliente y un asistente virtual para extraer información clave.
             
@@ -62,21 +31,90 @@ class ConversationAnalysisService:
                 "summary": "string" // breve resumen de la conversación (máx 150 palabras)
             }
             """
+
+# Sesiones con menos mensajes no se analizan
+MIN_ANALYSIS_MESSAGES = 3
+
+class ConversationAnalysisService:
+    """Servicio para analizar conversaciones y extraer insights"""
+    
+    def __init__(self):
+        # Inicializar servicios necesarios
+        self.email_service = EmailService()
+    
+    def build_messages(self, session):
+        """
+        Mensajes de la petición de análisis de una sesión
+        
+        Returns:
+            list: Mensajes en formato chat completions, o None si la sesión es demasiado corta
+        """
+        # Orden cronológico (el id es un UUID); sin consulta si los mensajes vienen precargados
+        messages = sorted(session.messages.all(), key=lambda message: message.created_at)
+        if len(messages) < MIN_ANALYSIS_MESSAGES:
+            return None
+        
+        conversation_text = self._format_conversation(messages)
+        return [
+            {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Aquí está la conversación para analizar:\n\n{conversation_text}"}
+        ]
+    
+    def request_body(self, messages, model):
+        """Cuerpo de la petición a chat completions (llamada directa o línea de un lote)"""
+        return {
+            "model": model,
+            "messages": messages,
+            "temperature": 0.2,
+            "response_format": {"type": "json_object"},
+        }
+    
+    def parse_analysis(self, text):
+        """
+        Convierte la respuesta del modelo en el diccionario de análisis
+        
+        Returns:
+            dict: Análisis, o None si la respuesta no es JSON válido
+        """
+        try:
+            analysis = json.loads((text or '').strip())
+        except ValueError:
+            return None
+        return analysis if isinstance(analysis, dict) and analysis else None
+    
+    def notify_lead(self, session):
+        """Envía el email de lead si el interés de compra es alto o medio"""
+        interest_level = (session.analysis_results or {}).get('purchase_interest_level', 'ninguno')
+        if interest_level in ['alto', 'medio']:
+            return self.email_service.send_lead_notification(session.company, session)
+        return False
+    
+    def analyze_session(self, session):
+        """
+        Analiza todos los mensajes de una sesión y genera un resumen con insights
+        
+        Llamada directa a OpenAI (acción del admin o ANALYSIS_BATCH_ENABLED=False);
+        lo habitual es el lote nocturno de analysis_batch_service.
+        
+        Args:
+            session: Objeto Session con la conversación completa
             
-            # Llamar a OpenAI para análisis
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Aquí está la conversación para analizar:\n\n{conversation_text}"}
-                ],
-                temperature=0.2,
-                response_format={"type": "json_object"}
-            )
+        Returns:
+            dict: Resultados del análisis con insights extraídos
+        """
+        try:
+            messages = self.build_messages(session)
+            if not messages:
+                logger.info(f"Sesión {session.id} tiene muy pocos mensajes para analizar")
+                return None
             
-            # Extraer y parsear la respuesta
-            analysis_text = response.choices[0].message.content.strip()
-            analysis = json.loads(analysis_text)
+            # Llamar a OpenAI para análisis (modelos de OPENAI_MODEL_ROUTES['analysis'])
+            response = call_openai(
+                'analysis',
+                lambda client, model: client.chat.completions.create(**self.request_body(messages, model)),
+                company=session.company
+            )
+            analysis = self.parse_analysis(response.choices[0].message.content)
             
             logger.info(f"Análisis completado para sesión {session.id}")
             
@@ -84,13 +122,10 @@ class ConversationAnalysisService:
             if analysis:
                 # Guardamos el análisis en la sesión
                 session.analysis_results = analysis
-                session.save()
+                session.save(update_fields=['analysis_results_json'])
                 
                 # Si es un lead de alta/media calidad, enviar notificación por email
-                interest_level = analysis.get('purchase_interest_level', 'ninguno')
-                if interest_level in ['alto', 'medio']:
-                    # Enviar notificación por email
-                    self.email_service.send_lead_notification(session.company, session)
+                self.notify_lead(session)
                 
                 return analysis
             return None
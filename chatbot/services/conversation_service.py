@@ -1,46 +1,284 @@
 import logging
+from datetime import datetime, timezone as dt_timezone
 
 from django.conf import settings
 from django.db import IntegrityError
 from django.utils import timezone
 
-from chatbot.models import CompanyAdmin, Ticket, TicketCategory, TicketImage, User
+from chatbot.models import CompanyAdmin, Message, Ticket, TicketCategory, TicketImage, User
+from chatbot.services.answer_cache_service import AnswerCacheService
+from chatbot.services.async_clients import db_sync_to_async
+from chatbot.services.context_store import get_context_store, session_context_key
 from chatbot.services.image_processing_service import ImageProcessingService
+from chatbot.services.deduplication_service import DeduplicationService
+from chatbot.services.openai_client import call_openai
+from chatbot.services.token_service import estimate_message_tokens, estimate_messages_tokens
+from .openai_metrics_service import OpenAIMetricsService
 from .openai_service import OpenAIService
 from chatbot.services.whatsapp_service import WhatsAppService
 
 logger = logging.getLogger(__name__)
 
+# Tipos de Message que forman parte del historial
+CONTEXT_MESSAGE_TYPES = ['text', 'audio', 'image']
+
 class ConversationService:
     """Service for managing conversations with users"""
     
-    def __init__(self, max_context_length=30):
+    def __init__(self, max_context_length=30, context_store=None, token_budget=None, token_target=None):
         self.openai_service = OpenAIService()
         self.whatsapp_service = WhatsAppService()
-        self.conversations = {}  # Store conversations in memory for now
+        self.deduplication_service = DeduplicationService()
+        self.answer_cache = AnswerCacheService()
+        self.metrics_service = OpenAIMetricsService()
+        # Historiales acotados (LRU/TTL) y compartibles entre workers (CONTEXT_STORE_BACKEND)
+        self.context_store = context_store or get_context_store()
         self.max_context_length = max_context_length
+        # Presupuesto de tokens del historial: al superarlo se recorta hasta token_target
+        # (con margen, para no resumir en cada turno) y lo que sale va al resumen de la sesión
+        self.token_budget = token_budget or settings.CONTEXT_TOKEN_BUDGET
+        self.token_target = min(token_target or settings.CONTEXT_TOKEN_TARGET, self.token_budget)
+    
+    def _context_key(self, user_id, session=None):
+        """El historial pertenece a la sesión; sin sesión, al número del usuario"""
+        return session_context_key(session.id) if session else f"user:{user_id}"
+    
+    def get_conversation(self, user_id, session=None):
+        """
+        Obtiene el historial de la conversación
+        
+        Si no está en el almacén (otro worker, reinicio, expulsado por LRU/TTL)
+        o la copia del proceso se ha quedado atrás, se reconstruye a partir de
+        los mensajes guardados de la sesión.
+        """
+        entry = self.context_store.get(self._context_key(user_id, session))
+        if isinstance(entry, dict) and (session is None or self._is_up_to_date(entry, session)):
+            return entry['messages']
+        return self._rebuild_conversation(session) if session else []
+    
+    def _is_up_to_date(self, entry, session):
+        """
+        Si el historial de un almacén del proceso (no compartido) sigue al día
+        
+        Desde que se guardó solo puede haber en la tabla Message la respuesta
+        de ese turno y los mensajes del usuario del turno actual. Una respuesta
+        posterior a un mensaje del usuario es un turno que ha atendido otro worker.
+        """
+        if getattr(self.context_store, 'shared', False):
+            return True
+        saved_at = datetime.fromtimestamp(entry['saved_at'], tz=dt_timezone.utc)
+        newer = Message.objects.filter(
+            session=session, message_type__in=CONTEXT_MESSAGE_TYPES, created_at__gt=saved_at
+        ).order_by('created_at').values_list('is_from_user', flat=True)
+        
+        user_waiting = False
+        for is_from_user in newer:
+            if is_from_user:
+                user_waiting = True
+            elif user_waiting:
+                logger.debug(f"Historial de la sesión {session.id} desfasado en este proceso; se reconstruye")
+                return False
+        return True
+    
+    def _rebuild_conversation(self, session):
+        """
+        Reconstruye el historial de una sesión desde la tabla Message
+        
+        Se omiten los mensajes que ya están en el resumen de la sesión (hasta
+        context_summary_until).
+        """
+        messages = Message.objects.filter(session=session, message_type__in=CONTEXT_MESSAGE_TYPES)
+        if session.context_summary_until:
+            messages = messages.filter(created_at__gt=session.context_summary_until)
+        rows = messages.order_by('-created_at').values_list('is_from_user', 'message_type', 'message_text')[:self.max_context_length]
+        
+        conversation = [self._history_entry(*row) for row in reversed(rows)]
+        logger.debug(f"Historial de la sesión {session.id} reconstruido con {len(conversation)} mensajes")
+        return conversation
+    
+    def _history_entry(self, is_from_user, message_type, text):
+        """Entrada del historial de un Message guardado"""
+        if message_type == 'image':
+            # Mismo formato que registra handle_image_message
+            if text and text != "[Imagen sin texto]":
+                text = f"[El usuario envió una imagen con el texto: '{text}']"
+            else:
+                text = "[El usuario envió una imagen sin texto adicional]"
+        return {"role": "user" if is_from_user else "assistant", "content": text}
+    
+    def _last_summarized_message_at(self, session, kept):
+        """
+        Fecha del Message más reciente que no está en el historial conservado
+        
+        Recorre a la vez los mensajes guardados y el historial conservado, de
+        más reciente a más antiguo. Las entradas sin Message (el análisis de
+        una imagen, la respuesta que aún no se ha guardado) se saltan; el
+        primer Message que no aparece en el historial es el último del resumen.
+        
+        Returns:
+            datetime: Fecha de ese Message, o None si todos siguen en el historial
+        """
+        rows = Message.objects.filter(
+            session=session, message_type__in=CONTEXT_MESSAGE_TYPES
+        ).order_by('-created_at').values_list('created_at', 'is_from_user', 'message_type', 'message_text')[:len(kept) + 1]
+        
+        pending = list(reversed(kept))
+        for created_at, *row in rows:
+            entry = self._history_entry(*row)
+            while pending and pending[0] != entry:
+                pending.pop(0)
+            if not pending:
+                return created_at
+            pending.pop(0)
+        return None
     
-    def get_conversation(self, user_id):
-        """Get or create a conversation for a user"""
-        if user_id not in self.conversations:
-            self.conversations[user_id] = []
-        return self.conversations[user_id]
+    def _save_conversation(self, user_id, conversation, session=None):
+        # Trim conversation if it's too long: keep the most recent messages
+        self.context_store.set(self._context_key(user_id, session), {
+            'messages': conversation[-self.max_context_length:],
+            'saved_at': timezone.now().timestamp(),
+        })
     
-    def add_message(self, user_id, message, is_from_user=True):
+    def _apply_token_budget(self, conversation, session=None):
+        """
+        Ajusta el historial al presupuesto de tokens
+        
+        Si supera token_budget (o max_context_length mensajes) se conservan los
+        mensajes más recientes hasta token_target (y la mitad de
+        max_context_length); los que salen se condensan en el resumen de la sesión.
+        El mensaje más reciente se conserva siempre.
+        
+        Returns:
+            list: Historial recortado
+        """
+        model = self.openai_service.model
+        if (len(conversation) <= self.max_context_length
+                and estimate_messages_tokens(conversation, model) <= self.token_budget):
+            return conversation
+        
+        kept = []
+        used = 0
+        for message in reversed(conversation):
+            tokens = estimate_message_tokens(message, model)
+            if kept and (used + tokens > self.token_target or len(kept) >= self.max_context_length // 2):
+                break
+            kept.append(message)
+            used += tokens
+        kept.reverse()
+        
+        dropped = conversation[:len(conversation) - len(kept)]
+        if session and dropped:
+            self._summarize_dropped(session, dropped, kept)
+        logger.info(f"Historial recortado a {len(kept)} mensajes (~{used} tokens); {len(dropped)} pasan al resumen")
+        return kept
+    
+    def _summarize_dropped(self, session, dropped, kept):
+        """Añade al resumen acumulado de la sesión los mensajes que salen del historial"""
+        if settings.CONTEXT_SUMMARY_ENABLED:
+            summary = self.openai_service.summarize_conversation(
+                dropped,
+                previous_summary=session.context_summary,
+                company=session.company,
+                session=session
+            )
+            if summary:
+                session.context_summary = summary
+            else:
+                logger.warning(f"No se pudo resumir el historial de la sesión {session.id}; se conserva el resumen anterior")
+        
+        # Se marcan aunque no se resuman, para no volver a cargarlos al reconstruir
+        session.context_summary_message_count += len(dropped)
+        summarized_until = self._last_summarized_message_at(session, kept)
+        if summarized_until and (session.context_summary_until is None or summarized_until > session.context_summary_until):
+            session.context_summary_until = summarized_until
+        session.save(update_fields=['context_summary', 'context_summary_message_count', 'context_summary_until'])
+    
+    def add_message(self, user_id, message, is_from_user=True, session=None):
         """Add a message to a user's conversation history"""
-        conversation = self.get_conversation(user_id)
+        conversation = self.get_conversation(user_id, session)
         
         # Add the new message
         role = "user" if is_from_user else "assistant"
         conversation.append({"role": role, "content": message})
         
-        # Trim conversation if it's too long
-        if len(conversation) > self.max_context_length:
-            # Keep the most recent messages
-            conversation = conversation[-self.max_context_length:]
-            self.conversations[user_id] = conversation
+        conversation = self._apply_token_budget(conversation, session)
+        self._save_conversation(user_id, conversation, session)
+    
+    def _start_turn(self, user_id, message, session=None, message_parts=None):
+        """
+        Añade el mensaje del usuario al historial
+        
+        Args:
+            message_parts (list): Textos de una ráfaga unida en `message` (opcional)
+        
+        Returns:
+            tuple: (historial, is_first_message)
+        """
+        conversation = self.get_conversation(user_id, session)
+        
+        # Al reconstruir desde BD el mensaje actual ya está guardado al final
+        # (una ráfaga, como un Message por texto): se sustituye por el turno unido
+        saved = [{"role": "user", "content": part} for part in message_parts or [message]]
+        if conversation[-len(saved):] == saved:
+            del conversation[-len(saved):]
+        is_first_message = not conversation
+        conversation.append({"role": "user", "content": message})
+        
+        conversation = self._apply_token_budget(conversation, session)
+        self._save_conversation(user_id, conversation, session)
+        return conversation, is_first_message
+    
+    def _is_context_free(self, conversation, session=None):
+        """Turno sin contexto: el mensaje actual es todo el historial y la sesión no tiene resumen"""
+        return len(conversation) == 1 and not (session and session.context_summary)
     
-    def generate_response(self, user_id, message, company_info=None, language_code='es', is_first_message=False, company=None, session=None):
+    def _get_cached_answer(self, message, language_code, company, session=None):
+        """
+        Respuesta cacheada de la empresa para un turno sin contexto
+        
+        Los aciertos se registran como uso cacheado (sin coste) para que el
+        dashboard muestre el ahorro.
+        
+        Returns:
+            str: La respuesta, o None si no hay
+        """
+        if not (company and settings.ANSWER_CACHE_ENABLED):
+            return None
+        
+        entry = self.answer_cache.get(company, language_code, message)
+        if entry is None:
+            return None
+        
+        self.metrics_service.record_cached_usage(
+            company,
+            session,
+            tokens_input=entry['tokens_input'],
+            tokens_output=entry['tokens_output'],
+            tokens_total=entry['tokens_input'] + entry['tokens_output'],
+            model=entry.get('model')
+        )
+        logger.info(f"Respuesta cacheada para '{message}' ({company.name}, {language_code})")
+        return entry['answer']
+    
+    def _cache_answer(self, message, response, usage, language_code, company):
+        """Guarda la respuesta de un turno sin contexto (salvo errores y respuestas de contingencia)"""
+        # Sin uso registrado no hubo llamada a OpenAI (error o circuito abierto)
+        if not (company and settings.ANSWER_CACHE_ENABLED) or not response or not usage:
+            return
+        if response.startswith(OpenAIService.ERROR_PREFIX):
+            return
+        self.answer_cache.set(
+            company,
+            language_code,
+            message,
+            response,
+            tokens_input=usage.get('prompt_tokens', 0),
+            tokens_output=usage.get('completion_tokens', 0),
+            model=usage.get('model')
+        )
+    
+    def generate_response(self, user_id, message, company_info=None, language_code='es', is_first_message=False, company=None, session=None,
+                          message_parts=None):
         """
         Genera una respuesta para el mensaje del usuario
         
@@ -49,36 +287,42 @@ class ConversationService:
             message (str): Mensaje del usuario
             company_info (dict): Información de la empresa
             language_code (str): Código ISO del idioma para la respuesta
+            message_parts (list): Textos originales si `message` une una ráfaga (opcional)
             
         Returns:
             str: Respuesta generada
         """
         try:
-            # Determinar si es el primer mensaje
-            is_first_message = user_id not in self.conversations or len(self.conversations[user_id]) == 0
-            
             # Log language code for debugging
             logger.info(f"Generating response in language: {language_code} for user {user_id}")
             
-            # Añadir mensaje a la conversación
-            self.add_message(user_id, message, is_from_user=True)
+            # Añadir mensaje a la conversación y determinar si es el primer mensaje
+            conversation, is_first_message = self._start_turn(user_id, message, session, message_parts)
             
-            # Obtener contexto de la conversación
-            conversation = self.get_conversation(user_id)
+            # Las preguntas sin contexto (horario, precios...) pueden venir de la caché de respuestas
+            context_free = self._is_context_free(conversation, session)
+            response = self._get_cached_answer(message, language_code, company, session) if context_free else None
             
             # Generar una respuesta
-            response = self.openai_service.generate_response(
-                message=message,
-                context=conversation,
-                company_info=company_info,
-                is_first_message=is_first_message,
-                language_code=language_code,  # Pasar el idioma especificado
-                company=company,
-                session=session
-            )
+            if response is None:
+                usage = {}
+                response = self.openai_service.generate_response(
+                    message=message,
+                    context=conversation,
+                    company_info=company_info,
+                    is_first_message=is_first_message,
+                    language_code=language_code,  # Pasar el idioma especificado
+                    company=company,
+                    session=session,
+                    conversation_summary=session.context_summary if session else None,
+                    usage=usage
+                )
+                if context_free:
+                    self._cache_answer(message, response, usage, language_code, company)
             
             # Añadir respuesta a la conversación
-            self.add_message(user_id, response, is_from_user=False)
+            conversation.append({"role": "assistant", "content": response})
+            self._save_conversation(user_id, conversation, session)
             
             return response
             
@@ -94,23 +338,65 @@ class ConversationService:
             
             return error_messages.get(language_code, "Lo siento, ha ocurrido un error.")
     
-    def clear_conversation(self, user_id):
+    async def generate_response_async(self, user_id, message, company_info=None, language_code='es', company=None, session=None,
+                                      message_parts=None):
+        """
+        Versión asíncrona de generate_response
+        
+        Returns:
+            str: Respuesta generada
+        """
+        try:
+            logger.info(f"Generating response in language: {language_code} for user {user_id}")
+            
+            # El almacén (caché compartida) y la reconstrucción tocan la BD: en un hilo
+            conversation, is_first_message = await db_sync_to_async(self._start_turn)(user_id, message, session, message_parts)
+            
+            context_free = self._is_context_free(conversation, session)
+            response = None
+            if context_free:
+                response = await db_sync_to_async(self._get_cached_answer)(message, language_code, company, session)
+            
+            if response is None:
+                usage = {}
+                response = await self.openai_service.generate_response_async(
+                    message=message,
+                    context=conversation,
+                    company_info=company_info,
+                    is_first_message=is_first_message,
+                    language_code=language_code,
+                    company=company,
+                    session=session,
+                    conversation_summary=session.context_summary if session else None,
+                    usage=usage
+                )
+                if context_free:
+                    await db_sync_to_async(self._cache_answer)(message, response, usage, language_code, company)
+            
+            conversation.append({"role": "assistant", "content": response})
+            await db_sync_to_async(self._save_conversation)(user_id, conversation, session)
+            
+            return response
+            
+        except Exception as e:
+            logger.error(f"Error generando respuesta: {e}")
+            
+            error_messages = {
+                'es': "Lo siento, ha ocurrido un error. Por favor, intenta de nuevo más tarde.",
+                'en': "I'm sorry, an error occurred. Please try again later.",
+            }
+            
+            return error_messages.get(language_code, "Lo siento, ha ocurrido un error.")
+    
+    def clear_conversation(self, user_id, session=None):
         """Clear a user's conversation history"""
-        self.conversations[user_id] = []
+        self.context_store.delete(self._context_key(user_id, session))
         
     def handle_image_message(self, from_phone, media_id, message_text, company, session):
         """
         Maneja mensajes con imágenes y los procesa como posibles tickets
         """
         try:
-            # Verificar si esta imagen ya fue procesada
-            from django.core.cache import cache
-            cache_key = f"processed_media_{media_id}_{from_phone}"
-            
-            if cache.get(cache_key):
-                logger.warning(f"Imagen duplicada detectada: {media_id}. Ignorando.")
-                return "Estoy procesando tu imagen, dame un momento..."
-            
             # VERIFICACIÓN DE SESIÓN CERRADA
             # ==============================
             # Verificar si la sesión está cerrada antes de continuar
@@ -118,8 +404,10 @@ class ConversationService:
                 logger.warning(f"No se procesará la imagen {media_id} para el usuario {from_phone} porque la sesión {session.id} está cerrada")
                 return "Lo siento, tu sesión anterior ha finalizado. Inicia una nueva conversación para enviar imágenes."
             
-            # Marcar como en proceso (con TTL de 1 hora)
-            cache.set(cache_key, True, 60 * 60)
+            # Verificar si esta imagen ya fue procesada y marcarla como en proceso (TTL de 1 hora)
+            if not self.deduplication_service.claim(f"{media_id}:{from_phone}", kind='media', ttl=60 * 60):
+                logger.warning(f"Imagen duplicada detectada: {media_id}. Ignorando.")
+                return "Estoy procesando tu imagen, dame un momento..."
             
             # Obtener usuario
             user = User.objects.get(whatsapp_number=from_phone)
@@ -131,7 +419,7 @@ class ConversationService:
             )
             
             # NUEVO: Obtener contexto de la conversación reciente
-            conversation_context = self._extract_conversation_context(from_phone)
+            conversation_context = self._extract_conversation_context(from_phone, session=session)
             
             # Descargar la imagen
             relative_path = self.whatsapp_service.download_media(media_id)
@@ -312,16 +600,16 @@ class ConversationService:
             else:
                 image_message = "[El usuario envió una imagen sin texto adicional]"
                 
-            self.add_message(from_phone, image_message, is_from_user=True)
+            self.add_message(from_phone, image_message, is_from_user=True, session=session)
             
             # 2. Registrar el análisis de la imagen como mensaje del asistente
             # Crear un mensaje resumido del análisis
             analysis_summary = f"[He analizado tu imagen. Puedo ver: {image_analysis}...]"
             
-            self.add_message(from_phone, analysis_summary, is_from_user=False)
+            self.add_message(from_phone, analysis_summary, is_from_user=False, session=session)
             
             # 3. Añadir la respuesta al historial de conversación
-            self.add_message(from_phone, response_message, is_from_user=False)
+            self.add_message(from_phone, response_message, is_from_user=False, session=session)
             
             # Devolver la respuesta como siempre
             return response_message
@@ -352,7 +640,7 @@ class ConversationService:
             logger.error(f"Error al notificar sobre nueva imagen: {e}")
             return False
 
-    def _extract_conversation_context(self, user_id, max_messages=5):
+    def _extract_conversation_context(self, user_id, max_messages=5, session=None):
         """
         Extrae contexto relevante de los mensajes recientes en la conversación
         
@@ -365,7 +653,7 @@ class ConversationService:
         """
         try:
             # Obtener conversación del usuario
-            conversation = self.get_conversation(user_id)
+            conversation = self.get_conversation(user_id, session)
             if not conversation:
                 return ""
             
@@ -400,19 +688,13 @@ class ConversationService:
                     {raw_context}
                     """
                     
-                    # Usar el cliente de OpenAI para resumir el contexto
-                    from openai import OpenAI
-            
-                    # Crear una nueva instancia
-                    client = OpenAI(api_key=self.openai_service.api_key)
-                    
-                    # Llamada directa a la API
-                    response = client.chat.completions.create(
-                        model="gpt-4o-mini",  # Modelo más económico para resúmenes
+                    # Llamada directa a la API con el cliente compartido
+                    response = call_openai('context', lambda client, model: client.chat.completions.create(
+                        model=model,  # Modelo económico de la tarea (OPENAI_MODEL_ROUTES)
                         messages=[{"role": "user", "content": summarize_prompt}],
                         temperature=0.0,  # Sin creatividad, solo análisis objetivo
                         max_tokens=250    # Respuesta corta y concisa
-                    )
+                    ))
                     
                     # Extraer resumen
                     summary = response.choices[0].message.content.strip()
@@ -0,0 +1,196 @@
+import json
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Max, Q, Sum
+from django.utils import timezone
+
+from ..models import Company, DashboardSnapshot, OpenAIMonthlySummary, Session
+from .openai_metrics_service import prompt_cache_rate
+
+logger = logging.getLogger(__name__)
+
+def _previous_month(year, month):
+    return (year - 1, 12) if month == 1 else (year, month - 1)
+
+def _change(current, previous):
+    """Variación porcentual respecto al mes anterior (0 sin datos previos)"""
+    if not previous:
+        return 0
+    return float((current - previous) / previous * 100)
+
+def build_openai_dashboard():
+    """Datos de OpenAIDashboardView: uso por empresa del mes actual y tendencia de 12 meses"""
+    today = timezone.localdate()
+    prev_year, prev_month = _previous_month(today.year, today.month)
+
+    summaries = OpenAIMonthlySummary.objects.filter(
+        Q(year=today.year, month=today.month) | Q(year=prev_year, month=prev_month)
+    )
+    current = {s.company_id: s for s in summaries if (s.year, s.month) == (today.year, today.month)}
+    previous = {s.company_id: s for s in summaries if (s.year, s.month) == (prev_year, prev_month)}
+
+    companies_data = []
+    for company in Company.objects.filter(Q(active=True) | Q(id__in=current.keys())).only('id', 'name'):
+        summary = current.get(company.id)
+        prev_summary = previous.get(company.id)
+        companies_data.append({
+            'company': {'id': str(company.id), 'name': company.name},
+            'total_tokens': summary.total_tokens if summary else 0,
+            'total_cost': float(summary.total_cost) if summary else 0,
+            'token_change': _change(summary.total_tokens, prev_summary.total_tokens) if summary and prev_summary else 0,
+            'cost_change': _change(summary.total_cost, prev_summary.total_cost) if summary and prev_summary else 0,
+            'prompt_cache_hit_rate': prompt_cache_rate(summary.total_tokens_cached_input, summary.total_tokens_input) if summary else 0,
+        })
+    # Por coste descendente; las empresas sin uso este mes al final
+    companies_data.sort(key=lambda item: item['total_cost'], reverse=True)
+
+    # Tendencia mensual: últimos 12 meses en una sola consulta
+    months = []
+    year, month = today.year, today.month
+    for _ in range(12):
+        months.append((year, month))
+        year, month = _previous_month(year, month)
+    months.reverse()
+    first_year, first_month = months[0]
+    totals = {
+        (row['year'], row['month']): row
+        for row in OpenAIMonthlySummary.objects.filter(
+            Q(year__gt=first_year) | Q(year=first_year, month__gte=first_month)
+        ).values('year', 'month').annotate(tokens=Sum('total_tokens'), cost=Sum('total_cost'))
+    }
+    monthly_data = [
+        {
+            'month': f"{month}/{year}",
+            'month_name': datetime(year, month, 1).strftime("%b %Y"),
+            'tokens': (totals.get((year, month)) or {}).get('tokens') or 0,
+            'cost': float((totals.get((year, month)) or {}).get('cost') or 0),
+        }
+        for year, month in months
+    ]
+
+    return {
+        'companies_data': companies_data,
+        'current_month': today.strftime("%B %Y"),
+        'total_tokens': sum(item['total_tokens'] for item in companies_data),
+        'total_cost': sum(item['total_cost'] for item in companies_data),
+        'monthly_data': monthly_data,
+    }
+
+def build_lead_statistics():
+    """Datos de LeadStatisticsPanel: sesiones analizadas por intención y por nivel de interés"""
+    pairs = Counter()
+    if connection.vendor == 'postgresql':
+        # Un solo recorrido de la tabla para las dos distribuciones
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT
+                    analysis_results_json::json->>'primary_intent' as intent,
+                    analysis_results_json::json->>'purchase_interest_level' as interest,
+                    COUNT(*) as count
+                FROM
+                    chatbot_session
+                WHERE
+                    analysis_results_json IS NOT NULL
+                GROUP BY
+                    intent, interest
+            """)
+            for intent, interest, count in cursor.fetchall():
+                pairs[(intent, interest)] += count
+    else:
+        for value in Session.objects.filter(analysis_results_json__isnull=False).values_list('analysis_results_json', flat=True).iterator():
+            try:
+                analysis = json.loads(value)
+            except ValueError:
+                continue
+            pairs[(analysis.get('primary_intent'), analysis.get('purchase_interest_level'))] += 1
+
+    intents, interests = Counter(), Counter()
+    for (intent, interest), count in pairs.items():
+        intents[intent] += count
+        interests[interest] += count
+    return {
+        'intent_stats': intents.most_common(),
+        'interest_stats': interests.most_common(),
+        'analyzed_sessions': sum(pairs.values()),
+    }
+
+# Páginas con instantánea: clave -> (versión del formato del payload, función que lo genera)
+DASHBOARD_SNAPSHOTS = {
+    'openai_dashboard': (1, build_openai_dashboard),
+    'lead_statistics': (1, build_lead_statistics),
+}
+
+class DashboardSnapshotService:
+    """
+    Instantáneas de las páginas de estadísticas.
+
+    El job refresh_dashboard_snapshots las regenera cada
+    DASHBOARD_SNAPSHOT_REFRESH_MINUTES; las páginas leen la última versión
+    con una consulta y muestran su antigüedad. Si no hay ninguna válida
+    (primera vez o formato antiguo) se genera al momento.
+    """
+
+    def get(self, key):
+        """
+        Última instantánea de una página
+
+        Returns:
+            DashboardSnapshot
+        """
+        schema_version, _ = DASHBOARD_SNAPSHOTS[key]
+        snapshot = DashboardSnapshot.objects.filter(key=key).order_by('-version').first()
+        if snapshot is None or snapshot.schema_version != schema_version:
+            return self.refresh(key)
+        return snapshot
+
+    def refresh(self, key):
+        """
+        Genera una versión nueva de la instantánea y borra las antiguas
+
+        Returns:
+            DashboardSnapshot
+        """
+        schema_version, builder = DASHBOARD_SNAPSHOTS[key]
+        started = time.monotonic()
+        payload = builder()
+        duration_ms = int((time.monotonic() - started) * 1000)
+
+        try:
+            with transaction.atomic():
+                last_version = DashboardSnapshot.objects.filter(key=key).aggregate(version=Max('version'))['version'] or 0
+                snapshot = DashboardSnapshot.objects.create(
+                    key=key,
+                    version=last_version + 1,
+                    schema_version=schema_version,
+                    payload=payload,
+                    duration_ms=duration_ms,
+                )
+        except IntegrityError:
+            # Otro proceso ha generado la misma versión a la vez
+            return DashboardSnapshot.objects.filter(key=key).order_by('-version').first()
+
+        DashboardSnapshot.objects.filter(
+            key=key, version__lte=snapshot.version - settings.DASHBOARD_SNAPSHOT_KEEP_VERSIONS
+        ).delete()
+        logger.info(f"Instantánea '{key}' v{snapshot.version} generada en {duration_ms} ms")
+        return snapshot
+
+    def refresh_all(self):
+        """Regenera todas las instantáneas; un fallo en una no impide las demás"""
+        refreshed = 0
+        for key in DASHBOARD_SNAPSHOTS:
+            try:
+                self.refresh(key)
+                refreshed += 1
+            except Exception as e:
+                logger.error(f"Error generando la instantánea '{key}': {e}", exc_info=True)
+        return refreshed
+
+    def is_stale(self, snapshot):
+        """La instantánea lleva más de dos intervalos de regeneración sin actualizarse"""
+        return timezone.now() - snapshot.generated_at > timedelta(minutes=2 * settings.DASHBOARD_SNAPSHOT_REFRESH_MINUTES)
@@ -0,0 +1,206 @@
+import hashlib
+import logging
+import math
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from ..models import ProcessedEvent
+
+logger = logging.getLogger(__name__)
+
+class BloomFilter:
+    """
+    Filtro de Bloom en memoria para descartar rápidamente claves nunca vistas.
+
+    Si `might_contain` devuelve False la clave no se ha añadido en este
+    proceso; si devuelve True puede ser un falso positivo, así que hay que
+    confirmarlo en el backend. Cuando se alcanza la capacidad se vacía
+    para que la tasa de falsos positivos no crezca indefinidamente.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self.size = max(8, int(math.ceil(-self.capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hash_count = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def _positions(self, item):
+        # Doble hashing (Kirsch-Mitzenmacher) a partir de un único digest
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        with self.lock:
+            if self.count >= self.capacity:
+                self.bits = bytearray(len(self.bits))
+                self.count = 0
+            for position in self._positions(item):
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def might_contain(self, item):
+        with self.lock:
+            return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+class DatabaseDeduplicationBackend:
+    """
+    Backend compartido entre workers e instancias basado en la tabla ProcessedEvent.
+
+    Reclamar una clave es un INSERT sobre un índice único: si falla por
+    conflicto, otro worker ya la reclamó (salvo que hubiera caducado sin
+    barrerse todavía, en cuyo caso se renueva con un UPDATE condicional).
+    """
+
+    _bloom = None
+    _bloom_lock = threading.Lock()
+
+    def __init__(self):
+        # Un filtro por proceso, compartido por todas las instancias del servicio
+        with DatabaseDeduplicationBackend._bloom_lock:
+            if DatabaseDeduplicationBackend._bloom is None:
+                DatabaseDeduplicationBackend._bloom = BloomFilter(
+                    capacity=settings.DEDUP_BLOOM_CAPACITY,
+                    error_rate=settings.DEDUP_BLOOM_ERROR_RATE
+                )
+        self.bloom = DatabaseDeduplicationBackend._bloom
+
+    def claim_many(self, keys, kind, ttl):
+        now = timezone.now()
+        expires_at = now + timedelta(seconds=ttl)
+
+        # Las claves que el filtro no ha visto nunca van directas al INSERT;
+        # solo las posibles repeticiones se consultan antes en bloque
+        maybe_seen = [key for key in keys if self.bloom.might_contain(f"{kind}:{key}")]
+        duplicates = set()
+        if maybe_seen:
+            duplicates = set(ProcessedEvent.objects.filter(
+                kind=kind,
+                key__in=maybe_seen,
+                expires_at__gt=now
+            ).values_list('key', flat=True))
+
+        claimed = set()
+        for key in keys:
+            if key in duplicates:
+                continue
+            if self._insert(key, kind, now, expires_at):
+                claimed.add(key)
+            self.bloom.add(f"{kind}:{key}")
+        return claimed
+
+    def _insert(self, key, kind, now, expires_at):
+        try:
+            with transaction.atomic():
+                ProcessedEvent.objects.create(key=key, kind=kind, created_at=now, expires_at=expires_at)
+            return True
+        except IntegrityError:
+            # Ya existe: solo se puede reclamar si había caducado
+            renewed = ProcessedEvent.objects.filter(
+                kind=kind,
+                key=key,
+                expires_at__lte=now
+            ).update(created_at=now, expires_at=expires_at)
+            return renewed == 1
+
+    def release(self, keys, kind):
+        ProcessedEvent.objects.filter(kind=kind, key__in=keys).delete()
+
+    def sweep(self):
+        count, _ = ProcessedEvent.objects.filter(expires_at__lte=timezone.now()).delete()
+        return count
+
+class CacheDeduplicationBackend:
+    """
+    Backend basado en la caché de Django (cache.add es atómico en Redis/Memcached).
+
+    Con la LocMemCache por defecto solo deduplica dentro de un proceso,
+    así que está pensado para desarrollo o para una caché compartida.
+    """
+
+    def _cache_key(self, key, kind):
+        return f"processed_{kind}_{key}"
+
+    def claim_many(self, keys, kind, ttl):
+        return {key for key in keys if django_cache.add(self._cache_key(key, kind), True, ttl)}
+
+    def release(self, keys, kind):
+        django_cache.delete_many([self._cache_key(key, kind) for key in keys])
+
+    def sweep(self):
+        # La caché expira las claves por sí misma
+        return 0
+
+DEDUP_BACKENDS = {
+    'database': DatabaseDeduplicationBackend,
+    'cache': CacheDeduplicationBackend,
+}
+
+class DeduplicationService:
+    """
+    Deduplicación de eventos de WhatsApp (mensajes, estados, imágenes)
+
+    Meta reentrega los webhooks si no recibe respuesta a tiempo, y con
+    varios workers o instancias la misma entrega puede llegar a procesos
+    distintos. `claim` devuelve True solo al primero que reclama la clave.
+
+    El backend se elige con DEDUP_BACKEND: 'database', 'cache' o la ruta
+    de una clase con los métodos claim_many, release y sweep.
+    """
+
+    def __init__(self, backend=None, ttl=None):
+        if backend is None:
+            backend_name = settings.DEDUP_BACKEND
+            backend_class = DEDUP_BACKENDS.get(backend_name) or import_string(backend_name)
+            backend = backend_class()
+        self.backend = backend
+        self.ttl = ttl or settings.DEDUP_TTL_HOURS * 60 * 60
+
+    def claim(self, key, kind='message', ttl=None):
+        """
+        Reclama una clave de forma atómica
+
+        Returns:
+            bool: True si el evento es nuevo y debe procesarse, False si es un duplicado
+        """
+        return key in self.claim_many([key], kind=kind, ttl=ttl)
+
+    def claim_many(self, keys, kind='message', ttl=None):
+        """
+        Reclama varias claves del mismo tipo
+
+        Returns:
+            set: Claves nuevas (las que no aparecen son duplicados)
+        """
+        keys = [key for key in dict.fromkeys(keys) if key]
+        if not keys:
+            return set()
+        return self.backend.claim_many(keys, kind, ttl or self.ttl)
+
+    def release(self, keys, kind='message'):
+        """Libera claves reclamadas para que un reintento pueda procesarlas"""
+        keys = [key for key in keys if key]
+        if not keys:
+            return
+        try:
+            self.backend.release(keys, kind)
+        except Exception as e:
+            logger.error(f"Error liberando claves de deduplicación {keys}: {e}")
+
+    def sweep_expired(self):
+        """
+        Elimina las claves caducadas
+
+        Returns:
+            int: Número de claves eliminadas
+        """
+        return self.backend.sweep()
@@ -0,0 +1,223 @@
+import json
+import logging
+import random
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from ..models import DelayedTask
+
+logger = logging.getLogger(__name__)
+
+# Tareas que se pueden programar: nombre -> función (ruta importable).
+# Los handlers deben ser idempotentes: con at-least-once una tarea puede
+# ejecutarse más de una vez si el worker muere antes de confirmarla.
+DELAYED_TASK_HANDLERS = {
+    'feedback_request': 'chatbot.services.feedback_service.send_delayed_feedback_request',
+}
+
+class DelayedTaskService:
+    """
+    Tareas diferidas persistentes en base de datos (sustituye a threading.Timer).
+
+    Semántica (la misma que la cola de entrada):
+    - schedule: programa la tarea; si ya existe una con la misma clave de
+      idempotencia no se crea otra.
+    - claim_due: un worker reclama tareas vencidas, que quedan invisibles
+      para el resto durante `visibility_timeout` segundos.
+    - run_due: ejecuta las tareas reclamadas y las confirma, o las
+      reprograma con backoff exponencial; tras `max_attempts` pasan a 'dead'.
+    """
+
+    def __init__(self, visibility_timeout=None, max_attempts=None, retry_backoff=None):
+        self.visibility_timeout = visibility_timeout or settings.DELAYED_TASK_VISIBILITY_TIMEOUT
+        self.max_attempts = max_attempts or settings.DELAYED_TASK_MAX_ATTEMPTS
+        self.retry_backoff = retry_backoff or settings.DELAYED_TASK_RETRY_BACKOFF
+        self.max_backoff = 60 * 30
+
+    def schedule(self, task, payload=None, delay=0, idempotency_key=None):
+        """
+        Programa una tarea para dentro de `delay` segundos
+
+        Args:
+            task (str): Nombre de la tarea (ver DELAYED_TASK_HANDLERS)
+            payload (dict): Argumentos con nombre para el handler
+            delay (float): Segundos de espera antes de ejecutarla
+            idempotency_key (str): Clave única de la tarea (por defecto, una nueva)
+
+        Returns:
+            tuple: (DelayedTask, bool) con la tarea y si se ha creado ahora
+        """
+        if task not in DELAYED_TASK_HANDLERS:
+            raise ValueError(f"Tarea diferida no registrada: {task}")
+
+        run_at = timezone.now() + timedelta(seconds=delay)
+        delayed_task = DelayedTask(
+            task=task,
+            payload_json=json.dumps(payload or {}),
+            idempotency_key=idempotency_key or f"{task}:{uuid.uuid4().hex}",
+            run_at=run_at,
+            available_at=run_at
+        )
+        try:
+            with transaction.atomic():
+                delayed_task.save(force_insert=True)
+        except IntegrityError:
+            logger.info(f"Tarea {task} ya programada con la clave {idempotency_key}")
+            return DelayedTask.objects.get(idempotency_key=idempotency_key), False
+        return delayed_task, True
+
+    def claim_due(self, worker_id, limit=50):
+        """
+        Reclama hasta `limit` tareas vencidas para un worker
+
+        Una tarea está disponible si está pendiente y su available_at ya pasó,
+        o si está en proceso pero su plazo de visibilidad expiró (worker caído).
+
+        Returns:
+            list: Tareas reclamadas, por hora programada
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            queryset = DelayedTask.objects.filter(
+                status__in=['pending', 'processing'],
+                available_at__lte=now
+            ).order_by('available_at')
+
+            # SKIP LOCKED permite ejecutar varios workers sin bloquearse
+            if connection.features.has_select_for_update_skip_locked:
+                queryset = queryset.select_for_update(skip_locked=True)
+            elif connection.features.has_select_for_update:
+                queryset = queryset.select_for_update()
+
+            claimed = []
+            for delayed_task in queryset[:limit]:
+                if delayed_task.status == 'processing' and delayed_task.attempts >= self.max_attempts:
+                    delayed_task.status = 'dead'
+                    delayed_task.last_error = (delayed_task.last_error or '') + "\nPlazo de visibilidad agotado en el último intento"
+                    delayed_task.locked_by = None
+                    delayed_task.save(update_fields=['status', 'last_error', 'locked_by'])
+                    logger.error(f"Tarea {delayed_task.id} movida a dead-letter tras {delayed_task.attempts} intentos")
+                    continue
+
+                delayed_task.status = 'processing'
+                delayed_task.attempts += 1
+                delayed_task.locked_by = worker_id
+                delayed_task.available_at = now + timedelta(seconds=self.visibility_timeout)
+                delayed_task.started_at = delayed_task.started_at or now
+                delayed_task.save(update_fields=['status', 'attempts', 'locked_by', 'available_at', 'started_at'])
+                claimed.append(delayed_task)
+
+        return claimed
+
+    def run_due(self, worker_id, limit=50):
+        """
+        Reclama y ejecuta las tareas vencidas
+
+        Returns:
+            int: Número de tareas ejecutadas correctamente
+        """
+        done = 0
+        for delayed_task in self.claim_due(worker_id, limit):
+            try:
+                handler = import_string(DELAYED_TASK_HANDLERS[delayed_task.task])
+                handler(**delayed_task.payload)
+            except Exception as e:
+                logger.error(f"Error ejecutando la tarea {delayed_task.task} ({delayed_task.id}): {e}", exc_info=True)
+                self.mark_failed(delayed_task, e)
+                continue
+
+            self.mark_done(delayed_task)
+            done += 1
+            logger.info(f"Tarea {delayed_task.task} ({delayed_task.idempotency_key}) ejecutada con {delayed_task.lag_seconds:.1f}s de retraso")
+        return done
+
+    def mark_done(self, delayed_task):
+        """Marca una tarea como completada"""
+        delayed_task.status = 'done'
+        delayed_task.processed_at = timezone.now()
+        delayed_task.locked_by = None
+        delayed_task.last_error = None
+        delayed_task.save(update_fields=['status', 'processed_at', 'locked_by', 'last_error'])
+
+    def mark_failed(self, delayed_task, error):
+        """
+        Registra un fallo y reprograma la tarea con backoff
+
+        Returns:
+            bool: True si se reintentará, False si ha pasado a dead-letter
+        """
+        delayed_task.last_error = str(error)[:5000]
+        delayed_task.locked_by = None
+
+        if delayed_task.attempts >= self.max_attempts:
+            delayed_task.status = 'dead'
+            delayed_task.save(update_fields=['status', 'last_error', 'locked_by'])
+            logger.error(f"Tarea {delayed_task.id} movida a dead-letter tras {delayed_task.attempts} intentos: {error}")
+            return False
+
+        delay = min(self.retry_backoff * (2 ** (delayed_task.attempts - 1)), self.max_backoff)
+        delay = delay * random.uniform(0.8, 1.2)
+
+        delayed_task.status = 'pending'
+        delayed_task.available_at = timezone.now() + timedelta(seconds=delay)
+        delayed_task.save(update_fields=['status', 'available_at', 'last_error', 'locked_by'])
+        logger.warning(f"Tarea {delayed_task.id} reprogramada en {delay:.0f}s (intento {delayed_task.attempts}/{self.max_attempts})")
+        return True
+
+    def requeue(self, queryset):
+        """
+        Vuelve a programar tareas para ya (por ejemplo, desde dead-letter)
+
+        Returns:
+            int: Número de tareas reprogramadas
+        """
+        return queryset.update(
+            status='pending',
+            attempts=0,
+            available_at=timezone.now(),
+            locked_by=None
+        )
+
+    def purge_done(self, days=7):
+        """
+        Elimina las tareas completadas más antiguas que `days` días
+
+        Returns:
+            int: Número de tareas eliminadas
+        """
+        cutoff = timezone.now() - timedelta(days=days)
+        count, _ = DelayedTask.objects.filter(status='done', processed_at__lt=cutoff).delete()
+        return count
+
+    def get_stats(self, window_minutes=60):
+        """
+        Obtiene el estado de la cola y su retraso
+
+        Returns:
+            dict: Tareas por estado, 'oldest_due_seconds' (cuánto lleva esperando
+            la tarea vencida más antigua) y 'lag_avg_seconds' / 'lag_max_seconds'
+            de las tareas iniciadas en los últimos `window_minutes` minutos
+        """
+        now = timezone.now()
+        stats = {status: 0 for status, _ in DelayedTask.STATUS_CHOICES}
+        for row in DelayedTask.objects.values('status').annotate(count=Count('id')):
+            stats[row['status']] = row['count']
+
+        oldest_due = DelayedTask.objects.filter(status='pending', run_at__lte=now).aggregate(oldest=Min('run_at'))['oldest']
+        stats['oldest_due_seconds'] = (now - oldest_due).total_seconds() if oldest_due else 0
+
+        lags = [
+            max(0.0, (started_at - run_at).total_seconds())
+            for run_at, started_at in DelayedTask.objects.filter(
+                started_at__gte=now - timedelta(minutes=window_minutes)
+            ).values_list('run_at', 'started_at')
+        ]
+        stats['lag_avg_seconds'] = sum(lags) / len(lags) if lags else 0
+        stats['lag_max_seconds'] = max(lags) if lags else 0
+        return stats
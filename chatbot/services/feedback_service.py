@@ -173,4 +173,30 @@ class FeedbackService:
         # Guardar en caché para consultas futuras
         cache.set(cache_key, stats, cache_time)
         
-        return stats
\ No newline at end of file
+        return stats
+
+
+def send_delayed_feedback_request(session_id, phone_number):
+    """
+    Tarea diferida 'feedback_request': pide feedback al cerrar una sesión
+
+    Es idempotente (no se envía si la sesión ya lo solicitó), así que puede
+    reintentarse sin duplicar el mensaje.
+    """
+    from .whatsapp_service import WhatsAppService
+    
+    session = Session.objects.select_related('company').filter(id=session_id).first()
+    if not session:
+        logger.warning(f"Sesión {session_id} no encontrada al pedir feedback")
+        return
+    
+    if session.feedback_requested:
+        logger.info(f"Feedback ya solicitado para sesión {session.id}, no se enviará nuevamente.")
+        return
+    
+    company = session.company
+    whatsapp = WhatsAppService(
+        api_token=company.whatsapp_api_token,
+        phone_number_id=company.whatsapp_phone_number_id
+    )
+    FeedbackService().send_feedback_request(whatsapp, phone_number, session)
@@ -1,6 +1,7 @@
 # services/image_processing_service.py
 import logging
 from chatbot.models import TicketCategory
+from chatbot.services.openai_client import call_openai
 from chatbot.services.openai_service import OpenAIService
 
 logger = logging.getLogger(__name__)
@@ -28,12 +29,10 @@ class ImageProcessingService:
                 base64_image = base64.b64encode(image_file.read()).decode('utf-8')
             
             # Seleccionar el prompt adecuado
-            prompt, model, max_tokens = self._get_appropriate_prompt(company_id, category_id)
+            prompt, preferred_model, max_tokens = self._get_appropriate_prompt(company_id, category_id)
             
             # Llamar a OpenAI para análisis
-            from openai import OpenAI
-            client = OpenAI()
-            response = client.chat.completions.create(
+            response = call_openai('vision', lambda client, model: client.chat.completions.create(
                 model=model,
                 messages=[
                     {
@@ -50,7 +49,7 @@ class ImageProcessingService:
                     }
                 ],
                 max_tokens=max_tokens,
-            )
+            ), model=preferred_model)
             
             return response.choices[0].message.content
             
@@ -63,7 +62,7 @@ class ImageProcessingService:
         Selecciona el prompt más apropiado según la empresa y categoría
         
         Returns:
-            tuple: (texto_prompt, modelo, max_tokens)
+            tuple: (texto_prompt, modelo, max_tokens); sin modelo configurado, None (lo elige el router)
         """
         try:
             from chatbot.models import ImageAnalysisPrompt
@@ -109,13 +108,13 @@ class ImageProcessingService:
             Estructura tu respuesta en párrafos cortos, con lenguaje técnico pero comprensible.
             """
             
-            return (default_prompt, "gpt-4o", 500)
+            return (default_prompt, None, 500)
             
         except Exception as e:
             logger.error(f"Error al obtener prompt: {e}")
             # Devolver valores por defecto en caso de error
             default_prompt = "Describe detalladamente lo que ves en esta imagen."
-            return (default_prompt, "gpt-4o", 300)
+            return (default_prompt, None, 300)
     
     def detect_issue_category(self, description, image_analysis, company_id):
         """
@@ -255,10 +254,8 @@ class ImageProcessingService:
             """
             
             # Llamada a OpenAI
-            from openai import OpenAI
-            client = OpenAI()
-            response = client.chat.completions.create(
-                model="gpt-4o",
+            response = call_openai('vision', lambda client, model: client.chat.completions.create(
+                model=model,
                 messages=[
                     {
                         "role": "user",
@@ -274,7 +271,7 @@ class ImageProcessingService:
                     }
                 ],
                 max_tokens=300,
-            )
+            ))
             
             return response.choices[0].message.content
         except Exception as e:
@@ -324,14 +321,12 @@ class ImageProcessingService:
             """
             
             # Usar OpenAI para clasificación
-            from openai import OpenAI
-            client = OpenAI()
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
+            response = call_openai('categorization', lambda client, model: client.chat.completions.create(
+                model=model,
                 messages=[{"role": "user", "content": prompt}],
                 response_format={"type": "json_object"},
                 temperature=0.1  # Baja temperatura para decisiones más consistentes
-            )
+            ))
             
             # Procesar respuesta
             import json
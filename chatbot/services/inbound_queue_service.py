@@ -0,0 +1,273 @@
+import json
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Exists, OuterRef, Q
+from django.utils import timezone
+
+from ..models import Company, InboundWebhookEvent
+from .whatsapp_service import WhatsAppService
+
+logger = logging.getLogger(__name__)
+
+class InboundQueueService:
+    """
+    Cola persistente (en base de datos) para los webhooks entrantes de WhatsApp.
+
+    Semántica:
+    - enqueue: guarda el payload en estado 'pending' (se llama desde el webhook).
+    - claim_batch: un worker reclama eventos disponibles. Mientras los procesa
+      quedan invisibles para el resto durante `visibility_timeout` segundos;
+      si el worker muere, vuelven a estar disponibles al expirar ese plazo.
+    - mark_done / mark_failed: confirma el evento o lo reprograma con backoff
+      exponencial. Tras `max_attempts` intentos pasa a 'dead' (dead-letter).
+    - Buzones: el payload se divide por conversación al encolar y solo se
+      entrega el evento más antiguo pendiente de cada conversación, de modo
+      que los mensajes de un usuario se procesan en orden y nunca a la vez.
+    - Agrupación (debounce): si la empresa tiene message_debounce_seconds,
+      los mensajes de una ráfaga se retienen hasta que el usuario deja de
+      escribir (con un máximo de DEBOUNCE_MAX_WAIT) y se entregan juntos.
+    """
+
+    def __init__(self, visibility_timeout=None, max_attempts=None, retry_backoff=None):
+        self.visibility_timeout = visibility_timeout or settings.INBOUND_QUEUE_VISIBILITY_TIMEOUT
+        self.max_attempts = max_attempts or settings.INBOUND_QUEUE_MAX_ATTEMPTS
+        self.retry_backoff = retry_backoff or settings.INBOUND_QUEUE_RETRY_BACKOFF
+        # Límite superior del backoff para no aplazar un mensaje indefinidamente
+        self.max_backoff = 60 * 30
+        self.debounce_max_wait = settings.MESSAGE_DEBOUNCE_MAX_WAIT
+        self.max_merge = settings.INBOUND_QUEUE_MAX_MERGE
+
+    def enqueue(self, body, remote_addr=None):
+        """
+        Guarda un payload de webhook en la cola, un evento por conversación
+
+        Args:
+            body (dict): Cuerpo del webhook ya parseado
+            remote_addr (str): IP de origen (opcional)
+
+        Returns:
+            list: Los eventos creados
+        """
+        now = timezone.now()
+        parts = WhatsAppService().split_webhook_by_conversation(body)
+        windows = self._debounce_windows([key for key, _ in parts if key])
+
+        events = []
+        for conversation_key, part in parts:
+            window = windows.get(conversation_key.split(':', 1)[0], 0) if conversation_key else 0
+            available_at = now + timedelta(seconds=window)
+            if window:
+                # Cada mensaje nuevo de la ráfaga retrasa a los anteriores que aún esperan
+                InboundWebhookEvent.objects.filter(
+                    conversation_key=conversation_key,
+                    status='pending',
+                    attempts=0,
+                    available_at__gt=now,
+                    received_at__gte=now - timedelta(seconds=self.debounce_max_wait)
+                ).update(available_at=available_at)
+
+            events.append(InboundWebhookEvent(
+                payload_json=json.dumps(part),
+                remote_addr=remote_addr,
+                conversation_key=conversation_key,
+                received_at=now,
+                available_at=available_at
+            ))
+
+        InboundWebhookEvent.objects.bulk_create(events)
+        logger.debug(f"Webhook encolado en {len(events)} eventos")
+        return events
+
+    def _debounce_windows(self, conversation_keys):
+        """Ventana de agrupación de cada empresa, por phone_number_id"""
+        phone_number_ids = {key.split(':', 1)[0] for key in conversation_keys}
+        if not phone_number_ids:
+            return {}
+        return dict(Company.objects.filter(
+            whatsapp_phone_number_id__in=phone_number_ids,
+            message_debounce_seconds__gt=0
+        ).values_list('whatsapp_phone_number_id', 'message_debounce_seconds'))
+
+    def claim_batch(self, worker_id, limit=1):
+        """
+        Reclama hasta `limit` eventos disponibles para un worker
+
+        Un evento está disponible si está pendiente y su available_at ya pasó,
+        o si está en proceso pero su plazo de visibilidad expiró (worker caído),
+        y además es la cabeza de su buzón: ningún evento anterior de la misma
+        conversación sigue pendiente o en proceso.
+
+        Junto con la cabeza se reclaman los siguientes eventos ya disponibles
+        del mismo buzón (una ráfaga), que quedan en `event.followers` para
+        procesarse en un solo payload (ver combined_payload).
+
+        Returns:
+            list: Eventos reclamados, en orden de llegada
+        """
+        now = timezone.now()
+
+        earlier_in_mailbox = InboundWebhookEvent.objects.filter(
+            conversation_key=OuterRef('conversation_key'),
+            status__in=['pending', 'processing']
+        ).filter(
+            Q(received_at__lt=OuterRef('received_at')) |
+            Q(received_at=OuterRef('received_at'), id__lt=OuterRef('id'))
+        )
+
+        with transaction.atomic():
+            queryset = InboundWebhookEvent.objects.filter(
+                status__in=['pending', 'processing'],
+                available_at__lte=now
+            ).exclude(
+                Exists(earlier_in_mailbox)
+            ).order_by('received_at', 'id')
+
+            # SKIP LOCKED permite que varios workers reclamen en paralelo sin bloquearse
+            if connection.features.has_select_for_update_skip_locked:
+                queryset = queryset.select_for_update(skip_locked=True)
+            elif connection.features.has_select_for_update:
+                queryset = queryset.select_for_update()
+
+            events = list(queryset[:limit])
+
+            claimed = []
+            for event in events:
+                # Un evento cuyo lease expiró demasiadas veces va a dead-letter
+                if event.status == 'processing' and event.attempts >= self.max_attempts:
+                    event.status = 'dead'
+                    event.last_error = (event.last_error or '') + "\nPlazo de visibilidad agotado en el último intento"
+                    event.locked_by = None
+                    event.save(update_fields=['status', 'last_error', 'locked_by'])
+                    logger.error(f"Evento {event.id} movido a dead-letter tras {event.attempts} intentos")
+                    continue
+
+                self._lease(event, worker_id, now)
+                event.followers = self._claim_followers(event, worker_id, now) if event.conversation_key else []
+                claimed.append(event)
+
+        return claimed
+
+    def _lease(self, event, worker_id, now):
+        event.status = 'processing'
+        event.attempts += 1
+        event.locked_by = worker_id
+        event.locked_at = now
+        event.available_at = now + timedelta(seconds=self.visibility_timeout)
+        event.save(update_fields=['status', 'attempts', 'locked_by', 'locked_at', 'available_at'])
+
+    def _claim_followers(self, head, worker_id, now):
+        """Reclama los eventos consecutivos ya disponibles del buzón de `head`"""
+        queryset = InboundWebhookEvent.objects.filter(
+            conversation_key=head.conversation_key,
+            status='pending'
+        ).exclude(id=head.id).order_by('received_at', 'id')
+        if connection.features.has_select_for_update:
+            queryset = queryset.select_for_update()
+
+        followers = []
+        for event in queryset[:self.max_merge - 1]:
+            # Respetar el orden: un evento aún retenido corta la ráfaga
+            if event.available_at > now:
+                break
+            self._lease(event, worker_id, now)
+            followers.append(event)
+        return followers
+
+    @staticmethod
+    def combined_payload(events):
+        """
+        Une los payloads de varios eventos en un único cuerpo de webhook
+
+        Args:
+            events (list): Eventos en orden de llegada
+
+        Returns:
+            dict: Cuerpo con todas las entradas, en el mismo orden
+        """
+        if len(events) == 1:
+            return events[0].payload
+        entries = []
+        for event in events:
+            entries.extend(event.payload.get("entry", []) or [])
+        return {"object": events[0].payload.get("object"), "entry": entries}
+
+    def mark_done(self, event):
+        """Marca un evento como procesado correctamente"""
+        event.status = 'done'
+        event.processed_at = timezone.now()
+        event.locked_by = None
+        event.last_error = None
+        event.save(update_fields=['status', 'processed_at', 'locked_by', 'last_error'])
+
+    def mark_failed(self, event, error):
+        """
+        Registra un fallo de procesamiento y reprograma el evento con backoff
+
+        Returns:
+            bool: True si se reintentará, False si ha pasado a dead-letter
+        """
+        event.last_error = str(error)[:5000]
+        event.locked_by = None
+
+        if event.attempts >= self.max_attempts:
+            event.status = 'dead'
+            event.save(update_fields=['status', 'last_error', 'locked_by'])
+            logger.error(f"Evento {event.id} movido a dead-letter tras {event.attempts} intentos: {error}")
+            return False
+
+        # Backoff exponencial con jitter para no sincronizar reintentos
+        delay = min(self.retry_backoff * (2 ** (event.attempts - 1)), self.max_backoff)
+        delay = delay * random.uniform(0.8, 1.2)
+
+        event.status = 'pending'
+        event.available_at = timezone.now() + timedelta(seconds=delay)
+        event.save(update_fields=['status', 'available_at', 'last_error', 'locked_by'])
+        logger.warning(f"Evento {event.id} reprogramado en {delay:.0f}s (intento {event.attempts}/{self.max_attempts})")
+        return True
+
+    def requeue(self, queryset):
+        """
+        Vuelve a poner en cola eventos (por ejemplo, desde dead-letter)
+
+        Returns:
+            int: Número de eventos reencolados
+        """
+        return queryset.update(
+            status='pending',
+            attempts=0,
+            available_at=timezone.now(),
+            locked_by=None
+        )
+
+    def purge_processed(self, days=7):
+        """
+        Elimina los eventos procesados más antiguos que `days` días
+
+        Returns:
+            int: Número de eventos eliminados
+        """
+        cutoff = timezone.now() - timedelta(days=days)
+        count, _ = InboundWebhookEvent.objects.filter(
+            status='done',
+            processed_at__lt=cutoff
+        ).delete()
+        return count
+
+    def get_stats(self):
+        """
+        Obtiene el número de eventos por estado y el retraso del más antiguo pendiente
+
+        Returns:
+            dict: {'pending': n, 'processing': n, 'done': n, 'dead': n, 'oldest_pending_seconds': s}
+        """
+        stats = {status: 0 for status, _ in InboundWebhookEvent.STATUS_CHOICES}
+        for row in InboundWebhookEvent.objects.values('status').annotate(count=Count('id')):
+            stats[row['status']] = row['count']
+
+        oldest = InboundWebhookEvent.objects.filter(status='pending').order_by('received_at').first()
+        stats['oldest_pending_seconds'] = (timezone.now() - oldest.received_at).total_seconds() if oldest else 0
+        return stats
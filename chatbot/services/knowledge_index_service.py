@@ -0,0 +1,206 @@
+import hashlib
+import logging
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+
+from ..models import CompanyInfo, TicketCategory
+from .company_service import company_cache_key
+from .token_service import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TICKET_INSTRUCTIONS = "Reporta problemas relacionados con esta categoría. Si precisas, puedes recibir fotos en el mismo chat."
+
+# Palabras vacías (es/en) que no aportan a la relevancia
+STOPWORDS = frozenset("""
+a al algo como con de del donde el en es esta este esto hay la las lo los me mi mis no o para pero por que se si sin su sus te tu un una uno y ya
+the and or of to in on for is are be it this that with what how do does can i you my your we our
+""".split())
+
+_WORD_RE = re.compile(r"\w+")
+
+def tokenize(text):
+    """
+    Términos normalizados de un texto para el índice
+
+    Minúsculas, sin tildes, sin palabras vacías y con un stemming mínimo
+    (plurales) para que «horarios» encuentre «horario».
+    """
+    text = unicodedata.normalize('NFKD', str(text or '').lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    terms = []
+    for word in _WORD_RE.findall(text):
+        if word in STOPWORDS or len(word) < 2:
+            continue
+        if len(word) > 4 and word.endswith('es'):
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith('s'):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+class KnowledgeIndex:
+    """
+    Índice BM25 de la información de una empresa (secciones de CompanyInfo y
+    categorías de tickets).
+
+    Se construye fuera de la petición (al guardar, ver chatbot/signals.py) o
+    la primera vez que se necesita, y se guarda en caché con la versión de
+    contenido de la empresa. Al reconstruirlo se reutilizan los documentos
+    que no han cambiado.
+    """
+
+    k1 = 1.5
+    b = 0.75
+    title_weight = 2  # los términos del título cuentan doble
+
+    def __init__(self, documents, previous=None, version=None):
+        self.version = version
+        reusable = {doc['key']: doc for doc in previous.documents} if previous else {}
+        self.documents = []
+        for document in documents:
+            old = reusable.get(document['key'])
+            if old and old['fingerprint'] == document['fingerprint']:
+                self.documents.append(old)
+            else:
+                terms = tokenize(document['title']) * self.title_weight + tokenize(document['content'])
+                document['terms'] = dict(Counter(terms))
+                document['length'] = len(terms)
+                document['tokens'] = estimate_tokens(document['title']) + estimate_tokens(document['content'])
+                self.documents.append(document)
+
+        self.doc_freq = Counter()
+        for document in self.documents:
+            self.doc_freq.update(document['terms'].keys())
+        self.avg_length = (sum(d['length'] for d in self.documents) / len(self.documents)) if self.documents else 0
+        self.total_tokens = sum(d['tokens'] for d in self.documents)
+
+    @property
+    def enabled(self):
+        """Solo compensa seleccionar secciones a partir de cierto tamaño"""
+        return bool(self.documents) and self.total_tokens >= settings.KNOWLEDGE_RETRIEVAL_MIN_TOKENS
+
+    def search(self, query, top_k=None):
+        """
+        Documentos más relevantes para una consulta
+
+        Args:
+            query (str): Pregunta actual y mensajes recientes del usuario
+            top_k (int): Máximo de documentos (por defecto KNOWLEDGE_RETRIEVAL_TOP_K)
+
+        Returns:
+            list: Documentos con puntuación > 0, de más a menos relevante
+        """
+        top_k = top_k or settings.KNOWLEDGE_RETRIEVAL_TOP_K
+        query_terms = set(tokenize(query))
+        if not query_terms or not self.documents:
+            return []
+
+        total = len(self.documents)
+        scored = []
+        for document in self.documents:
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * document['length'] / (self.avg_length or 1))
+            for term in query_terms:
+                tf = document['terms'].get(term)
+                if not tf:
+                    continue
+                df = self.doc_freq[term]
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                score += idf * tf * (self.k1 + 1) / (tf + norm)
+            if score > 0:
+                scored.append((score, document))
+
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [document for _, document in scored[:top_k]]
+
+    def render(self, query, top_k=None):
+        """
+        Mensaje de sistema con las secciones relevantes para la consulta
+
+        Returns:
+            str: Texto para el prompt (vacío si nada es relevante)
+        """
+        documents = self.search(query, top_k)
+        if not documents:
+            return ""
+
+        text = "--- INFORMACIÓN RELEVANTE PARA ESTA CONSULTA ---\n"
+        for document in documents:
+            text += f"\n#### {document['title']} ####\n{document['content']}\n"
+            if document.get('ask_for_photos'):
+                text += ("Para este tipo de reporte, solicita amablemente al usuario que envíe fotos del problema "
+                         "a este mismo chat para facilitar su evaluación.\n")
+        return text
+
+def _fingerprint(*parts):
+    return hashlib.sha1("\x00".join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+def load_documents(company):
+    """Documentos indexables de la empresa (mismo contenido que el prompt completo)"""
+    documents = []
+    for section in CompanyInfo.objects.filter(company=company).only('id', 'title', 'content'):
+        if section.title and section.content:
+            documents.append({
+                'key': f"info:{section.id}",
+                'title': section.title,
+                'content': section.content,
+                'fingerprint': _fingerprint(section.title, section.content),
+            })
+    for category in TicketCategory.objects.filter(company=company):
+        content = category.prompt_instructions or DEFAULT_TICKET_INSTRUCTIONS
+        documents.append({
+            'key': f"ticket:{category.id}",
+            'title': f"🔧 {category.name}",
+            'content': content,
+            'ask_for_photos': category.ask_for_photos,
+            'fingerprint': _fingerprint(category.name, content, category.ask_for_photos),
+        })
+    return documents
+
+# Último índice construido por empresa en este proceso (para reconstruir solo lo que cambia)
+_last_indexes = {}
+_lock = threading.Lock()
+
+def build_index(company):
+    """
+    Construye el índice de la empresa y lo guarda en caché con su versión actual
+
+    Returns:
+        KnowledgeIndex: El índice construido
+    """
+    with _lock:
+        previous = _last_indexes.get(company.id)
+    index = KnowledgeIndex(load_documents(company), previous=previous, version=company.knowledge_version)
+    with _lock:
+        _last_indexes[company.id] = index
+    caches[settings.SYSTEM_PROMPT_CACHE].set(
+        company_cache_key(company, "knowledge_index"), index, settings.SYSTEM_PROMPT_CACHE_TTL
+    )
+    logger.info(f"Índice de conocimiento de {company.name}: {len(index.documents)} documentos, ~{index.total_tokens} tokens")
+    return index
+
+def get_index(company):
+    """
+    Índice de la empresa para su versión de contenido actual
+
+    Sin consultas si ya está en memoria o en caché; si no, se construye.
+    """
+    with _lock:
+        index = _last_indexes.get(company.id)
+    if index is not None and index.version == company.knowledge_version:
+        return index
+    
+    index = caches[settings.SYSTEM_PROMPT_CACHE].get(company_cache_key(company, "knowledge_index"))
+    if index is None:
+        return build_index(company)
+    
+    with _lock:
+        _last_indexes[company.id] = index
+    return index
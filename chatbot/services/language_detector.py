@@ -0,0 +1,164 @@
+import json
+import math
+import os
+import re
+from collections import Counter
+
+# Textos de entrenamiento (uno por idioma) y frases de prueba del benchmark
+LANGUAGE_DATA_DIR = os.path.join(os.path.dirname(__file__), 'language_data')
+
+LANGUAGE_NAMES = {
+    'es': 'español',
+    'en': 'inglés',
+    'fr': 'francés',
+    'de': 'alemán',
+    'it': 'italiano',
+    'pt': 'portugués',
+    'ca': 'catalán',
+    'nl': 'neerlandés',
+    'ru': 'ruso',
+    'uk': 'ucraniano',
+    'el': 'griego',
+    'ar': 'árabe',
+    'fa': 'persa',
+    'he': 'hebreo',
+    'zh': 'chino',
+    'ja': 'japonés',
+    'ko': 'coreano',
+    'hi': 'hindi',
+    'th': 'tailandés',
+}
+
+# Alfabetos que identifican el idioma por sí solos: (código, confianza, rangos)
+SCRIPTS = [
+    ('ko', 0.99, [(0xAC00, 0xD7AF), (0x1100, 0x11FF), (0x3130, 0x318F)]),
+    ('ja', 0.99, [(0x3040, 0x30FF)]),
+    ('zh', 0.95, [(0x4E00, 0x9FFF), (0x3400, 0x4DBF)]),
+    ('el', 0.99, [(0x0370, 0x03FF)]),
+    ('he', 0.99, [(0x0590, 0x05FF)]),
+    ('ar', 0.90, [(0x0600, 0x06FF), (0x0750, 0x077F)]),
+    ('ru', 0.90, [(0x0400, 0x04FF)]),
+    ('hi', 0.90, [(0x0900, 0x097F)]),
+    ('th', 0.99, [(0x0E00, 0x0E7F)]),
+]
+
+# Letras que distinguen un idioma de otro con el mismo alfabeto
+SCRIPT_VARIANTS = {
+    'ru': ('uk', set('іїєґ')),
+    'ar': ('fa', set('پچژگ')),
+}
+
+WORD_RE = re.compile(r"[^\W\d_]+")
+
+NGRAM_ORDERS = (1, 2, 3)
+SMOOTHING = 0.5
+# Los n-gramas de un texto se solapan: sin atemperar, la confianza de un
+# texto corto sería casi siempre 1.0
+TEMPERATURE = 3.0
+# Un texto latino con menos letras no da para decidir
+MIN_LETTERS = 4
+
+def _script_of(char):
+    code = ord(char)
+    if code < 0x0370:
+        # Latín y sus diacríticos
+        return None
+    for language, _, ranges in SCRIPTS:
+        for start, end in ranges:
+            if start <= code <= end:
+                return language
+    return None
+
+def _ngrams(text):
+    """N-gramas de caracteres de las palabras del texto (con espacio como borde de palabra)"""
+    padded = " " + " ".join(WORD_RE.findall(text.lower())) + " "
+    for n in NGRAM_ORDERS:
+        for i in range(len(padded) - n + 1):
+            gram = padded[i:i + n]
+            if gram.strip():
+                yield gram
+
+class LanguageProfile:
+    """Log-probabilidades de n-gramas de un idioma (Naive Bayes con suavizado aditivo)"""
+
+    def __init__(self, text):
+        counts = Counter(_ngrams(text))
+        totals, vocabulary = Counter(), Counter()
+        for gram, count in counts.items():
+            totals[len(gram)] += count
+            vocabulary[len(gram)] += 1
+
+        # Probabilidad de un n-grama no visto, por orden
+        self.unseen = {
+            n: math.log(SMOOTHING / (totals[n] + SMOOTHING * (vocabulary[n] + 1)))
+            for n in NGRAM_ORDERS
+        }
+        self.log_probs = {
+            gram: math.log((count + SMOOTHING) / (totals[len(gram)] + SMOOTHING * (vocabulary[len(gram)] + 1)))
+            for gram, count in counts.items()
+        }
+
+    def score(self, grams):
+        """Log-verosimilitud de un Counter de n-gramas"""
+        log_probs, unseen = self.log_probs, self.unseen
+        return sum(count * log_probs.get(gram, unseen[len(gram)]) for gram, count in grams.items())
+
+class LanguageDetector:
+    """
+    Detector de idioma local, sin red.
+
+    Los textos en alfabetos propios (cirílico, griego, árabe, CJK...) se
+    resuelven por el alfabeto. Los de alfabeto latino se puntúan con perfiles
+    de n-gramas de 1 a 3 caracteres construidos al cargar el módulo a partir
+    de language_data/training.json; la confianza es la probabilidad a
+    posteriori del idioma ganador.
+    """
+
+    def __init__(self, training_texts=None):
+        if training_texts is None:
+            with open(os.path.join(LANGUAGE_DATA_DIR, 'training.json'), encoding='utf-8') as f:
+                training_texts = json.load(f)
+        self.profiles = {language: LanguageProfile(text) for language, text in training_texts.items()}
+
+    def detect(self, text):
+        """
+        Detecta el idioma de un texto
+
+        Args:
+            text (str): Texto a analizar
+
+        Returns:
+            tuple: (código ISO, confianza entre 0 y 1). (None, 0.0) si no hay texto suficiente
+        """
+        letters = [char for char in text if char.isalpha()]
+        if not letters:
+            return None, 0.0
+
+        scripts = Counter(_script_of(char) for char in letters)
+        script, count = scripts.most_common(1)[0]
+        if script in ('zh', 'ja'):
+            # Los textos japoneses mezclan kanji y kana
+            count = scripts['zh'] + scripts['ja']
+        if script is not None and count * 2 >= len(letters):
+            return self._detect_script(script, letters, count / len(letters))
+
+        if len(letters) < MIN_LETTERS:
+            return None, 0.0
+
+        grams = Counter(_ngrams(text))
+        scores = {language: profile.score(grams) / TEMPERATURE for language, profile in self.profiles.items()}
+        best = max(scores, key=scores.get)
+        total = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1.0 / total
+
+    def _detect_script(self, script, letters, share):
+        language, confidence = script, next(c for code, c, _ in SCRIPTS if code == script)
+        if script == 'zh' and any(_script_of(char) == 'ja' for char in letters):
+            language, confidence = 'ja', 0.99
+        variant = SCRIPT_VARIANTS.get(script)
+        if variant and any(char in variant[1] for char in letters):
+            language = variant[0]
+        return language, confidence * share
+
+# Detector del proceso (los perfiles se construyen una vez al importar)
+language_detector = LanguageDetector()
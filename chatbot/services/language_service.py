@@ -1,15 +1,35 @@
 import logging
-from openai import OpenAI
+
 from django.conf import settings
 
+from .language_detector import LANGUAGE_NAMES, language_detector
+from .openai_client import call_openai
+
 logger = logging.getLogger(__name__)
 
 class LanguageService:
     """Servicio para la detección y gestión de idiomas"""
     
-    def __init__(self):
-        self.client = OpenAI(api_key=settings.OPENAI_API_KEY)
+    def detect_language(self, text):
+        """
+        Detecta el idioma de un texto con el detector local y, si no está
+        seguro, con OpenAI
+        
+        Args:
+            text (str): Texto para detectar idioma
+            
+        Returns:
+            dict: code, name y source ('local' u 'openai')
+        """
+        if settings.LANGUAGE_DETECTION_LOCAL_ENABLED:
+            code, confidence = language_detector.detect(text)
+            if code and confidence >= settings.LANGUAGE_DETECTION_MIN_CONFIDENCE:
+                logger.info(f"Idioma detectado localmente para '{text[:20]}...': {code} ({confidence:.2f})")
+                return {"code": code, "name": LANGUAGE_NAMES[code], "source": "local"}
+            logger.info(f"Detección local insegura para '{text[:20]}...' ({code}, {confidence:.2f}): se consulta a OpenAI")
         
+        return {**self.detect_language_with_openai(text), "source": "openai"}
+    
     def detect_language_with_openai(self, text):
         """
         Detecta el idioma de un texto usando OpenAI
@@ -26,15 +46,15 @@ class LanguageService:
                 return {"code": "es", "name": "español"}
                 
             # Prompt para OpenAI para detectar cualquier idioma
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
+            response = call_openai('language', lambda client, model: client.chat.completions.create(
+                model=model,
                 messages=[
                     {"role": "system", "content": "Eres un detector preciso de idiomas. Identifica el idioma de cualquier texto proporcionado. Responde SOLAMENTE con formato 'código_ISO,nombre_idioma', por ejemplo: 'es,español' o 'zh,chino'."},
                     {"role": "user", "content": f"Detecta el idioma del siguiente texto: '{text}'"}
                 ],
                 max_tokens=20,
                 temperature=0.3
-            )
+            ))
             
             # Procesar respuesta
             result = response.choices[0].message.content.strip()
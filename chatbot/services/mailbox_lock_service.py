@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+class MailboxLockTimeout(Exception):
+    """No se pudo obtener el lock de una conversación a tiempo"""
+    pass
+
+class MailboxLockService:
+    """
+    Lock por conversación (empresa + usuario) compartido entre workers y nodos.
+
+    Garantiza que los mensajes de una misma conversación no se procesen a la
+    vez (creación de sesiones, historial en memoria), mientras que las
+    conversaciones distintas siguen en paralelo. El orden de llegada lo
+    garantiza la cola de entrada, que solo entrega la cabeza de cada buzón.
+
+    Backends (MAILBOX_LOCK_BACKEND):
+    - 'advisory': pg_try_advisory_lock de PostgreSQL (se libera solo si la
+      conexión se cae). Requiere conexiones de sesión, no pgbouncer en modo
+      transacción.
+    - 'cache': cache.add con TTL; solo es compartido si la caché lo es.
+    - 'auto': 'advisory' en PostgreSQL y 'cache' en el resto.
+    """
+
+    def __init__(self, backend=None, timeout=None, lease=None):
+        backend = backend or settings.MAILBOX_LOCK_BACKEND
+        if backend == 'auto':
+            backend = 'advisory' if connection.vendor == 'postgresql' else 'cache'
+        self.backend = backend
+        self.timeout = timeout or settings.MAILBOX_LOCK_TIMEOUT
+        # Vida máxima del lock en caché si el worker muere sin liberarlo
+        self.lease = lease or settings.INBOUND_QUEUE_VISIBILITY_TIMEOUT
+        self.poll_interval = 0.1
+        # Locks locales para la ruta asíncrona: todas las corrutinas de un
+        # proceso comparten conexión, y los advisory locks son reentrantes
+        self._local_locks = weakref.WeakValueDictionary()
+
+    def _lock_id(self, conversation_key):
+        """Convierte la clave de conversación en un bigint con signo para PostgreSQL"""
+        digest = hashlib.blake2b(conversation_key.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big', signed=True)
+
+    @contextmanager
+    def lock(self, conversation_key):
+        """
+        Obtiene el lock de una conversación durante el bloque `with`
+
+        Args:
+            conversation_key (str): Identificador del buzón (phone_number_id:número del usuario)
+
+        Raises:
+            MailboxLockTimeout: Si no se obtiene el lock en `timeout` segundos
+        """
+        if not conversation_key:
+            yield
+            return
+
+        if self.backend == 'advisory':
+            acquire, release = self._advisory_acquire, self._advisory_release
+        else:
+            acquire, release = self._cache_acquire, self._cache_release
+
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.timeout
+        while not acquire(conversation_key, token):
+            if time.monotonic() >= deadline:
+                raise MailboxLockTimeout(f"Timeout esperando el lock de la conversación {conversation_key}")
+            time.sleep(self.poll_interval)
+
+        try:
+            yield
+        finally:
+            try:
+                release(conversation_key, token)
+            except Exception as e:
+                logger.error(f"Error liberando el lock de la conversación {conversation_key}: {e}")
+
+    @asynccontextmanager
+    async def lock_async(self, conversation_key):
+        """
+        Versión asíncrona de lock: espera sin bloquear el event loop
+
+        Raises:
+            MailboxLockTimeout: Si no se obtiene el lock en `timeout` segundos
+        """
+        if not conversation_key:
+            yield
+            return
+
+        local_lock = self._local_locks.get(conversation_key)
+        if local_lock is None:
+            local_lock = asyncio.Lock()
+            self._local_locks[conversation_key] = local_lock
+
+        try:
+            await asyncio.wait_for(local_lock.acquire(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise MailboxLockTimeout(f"Timeout esperando el lock de la conversación {conversation_key}")
+
+        try:
+            if self.backend == 'advisory':
+                acquire, release = self._advisory_acquire, self._advisory_release
+            else:
+                acquire, release = self._cache_acquire, self._cache_release
+
+            # thread_sensitive: el advisory lock pertenece a la conexión, y
+            # adquirirlo y liberarlo debe hacerse desde el mismo hilo
+            acquire, release = sync_to_async(acquire), sync_to_async(release)
+
+            token = uuid.uuid4().hex
+            deadline = time.monotonic() + self.timeout
+            while not await acquire(conversation_key, token):
+                if time.monotonic() >= deadline:
+                    raise MailboxLockTimeout(f"Timeout esperando el lock de la conversación {conversation_key}")
+                await asyncio.sleep(self.poll_interval)
+
+            try:
+                yield
+            finally:
+                try:
+                    await release(conversation_key, token)
+                except Exception as e:
+                    logger.error(f"Error liberando el lock de la conversación {conversation_key}: {e}")
+        finally:
+            local_lock.release()
+
+    def _advisory_acquire(self, conversation_key, token):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [self._lock_id(conversation_key)])
+            return cursor.fetchone()[0]
+
+    def _advisory_release(self, conversation_key, token):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [self._lock_id(conversation_key)])
+
+    def _cache_key(self, conversation_key):
+        return f"mailbox_lock_{conversation_key}"
+
+    def _cache_acquire(self, conversation_key, token):
+        return django_cache.add(self._cache_key(conversation_key), token, self.lease)
+
+    def _cache_release(self, conversation_key, token):
+        # Solo se borra si el lock sigue siendo nuestro (no expiró y lo tomó otro)
+        cache_key = self._cache_key(conversation_key)
+        if django_cache.get(cache_key) == token:
+            django_cache.delete(cache_key)
@@ -0,0 +1,86 @@
+import logging
+from functools import cached_property
+
+from ..models import Message, PolicyVersion
+from .company_service import CompanyService
+from .session_service import SessionService
+from .whatsapp_service import WhatsAppService
+
+logger = logging.getLogger(__name__)
+
+company_service = CompanyService()
+session_service = SessionService()
+
+class MessageContext:
+    """
+    Estado de un mensaje entrante compartido por todas las etapas del pipeline.
+
+    Cada entidad (empresa, usuario, sesión, política activa, información de
+    la empresa...) se resuelve como mucho una vez por mensaje, la primera
+    vez que una etapa la necesita.
+    """
+
+    def __init__(self, event, remote_addr=None, default_whatsapp=None, companies=None, users=None):
+        self.event = event
+        self.from_phone = event.from_phone
+        self.message_text = event.message_text
+        self.message_id = event.message_id
+        self.metadata = event.metadata
+        self.message_type = event.metadata.get("type")
+        self.button_id = event.metadata.get("button_id")
+        self.remote_addr = remote_addr
+        self.default_whatsapp = default_whatsapp or WhatsAppService()
+        self.companies = companies
+        self.users = users
+
+        self.company = None
+        self.user = None
+        self.contact_name = None
+        self.whatsapp = self.default_whatsapp
+
+    def resolve(self):
+        """
+        Obtiene empresa, usuario y servicio WhatsApp del mensaje
+
+        Returns:
+            bool: True si se pudieron obtener empresa y usuario
+        """
+        self.company, self.user, self.contact_name, self.whatsapp = company_service.get_company_user_and_whatsapp_service(
+            self.metadata, self.from_phone, self.default_whatsapp, companies=self.companies, users=self.users
+        )
+        return bool(self.company and self.user)
+
+    @cached_property
+    def session(self):
+        """Sesión activa del usuario con la empresa (se crea si no existe)"""
+        return session_service.get_or_create_session(self.user, self.company)
+
+    @cached_property
+    def policy(self):
+        """Política de privacidad activa (o None)"""
+        return PolicyVersion.objects.filter(active=True).first()
+
+    @cached_property
+    def company_info(self):
+        """Información de la empresa para el prompt de OpenAI"""
+        return company_service.get_company_info(self.company)
+
+    @cached_property
+    def is_new_conversation(self):
+        """Si el usuario no tiene mensajes previos (flag ya cargado con el usuario)"""
+        return not self.user.has_messages
+
+    def save_message(self, text, is_from_user, message_type="text"):
+        """Guarda un mensaje de la conversación en la sesión actual"""
+        return Message.objects.create(
+            company=self.company,
+            session=self.session,
+            user=self.user,
+            message_text=text,
+            message_type=message_type,
+            is_from_user=is_from_user
+        )
+
+    def send(self, text):
+        """Envía un mensaje de texto al usuario con el servicio WhatsApp de la empresa"""
+        return self.whatsapp.send_message(self.from_phone, text)
@@ -0,0 +1,112 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+class ModelStats:
+    """Latencias y errores recientes de un modelo en una tarea (ventana temporal)"""
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()  # (timestamp, latencia, ok)
+
+    def add(self, latency, ok):
+        self.samples.append((time.monotonic(), latency, ok))
+        self._prune()
+
+    def _prune(self):
+        limit = time.monotonic() - self.window
+        while self.samples and self.samples[0][0] < limit:
+            self.samples.popleft()
+
+    def summary(self):
+        """
+        Returns:
+            dict: Número de llamadas, tasa de error y latencia p90 de las correctas
+        """
+        self._prune()
+        latencies = sorted(latency for _, latency, ok in self.samples if ok)
+        count = len(self.samples)
+        errors = sum(1 for _, _, ok in self.samples if not ok)
+        return {
+            'count': count,
+            'error_rate': errors / count if count else 0.0,
+            'p90': latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))] if latencies else None,
+        }
+
+class ModelRouter:
+    """
+    Elige el modelo de cada llamada a OpenAI según la tarea.
+
+    Cada tarea tiene una lista de modelos (OPENAI_MODEL_ROUTES, o
+    Company.model_routes para una empresa): el primero es el principal y
+    los siguientes las alternativas. Un modelo con suficientes llamadas
+    recientes cuya latencia p90 supera el SLO de la tarea, o con demasiados
+    errores, pasa al final de la lista. Como las muestras caducan
+    (OPENAI_ROUTER_WINDOW), pasado ese tiempo el principal se vuelve a probar.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def routes(self, task, company=None, preferred=None):
+        """Modelos configurados para la tarea, sin repetir, en orden de preferencia"""
+        company_routes = getattr(company, 'model_routes', None) or {}
+        models = [preferred] if preferred else []
+        models += company_routes.get(task) or settings.OPENAI_MODEL_ROUTES.get(task) or [settings.OPENAI_MODEL]
+        return list(dict.fromkeys(models))
+
+    def latency_slo(self, task):
+        return settings.OPENAI_TASK_LATENCY_SLO.get(task, settings.OPENAI_LATENCY_SLO)
+
+    def is_healthy(self, task, model):
+        """Un modelo sin suficientes llamadas recientes se considera sano"""
+        with self._lock:
+            stats = self._stats.get((task, model))
+            summary = stats.summary() if stats else None
+        if not summary or summary['count'] < settings.OPENAI_ROUTER_MIN_SAMPLES:
+            return True
+        if summary['error_rate'] > settings.OPENAI_ROUTER_MAX_ERROR_RATE:
+            return False
+        return summary['p90'] is None or summary['p90'] <= self.latency_slo(task)
+
+    def candidates(self, task, company=None, preferred=None):
+        """
+        Modelos a probar para una llamada, en orden
+
+        Args:
+            task (str): Tarea ('chat', 'vision', 'language'...)
+            company (Company): Empresa con rutas propias (opcional)
+            preferred (str): Modelo configurado para esta llamada concreta, p. ej.
+                el de un ImageAnalysisPrompt (opcional, va el primero)
+
+        Returns:
+            list: Primero los modelos sanos y después el resto, cada grupo en el orden configurado
+        """
+        models = self.routes(task, company, preferred)
+        healthy = [model for model in models if self.is_healthy(task, model)]
+        if healthy and healthy[0] != models[0]:
+            logger.warning(f"Modelo '{models[0]}' fuera de SLO para '{task}'; se usa '{healthy[0]}'")
+        return healthy + [model for model in models if model not in healthy]
+
+    def record(self, task, model, latency, ok=True):
+        """Registra la duración de una llamada (ok=False si falló)"""
+        with self._lock:
+            stats = self._stats.get((task, model))
+            if stats is None:
+                stats = ModelStats(settings.OPENAI_ROUTER_WINDOW)
+                self._stats[(task, model)] = stats
+            stats.add(latency, ok)
+
+    def stats(self):
+        """Resumen por tarea y modelo de este proceso"""
+        with self._lock:
+            return {f"{task}:{model}": stats.summary() for (task, model), stats in self._stats.items()}
+
+# Router del proceso (las estadísticas son locales a cada worker)
+model_router = ModelRouter()
@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import httpx
+import openai
+from django.conf import settings
+from openai import OpenAI
+
+from .async_clients import get_async_openai_client
+from .model_router import model_router
+
+logger = logging.getLogger(__name__)
+
+# Errores que indican un problema transitorio de OpenAI (se reintentan y
+# cuentan para el circuit breaker). Los 4xx de la petición no.
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+class OpenAIUnavailableError(Exception):
+    """OpenAI no puede responder ahora: el llamador usa su respuesta de contingencia"""
+
+class CircuitOpenError(OpenAIUnavailableError):
+    """Todos los modelos de la tarea tienen el circuito abierto: no se llama a OpenAI"""
+
+class DeadlineExceededError(OpenAIUnavailableError):
+    """Se agotó el plazo total de la llamada (OPENAI_DEADLINE) entre reintentos y modelos"""
+
+class CircuitBreaker:
+    """
+    Circuit breaker por tarea y modelo.
+
+    - closed: las llamadas pasan; tras `failure_threshold` fallos seguidos se abre.
+    - open: las llamadas fallan al instante con CircuitOpenError durante
+      `reset_timeout` segundos.
+    - half_open: pasa una sola llamada de prueba; si va bien se cierra, si
+      falla se vuelve a abrir.
+    """
+
+    def __init__(self, name, failure_threshold=None, reset_timeout=None):
+        self.name = name
+        self.failure_threshold = failure_threshold or settings.OPENAI_CIRCUIT_FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout or settings.OPENAI_CIRCUIT_RESET_TIMEOUT
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Indica si se puede llamar a OpenAI ahora"""
+        with self._lock:
+            if self.state == 'open':
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = 'half_open'
+                self._probe_in_flight = False
+            if self.state == 'half_open':
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f"Circuito de OpenAI '{self.name}' cerrado de nuevo")
+            self.state = 'closed'
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def release(self):
+        """Libera la llamada de prueba sin cambiar el estado (errores que no dicen nada del servicio)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.error(f"Circuito de OpenAI '{self.name}' abierto tras {self.failures} fallos seguidos")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures}
+
+_client = None
+_task_clients = {}
+_breakers = {}
+_lock = threading.Lock()
+
+def task_timeout(task):
+    """Timeout en segundos de una tarea (OPENAI_TASK_TIMEOUTS o OPENAI_TIMEOUT)"""
+    return settings.OPENAI_TASK_TIMEOUTS.get(task, settings.OPENAI_TIMEOUT)
+
+def task_deadline(task):
+    """Plazo total en segundos de una llamada de la tarea (OPENAI_TASK_DEADLINES o OPENAI_DEADLINE)"""
+    return settings.OPENAI_TASK_DEADLINES.get(task, settings.OPENAI_DEADLINE)
+
+def get_openai_client(task='chat'):
+    """
+    Cliente OpenAI compartido del proceso con el timeout de la tarea
+
+    Todas las tareas comparten el mismo pool de conexiones keep-alive; los
+    reintentos del SDK están desactivados porque los hace call_openai.
+
+    Returns:
+        OpenAI: Cliente síncrono
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            _client = OpenAI(
+                api_key=settings.OPENAI_API_KEY,
+                max_retries=0,
+                http_client=httpx.Client(
+                    timeout=httpx.Timeout(settings.OPENAI_TIMEOUT, connect=5.0),
+                    limits=httpx.Limits(
+                        max_connections=settings.OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=settings.OPENAI_MAX_CONNECTIONS // 2
+                    )
+                )
+            )
+        client = _task_clients.get(task)
+        if client is None:
+            client = _client.with_options(timeout=task_timeout(task))
+            _task_clients[task] = client
+        return client
+
+def get_circuit_breaker(task, model=None):
+    """Circuit breaker de la tarea y el modelo (uno por proceso)"""
+    name = f"{task}:{model}" if model else task
+    with _lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name)
+            _breakers[name] = breaker
+        return breaker
+
+def _retry_delay(attempt, error):
+    """Espera antes del siguiente intento: backoff exponencial con jitter completo"""
+    delay = random.uniform(0, settings.OPENAI_RETRY_BACKOFF * (2 ** attempt))
+    # Con 429 OpenAI indica cuánto esperar
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), 10.0))
+        except ValueError:
+            pass
+    return delay
+
+def _open_circuit_error(task, models):
+    return CircuitOpenError(f"Circuito de OpenAI '{task}' abierto para {', '.join(models)}")
+
+def _deadline_error(task):
+    return DeadlineExceededError(f"Plazo de {task_deadline(task):g}s agotado para OpenAI '{task}'")
+
+def call_openai(task, request, company=None, model=None, routing=None):
+    """
+    Ejecuta una llamada a OpenAI con el modelo que elija el router, reintentos y circuit breaker
+
+    Se prueban los modelos de la tarea en el orden del router; si uno agota
+    sus reintentos o tiene el circuito abierto, se pasa al siguiente. Todo
+    ello dentro del plazo de la tarea (task_deadline): cada intento dispone
+    como máximo de lo que queda y no se reintenta si la espera lo supera.
+
+    Args:
+        task (str): Tarea ('chat', 'summary', 'language', 'vision', 'audio', 'analysis'...)
+        request (callable): Recibe el cliente y el modelo y hace la llamada, p. ej.
+            lambda client, model: client.chat.completions.create(model=model, ...)
+        company (Company): Empresa con rutas de modelos propias (opcional)
+        model (str): Modelo preferido para esta llamada (opcional)
+        routing (dict): Si se pasa, se rellena con el modelo usado ('model')
+
+    Returns:
+        La respuesta de la llamada
+
+    Raises:
+        CircuitOpenError: Si todos los modelos de la tarea tienen el circuito abierto
+        DeadlineExceededError: Si se agota el plazo de la tarea
+        openai.OpenAIError: Si falla con todos los modelos
+    """
+    models = model_router.candidates(task, company, model)
+    client = get_openai_client(task)
+    timeout = task_timeout(task)
+    deadline = time.monotonic() + task_deadline(task)
+    last_error = None
+    out_of_time = False
+    for candidate in models:
+        if time.monotonic() >= deadline:
+            out_of_time = True
+            break
+        breaker = get_circuit_breaker(task, candidate)
+        if not breaker.allow():
+            continue
+        for attempt in range(settings.OPENAI_MAX_RETRIES + 1):
+            remaining = deadline - time.monotonic()
+            started = time.monotonic()
+            try:
+                result = request(client if remaining >= timeout else client.with_options(timeout=remaining), candidate)
+            except RETRYABLE_ERRORS as e:
+                model_router.record(task, candidate, time.monotonic() - started, ok=False)
+                last_error = e
+                delay = _retry_delay(attempt, e)
+                out_of_time = time.monotonic() + delay >= deadline
+                if attempt >= settings.OPENAI_MAX_RETRIES or out_of_time:
+                    breaker.record_failure()
+                    break
+                logger.warning(f"OpenAI '{task}' ({candidate}) falló ({type(e).__name__}); reintento {attempt + 1} en {delay:.2f}s")
+                time.sleep(delay)
+            except Exception:
+                # Petición inválida o error inesperado: no dice si el servicio está disponible
+                breaker.release()
+                raise
+            else:
+                model_router.record(task, candidate, time.monotonic() - started)
+                breaker.record_success()
+                if routing is not None:
+                    routing['model'] = candidate
+                return result
+    if out_of_time:
+        raise _deadline_error(task) from last_error
+    raise last_error or _open_circuit_error(task, models)
+
+async def call_openai_async(task, request, company=None, model=None, routing=None):
+    """
+    Versión asíncrona de call_openai (cliente AsyncOpenAI del event loop)
+
+    Args:
+        request (callable): Recibe el cliente y el modelo y devuelve la corrutina de la llamada
+    """
+    models = model_router.candidates(task, company, model)
+    timeout = task_timeout(task)
+    client = get_async_openai_client().with_options(timeout=timeout, max_retries=0)
+    deadline = time.monotonic() + task_deadline(task)
+    last_error = None
+    out_of_time = False
+    for candidate in models:
+        if time.monotonic() >= deadline:
+            out_of_time = True
+            break
+        breaker = get_circuit_breaker(task, candidate)
+        if not breaker.allow():
+            continue
+        for attempt in range(settings.OPENAI_MAX_RETRIES + 1):
+            remaining = deadline - time.monotonic()
+            started = time.monotonic()
+            try:
+                result = await request(client if remaining >= timeout else client.with_options(timeout=remaining), candidate)
+            except RETRYABLE_ERRORS as e:
+                model_router.record(task, candidate, time.monotonic() - started, ok=False)
+                last_error = e
+                delay = _retry_delay(attempt, e)
+                out_of_time = time.monotonic() + delay >= deadline
+                if attempt >= settings.OPENAI_MAX_RETRIES or out_of_time:
+                    breaker.record_failure()
+                    break
+                logger.warning(f"OpenAI '{task}' ({candidate}) falló ({type(e).__name__}); reintento {attempt + 1} en {delay:.2f}s")
+                await asyncio.sleep(delay)
+            except Exception:
+                breaker.release()
+                raise
+            else:
+                model_router.record(task, candidate, time.monotonic() - started)
+                breaker.record_success()
+                if routing is not None:
+                    routing['model'] = candidate
+                return result
+    if out_of_time:
+        raise _deadline_error(task) from last_error
+    raise last_error or _open_circuit_error(task, models)
+
+def get_openai_stats():
+    """Estado de los circuitos y latencias por modelo de este proceso"""
+    with _lock:
+        breakers = dict(_breakers)
+    return {
+        'circuits': {name: breaker.stats() for name, breaker in breakers.items()},
+        'models': model_router.stats(),
+    }
@@ -1,235 +1,129 @@
+import calendar
 import logging
-from datetime import datetime, timedelta
-from decimal import Decimal
-from django.db.models import Sum, Count, F, Q
+from datetime import date, timedelta
+from django.db.models import Sum
 from django.utils import timezone
-from django.db import transaction
-from django.core.cache import cache
+from django.conf import settings
 
-from ..models import OpenAIUsageRecord, OpenAIMonthlySummary, Company
+from ..models import OpenAIDailySummary, OpenAIUsageRecord
+from .usage_buffer import usage_buffer
+from .usage_rollup_service import usage_rollup_service
 
 logger = logging.getLogger(__name__)
 
+def prompt_cache_rate(cached_tokens, input_tokens):
+    """Porcentaje de tokens de entrada servidos por la caché de prompts de OpenAI"""
+    if not input_tokens:
+        return 0
+    return round((cached_tokens or 0) / input_tokens * 100, 2)
+
 class OpenAIMetricsService:
     """Servicio para gestionar métricas de uso de OpenAI"""
     
     def record_api_usage(self, company, session, response_data):
         """
-        Registra el uso de la API de OpenAI a partir de la respuesta directa de la API
+        Registra el uso de la API de OpenAI (write-behind, ver usage_buffer)
         
         Args:
             company: Objeto Company
             session: Objeto Session opcional
-            response_data: La respuesta completa de la API de OpenAI
+            response_data: dict con 'model' y 'usage' (prompt/completion/total/cached_tokens)
+            
+        Returns:
+            OpenAIUsageRecord: Registro pendiente de guardar, o None si no hay datos de uso
         """
         try:
-            # Agregar más logs para depuración
-            logger.info(f"Intentando registrar uso de API para: {company.name}")
-            logger.info(f"Datos de respuesta: {response_data}")
-            
-            # Validar que tenemos datos de uso
-            if not response_data or not isinstance(response_data, dict) or 'usage' not in response_data:
-                logger.warning(f"No se encontraron datos de uso en la respuesta de OpenAI: {response_data}")
-                return False
-            
-            usage = response_data['usage']
-            model = response_data.get('model', 'gpt-4o-mini')
+            usage = (response_data or {}).get('usage')
+            if not usage:
+                logger.warning(f"No se encontraron datos de uso en la respuesta de OpenAI para {company.name}")
+                return None
             
-            # Mostrar información detallada de lo que vamos a registrar
-            logger.info(f"Registrando uso: Modelo={model}, Tokens={usage.get('total_tokens', 0)}")
-            
-            # Import at function level to avoid circular imports
-            from ..models import OpenAIUsageRecord
-            
-            # Crear registro de uso
-            record = OpenAIUsageRecord(
+            return usage_buffer.add(OpenAIUsageRecord(
                 company=company,
                 session=session,
-                model=model,
+                model=response_data.get('model') or 'gpt-4o-mini',
                 tokens_input=usage.get('prompt_tokens', 0),
                 tokens_output=usage.get('completion_tokens', 0),
                 tokens_total=usage.get('total_tokens', 0),
-                cached_request=False,  # Por defecto asumimos que no es cacheado
+                tokens_cached_input=usage.get('cached_tokens', 0),
+                cached_request=False,
                 timestamp=timezone.now()
-            )
-            
-            # Calcular costos antes de guardar
-            self._calculate_costs(record)
-            
-            # Guardar explícitamente
-            record.save()
-            
-            logger.info(f"✅ Registro de uso guardado exitosamente: {company.name}, {record.tokens_total} tokens, ${record.cost_total}")
-            return record
+            ))
             
         except Exception as e:
-            logger.error(f"❌ Error al registrar uso de OpenAI: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.error(f"Error al registrar uso de OpenAI: {e}", exc_info=True)
             return None
     
-    def _calculate_costs(self, record):
-        """Calcula los costos para un registro de uso"""
-        try:
-            # GPT-4o-mini precios: $0.50/1M tokens (input), $1.50/1M tokens (output)
-            # Todos los precios en dólares americanos (USD)
-            
-            # Calcular costo en dólares
-            if record.model == 'gpt-4o-mini':
-                # GPT-4o-mini precios
-                input_rate = Decimal('0.5') / Decimal('1000000')  # $0.5 por millón de tokens
-                output_rate = Decimal('1.5') / Decimal('1000000') # $1.5 por millón de tokens
-            elif record.model == 'gpt-4':
-                # GPT-4 precios
-                input_rate = Decimal('10.0') / Decimal('1000000')  # $10 por millón de tokens
-                output_rate = Decimal('30.0') / Decimal('1000000') # $30 por millón de tokens
-            elif record.model == 'gpt-4o':
-                # GPT-4o precios
-                input_rate = Decimal('5.0') / Decimal('1000000')   # $5 por millón de tokens
-                output_rate = Decimal('15.0') / Decimal('1000000') # $15 por millón de tokens
-            else:
-                # Default para modelos no especificados
-                input_rate = Decimal('0.5') / Decimal('1000000')   # $0.5 por millón de tokens
-                output_rate = Decimal('1.5') / Decimal('1000000')  # $1.5 por millón de tokens
-                
-            # Si es una solicitud cacheada, aplicamos una tarifa reducida (ej: 10% del costo normal)
-            if record.cached_request:
-                input_rate *= Decimal('0.1')
-                output_rate *= Decimal('0.1')
-                
-            # Calcular costos individuales
-            record.cost_input = Decimal(record.tokens_input) * input_rate
-            record.cost_output = Decimal(record.tokens_output) * output_rate
-            record.cost_total = record.cost_input + record.cost_output
-            
-            return True
-        except Exception as e:
-            logger.error(f"Error al calcular costos: {e}")
-            return False
-    
-    def record_cached_usage(self, company, session, tokens_input, tokens_output, tokens_total):
+    def record_cached_usage(self, company, session, tokens_input, tokens_output, tokens_total, model=None):
         """
         Registra uso de caché (sin llamada a API real)
         
         Args:
             company: Objeto Company
             session: Objeto Session opcional
-            tokens_*: Contadores de tokens
+            tokens_*: Contadores de tokens (los que habría consumido la llamada)
+            model: Modelo que habría respondido (por defecto OPENAI_MODEL)
         """
         try:
-            # Import at function level to avoid circular imports
-            from ..models import OpenAIUsageRecord
-            
-            # Crear registro de uso para caché
-            record = OpenAIUsageRecord(
+            return usage_buffer.add(OpenAIUsageRecord(
                 company=company,
                 session=session,
-                model='gpt-4o-mini',  # O el modelo que uses por defecto
+                model=model or settings.OPENAI_MODEL,
                 tokens_input=tokens_input,
                 tokens_output=tokens_output,
                 tokens_total=tokens_total,
                 cached_request=True,
                 timestamp=timezone.now()
-            )
-            
-            # Calcular costos
-            self._calculate_costs(record)
-            
-            # Guardar
-            record.save()
-            
-            logger.info(f"Registro de uso cacheado: {company.name}, {tokens_total} tokens")
-            return record
+            ))
             
         except Exception as e:
             logger.error(f"Error al registrar uso cacheado: {e}")
             return None
     
-    @transaction.atomic
     def generate_monthly_summary(self, year=None, month=None, company=None):
         """
-        Genera o actualiza resúmenes mensuales para una o todas las empresas
+        Recalcula los resúmenes diarios y mensuales de un mes desde los registros
+        
+        Los resúmenes se mantienen al guardar cada registro (usage_rollup_service):
+        esto es solo la reparación, con un único GROUP BY para todas las empresas.
         """
         try:
-            # Import at function level to avoid circular imports
-            from ..models import OpenAIUsageRecord, OpenAIMonthlySummary
-            
             # Definir período
-            current_date = timezone.now().date()
+            current_date = timezone.localdate()
             year = year or current_date.year
             month = month or current_date.month
             
-            # Definir compañías a procesar
-            companies = [company] if company else Company.objects.filter(active=True)
+            start_date = date(year, month, 1)
+            end_date = date(year, month, calendar.monthrange(year, month)[1])
             
-            # Para cada compañía, generar o actualizar su resumen mensual
-            for company in companies:
-                logger.info(f"Generando resumen mensual para {company.name}, {month}/{year}")
-                
-                # Obtener todos los registros de uso del mes para esta empresa
-                usage_records = OpenAIUsageRecord.objects.filter(
-                    company=company,
-                    timestamp__year=year,
-                    timestamp__month=month
-                )
-                
-                # Contar registros para depuración
-                record_count = usage_records.count()
-                logger.info(f"Encontrados {record_count} registros para {company.name} en {month}/{year}")
-                
-                # Agregar métricas
-                aggregated = usage_records.aggregate(
-                    total_requests=Count('id'),
-                    total_tokens_input=Sum('tokens_input'),
-                    total_tokens_output=Sum('tokens_output'),
-                    total_tokens=Sum('tokens_total'),
-                    total_cost_input=Sum('cost_input'),
-                    total_cost_output=Sum('cost_output'),
-                    total_cost=Sum('cost_total')
-                )
-                
-                # Manejar caso de no haber registros
-                if not aggregated['total_requests']:
-                    logger.info(f"No hay registros para {company.name} en {month}/{year}")
-                    continue
-                
-                # Crear o actualizar resumen mensual
-                summary, created = OpenAIMonthlySummary.objects.update_or_create(
-                    company=company,
-                    year=year,
-                    month=month,
-                    defaults={
-                        'total_requests': aggregated['total_requests'] or 0,
-                        'total_tokens_input': aggregated['total_tokens_input'] or 0,
-                        'total_tokens_output': aggregated['total_tokens_output'] or 0,
-                        'total_tokens': aggregated['total_tokens'] or 0,
-                        'total_cost_input': aggregated['total_cost_input'] or 0,
-                        'total_cost_output': aggregated['total_cost_output'] or 0,
-                        'total_cost': aggregated['total_cost'] or 0,
-                    }
-                )
-                
-                action = "Creado" if created else "Actualizado"
-                logger.info(f"{action} resumen mensual para {company.name}, {month}/{year}: {summary.total_tokens} tokens, ${summary.total_cost}")
-                
+            logger.info(f"Recalculando resúmenes de OpenAI de {month}/{year}")
+            usage_rollup_service.rebuild(start_date, end_date, company=company)
             return True
             
         except Exception as e:
-            logger.error(f"Error al generar resumen mensual: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.error(f"Error al generar resumen mensual: {e}", exc_info=True)
             return False
+    
+    def reconcile_recent_usage(self, days=None):
+        """
+        Recalcula los resúmenes de los últimos días completos
+        
+        Recoge los registros que no pasaron por usage_buffer (p. ej. guardados a mano)
+        """
+        days = days or settings.OPENAI_ROLLUP_RECONCILE_DAYS
+        yesterday = timezone.localdate() - timedelta(days=1)
+        return usage_rollup_service.rebuild(yesterday - timedelta(days=days - 1), yesterday)
             
     def get_company_usage(self, company, start_date=None, end_date=None):
         """
         Obtiene estadísticas de uso para una empresa en un período
+        
+        Se leen de los resúmenes diarios (OpenAIDailySummary), que están al día
+        y son pocas filas por empresa, así que no hace falta caché.
         """
         try:
-            # Import at function level to avoid circular imports
-            from ..models import OpenAIUsageRecord
-            
             # Definir período
-            today = timezone.now().date()
+            today = timezone.localdate()
             
             if not start_date:
                 # Por defecto, primer día del mes actual
@@ -237,27 +131,19 @@ class OpenAIMetricsService:
                 
             if not end_date:
                 end_date = today
-                
-            # Generamos una clave de caché única para estos parámetros
-            cache_key = f"company_usage_{company.id}_{start_date}_{end_date}"
-            cached_data = cache.get(cache_key)
-            if cached_data:
-                return cached_data
-                
-            # Obtener registros en el período
-            usage_records = OpenAIUsageRecord.objects.filter(
-                company=company,
-                timestamp__date__range=(start_date, end_date)
-            )
             
             # Agregar métricas
-            stats = usage_records.aggregate(
-                total_requests=Count('id'),
-                total_tokens_input=Sum('tokens_input'),
-                total_tokens_output=Sum('tokens_output'),
-                total_tokens=Sum('tokens_total'),
-                cached_requests=Count('id', filter=Q(cached_request=True)),
-                total_cost=Sum('cost_total')
+            stats = OpenAIDailySummary.objects.filter(
+                company=company,
+                date__range=(start_date, end_date)
+            ).aggregate(
+                total_requests=Sum('total_requests'),
+                total_tokens_input=Sum('total_tokens_input'),
+                total_tokens_output=Sum('total_tokens_output'),
+                total_tokens=Sum('total_tokens'),
+                total_tokens_cached_input=Sum('total_tokens_cached_input'),
+                cached_requests=Sum('cached_requests'),
+                total_cost=Sum('total_cost')
             )
             
             # Manejar caso de no haber registros
@@ -269,6 +155,8 @@ class OpenAIMetricsService:
                     'total_tokens': 0,
                     'cached_requests': 0,
                     'cached_percent': 0,
+                    'total_tokens_cached_input': 0,
+                    'prompt_cache_hit_rate': 0,
                     'total_cost': 0,
                     'start_date': start_date,
                     'end_date': end_date,
@@ -280,17 +168,20 @@ class OpenAIMetricsService:
             # Calcular porcentajes y promedios
             days_count = (end_date - start_date).days + 1
             cached_percent = (stats['cached_requests'] / stats['total_requests']) * 100 if stats['total_requests'] > 0 else 0
+            prompt_cache_hit_rate = prompt_cache_rate(stats['total_tokens_cached_input'], stats['total_tokens_input'])
             daily_avg_tokens = stats['total_tokens'] / days_count if stats['total_tokens'] else 0
             daily_avg_cost = stats['total_cost'] / days_count if stats['total_cost'] else 0
             
             # Preparar resultado
-            result = {
+            return {
                 'total_requests': stats['total_requests'] or 0,
                 'total_tokens_input': stats['total_tokens_input'] or 0,
                 'total_tokens_output': stats['total_tokens_output'] or 0,
                 'total_tokens': stats['total_tokens'] or 0,
                 'cached_requests': stats['cached_requests'] or 0,
                 'cached_percent': round(cached_percent, 2),
+                'total_tokens_cached_input': stats['total_tokens_cached_input'] or 0,
+                'prompt_cache_hit_rate': prompt_cache_hit_rate,
                 'total_cost': stats['total_cost'] or 0,
                 'start_date': start_date,
                 'end_date': end_date,
@@ -299,72 +190,70 @@ class OpenAIMetricsService:
                 'daily_avg_cost': daily_avg_cost
             }
             
-            # Guardar en caché por 15 minutos
-            cache.set(cache_key, result, 60*15)
-            
-            return result
-            
         except Exception as e:
             logger.error(f"Error al obtener estadísticas de uso: {e}")
             return {'error': str(e)}
-            
-    def get_daily_usage_data(self, company, days=30):
+    
+    def get_model_usage(self, company, start_date, end_date):
+        """
+        Desglose por modelo del uso de una empresa en un período
+        
+        Returns:
+            list: dicts con model, requests, tokens y cost, de mayor a menor coste
+        """
+        rows = OpenAIDailySummary.objects.filter(
+            company=company,
+            date__range=(start_date, end_date)
+        ).values('model').annotate(
+            requests=Sum('total_requests'),
+            tokens_input=Sum('total_tokens_input'),
+            tokens_output=Sum('total_tokens_output'),
+            tokens=Sum('total_tokens'),
+            cost=Sum('total_cost')
+        ).order_by('-cost')
+        return list(rows)
+            
+    def get_daily_usage_data(self, company, days=30, start_date=None, end_date=None):
         """
         Obtiene datos de uso diario para visualizaciones
+        
+        Args:
+            days (int): Días hasta hoy si no se indica el período
+            start_date, end_date (date): Período (opcional)
         """
         try:
-            # Import at function level to avoid circular imports
-            from ..models import OpenAIUsageRecord
-            from django.db.models.functions import TruncDate
-            
             # Definir período
-            end_date = timezone.now().date()
-            start_date = end_date - timedelta(days=days-1)
-            
-            # Generar clave de caché
-            cache_key = f"daily_usage_{company.id}_{days}"
-            cached_data = cache.get(cache_key)
-            if cached_data:
-                return cached_data
-                
-            # Preparar array de días para el período
-            date_range = []
-            current_date = start_date
-            while current_date <= end_date:
-                date_range.append(current_date)
-                current_date += timedelta(days=1)
+            end_date = end_date or timezone.localdate()
+            start_date = start_date or end_date - timedelta(days=days-1)
             
-            # Consulta para agrupar por día
-            daily_data = OpenAIUsageRecord.objects.filter(
+            # Un resumen por día y modelo: sumar los modelos de cada día
+            daily_data = OpenAIDailySummary.objects.filter(
                 company=company,
-                timestamp__date__range=(start_date, end_date)
-            ).annotate(
-                day=TruncDate('timestamp')
-            ).values('day').annotate(
-                tokens=Sum('tokens_total'),
-                cost=Sum('cost_total'),
-                requests=Count('id')
-            ).order_by('day')
+                date__range=(start_date, end_date)
+            ).values('date').annotate(
+                tokens=Sum('total_tokens'),
+                cost=Sum('total_cost'),
+                requests=Sum('total_requests')
+            ).order_by('date')
             
             # Convertir a diccionario para acceso rápido
-            daily_dict = {item['day']: item for item in daily_data}
+            daily_dict = {item['date']: item for item in daily_data}
             
             # Construir resultado con todos los días del período
             result = []
-            for day in date_range:
-                data = daily_dict.get(day, {})
+            current_date = start_date
+            while current_date <= end_date:
+                data = daily_dict.get(current_date, {})
                 result.append({
-                    'date': day,
+                    'date': current_date,
                     'tokens': data.get('tokens', 0),
                     'cost': float(data.get('cost', 0)),
                     'requests': data.get('requests', 0),
                 })
-            
-            # Guardar en caché por 15 minutos
-            cache.set(cache_key, result, 60*15)
+                current_date += timedelta(days=1)
                 
             return result
             
         except Exception as e:
             logger.error(f"Error al obtener datos de uso diario: {e}")
-            return []
\ No newline at end of file
+            return []
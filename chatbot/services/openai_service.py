@@ -1,22 +1,59 @@
 import logging
 import openai
 from django.conf import settings
+from django.core.cache import caches
 from django.utils import timezone
 
 from chatbot.models import TicketCategory
+from .async_clients import db_sync_to_async
+from .company_service import company_cache_key
+from .openai_client import OpenAIUnavailableError, call_openai, call_openai_async
+from . import knowledge_index_service
+from .token_service import estimate_messages_tokens, estimate_tokens
 
 logger = logging.getLogger(__name__)
 
+def extract_usage(response):
+    """
+    Tokens consumidos según el campo usage de una respuesta de OpenAI
+
+    Returns:
+        dict: prompt_tokens, completion_tokens, total_tokens y cached_tokens, o None si no viene
+    """
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return None
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'prompt_tokens': usage.prompt_tokens or 0,
+        'completion_tokens': usage.completion_tokens or 0,
+        'total_tokens': usage.total_tokens or 0,
+        'cached_tokens': getattr(details, 'cached_tokens', None) or 0,
+    }
+
 class OpenAIService:
     """Service for handling interactions with OpenAI's API."""
     
+    # Las respuestas de error empiezan así (no deben cachearse ni contarse como respuesta)
+    ERROR_PREFIX = "Error en el servicio"
+    
+    # Respuesta inmediata mientras OpenAI no está disponible (circuito abierto)
+    FALLBACK_REPLIES = {
+        'es': "Ahora mismo no puedo responderte. Por favor, inténtalo de nuevo en unos minutos.",
+        'en': "I can't answer right now. Please try again in a few minutes.",
+        'fr': "Je ne peux pas répondre pour le moment. Veuillez réessayer dans quelques minutes.",
+        'de': "Ich kann gerade nicht antworten. Bitte versuche es in ein paar Minuten erneut.",
+        'it': "Al momento non posso rispondere. Riprova tra qualche minuto.",
+        'pt': "Neste momento não posso responder. Por favor, tente novamente dentro de alguns minutos.",
+    }
+    
     def __init__(self):
         self.api_key = settings.OPENAI_API_KEY
         self.model = settings.OPENAI_MODEL
         openai.api_key = self.api_key
         
     def generate_response(self, message, context=None, company_info=None, is_first_message=False, 
-                         language_code='es', company=None, session=None):
+                         language_code='es', company=None, session=None, conversation_summary=None, usage=None):
         """
         Generate a response using OpenAI
         
@@ -28,173 +65,297 @@ class OpenAIService:
             language_code (str): Language code for the response
             company (Company): The company object for tracking usage
             session (Session): The session object for tracking usage
+            conversation_summary (str): Resumen de los mensajes que ya no están en el historial (opcional)
+            usage (dict): Si se pasa, se rellena con los tokens consumidos (opcional)
             
         Returns:
             str: The generated response
         """
         try:
-            # AÑADIR AQUÍ: Asegurar que company_info tiene el ID de la empresa
-            if company and (not company_info or not company_info.get('id')):
-                company_info = company_info or {}
-                company_info['id'] = company.id  # Añadir directamente el ID de la empresa
-                logger.info(f"DEBUG - Añadido ID de empresa {company.id} a company_info")
+            messages = self._build_messages(message, context, company_info, is_first_message, language_code, company,
+                                            conversation_summary)
             
-            system_prompt = self._create_system_prompt(company_info, language_code)
+            # Call the OpenAI API (el router elige el modelo de la tarea)
+            routing = {}
+            response = call_openai('chat', lambda client, model: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.7
+            ), company=company, routing=routing)
             
-            # Log language code for debugging
-            logger.info(f"Generating response in language: {language_code}")
+            # Extract the text response
+            result = response.choices[0].message.content
             
-            # Add first message indicator if needed
-            if is_first_message:
-                system_prompt += "\n\nEste es el primer mensaje del usuario. Preséntate, menciona que eres un asistente virtual y enumera brevemente las categorías de información disponibles para ayudarle."
+            # Registrar uso de la API si hay una empresa asociada
+            if company:
+                usage_data = self._record_usage(response, messages, result, company, session, routing.get('model'))
+                if usage is not None and usage_data:
+                    usage.update(usage_data)
             
-            # Start with a system message to set the context
-            messages = [
-                {
-                    "role": "system",
-                    "content": system_prompt
-                }
-            ]
+            return result
             
-            # Add conversation history if provided
-            if context:
-                for msg in context:
-                    messages.append(msg)
-            else:
-                # If no context, just add the user message
-                messages.append({"role": "user", "content": message})
+        except OpenAIUnavailableError as e:
+            logger.warning(f"{e}: respuesta de contingencia")
+            return self.fallback_reply(language_code)
+        except Exception as e:
+            logger.error(f"Error generando respuesta: {e}")
+            return f"{self.ERROR_PREFIX}: {str(e)}"
+    
+    async def generate_response_async(self, message, context=None, company_info=None, is_first_message=False,
+                                      language_code='es', company=None, session=None, conversation_summary=None,
+                                      usage=None):
+        """
+        Versión asíncrona de generate_response (AsyncOpenAI)
+        
+        El prompt y el registro de uso acceden a la base de datos, así que se
+        ejecutan en un hilo; la espera a OpenAI no bloquea el event loop.
+        
+        Returns:
+            str: The generated response
+        """
+        try:
+            messages = await db_sync_to_async(self._build_messages)(
+                message, context, company_info, is_first_message, language_code, company, conversation_summary
+            )
             
-            # Call the OpenAI API
-            from openai import OpenAI
-            client = OpenAI(api_key=self.api_key)
-            response = client.chat.completions.create(
-                model=self.model,
+            routing = {}
+            response = await call_openai_async('chat', lambda client, model: client.chat.completions.create(
+                model=model,
                 messages=messages,
                 temperature=0.7
-            )
+            ), company=company, routing=routing)
             
-            # Extract the text response
             result = response.choices[0].message.content
             
-            # Registrar uso de la API si hay una empresa asociada
             if company:
-                try:
-                    logger.info(f"DEBUG - Intentando acceder a response.usage...")
-                    
-                    # MÉTODOS PARA EXTRAER USO
-                    usage_data = None
-                    
-                    # 1. Intentar la nueva estructura mediante model_dump (APIs más nuevas)
-                    try:
-                        if hasattr(response, 'model_dump'):
-                            response_dict = response.model_dump()
-                            if isinstance(response_dict, dict) and 'usage' in response_dict:
-                                usage = response_dict['usage']
-                                usage_data = {
-                                    'prompt_tokens': usage.get('prompt_tokens', 0),
-                                    'completion_tokens': usage.get('completion_tokens', 0),
-                                    'total_tokens': usage.get('total_tokens', 0)
-                                }
-                                logger.info(f"DEBUG - Tokens encontrados con model_dump: {usage_data}")
-                    except Exception as e:
-                        logger.error(f"Error con model_dump: {e}")
-                        
-                    # 2. Acceso directo a usage como propiedad
-                    if not usage_data:
-                        try:
-                            if hasattr(response, 'usage'):
-                                usage = response.usage
-                                if hasattr(usage, 'prompt_tokens'):
-                                    usage_data = {
-                                        'prompt_tokens': usage.prompt_tokens,
-                                        'completion_tokens': usage.completion_tokens,
-                                        'total_tokens': usage.total_tokens
-                                    }
-                                    logger.info(f"DEBUG - Tokens encontrados con acceso directo: {usage_data}")
-                        except Exception as e:
-                            logger.error(f"Error con acceso directo: {e}")
-                            
-                    # 3. Método de diccionario usando to_dict o __dict__
-                    if not usage_data:
-                        try:
-                            dict_method = getattr(response, 'to_dict', None) or (lambda: response.__dict__)
-                            response_dict = dict_method()
-                            if 'usage' in response_dict:
-                                usage = response_dict['usage']
-                                usage_data = {
-                                    'prompt_tokens': usage.get('prompt_tokens', 0),
-                                    'completion_tokens': usage.get('completion_tokens', 0),
-                                    'total_tokens': usage.get('total_tokens', 0)
-                                }
-                                logger.info(f"DEBUG - Tokens encontrados con to_dict: {usage_data}")
-                        except Exception as e:
-                            logger.error(f"Error con to_dict: {e}")
-                            
-                    # 4. Si todo falla, usar estimación
-                    if not usage_data:
-                        # Hacer una estimación aproximada basada en la longitud de los mensajes y la respuesta
-                        total_input_chars = sum(len(str(m.get('content', ''))) for m in messages)
-                        total_output_chars = len(result)
-                        
-                        # Estimación: aproximadamente 4 caracteres por token
-                        estimated_input_tokens = total_input_chars // 4
-                        estimated_output_tokens = total_output_chars // 4
-                        estimated_total_tokens = estimated_input_tokens + estimated_output_tokens
-                        
-                        usage_data = {
-                            'prompt_tokens': estimated_input_tokens,
-                            'completion_tokens': estimated_output_tokens,
-                            'total_tokens': estimated_total_tokens
-                        }
-                        logger.info(f"DEBUG - Tokens estimados: {usage_data}")
-                    
-                    # Crear diccionario con datos de uso
-                    response_dict = {
-                        'id': response.id,
-                        'model': response.model,
-                        'usage': usage_data
-                    }
-                    
-                    # Registrar uso con log detallado
-                    logger.info(f"Registrando uso de OpenAI para {company.name}: {usage_data['total_tokens']} tokens")
-                    
-                    # Importar aquí para evitar circular imports
-                    from .openai_metrics_service import OpenAIMetricsService
-                    metrics_service = OpenAIMetricsService()
-                    
-                    record = metrics_service.record_api_usage(
-                        company=company, 
-                        session=session,
-                        response_data=response_dict
-                    )
-                    
-                    if record:
-                        logger.info(f"✓ Registro de uso guardado: ID={record.id}, Tokens={record.tokens_total}, Costo=${record.cost_total}")
-                    
-                except Exception as e:
-                    logger.error(f"Error registrando uso de OpenAI: {e}")
-                    import traceback
-                    logger.error(traceback.format_exc())
+                usage_data = await db_sync_to_async(self._record_usage)(
+                    response, messages, result, company, session, routing.get('model')
+                )
+                if usage is not None and usage_data:
+                    usage.update(usage_data)
             
             return result
             
+        except OpenAIUnavailableError as e:
+            logger.warning(f"{e}: respuesta de contingencia")
+            return self.fallback_reply(language_code)
         except Exception as e:
             logger.error(f"Error generando respuesta: {e}")
-            return f"Error en el servicio: {str(e)}"
+            return f"{self.ERROR_PREFIX}: {str(e)}"
+    
+    def fallback_reply(self, language_code='es'):
+        """Respuesta de contingencia en el idioma del usuario (español si no hay traducción)"""
+        return self.FALLBACK_REPLIES.get(language_code, self.FALLBACK_REPLIES['es'])
+    
+    def _build_messages(self, message, context, company_info, is_first_message, language_code, company,
+                        conversation_summary=None):
+        """
+        Construye la lista de mensajes (prompt de sistema + historial) para OpenAI
+        
+        Returns:
+            list: Mensajes en el formato de chat completions
+        """
+        # AÑADIR AQUÍ: Asegurar que company_info tiene el ID de la empresa
+        if company and (not company_info or not company_info.get('id')):
+            company_info = company_info or {}
+            company_info['id'] = company.id  # Añadir directamente el ID de la empresa
+            logger.info(f"DEBUG - Añadido ID de empresa {company.id} a company_info")
+        
+        # Con mucha información se envían solo las secciones relevantes (índice BM25)
+        knowledge_index = knowledge_index_service.get_index(company) if company else None
+        use_retrieval = knowledge_index is not None and knowledge_index.enabled
+        system_prompt = self._get_system_prompt(company_info, company, detailed=not use_retrieval)
+        
+        # Log language code for debugging
+        logger.info(f"Generating response in language: {language_code}")
+        
+        # Primero el prompt de la empresa, idéntico byte a byte en todas sus
+        # peticiones (prefijo que OpenAI puede servir desde su caché de prompts);
+        # después lo que cambia por petición: idioma, primer mensaje, resumen e historial
+        messages = [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            {
+                "role": "system",
+                "content": self._create_request_instructions(language_code, is_first_message)
+            }
+        ]
+        
+        if use_retrieval:
+            relevant_knowledge = knowledge_index.render(self._retrieval_query(message, context))
+            if relevant_knowledge:
+                messages.append({"role": "system", "content": relevant_knowledge})
+        
+        # Los mensajes antiguos que no caben en el presupuesto llegan resumidos
+        if conversation_summary:
+            messages.append({
+                "role": "system",
+                "content": f"Resumen de la conversación anterior con este usuario:\n{conversation_summary}"
+            })
+        
+        # Add conversation history if provided
+        if context:
+            for msg in context:
+                messages.append(msg)
+        else:
+            # If no context, just add the user message
+            messages.append({"role": "user", "content": message})
+        
+        return messages
+    
+    def summarize_conversation(self, messages, previous_summary=None, company=None, session=None):
+        """
+        Condensa mensajes antiguos de la conversación en un resumen acumulado
         
-    def _create_system_prompt(self, company_info, language_code='es'):
+        Args:
+            messages (list): Mensajes que salen del historial (formato chat completions)
+            previous_summary (str): Resumen anterior de la sesión, que se amplía
+            company (Company): Empresa a la que se imputa el uso
+            session (Session): Sesión asociada (opcional)
+            
+        Returns:
+            str: Nuevo resumen, o None si no se pudo generar
+        """
+        # Textos pegados muy largos: basta con su principio para resumirlos
+        transcript = "\n".join(
+            f"{'Usuario' if m['role'] == 'user' else 'Asistente'}: {str(m.get('content', ''))[:2000]}"
+            for m in messages
+        )
+        prompt = (
+            "Actualiza el resumen de una conversación de atención al cliente por WhatsApp. "
+            "Conserva los datos útiles para seguir atendiendo al usuario: nombre y datos de contacto, "
+            "qué necesita, incidencias o tickets abiertos, respuestas ya dadas y preferencias (incluido el idioma). "
+            "Omite saludos y cortesías. Responde solo con el resumen, en frases breves.\n\n"
+            f"Resumen anterior:\n{previous_summary or '(ninguno)'}\n\n"
+            f"Mensajes nuevos:\n{transcript}"
+        )
+        summary_messages = [{"role": "user", "content": prompt}]
+        
+        try:
+            routing = {}
+            response = call_openai('summary', lambda client, model: client.chat.completions.create(
+                model=model,
+                messages=summary_messages,
+                temperature=0.2,
+                max_tokens=settings.CONTEXT_SUMMARY_MAX_TOKENS
+            ), company=company, routing=routing)
+            summary = (response.choices[0].message.content or '').strip()
+            
+            if company:
+                self._record_usage(response, summary_messages, summary, company, session, routing.get('model'))
+            
+            return summary or None
+            
+        except Exception as e:
+            logger.error(f"Error resumiendo la conversación: {e}")
+            return None
+    
+    def _record_usage(self, response, messages, result, company, session, model=None):
+        """
+        Registra el uso de tokens de una respuesta de OpenAI
+        
+        Args:
+            response: Respuesta de chat completions
+            messages (list): Mensajes enviados (para estimar si no hay usage)
+            result (str): Texto generado
+            company (Company): Empresa a la que se imputa el uso
+            session (Session): Sesión asociada (opcional)
+            model (str): Modelo elegido por el router (por defecto el que indica la respuesta)
+            
+        Returns:
+            dict: Tokens registrados (prompt, completion, total, cached) y modelo, o None si falla
+        """
+        try:
+            usage_data = extract_usage(response)
+            if usage_data is None:
+                # Sin usage en la respuesta (proxies, stubs): estimación local
+                prompt_tokens = estimate_messages_tokens(messages, model or self.model)
+                completion_tokens = estimate_tokens(result or '', model or self.model)
+                usage_data = {
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': completion_tokens,
+                    'total_tokens': prompt_tokens + completion_tokens,
+                    'cached_tokens': 0,
+                }
+            
+            # Importar aquí para evitar circular imports
+            from .openai_metrics_service import OpenAIMetricsService
+            model = model or getattr(response, 'model', None)
+            OpenAIMetricsService().record_api_usage(
+                company=company,
+                session=session,
+                response_data={'model': model, 'usage': usage_data}
+            )
+            return {**usage_data, 'model': model}
+            
+        except Exception as e:
+            logger.error(f"Error registrando uso de OpenAI: {e}", exc_info=True)
+            return None
+        
+    def _get_system_prompt(self, company_info, company=None, detailed=True):
+        """
+        Prompt de sistema de la empresa, en caché por empresa y versión de contenido
+        
+        No depende del idioma ni del usuario, así que es el mismo texto para
+        todas las peticiones de la empresa. Sin empresa no hay versión con la
+        que invalidarlo, así que se compila siempre.
+        
+        Args:
+            detailed (bool): Incluir el contenido de todas las secciones (False
+                cuando se envían solo las relevantes a cada consulta)
+        
+        Returns:
+            str: El prompt de sistema
+        """
+        if not company:
+            return self._create_system_prompt(company_info, detailed)
+        
+        cache = caches[settings.SYSTEM_PROMPT_CACHE]
+        cache_key = company_cache_key(company, "system_prompt", "full" if detailed else "compact")
+        system_prompt = cache.get(cache_key)
+        if system_prompt is None:
+            system_prompt = self._create_system_prompt(company_info, detailed)
+            cache.set(cache_key, system_prompt, settings.SYSTEM_PROMPT_CACHE_TTL)
+        return system_prompt
+    
+    def _retrieval_query(self, message, context):
+        """Texto con el que se buscan las secciones relevantes: la pregunta y los últimos mensajes del usuario"""
+        recent = [m['content'] for m in (context or []) if m.get('role') == 'user'][-3:]
+        if message and message not in recent:
+            recent.append(message)
+        return "\n".join(str(text) for text in recent)
+    
+    def _create_request_instructions(self, language_code='es', is_first_message=False):
+        """
+        Instrucciones que cambian en cada petición (idioma y primer mensaje)
+        
+        Returns:
+            str: Mensaje de sistema que va tras el prompt de la empresa
+        """
+        # Instrucción clara de idioma
+        instructions = f"INSTRUCCIÓN IMPORTANTE: Traduce tu respuesta al siguiente codigo ISO / lenguage: '{language_code}'. Adapta tu tono y estilo a este idioma.\n"
+        instructions += "Si te solicitan un cambio de idioma a mitad de conversación, cambialo y traduce tu respuesta al nuevo idioma solicitado."
+        
+        # Add first message indicator if needed
+        if is_first_message:
+            instructions += "\n\nEste es el primer mensaje del usuario. Preséntate, menciona que eres un asistente virtual y enumera brevemente las categorías de información disponibles para ayudarle."
+        
+        return instructions
+    
+    def _create_system_prompt(self, company_info, detailed=True):
         """
         Create a system prompt based on company information
         
         Args:
             company_info (dict): Information about the company
+            detailed (bool): Incluir el contenido de todas las categorías o solo su lista
                 
         Returns:
             str: The system prompt
         """
-        # Instrucción clara de idioma
-        prompt = f"INSTRUCCIÓN IMPORTANTE: Traduce tu respuesta al siguiente codigo ISO / lenguage: '{language_code}'. Adapta tu tono y estilo a este idioma.\n"
-        prompt += "Si te solicitan un cambio de idioma a mitad de conversación, cambialo y traduce tu respuesta al nuevo idioma solicitado.\n\n"
+        prompt = ""
     
         if not company_info:
             return "Eres un asistente virtual que ayuda a los clientes con sus consultas."
@@ -274,32 +435,35 @@ class OpenAIService:
             for category in all_categories:
                 prompt += f"- {category['title']}\n"
         
-        # 2. Luego añadir secciones detalladas
-        prompt += "\n\n--- INFORMACIÓN DETALLADA POR CATEGORÍA ---\n"
-        
-        # 2.1 Información general
-        info_categories = [c for c in all_categories if c['type'] == 'info']
-        if info_categories:
-            prompt += "\n### INFORMACIÓN GENERAL ###\n"
-            for category in info_categories:
-                prompt += f"\n#### {category['title']} ####\n{category['content']}\n"
-        
-        # 2.2 Categorías de tickets/problemas
-        ticket_categories = [c for c in all_categories if c['type'] == 'ticket']
-        if ticket_categories:
-            prompt += "\n### REPORTES DE PROBLEMAS Y DESPERFECTOS ###\n"
-            prompt += "Puedes ayudar a reportar problemas o desperfectos en las siguientes categorías:\n\n"
+        # 2. Luego añadir secciones detalladas (o se indica que llegan aparte)
+        if not detailed:
+            prompt += "\n\nEn cada consulta recibirás aparte la información detallada de las categorías relevantes para ella.\n"
+        else:
+            prompt += "\n\n--- INFORMACIÓN DETALLADA POR CATEGORÍA ---\n"
+        
+            # 2.1 Información general
+            info_categories = [c for c in all_categories if c['type'] == 'info']
+            if info_categories:
+                prompt += "\n### INFORMACIÓN GENERAL ###\n"
+                for category in info_categories:
+                    prompt += f"\n#### {category['title']} ####\n{category['content']}\n"
+        
+            # 2.2 Categorías de tickets/problemas
+            ticket_categories = [c for c in all_categories if c['type'] == 'ticket']
+            if ticket_categories:
+                prompt += "\n### REPORTES DE PROBLEMAS Y DESPERFECTOS ###\n"
+                prompt += "Puedes ayudar a reportar problemas o desperfectos en las siguientes categorías:\n\n"
             
-            for category in ticket_categories:
-                prompt += f"#### {category['title']} ####\n{category['content']}\n\n"
+                for category in ticket_categories:
+                    prompt += f"#### {category['title']} ####\n{category['content']}\n\n"
             
-            # Instrucciones para categorías que requieren fotos 
-            photo_categories = [c['name'] for c in ticket_categories_data if c.get('ask_for_photos')]
-            if photo_categories:
-                categories_str = ", ".join([f"'{cat}'" for cat in photo_categories])
-                prompt += f"\nPara reportes de {categories_str}, solicita amablemente al usuario "
-                prompt += "que envíe fotos del problema para facilitar su evaluación. Que envie fotos a este mismo chat.\n"
-                prompt += "Las fotos son muy útiles para diagnosticar correctamente el problema.\n"
+                # Instrucciones para categorías que requieren fotos 
+                photo_categories = [c['name'] for c in ticket_categories_data if c.get('ask_for_photos')]
+                if photo_categories:
+                    categories_str = ", ".join([f"'{cat}'" for cat in photo_categories])
+                    prompt += f"\nPara reportes de {categories_str}, solicita amablemente al usuario "
+                    prompt += "que envíe fotos del problema para facilitar su evaluación. Que envie fotos a este mismo chat.\n"
+                    prompt += "Las fotos son muy útiles para diagnosticar correctamente el problema.\n"
         
         # Añadir instrucciones especiales
         prompt += "\n\n--- INSTRUCCIONES ESPECIALES ---\n"
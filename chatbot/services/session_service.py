@@ -1,8 +1,10 @@
 import logging
+from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
 from ..models import Session
 from .conversation_analysis_service import ConversationAnalysisService
+from .context_store import get_context_store, session_context_key
 
 logger = logging.getLogger(__name__)
 
@@ -84,7 +86,7 @@ class SessionService:
                 count += 1
             
             if count > 0:
-                logger.info(f"Finalizadas y analizadas {count} sesiones inactivas (> {minutes} minutos)")
+                logger.info(f"Finalizadas {count} sesiones inactivas (> {minutes} minutos)")
             
             return count
             
@@ -105,6 +107,9 @@ class SessionService:
             session.save()
             logger.info(f"Sesión {session.id} finalizada")
         
+        # El historial de la sesión ya no se usará: liberar el almacén de contexto
+        get_context_store().delete(session_context_key(session.id))
+        
         # SOLO enviar solicitud de feedback si:
         # 1. La sesión estaba activa antes (se está cerrando ahora)
         # 2. No se ha enviado un mensaje de despedida previamente
@@ -121,7 +126,6 @@ class SessionService:
                     return
                 
                 # Crear WhatsApp service
-                from django.conf import settings
                 from .whatsapp_service import WhatsAppService
                 
                 whatsapp_service = WhatsAppService(
@@ -163,15 +167,12 @@ class SessionService:
         elif session.farewell_message_sent:
             logger.info(f"No se envía feedback para sesión {session.id} porque ya se procesó anteriormente")
         
-        # Ejecutar análisis de la conversación (siempre, independientemente del estado)
+        # El análisis de la conversación se hace en el lote nocturno (analysis_batch_service);
+        # sin lotes, se analiza aquí (siempre, independientemente del estado)
+        if settings.ANALYSIS_BATCH_ENABLED:
+            return
         try:
-            # Analizar la sesión
-            analysis = self.analysis_service.analyze_session(session)
-            
-            # Si hay análisis, guardarlo en la sesión
-            if analysis:
-                session.analysis_results = analysis
-                session.save()
+            if self.analysis_service.analyze_session(session):
                 logger.info(f"Análisis completado y guardado para sesión {session.id}")
                 
         except Exception as e:
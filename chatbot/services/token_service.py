@@ -0,0 +1,61 @@
+import math
+import re
+
+# Bytes UTF-8 por token aproximados por familia de modelo (prefijo del nombre).
+# El vocabulario o200k (gpt-4o, o1, o3...) trocea menos que cl100k (gpt-4, gpt-3.5).
+MODEL_BYTES_PER_TOKEN = {
+    'gpt-4o': 4.2,
+    'o1': 4.2,
+    'o3': 4.2,
+    'gpt-4': 3.8,
+    'gpt-3.5': 3.8,
+}
+DEFAULT_BYTES_PER_TOKEN = 3.8
+
+# Tokens fijos por mensaje (rol y delimitadores) y por respuesta
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+# Palabras y signos sueltos: el BPE casi nunca une un signo con la palabra vecina
+_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+
+def bytes_per_token(model=None):
+    """Ratio bytes/token del modelo (el prefijo más largo que coincida)"""
+    if model:
+        for prefix in sorted(MODEL_BYTES_PER_TOKEN, key=len, reverse=True):
+            if model.startswith(prefix):
+                return MODEL_BYTES_PER_TOKEN[prefix]
+    return DEFAULT_BYTES_PER_TOKEN
+
+def estimate_tokens(text, model=None):
+    """
+    Estima los tokens de un texto sin llamar a la API
+
+    Cada palabra o signo cuenta al menos un token y las piezas largas se
+    trocean según el ratio del modelo; se mide en bytes UTF-8 para que las
+    tildes y los emojis cuenten más, como en el tokenizador real.
+
+    Args:
+        text (str): Texto a medir
+        model (str): Modelo de OpenAI (por defecto, ratio genérico)
+
+    Returns:
+        int: Tokens estimados
+    """
+    if not text:
+        return 0
+    ratio = bytes_per_token(model)
+    return sum(max(1, math.ceil(len(piece.encode('utf-8')) / ratio)) for piece in _PIECE_RE.findall(str(text)))
+
+def estimate_message_tokens(message, model=None):
+    """Tokens estimados de un mensaje de chat completions (contenido + rol)"""
+    return MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message.get('content'), model)
+
+def estimate_messages_tokens(messages, model=None):
+    """
+    Tokens estimados de una lista de mensajes de chat completions
+
+    Returns:
+        int: Tokens estimados del prompt completo
+    """
+    return REPLY_PRIMING_TOKENS + sum(estimate_message_tokens(message, model) for message in messages)
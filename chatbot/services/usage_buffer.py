@@ -0,0 +1,157 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections, transaction
+
+from ..models import OpenAIUsageRecord
+from .usage_rollup_service import usage_rollup_service
+
+logger = logging.getLogger(__name__)
+
+class UsageBuffer:
+    """
+    Buffer write-behind de registros de uso de OpenAI.
+
+    Los registros se acumulan en memoria y se insertan con un único
+    bulk_create cuando hay `max_size` pendientes o el más antiguo lleva
+    `flush_interval` segundos esperando, y en la misma transacción se suman
+    a los resúmenes diarios y mensuales (usage_rollup_service). Un hilo en segundo plano vacía el
+    buffer cuando deja de haber tráfico y al terminar el proceso se vacía
+    lo que quede. Si la inserción falla por un error transitorio de la BD
+    (conexión, bloqueo), los registros vuelven al buffer (hasta 10 veces
+    `max_size`) para el siguiente intento; con cualquier otro error se
+    guardan uno a uno y se descartan los que fallan (p. ej. de una sesión ya
+    borrada), para que un registro inválido no bloquee los demás.
+    """
+
+    def __init__(self, max_size=None, flush_interval=None):
+        self.max_size = max_size or settings.USAGE_BUFFER_MAX_SIZE
+        self.flush_interval = flush_interval or settings.USAGE_BUFFER_FLUSH_INTERVAL
+        self._records = []
+        self._first_added_at = None
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def add(self, record):
+        """
+        Añade un registro sin guardar (los costes se calculan aquí, bulk_create no llama a save)
+
+        Returns:
+            OpenAIUsageRecord: El mismo registro (con su id ya asignado)
+        """
+        if not settings.USAGE_BUFFER_ENABLED:
+            with transaction.atomic():
+                record.save()
+                usage_rollup_service.apply([record])
+            return record
+
+        record.calculate_costs()
+        with self._lock:
+            if not self._records:
+                self._first_added_at = time.monotonic()
+            self._records.append(record)
+            due = self._is_due()
+        self._ensure_flusher()
+
+        if due:
+            self.flush()
+        return record
+
+    def _is_due(self):
+        return bool(self._records) and (
+            len(self._records) >= self.max_size
+            or time.monotonic() - self._first_added_at >= self.flush_interval
+        )
+
+    def pending(self):
+        """Número de registros pendientes de guardar"""
+        with self._lock:
+            return len(self._records)
+
+    def flush(self):
+        """
+        Guarda los registros pendientes con un único bulk_create y actualiza los resúmenes
+
+        Returns:
+            int: Registros guardados
+        """
+        with self._lock:
+            records, self._records = self._records, []
+        if not records:
+            return 0
+
+        try:
+            self._save(records)
+        except (OperationalError, InterfaceError) as e:
+            logger.error(f"Error guardando {len(records)} registros de uso de OpenAI: {e}")
+            self._requeue(records)
+            return 0
+        except Exception as e:
+            logger.warning(f"Error guardando {len(records)} registros de uso de OpenAI, se guardan uno a uno: {e}")
+            return self._save_one_by_one(records)
+
+        logger.debug(f"Guardados {len(records)} registros de uso de OpenAI")
+        return len(records)
+
+    def _save(self, records):
+        with transaction.atomic():
+            OpenAIUsageRecord.objects.bulk_create(records, batch_size=500)
+            usage_rollup_service.apply(records)
+
+    def _save_one_by_one(self, records):
+        """Guarda cada registro en su transacción y descarta los inválidos"""
+        saved = 0
+        for index, record in enumerate(records):
+            # El bulk_create revertido pudo asignar ids
+            record.pk = None
+            record._state.adding = True
+            try:
+                self._save([record])
+                saved += 1
+            except (OperationalError, InterfaceError) as e:
+                logger.error(f"Error guardando registros de uso de OpenAI: {e}")
+                self._requeue(records[index:])
+                break
+            except Exception as e:
+                logger.error(
+                    f"Registro de uso de OpenAI descartado (empresa {record.company_id}, "
+                    f"sesión {record.session_id}, modelo {record.model}): {e}"
+                )
+        return saved
+
+    def _requeue(self, records):
+        with self._lock:
+            self._records = (records + self._records)[-self.max_size * 10:]
+            self._first_added_at = time.monotonic()
+
+    def _ensure_flusher(self):
+        """Arranca (una vez por proceso) el hilo que vacía el buffer sin tráfico"""
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="usage-buffer-flusher", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            with self._lock:
+                due = self._is_due()
+            if not due:
+                continue
+            # Hilo propio: descartar conexiones caducadas como al empezar/terminar una petición
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+# Buffer del proceso
+usage_buffer = UsageBuffer()
+
+atexit.register(usage_buffer.flush)
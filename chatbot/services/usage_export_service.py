@@ -0,0 +1,156 @@
+import csv
+import json
+import zlib
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from ..models import OpenAIUsageRecord
+
+# Columnas exportadas (orden de values_list) y cabeceras del CSV
+EXPORT_FIELDS = [
+    'timestamp', 'model', 'tokens_input', 'tokens_output', 'tokens_total',
+    'tokens_cached_input', 'cached_request', 'cost_input', 'cost_output', 'cost_total',
+]
+CSV_HEADER = [
+    'Fecha', 'Hora', 'Modelo', 'Tokens Entrada', 'Tokens Salida',
+    'Total Tokens', 'Tokens Entrada Cacheados', 'Cacheado', 'Coste Entrada ($)', 'Coste Salida ($)',
+    'Coste Total ($)'
+]
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+def _gzip_compressor():
+    return zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+
+class _Echo:
+    """Destino de csv.writer que devuelve la línea en lugar de guardarla"""
+
+    def write(self, value):
+        return value
+
+class UsageExportService:
+    """
+    Exportación en streaming de los registros de uso de OpenAI de una empresa.
+
+    Los registros se leen con values_list().iterator(chunk_size) (cursor de
+    servidor en PostgreSQL) y se emiten por bloques, así que la memoria no
+    depende del número de filas. Opcionalmente se comprime en gzip al vuelo.
+    Con ASGI se usa astream (aiterator): Django consume un iterador síncrono
+    entero con sync_to_async(list) antes de enviarlo.
+    """
+
+    def __init__(self, company, start_date, end_date, chunk_size=None):
+        self.company = company
+        self.start_date = start_date
+        self.end_date = end_date
+        self.chunk_size = chunk_size or settings.USAGE_EXPORT_CHUNK_SIZE
+
+    def queryset(self):
+        """Registros del rango en orden cronológico (días locales incluidos)"""
+        start = timezone.make_aware(datetime.combine(self.start_date, time.min))
+        end = timezone.make_aware(datetime.combine(self.end_date + timedelta(days=1), time.min))
+        return OpenAIUsageRecord.objects.filter(
+            company=self.company,
+            timestamp__gte=start,
+            timestamp__lt=end
+        ).order_by('timestamp')
+
+    def rows(self):
+        """Tuplas de EXPORT_FIELDS"""
+        return self.queryset().values_list(*EXPORT_FIELDS).iterator(chunk_size=self.chunk_size)
+
+    async def arows(self):
+        """Tuplas de EXPORT_FIELDS leídas con aiterator"""
+        # values() y no values_list(): en Django 5.1 values_list().aiterator()
+        # ejecuta la consulta fuera de sync_to_async
+        async for row in self.queryset().values(*EXPORT_FIELDS).aiterator(chunk_size=self.chunk_size):
+            yield tuple(row[field] for field in EXPORT_FIELDS)
+
+    def _batched(self, lines):
+        """Agrupa líneas para no emitir un fragmento HTTP por fila"""
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= self.chunk_size:
+                yield "".join(batch)
+                batch = []
+        if batch:
+            yield "".join(batch)
+
+    def csv_lines(self, rows, header=True):
+        writer = csv.writer(_Echo())
+        if header:
+            yield writer.writerow(CSV_HEADER)
+        for timestamp, model, *values, cached, cost_input, cost_output, cost_total in rows:
+            timestamp = timezone.localtime(timestamp)
+            yield writer.writerow([
+                timestamp.strftime('%Y-%m-%d'),
+                timestamp.strftime('%H:%M:%S'),
+                model,
+                *values,
+                'Sí' if cached else 'No',
+                cost_input,
+                cost_output,
+                cost_total
+            ])
+
+    def ndjson_lines(self, rows, header=True):
+        for row in rows:
+            record = dict(zip(EXPORT_FIELDS, row))
+            record['timestamp'] = timezone.localtime(record['timestamp']).isoformat()
+            for field in ('cost_input', 'cost_output', 'cost_total'):
+                record[field] = str(record[field])
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+
+    def _encode(self, rows, export_format, header, compressor):
+        """Fragmentos de un grupo de filas (comprimidos si hay compresor)"""
+        lines_for = self.ndjson_lines if export_format == 'ndjson' else self.csv_lines
+        chunks = self._batched(lines_for(rows, header=header))
+        return self._gzip(chunks, compressor) if compressor else chunks
+
+    def stream(self, export_format='csv', compress=False):
+        """
+        Contenido de la exportación por fragmentos
+
+        Args:
+            export_format (str): 'csv' o 'ndjson'
+            compress (bool): Comprimir en gzip
+
+        Returns:
+            generator: Fragmentos str (o bytes si compress)
+        """
+        compressor = _gzip_compressor() if compress else None
+        yield from self._encode(self.rows(), export_format, True, compressor)
+        if compressor:
+            yield compressor.flush()
+
+    async def astream(self, export_format='csv', compress=False):
+        """
+        Igual que stream, pero como iterador asíncrono para servidores ASGI
+
+        Las filas se leen con aiterator y se codifican por grupos de
+        chunk_size, así que solo hay un grupo en memoria a la vez.
+        """
+        compressor = _gzip_compressor() if compress else None
+        rows, header = [], True
+        async for row in self.arows():
+            rows.append(row)
+            if len(rows) >= self.chunk_size:
+                for chunk in self._encode(rows, export_format, header, compressor):
+                    yield chunk
+                rows, header = [], False
+        for chunk in self._encode(rows, export_format, header, compressor):
+            yield chunk
+        if compressor:
+            yield compressor.flush()
+
+    def _gzip(self, chunks, compressor):
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8'))
+            if data:
+                yield data
@@ -0,0 +1,160 @@
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear, TruncDate
+from django.utils import timezone
+
+from ..models import OpenAIDailySummary, OpenAIMonthlySummary, OpenAIUsageRecord
+
+logger = logging.getLogger(__name__)
+
+# Campos acumulados de OpenAIDailySummary y cómo se agregan desde los registros
+DAILY_AGGREGATES = {
+    'total_requests': Count('id'),
+    'cached_requests': Count('id', filter=Q(cached_request=True)),
+    'total_tokens_input': Sum('tokens_input'),
+    'total_tokens_output': Sum('tokens_output'),
+    'total_tokens': Sum('tokens_total'),
+    'total_tokens_cached_input': Sum('tokens_cached_input'),
+    'total_cost_input': Sum('cost_input'),
+    'total_cost_output': Sum('cost_output'),
+    'total_cost': Sum('cost_total'),
+}
+
+# OpenAIMonthlySummary no separa las solicitudes cacheadas
+MONTHLY_FIELDS = [field for field in DAILY_AGGREGATES if field != 'cached_requests']
+
+def _record_totals(record):
+    return {
+        'total_requests': 1,
+        'cached_requests': int(record.cached_request),
+        'total_tokens_input': record.tokens_input,
+        'total_tokens_output': record.tokens_output,
+        'total_tokens': record.tokens_total,
+        'total_tokens_cached_input': record.tokens_cached_input,
+        'total_cost_input': record.cost_input,
+        'total_cost_output': record.cost_output,
+        'total_cost': record.cost_total,
+    }
+
+def _month_start(day):
+    return day.replace(day=1)
+
+def _next_month(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+class UsageRollupService:
+    """
+    Resúmenes diarios (OpenAIDailySummary) y mensuales (OpenAIMonthlySummary) del uso de OpenAI.
+
+    - apply: suma los registros recién guardados a sus resúmenes (un UPDATE
+      con F() por día/modelo y por mes). Lo llama usage_buffer en la misma
+      transacción que el bulk_create, así que los resúmenes están al día
+      en cuanto se guardan los registros.
+    - rebuild: reparación. Recalcula un rango de días con un único GROUP BY
+      sobre los registros (filtrando por timestamp, que usa el índice
+      company/timestamp) y los meses afectados desde los resúmenes diarios.
+    """
+
+    def apply(self, records):
+        """
+        Suma registros ya guardados a los resúmenes
+
+        Args:
+            records (list): OpenAIUsageRecord con los costes calculados
+        """
+        daily = defaultdict(lambda: defaultdict(int))
+        monthly = defaultdict(lambda: defaultdict(int))
+        for record in records:
+            day = timezone.localdate(record.timestamp)
+            for field, value in _record_totals(record).items():
+                daily[(record.company_id, day, record.model)][field] += value
+                if field in MONTHLY_FIELDS:
+                    monthly[(record.company_id, day.year, day.month)][field] += value
+
+        for (company_id, day, model), totals in daily.items():
+            self._increment(OpenAIDailySummary, {'company_id': company_id, 'date': day, 'model': model}, totals)
+        for (company_id, year, month), totals in monthly.items():
+            self._increment(OpenAIMonthlySummary, {'company_id': company_id, 'year': year, 'month': month}, totals)
+
+    def _increment(self, model, keys, totals):
+        updates = {field: F(field) + value for field, value in totals.items()}
+        updates['last_updated'] = timezone.now()
+        if model.objects.filter(**keys).update(**updates):
+            return
+        try:
+            with transaction.atomic():
+                model.objects.create(**keys, **totals)
+        except IntegrityError:
+            # Otro proceso acaba de crear la fila
+            model.objects.filter(**keys).update(**updates)
+
+    @transaction.atomic
+    def rebuild(self, start_date, end_date, company=None):
+        """
+        Recalcula los resúmenes de un rango de días desde los registros
+
+        Args:
+            start_date (date): Primer día (incluido)
+            end_date (date): Último día (incluido)
+            company (Company): Solo esta empresa (opcional)
+
+        Returns:
+            int: Resúmenes diarios generados
+        """
+        start = timezone.make_aware(datetime.combine(start_date, time.min))
+        end = timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min))
+        records = OpenAIUsageRecord.objects.filter(timestamp__gte=start, timestamp__lt=end)
+        summaries = OpenAIDailySummary.objects.filter(date__range=(start_date, end_date))
+        if company:
+            records = records.filter(company=company)
+            summaries = summaries.filter(company=company)
+
+        rows = records.annotate(day=TruncDate('timestamp')).values('company_id', 'day', 'model').annotate(**DAILY_AGGREGATES)
+        summaries.delete()
+        created = OpenAIDailySummary.objects.bulk_create([
+            OpenAIDailySummary(
+                company_id=row['company_id'],
+                date=row['day'],
+                model=row['model'],
+                **{field: row[field] or 0 for field in DAILY_AGGREGATES}
+            )
+            for row in rows
+        ], batch_size=500)
+
+        self._rebuild_months(_month_start(start_date), _next_month(end_date), company)
+        logger.info(f"Resúmenes de uso de OpenAI recalculados del {start_date} al {end_date}: {len(created)} diarios")
+        return len(created)
+
+    def _rebuild_months(self, start_date, end_date, company=None):
+        """Recalcula los resúmenes mensuales de [start_date, end_date) desde los diarios"""
+        daily = OpenAIDailySummary.objects.filter(date__gte=start_date, date__lt=end_date)
+        monthly = OpenAIMonthlySummary.objects.none()
+        day = start_date
+        while day < end_date:
+            monthly |= OpenAIMonthlySummary.objects.filter(year=day.year, month=day.month)
+            day = _next_month(day)
+        if company:
+            daily = daily.filter(company=company)
+            monthly = monthly.filter(company=company)
+
+        rows = daily.annotate(
+            year=ExtractYear('date'), month=ExtractMonth('date')
+        ).values('company_id', 'year', 'month').annotate(
+            **{field: Sum(field) for field in MONTHLY_FIELDS}
+        )
+        monthly.delete()
+        OpenAIMonthlySummary.objects.bulk_create([
+            OpenAIMonthlySummary(
+                company_id=row['company_id'],
+                year=row['year'],
+                month=row['month'],
+                **{field: row[field] or 0 for field in MONTHLY_FIELDS}
+            )
+            for row in rows
+        ], batch_size=500)
+
+usage_rollup_service = UsageRollupService()
@@ -1,20 +1,52 @@
 import requests
 import json
 import logging
+from dataclasses import dataclass
 from django.conf import settings
 
+from .async_clients import get_async_http_client
+
 logger = logging.getLogger(__name__)
 
+def conversation_key(phone_number_id, from_phone):
+    """Clave de buzón de una conversación: número de la empresa y número del usuario"""
+    if not phone_number_id or not from_phone:
+        return None
+    return f"{phone_number_id}:{from_phone}"
+
+@dataclass
+class WebhookMessageEvent:
+    """Mensaje entrante extraído de un webhook de WhatsApp"""
+    from_phone: str
+    message_text: str
+    message_id: str
+    metadata: dict
+    timestamp: str = None
+    
+    @property
+    def conversation_key(self):
+        """Identifica el buzón de la conversación (empresa + usuario)"""
+        return conversation_key(self.metadata.get("phone_number_id"), self.from_phone)
+
+@dataclass
+class WebhookStatusEvent:
+    """Actualización de estado (sent, delivered, read, failed) de un mensaje enviado"""
+    status_id: str
+    status: str
+    recipient_id: str
+    phone_number_id: str
+    timestamp: str = None
+
 class WhatsAppService:
     """Service for handling WhatsApp messages."""
     
-    BASE_URL = "https://graph.facebook.com/v22.0"
-    
     def __init__(self, api_token=None, phone_number_id=None):
         # Si se proporcionan credenciales de WhatsApp en settings, se utilizan
         # de lo contrario, se utilizan las credenciales de la empresa
         self.api_token = api_token or settings.WHATSAPP_API_TOKEN
         self.phone_number_id = phone_number_id or settings.WHATSAPP_PHONE_NUMBER_ID
+        # Configurable para apuntar a un servidor simulado (manage.py load_test)
+        self.base_url = settings.WHATSAPP_GRAPH_API_URL
         
     def _get_headers(self):
         """Get headers for the API request."""
@@ -34,7 +66,7 @@ class WhatsAppService:
         Returns:
             dict: The API response or None if error
         """
-        endpoint = f"{self.BASE_URL}/{self.phone_number_id}/messages"
+        endpoint = f"{self.base_url}/{self.phone_number_id}/messages"
         
         payload = {
             "messaging_product": "whatsapp",
@@ -74,6 +106,54 @@ class WhatsAppService:
             logger.error(f"Exception sending message: {str(e)}")
             return None
         
+    async def send_message_async(self, to_phone, message_text):
+        """
+        Versión asíncrona de send_message (httpx.AsyncClient compartido)
+        
+        Args:
+            to_phone (str): Recipient's phone number
+            message_text (str): The message to send
+        
+        Returns:
+            dict: The API response or None if error
+        """
+        endpoint = f"{self.base_url}/{self.phone_number_id}/messages"
+        
+        payload = {
+            "messaging_product": "whatsapp",
+            "recipient_type": "individual",
+            "to": to_phone,
+            "type": "text",
+            "text": {
+                "body": message_text
+            }
+        }
+        
+        try:
+            response = await get_async_http_client().post(
+                endpoint,
+                headers=self._get_headers(),
+                content=json.dumps(payload)
+            )
+            
+            if response.status_code == 200:
+                return response.json()
+            
+            error_data = response.json()
+            logger.error(f"Error sending message to {to_phone}: {response.status_code} {response.reason_phrase}")
+            logger.error(f"Error response: {error_data}")
+            
+            if response.status_code == 401:
+                error_obj = error_data.get("error", {})
+                if error_obj.get("code") == 190 and error_obj.get("error_subcode") == 463:
+                    logger.critical("WhatsApp TOKEN EXPIRED! Please generate a new token in Meta Developer Portal")
+            
+            return None
+            
+        except Exception as e:
+            logger.error(f"Exception sending message: {str(e)}")
+            return None
+        
     def send_interactive_message(self, phone_number, body_text, buttons, header_text=None, footer_text=None):
         """
         Envía un mensaje interactivo con botones
@@ -138,7 +218,7 @@ class WhatsAppService:
         
         try:
             # Usar el mismo endpoint y encabezados que se utilizan para enviar mensajes normales
-            endpoint = f"{self.BASE_URL}/{self.phone_number_id}/messages"
+            endpoint = f"{self.base_url}/{self.phone_number_id}/messages"
             
             headers = {
                 "Content-Type": "application/json",
@@ -180,10 +260,102 @@ class WhatsAppService:
             return True
         return False
     
+    def iter_webhook_events(self, body):
+        """
+        Recorre todos los eventos de un webhook de WhatsApp
+        
+        Meta puede agrupar varias entradas, cambios, mensajes y estados en un
+        mismo POST, así que se recorren todos en el orden del payload.
+        
+        Args:
+            body (dict): The webhook event body
+            
+        Yields:
+            WebhookMessageEvent | WebhookStatusEvent: Un evento por cada mensaje procesable y cada estado
+        """
+        for entry in body.get("entry", []) or []:
+            for change in entry.get("changes", []) or []:
+                value = change.get("value", {}) or {}
+                
+                # Extraer el phone_number_id para identificar la empresa
+                phone_number_id = value.get("metadata", {}).get("phone_number_id")
+                
+                for status in value.get("statuses", []) or []:
+                    yield WebhookStatusEvent(
+                        status_id=status.get("id"),
+                        status=status.get("status"),
+                        recipient_id=status.get("recipient_id"),
+                        phone_number_id=phone_number_id,
+                        timestamp=status.get("timestamp")
+                    )
+                
+                contacts = value.get("contacts", []) or []
+                for message in value.get("messages", []) or []:
+                    try:
+                        event = self._parse_message(message, phone_number_id, contacts)
+                    except Exception as e:
+                        logger.error(f"Error parsing webhook message: {e}", exc_info=True)
+                        continue
+                    if event:
+                        yield event
+    
+    def split_webhook_by_conversation(self, body):
+        """
+        Divide un webhook en un payload por conversación
+        
+        Mantiene la estructura entry/changes/value de Meta para que cada parte
+        se procese igual que un webhook completo. Los mensajes de una misma
+        conversación conservan su orden; los estados van en una parte sin clave.
+        
+        Args:
+            body (dict): The webhook event body
+            
+        Returns:
+            list: Tuplas (conversation_key, body) en el orden del payload
+        """
+        parts = {}
+        
+        def add(key, entry, change, value, field, items, contacts=None):
+            part = parts.setdefault(key, {"object": body.get("object"), "entry": []})
+            part_value = {k: v for k, v in value.items() if k not in ("messages", "statuses", "contacts")}
+            part_value[field] = items
+            if contacts:
+                part_value["contacts"] = contacts
+            part["entry"].append({
+                "id": entry.get("id"),
+                "changes": [{"field": change.get("field"), "value": part_value}]
+            })
+        
+        for entry in body.get("entry", []) or []:
+            for change in entry.get("changes", []) or []:
+                value = change.get("value", {}) or {}
+                phone_number_id = value.get("metadata", {}).get("phone_number_id")
+                
+                statuses = value.get("statuses", []) or []
+                if statuses:
+                    add(None, entry, change, value, "statuses", statuses)
+                
+                # Agrupar los mensajes de este cambio por remitente, respetando el orden
+                by_sender = {}
+                for message in value.get("messages", []) or []:
+                    by_sender.setdefault(message.get("from"), []).append(message)
+                
+                contacts = value.get("contacts", []) or []
+                for from_phone, messages in by_sender.items():
+                    sender_contacts = [c for c in contacts if c.get("wa_id") == from_phone] or contacts
+                    add(conversation_key(phone_number_id, from_phone), entry, change, value, "messages", messages, sender_contacts)
+        
+        if not parts:
+            return [(None, body)]
+        return list(parts.items())
+    
     def parse_webhook_message(self, body):
         """
         Parse an incoming webhook message from WhatsApp
         
+        Solo devuelve el primer mensaje del payload; para procesar todos los
+        mensajes de un webhook agrupado usar iter_webhook_events.
+        
         Args:
             body (dict): The webhook event body
             
@@ -192,128 +364,134 @@ class WhatsAppService:
                    metadata contains additional information like button_id for interactive messages
         """
         try:
-            entry = body.get("entry", [])
-            if not entry:
-                return None, None, None, None
+            for event in self.iter_webhook_events(body):
+                if isinstance(event, WebhookMessageEvent):
+                    return event.from_phone, event.message_text, event.message_id, event.metadata
+            return None, None, None, None
+        
+        except Exception as e:
+            logger.error(f"Error parsing webhook message: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            return None, None, None, None
+    
+    def _parse_message(self, message, phone_number_id, contacts):
+        """
+        Convierte un mensaje del webhook en un WebhookMessageEvent
+        
+        Args:
+            message (dict): Mensaje tal como llega en value.messages
+            phone_number_id (str): ID del número de WhatsApp de la empresa
+            contacts (list): Contactos incluidos en el mismo cambio
             
-            changes = entry[0].get("changes", [])
-            if not changes:
-                return None, None, None, None
+        Returns:
+            WebhookMessageEvent: El evento, o None si el tipo de mensaje no se procesa
+        """
+        from_phone = message.get("from")
+        message_id = message.get("id")
+        message_type = message.get("type")
+        
+        # En un lote puede haber mensajes de varios usuarios: quedarse con su contacto
+        sender_contacts = [c for c in contacts if c.get("wa_id") == from_phone] or contacts
+        
+        # Objeto para información adicional
+        metadata = {
+            "phone_number_id": phone_number_id,
+            "type": message_type,
+            "contacts": sender_contacts
+        }
+        
+        def build(text):
+            return WebhookMessageEvent(
+                from_phone=from_phone,
+                message_text=text,
+                message_id=message_id,
+                metadata=metadata,
+                timestamp=message.get("timestamp")
+            )
+        
+        # Procesar según el tipo de mensaje
+        if message_type == "text":
+            # Mensaje de texto normal
+            text = message.get("text", {}).get("body")
+            logger.info(f"Received text message from {from_phone}: {text}")
+            return build(text)
+            
+        elif message_type == "interactive":
+            # Mensaje interactivo (respuesta a botones)
+            interactive = message.get("interactive", {})
+            interactive_type = interactive.get("type")
+            
+            if interactive_type == "button_reply":
+                button_reply = interactive.get("button_reply", {})
+                button_id = button_reply.get("id")
+                button_title = button_reply.get("title")
+                
+                logger.info(f"Received button reply from {from_phone}: {button_title} (ID: {button_id})")
+                metadata["button_id"] = button_id
+                metadata["button_title"] = button_title
+                
+                # Devolver el ID del botón como mensaje
+                return build(f"BUTTON:{button_id}")
+                
+            elif interactive_type == "list_reply":
+                list_reply = interactive.get("list_reply", {})
+                list_id = list_reply.get("id")
+                list_title = list_reply.get("title")
+                
+                logger.info(f"Received list selection from {from_phone}: {list_title} (ID: {list_id})")
+                metadata["list_id"] = list_id
+                metadata["list_title"] = list_title
+                
+                # Devolver el ID de la lista como mensaje
+                return build(f"LIST:{list_id}")
+                
+            else:
+                logger.info(f"Received unsupported interactive type: {interactive_type}")
+                return None
+                
+        elif message_type == "audio":
+            # Procesar mensaje de audio
+            audio = message.get("audio", {})
+            audio_id = audio.get("id")
             
-            value = changes[0].get("value", {})
+            if not audio_id:
+                logger.error(f"Mensaje de audio sin ID recibido de {from_phone}")
+                return None
             
-            if "statuses" in value:
-                logger.info("Received a status update, not a message")
-                return None, None, None, None
+            logger.info(f"Mensaje de audio recibido de {from_phone}, ID: {audio_id}")
             
-            # Extraer el phone_number_id para identificar la empresa
-            phone_number_id = value.get("metadata", {}).get("phone_number_id")
+            # Añadir ID del audio a los metadatos
+            metadata["audio_id"] = audio_id
             
-            messages = value.get("messages", [])
+            # Devolver información básica para el mensaje de audio
+            return build("[Audio Message]")
+        
+        elif message_type == "image":
+            # Procesar mensaje de imagen
+            image_data = message.get("image", {})
+            media_id = image_data.get("id")
+            caption = image_data.get("caption", "")
             
-            if not messages:
-                return None, None, None, None
+            if not media_id:
+                logger.error(f"Mensaje de imagen sin ID recibido de {from_phone}")
+                return None
             
-            message = messages[0]
-            from_phone = message.get("from")
-            message_id = message.get("id")
-            message_type = message.get("type")
+            logger.info(f"Mensaje de imagen recibido de {from_phone}, ID: {media_id}, Caption: {caption}")
             
-            # Objeto para información adicional
-            metadata = {
-                "phone_number_id": phone_number_id,
-                "type": message_type,
-                "contacts": value.get("contacts", [])
+            # Añadir información de la imagen a los metadatos
+            metadata["image"] = {
+                "id": media_id,
+                "caption": caption
             }
             
-            # Procesar según el tipo de mensaje
-            if message_type == "text":
-                # Mensaje de texto normal
-                text = message.get("text", {}).get("body")
-                logger.info(f"Received text message from {from_phone}: {text}")
-                return from_phone, text, message_id, metadata
-                
-            elif message_type == "interactive":
-                # Mensaje interactivo (respuesta a botones)
-                interactive = message.get("interactive", {})
-                interactive_type = interactive.get("type")
-                
-                if interactive_type == "button_reply":
-                    button_reply = interactive.get("button_reply", {})
-                    button_id = button_reply.get("id")
-                    button_title = button_reply.get("title")
-                    
-                    logger.info(f"Received button reply from {from_phone}: {button_title} (ID: {button_id})")
-                    metadata["button_id"] = button_id
-                    metadata["button_title"] = button_title
-                    
-                    # Devolver el ID del botón como mensaje
-                    return from_phone, f"BUTTON:{button_id}", message_id, metadata
-                    
-                elif interactive_type == "list_reply":
-                    list_reply = interactive.get("list_reply", {})
-                    list_id = list_reply.get("id")
-                    list_title = list_reply.get("title")
-                    
-                    logger.info(f"Received list selection from {from_phone}: {list_title} (ID: {list_id})")
-                    metadata["list_id"] = list_id
-                    metadata["list_title"] = list_title
-                    
-                    # Devolver el ID de la lista como mensaje
-                    return from_phone, f"LIST:{list_id}", message_id, metadata
-                    
-                else:
-                    logger.info(f"Received unsupported interactive type: {interactive_type}")
-                    return None, None, None, None
-                    
-            elif message_type == "audio":
-                # Procesar mensaje de audio
-                audio = message.get("audio", {})
-                audio_id = audio.get("id")
-                
-                if not audio_id:
-                    logger.error(f"Mensaje de audio sin ID recibido de {from_phone}")
-                    return None, None, None, None
-                
-                logger.info(f"Mensaje de audio recibido de {from_phone}, ID: {audio_id}")
+            # Devolver información para el mensaje de imagen
+            return build(caption or "[Imagen]")
                 
-                # Añadir ID del audio a los metadatos
-                metadata["audio_id"] = audio_id
-                
-                # Devolver información básica para el mensaje de audio
-                return from_phone, "[Audio Message]", message_id, metadata
-            
-            elif message_type == "image":
-                # Procesar mensaje de imagen
-                image_data = message.get("image", {})
-                media_id = image_data.get("id")
-                caption = image_data.get("caption", "")
-                
-                if not media_id:
-                    logger.error(f"Mensaje de imagen sin ID recibido de {from_phone}")
-                    return None, None, None, None
-                
-                logger.info(f"Mensaje de imagen recibido de {from_phone}, ID: {media_id}, Caption: {caption}")
-                
-                # Añadir información de la imagen a los metadatos
-                metadata["image"] = {
-                    "id": media_id,
-                    "caption": caption
-                }
-                
-                # Devolver información para el mensaje de imagen
-                return from_phone, caption or "[Imagen]", message_id, metadata
-                    
-            else:
-                # Otros tipos de mensajes (imagen, audio, etc.)
-                logger.info(f"Received non-text message type: {message_type}")
-                return None, None, None, None
-        
-        except Exception as e:
-            logger.error(f"Error parsing webhook message: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
-            return None, None, None, None
+        else:
+            # Otros tipos de mensajes (vídeo, ubicación, etc.)
+            logger.info(f"Received non-text message type: {message_type}")
+            return None
 
     def send_policy_acceptance_message(self, phone_number, policy):
         """
@@ -468,7 +646,7 @@ class WhatsAppService:
         """
         try:
             # URL para obtener información del recurso
-            endpoint = f"https://graph.facebook.com/v22.0/{media_id}"
+            endpoint = f"{self.base_url}/{media_id}"
             
             # Headers de autorización
             headers = {
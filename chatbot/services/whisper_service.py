@@ -4,7 +4,8 @@ import requests
 import logging
 import uuid
 from django.core.files import File
-from openai import OpenAI
+
+from .openai_client import call_openai
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +14,6 @@ class WhisperService:
         # Obtener la API key de las variables de entorno o settings
         from django.conf import settings
         self.api_key = api_key or getattr(settings, 'OPENAI_API_KEY', None)
-        self.client = OpenAI(api_key=self.api_key)
     
     def process_whatsapp_audio(self, message, audio_id, company):
         """
@@ -80,20 +80,24 @@ class WhisperService:
                     audio_message.audio_file.save(file_name, File(f))
                 
                 # 4. Transcribir el audio con Whisper
+                # Se pasa el contenido (no el fichero abierto) para poder reintentar la subida
                 with open(temp_path, 'rb') as audio_file:
-                    # Llamar a la API de OpenAI Whisper
-                    result = self.client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=audio_file,
-                        language="es"
-                    )
-                    
-                    # Obtener el texto transcrito
-                    text = result.text
+                    audio_content = audio_file.read()
+                
+                # Llamar a la API de OpenAI Whisper
+                routing = {}
+                result = call_openai('audio', lambda client, model: client.audio.transcriptions.create(
+                    model=model,
+                    file=(os.path.basename(temp_path), audio_content),
+                    language="es"
+                ), company=company, routing=routing)
+                
+                # Obtener el texto transcrito
+                text = result.text
                     
                 # 5. Actualizar el mensaje de audio
                 audio_message.transcription = text
-                audio_message.transcription_model = "whisper-1"
+                audio_message.transcription_model = routing['model']
                 audio_message.processing_status = 'completed'
                 audio_message.save()
                 
@@ -0,0 +1,57 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Company, CompanyInfo, TicketCategory, new_knowledge_version
+
+logger = logging.getLogger(__name__)
+
+def bump_knowledge_version(company_id):
+    """
+    Asigna una versión nueva al contenido de la empresa
+
+    Los prompts e información en caché van con la versión en la clave, así
+    que las entradas anteriores dejan de usarse en todos los workers (el
+    Company que carga cada mensaje ya trae la versión nueva). Se usa update()
+    para no volver a disparar post_save. Al borrar una empresa no hace falta:
+    sus entradas ya no se pueden pedir y caducan por TTL.
+
+    Returns:
+        str: La nueva versión
+    """
+    version = new_knowledge_version()
+    Company.objects.filter(pk=company_id).update(knowledge_version=version)
+    logger.debug(f"Versión de contenido renovada para la empresa {company_id}")
+    transaction.on_commit(lambda: rebuild_knowledge_index(company_id))
+    return version
+
+def rebuild_knowledge_index(company_id):
+    """Reconstruye el índice de conocimiento fuera del camino de los mensajes"""
+    from .services import knowledge_index_service
+    
+    company = Company.objects.filter(pk=company_id).first()
+    if not company:
+        return
+    try:
+        knowledge_index_service.build_index(company)
+    except Exception as e:
+        # Si falla, se construirá con el primer mensaje que lo necesite
+        logger.error(f"Error reconstruyendo el índice de conocimiento de {company_id}: {e}")
+
+@receiver(post_save, sender=Company)
+def company_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # La instancia guardada (admin, formularios) puede seguir usándose tras el save
+    instance.knowledge_version = bump_knowledge_version(instance.pk)
+
+@receiver(post_save, sender=CompanyInfo)
+@receiver(post_delete, sender=CompanyInfo)
+@receiver(post_save, sender=TicketCategory)
+@receiver(post_delete, sender=TicketCategory)
+def company_content_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    bump_knowledge_version(instance.company_id)
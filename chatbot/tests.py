@@ -1,3 +1,956 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User as DjangoUser
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+import httpx
+import openai
+from openai.types.chat import ChatCompletion
+
+from . import views
+from .models import (
+    Company, CompanyInfo, DelayedTask, InboundWebhookEvent, Message, OpenAIDailySummary, OpenAIMonthlySummary, OpenAIUsageRecord,
+    PolicyVersion, Session, TicketCategory, User,
+)
+from .services.company_service import CompanyService
+from .services.context_store import MemoryContextStore
+from .services.dashboard_snapshot_service import DashboardSnapshotService
+from .services.conversation_service import ConversationService
+from .services.analysis_batch_service import AnalysisBatchService
+from .services.answer_cache_service import AnswerCacheService, normalize_question
+from .services.delayed_task_service import DelayedTaskService
+from .services.inbound_queue_service import InboundQueueService
+from .services import openai_client
+from .services.language_service import LanguageService
+from .services.mailbox_lock_service import MailboxLockService
+from .services.model_router import ModelRouter
+from .services.usage_buffer import UsageBuffer, usage_buffer
+from .services.usage_rollup_service import usage_rollup_service
+from .services.openai_service import OpenAIService
+from .services.whatsapp_service import WebhookMessageEvent, WhatsAppService
+
+PHONE_NUMBER_ID = "1000"
+FROM_PHONE = "34600000001"
+OTHER_PHONE = "34600000002"
+
+def webhook_body(text, message_id, from_phone=FROM_PHONE):
+    """Cuerpo de webhook de Meta con un mensaje de texto"""
+    return {"object": "whatsapp_business_account", "entry": [{"id": "waba", "changes": [{"field": "messages", "value": {
+        "metadata": {"phone_number_id": PHONE_NUMBER_ID},
+        "contacts": [{"profile": {"name": "Cliente"}, "wa_id": from_phone}],
+        "messages": [{"from": from_phone, "id": message_id, "type": "text", "text": {"body": text}}],
+    }}]}]}
+
+class MessagePipelineQueryBudgetTests(TestCase):
+    """
+    Número máximo de consultas por tipo de mensaje en el pipeline de entrada.
+
+    Cada etapa comparte el MessageContext del mensaje, así que empresa,
+    usuario, sesión y política se resuelven una sola vez. Si un cambio
+    vuelve a repetir consultas, estos presupuestos fallan.
+    """
+
+    TEXT_BUDGET = 13
+    POLICY_GATE_BUDGET = 5
+    LANGUAGE_BUTTON_BUDGET = 10
+    FEEDBACK_BUTTON_BUDGET = 4
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(
+            name="Empresa Test",
+            phone_number="34900000000",
+            whatsapp_api_token="token",
+            whatsapp_phone_number_id=PHONE_NUMBER_ID,
+        )
+        PolicyVersion.objects.create(
+            version="1.0",
+            title="Política",
+            description="Descripción",
+            privacy_policy_text="Privacidad",
+            terms_text="Términos",
+        )
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(views.conversation_service, "generate_response", return_value="Respuesta"),
+            mock.patch.object(WhatsAppService, "send_message", return_value={"messages": [{"id": "wamid.out"}]}),
+            mock.patch.object(WhatsAppService, "send_language_selection_message", return_value={}),
+            mock.patch.object(WhatsAppService, "send_policy_acceptance_message", return_value={}),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_user(self, **fields):
+        defaults = {
+            "whatsapp_number": FROM_PHONE,
+            "name": "Cliente",
+            "policies_accepted": True,
+            "policies_version": "1.0",
+            "language": "es",
+        }
+        defaults.update(fields)
+        return User.objects.create(**defaults)
+
+    def make_event(self, text, message_id="wamid.in", **metadata):
+        metadata.setdefault("type", "text")
+        metadata.update({
+            "phone_number_id": PHONE_NUMBER_ID,
+            "contacts": [{"profile": {"name": "Cliente"}, "wa_id": FROM_PHONE}],
+        })
+        return WebhookMessageEvent(FROM_PHONE, text, message_id, metadata)
+
+    def count_queries(self, event):
+        with CaptureQueriesContext(connection) as queries:
+            views.process_message_event(event)
+        return len(queries)
+
+    def test_text_message_from_returning_user(self):
+        user = self.make_user()
+        Message.objects.create(company=self.company, user=user, message_text="Hola", is_from_user=True)
+
+        num_queries = self.count_queries(self.make_event("¿Qué horario tenéis?"))
+
+        self.assertLessEqual(num_queries, self.TEXT_BUDGET)
+        self.assertEqual(Message.objects.filter(user=user).count(), 3)
+
+    def test_policy_gate_for_new_user(self):
+        num_queries = self.count_queries(self.make_event("Hola"))
+
+        self.assertLessEqual(num_queries, self.POLICY_GATE_BUDGET)
+        user = User.objects.get(whatsapp_number=FROM_PHONE)
+        self.assertTrue(user.waiting_policy_acceptance)
+        self.assertEqual(user.pending_message_text, "Hola")
+
+    def test_language_button(self):
+        user = self.make_user(language=None)
+
+        event = self.make_event("Español", type="interactive", button_id="lang_es")
+        num_queries = self.count_queries(event)
+
+        self.assertLessEqual(num_queries, self.LANGUAGE_BUTTON_BUDGET)
+        user.refresh_from_db()
+        self.assertEqual(user.language, "es")
+        self.assertTrue(user.has_messages)
+
+    def test_feedback_button_without_recent_session(self):
+        user = self.make_user()
+        Message.objects.create(company=self.company, user=user, message_text="Hola", is_from_user=True)
+
+        event = self.make_event("👍", type="interactive", button_id="positive")
+        num_queries = self.count_queries(event)
+
+        self.assertLessEqual(num_queries, self.FEEDBACK_BUTTON_BUDGET)
+
+
+class WebhookRetryTests(TestCase):
+
+    def test_failed_image_event_is_processed_again_on_retry(self):
+        Company.objects.create(
+            name="Empresa Test", phone_number="34900000000", whatsapp_api_token="token", whatsapp_phone_number_id=PHONE_NUMBER_ID
+        )
+        PolicyVersion.objects.create(version="1.0", title="P", description="D", privacy_policy_text="P", terms_text="T")
+        User.objects.create(whatsapp_number=FROM_PHONE, name="Cliente", policies_accepted=True, policies_version="1.0", language="es")
+        event = WebhookMessageEvent(FROM_PHONE, "", "wamid.img", {
+            "type": "image",
+            "image": {"id": "media-1", "caption": "Grifo roto"},
+            "phone_number_id": PHONE_NUMBER_ID,
+            "contacts": [{"profile": {"name": "Cliente"}, "wa_id": FROM_PHONE}],
+        })
+
+        def handle_image(from_phone, media_id, **kwargs):
+            # Como handle_image_message: reclama la imagen antes de procesarla
+            views.deduplication_service.claim(f"{media_id}:{from_phone}", kind="media")
+            if handle.call_count == 1:
+                raise RuntimeError("Graph API caída")
+            return "Ticket creado"
+
+        with mock.patch.object(views.conversation_service, "handle_image_message", side_effect=handle_image) as handle, \
+                mock.patch.object(WhatsAppService, "send_message", return_value={"messages": [{"id": "wamid.out"}]}) as send:
+            with self.assertRaises(RuntimeError):
+                views.process_webhook_events([event])
+            views.process_webhook_events([event])
+
+        self.assertEqual(handle.call_count, 2)
+        self.assertEqual(send.call_args.args[1], "Ticket creado")
+
+
+class MessageBurstTests(TestCase):
+
+    def test_merged_burst_reaches_openai_once_as_a_single_turn(self):
+        Company.objects.create(
+            name="Empresa Test", phone_number="34900000000", whatsapp_api_token="token",
+            whatsapp_phone_number_id=PHONE_NUMBER_ID, message_debounce_seconds=3
+        )
+        PolicyVersion.objects.create(version="1.0", title="P", description="D", privacy_policy_text="P", terms_text="T")
+        user = User.objects.create(
+            whatsapp_number=FROM_PHONE, name="Cliente", policies_accepted=True, policies_version="1.0", language="es", has_messages=True
+        )
+        metadata = {"type": "text", "phone_number_id": PHONE_NUMBER_ID, "contacts": [{"profile": {"name": "Cliente"}, "wa_id": FROM_PHONE}]}
+        events = [
+            WebhookMessageEvent(FROM_PHONE, text, f"wamid.burst.{i}", dict(metadata))
+            for i, text in enumerate(["Hola", "quería saber", "¿abrís el sábado?"])
+        ]
+        contexts = []
+
+        def fake_generate(**kwargs):
+            contexts.append(list(kwargs["context"]))
+            return "Sí, de 9 a 14"
+
+        with mock.patch.object(views.conversation_service.openai_service, "generate_response", side_effect=fake_generate), \
+                mock.patch.object(WhatsAppService, "send_message", return_value={"messages": [{"id": "wamid.out"}]}) as send:
+            views.process_webhook_events(events)
+
+        self.assertEqual(contexts, [[{"role": "user", "content": "Hola\nquería saber\n¿abrís el sábado?"}]])
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(
+            list(Message.objects.filter(user=user, is_from_user=True).order_by("created_at").values_list("message_text", flat=True)),
+            ["Hola", "quería saber", "¿abrís el sábado?"]
+        )
+
+class AsyncWebhookTests(TransactionTestCase):
+    """Ruta asíncrona del webhook; los hilos de db_sync_to_async necesitan datos confirmados"""
+
+    def setUp(self):
+        Company.objects.create(
+            name="Empresa Test", phone_number="34900000000", whatsapp_api_token="token", whatsapp_phone_number_id=PHONE_NUMBER_ID
+        )
+        PolicyVersion.objects.create(version="1.0", title="P", description="D", privacy_policy_text="P", terms_text="T")
+        for phone in [FROM_PHONE, OTHER_PHONE]:
+            User.objects.create(
+                whatsapp_number=phone, name="Cliente", policies_accepted=True, policies_version="1.0", language="es", has_messages=True
+            )
+
+    async def test_same_conversation_is_serialised_across_payloads(self):
+        calls = []
+
+        async def slow_generate(user_id, message, **kwargs):
+            calls.append(("start", user_id, message))
+            await asyncio.sleep(0.3)
+            calls.append(("end", user_id, message))
+            return "Respuesta"
+
+        async def delayed(coroutine):
+            # El segundo mensaje llega mientras el primero sigue en OpenAI
+            await asyncio.sleep(0.05)
+            await coroutine
+
+        lock_service = MailboxLockService(backend="cache", timeout=5)
+        with mock.patch.object(views, "mailbox_lock_service", lock_service), \
+                mock.patch.object(views.conversation_service, "generate_response_async", side_effect=slow_generate), \
+                mock.patch.object(WhatsAppService, "send_message_async", return_value={"messages": [{"id": "wamid.out"}]}), \
+                mock.patch.object(lock_service, "_cache_acquire", wraps=lock_service._cache_acquire) as cache_acquire:
+            await asyncio.gather(
+                views.process_webhook_payload_async(webhook_body("primero", "wamid.1")),
+                delayed(views.process_webhook_payload_async(webhook_body("segundo", "wamid.2"))),
+                views.process_webhook_payload_async(webhook_body("otro", "wamid.3", from_phone=OTHER_PHONE)),
+            )
+
+        same_conversation = [(step, message) for step, user_id, message in calls if user_id == FROM_PHONE]
+        self.assertEqual(same_conversation, [("start", "primero"), ("end", "primero"), ("start", "segundo"), ("end", "segundo")])
+        # La otra conversación no espera al lock de la primera
+        self.assertLess(calls.index(("start", OTHER_PHONE, "otro")), calls.index(("end", FROM_PHONE, "primero")))
+        self.assertEqual(
+            sorted(call.args[0] for call in cache_acquire.call_args_list),
+            sorted([f"{PHONE_NUMBER_ID}:{FROM_PHONE}"] * 2 + [f"{PHONE_NUMBER_ID}:{OTHER_PHONE}"])
+        )
+        self.assertEqual(len(lock_service._local_locks), 0)
+
+    @override_settings(INBOUND_QUEUE_ENABLED=False)
+    async def test_webhook_replies_through_async_openai_and_graph_api(self):
+        requests = []
+
+        def handle(request):
+            requests.append(request)
+            if request.url.host == "api.openai.com":
+                return httpx.Response(200, json={
+                    "id": "chatcmpl-1",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": "gpt-4o",
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Abrimos de 9 a 14"}}],
+                    "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110},
+                })
+            return httpx.Response(200, json={"messages": [{"id": "wamid.out"}]})
+
+        http_client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+        openai_async = openai.AsyncOpenAI(api_key="sk-test", max_retries=0, http_client=http_client)
+        with mock.patch.object(openai_client, "_breakers", {}), \
+                mock.patch.object(openai_client, "get_async_openai_client", return_value=openai_async), \
+                mock.patch("chatbot.services.whatsapp_service.get_async_http_client", return_value=http_client):
+            response = await self.async_client.post(
+                reverse("webhook"), json.dumps(webhook_body("¿Abrís el sábado?", "wamid.1")), content_type="application/json"
+            )
+        await http_client.aclose()
+        await sync_to_async(usage_buffer.flush)()
+
+        self.assertEqual(response.status_code, 200)
+        openai_request, graph_request = requests
+        self.assertEqual(json.loads(openai_request.content)["messages"][-1], {"role": "user", "content": "¿Abrís el sábado?"})
+        self.assertEqual(str(graph_request.url), f"{settings.WHATSAPP_GRAPH_API_URL}/{PHONE_NUMBER_ID}/messages")
+        sent = json.loads(graph_request.content)
+        self.assertEqual((sent["to"], sent["text"]["body"]), (FROM_PHONE, "Abrimos de 9 a 14"))
+        saved = [
+            (message.message_text, message.is_from_user)
+            async for message in Message.objects.filter(user__whatsapp_number=FROM_PHONE).order_by("created_at")
+        ]
+        self.assertEqual(saved, [("¿Abrís el sábado?", True), ("Abrimos de 9 a 14", False)])
+        self.assertEqual(await OpenAIUsageRecord.objects.acount(), 1)
+
+
+class DelayedTaskServiceTests(TestCase):
+    HANDLER = "chatbot.services.feedback_service.send_delayed_feedback_request"
+
+    def setUp(self):
+        self.service = DelayedTaskService(visibility_timeout=60, max_attempts=3, retry_backoff=1)
+
+    def test_schedule_is_idempotent(self):
+        first, created = self.service.schedule("feedback_request", {"session_id": "s1", "phone_number": "1"}, idempotency_key="feedback_request:s1")
+        again, created_again = self.service.schedule("feedback_request", {"session_id": "s1", "phone_number": "1"}, idempotency_key="feedback_request:s1")
+
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(first.pk, again.pk)
+        self.assertEqual(DelayedTask.objects.count(), 1)
+
+    def test_failed_task_is_retried_and_expired_lease_is_reclaimed(self):
+        delayed_task, _ = self.service.schedule("feedback_request", {"session_id": "s1", "phone_number": "1"})
+
+        with mock.patch(self.HANDLER, side_effect=RuntimeError("Graph API caída")):
+            self.assertEqual(self.service.run_due("worker-1"), 0)
+        delayed_task.refresh_from_db()
+        self.assertEqual(delayed_task.status, "pending")
+        self.assertEqual(delayed_task.attempts, 1)
+
+        # Un worker que muere tras reclamarla no la pierde: vuelve al expirar el plazo
+        DelayedTask.objects.filter(pk=delayed_task.pk).update(available_at=timezone.now())
+        self.assertEqual(len(self.service.claim_due("worker-2")), 1)
+        DelayedTask.objects.filter(pk=delayed_task.pk).update(available_at=timezone.now())
+
+        with mock.patch(self.HANDLER) as handler:
+            self.assertEqual(self.service.run_due("worker-3"), 1)
+        handler.assert_called_once_with(session_id="s1", phone_number="1")
+        delayed_task.refresh_from_db()
+        self.assertEqual(delayed_task.status, "done")
+        self.assertEqual(delayed_task.attempts, 3)
+
+
+class InboundQueueServiceTests(TestCase):
+
+    def setUp(self):
+        self.service = InboundQueueService(visibility_timeout=60, max_attempts=3, retry_backoff=1)
+
+    def make_available(self, event):
+        InboundWebhookEvent.objects.filter(pk=event.pk).update(available_at=timezone.now())
+
+    def test_enqueue_claim_done_and_purge(self):
+        [event] = self.service.enqueue(webhook_body("Hola", "wamid.1"))
+        self.assertEqual(event.conversation_key, f"{PHONE_NUMBER_ID}:{FROM_PHONE}")
+
+        [claimed] = self.service.claim_batch("worker-1")
+        self.assertEqual(claimed.pk, event.pk)
+        self.assertEqual((claimed.status, claimed.attempts, claimed.locked_by), ("processing", 1, "worker-1"))
+        self.assertEqual(claimed.payload["entry"][0]["changes"][0]["value"]["messages"][0]["id"], "wamid.1")
+
+        self.service.mark_done(claimed)
+        event.refresh_from_db()
+        self.assertEqual(event.status, "done")
+        self.assertIsNone(event.locked_by)
+        self.assertEqual(self.service.claim_batch("worker-1"), [])
+
+        InboundWebhookEvent.objects.filter(pk=event.pk).update(processed_at=timezone.now() - timedelta(days=8))
+        self.assertEqual(self.service.purge_processed(days=7), 1)
+        self.assertFalse(InboundWebhookEvent.objects.exists())
+
+    def test_failed_event_is_retried_after_backoff(self):
+        self.service.enqueue(webhook_body("Hola", "wamid.1"))
+        [event] = self.service.claim_batch("worker-1")
+
+        self.assertTrue(self.service.mark_failed(event, RuntimeError("Graph API caída")))
+        event.refresh_from_db()
+        self.assertEqual(event.status, "pending")
+        self.assertEqual(event.last_error, "Graph API caída")
+        self.assertGreater(event.available_at, timezone.now())
+        # Hasta que pasa el backoff no se vuelve a entregar
+        self.assertEqual(self.service.claim_batch("worker-2"), [])
+
+        self.make_available(event)
+        [retried] = self.service.claim_batch("worker-2")
+        self.assertEqual(retried.pk, event.pk)
+        self.assertEqual(retried.attempts, 2)
+
+    def test_event_goes_to_dead_letter_after_max_attempts(self):
+        self.service.enqueue(webhook_body("Hola", "wamid.1"))
+
+        results = []
+        for attempt in range(3):
+            [event] = self.service.claim_batch(f"worker-{attempt}")
+            results.append(self.service.mark_failed(event, RuntimeError("Graph API caída")))
+            self.make_available(event)
+
+        self.assertEqual(results, [True, True, False])
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), ("dead", 3))
+        self.assertEqual(self.service.claim_batch("worker-4"), [])
+
+    def test_expired_lease_is_reclaimed_by_another_worker(self):
+        self.service.enqueue(webhook_body("Hola", "wamid.1"))
+        [event] = self.service.claim_batch("worker-1")
+        # El lease sigue vigente: nadie más puede reclamarlo
+        self.assertEqual(self.service.claim_batch("worker-2"), [])
+
+        # worker-1 muere sin confirmar; al expirar el plazo vuelve a estar disponible
+        self.make_available(event)
+        [reclaimed] = self.service.claim_batch("worker-2")
+        self.assertEqual(reclaimed.pk, event.pk)
+        self.assertEqual((reclaimed.status, reclaimed.attempts, reclaimed.locked_by), ("processing", 2, "worker-2"))
+
+    def test_next_event_of_a_conversation_waits_for_the_one_in_process(self):
+        self.service.enqueue(webhook_body("Hola", "wamid.1"))
+        [first] = self.service.claim_batch("worker-1")
+        [second] = self.service.enqueue(webhook_body("¿Abrís hoy?", "wamid.2"))
+        [other] = self.service.enqueue(webhook_body("Hola", "wamid.3", from_phone=OTHER_PHONE))
+
+        # Solo se entrega la otra conversación; la segunda espera a la primera
+        claimed = self.service.claim_batch("worker-2", limit=10)
+        self.assertEqual([event.pk for event in claimed], [other.pk])
+
+        self.service.mark_done(first)
+        [head] = self.service.claim_batch("worker-2", limit=10)
+        self.assertEqual(head.pk, second.pk)
+
+
+class ConversationContextStoreTests(TestCase):
+
+    def test_memory_store_evicts_least_recently_used(self):
+        store = MemoryContextStore(max_entries=2, max_bytes=10_000, ttl=60)
+        store.set("a", [{"role": "user", "content": "1"}])
+        store.set("b", [{"role": "user", "content": "2"}])
+        store.get("a")
+        store.set("c", [{"role": "user", "content": "3"}])
+
+        self.assertIsNone(store.get("b"))
+        self.assertIsNotNone(store.get("a"))
+        stats = store.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertGreater(stats["bytes"], 0)
+
+    def test_context_is_rebuilt_from_messages_on_miss(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        user = User.objects.create(whatsapp_number=FROM_PHONE)
+        session = Session.objects.create(user=user, company=company)
+        for text, is_from_user in [("Hola", True), ("¿En qué puedo ayudarte?", False), ("¿Abrís mañana?", True)]:
+            Message.objects.create(company=company, session=session, user=user, message_text=text, is_from_user=is_from_user)
+
+        calls = []
+
+        def fake_generate(**kwargs):
+            calls.append((list(kwargs["context"]), kwargs["is_first_message"]))
+            return "Sí, de 9 a 14"
+
+        service = ConversationService(context_store=MemoryContextStore(max_entries=10, max_bytes=10_000, ttl=60))
+        with mock.patch.object(service.openai_service, "generate_response", side_effect=fake_generate):
+            service.generate_response(FROM_PHONE, "¿Abrís mañana?", company=company, session=session)
+
+        context, is_first_message = calls[0]
+        self.assertEqual([m["content"] for m in context], ["Hola", "¿En qué puedo ayudarte?", "¿Abrís mañana?"])
+        self.assertFalse(is_first_message)
+        self.assertEqual(service.get_conversation(FROM_PHONE, session)[-1], {"role": "assistant", "content": "Sí, de 9 a 14"})
+
+    def test_stale_process_history_is_rebuilt_after_another_worker_handled_the_session(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        user = User.objects.create(whatsapp_number=FROM_PHONE)
+        session = Session.objects.create(user=user, company=company)
+        workers = [ConversationService(context_store=MemoryContextStore(max_entries=10, max_bytes=10_000, ttl=60)) for _ in range(2)]
+        contexts = []
+
+        def turn(worker, text, reply):
+            # Como el pipeline: el mensaje del usuario se guarda antes y la respuesta después
+            Message.objects.create(company=company, session=session, user=user, message_text=text, is_from_user=True)
+            def fake_generate(**kwargs):
+                contexts.append([m["content"] for m in kwargs["context"]])
+                return reply
+
+            with mock.patch.object(worker.openai_service, "generate_response", side_effect=fake_generate):
+                worker.generate_response(FROM_PHONE, text, company=company, session=session)
+            Message.objects.create(company=company, session=session, user=user, message_text=reply, is_from_user=False)
+
+        turn(workers[0], "Hola", "¿En qué puedo ayudarte?")
+        turn(workers[0], "¿Abrís mañana?", "Sí, de 9 a 14")
+        turn(workers[1], "¿Y el sábado?", "No, cerramos")
+        with CaptureQueriesContext(connection) as queries:
+            turn(workers[0], "¿Y el domingo?", "Tampoco")
+
+        self.assertEqual(contexts[1], ["Hola", "¿En qué puedo ayudarte?", "¿Abrís mañana?"])
+        self.assertEqual(contexts[3], [
+            "Hola", "¿En qué puedo ayudarte?", "¿Abrís mañana?", "Sí, de 9 a 14", "¿Y el sábado?", "No, cerramos", "¿Y el domingo?"
+        ])
+        self.assertLessEqual(len([q for q in queries.captured_queries if "chatbot_message" in q["sql"]]), 4)
+
+    def test_rebuild_skips_summarized_messages_when_history_and_messages_drift(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        user = User.objects.create(whatsapp_number=FROM_PHONE)
+        session = Session.objects.create(user=user, company=company)
+        service = ConversationService(
+            context_store=MemoryContextStore(max_entries=10, max_bytes=100_000, ttl=60),
+            token_budget=200,
+            token_target=60
+        )
+        pasted = "Texto pegado muy largo sobre la avería de la caldera. " * 30
+
+        def save(text, is_from_user, message_type="text"):
+            Message.objects.create(company=company, session=session, user=user, message_text=text, is_from_user=is_from_user, message_type=message_type)
+
+        def turn(text, reply):
+            save(text, True)
+            with mock.patch.object(service.openai_service, "generate_response", return_value=reply):
+                service.generate_response(FROM_PHONE, text, company=company, session=session)
+            save(reply, False)
+
+        with mock.patch.object(service.openai_service, "summarize_conversation", return_value="Resumen"):
+            turn("Hola", "¿En qué puedo ayudarte?")
+            # Turno de imagen: el análisis está en el historial pero no en la tabla Message
+            save("Grifo roto", True, message_type="image")
+            service.add_message(FROM_PHONE, "[El usuario envió una imagen con el texto: 'Grifo roto']", session=session)
+            service.add_message(FROM_PHONE, "[He analizado tu imagen. Puedo ver: un grifo...]", is_from_user=False, session=session)
+            service.add_message(FROM_PHONE, "He creado un reporte", is_from_user=False, session=session)
+            save("He creado un reporte", False)
+            turn(pasted, "Lo revisamos")
+
+        session.refresh_from_db()
+        self.assertEqual(session.context_summary_message_count, 5)
+        self.assertEqual([m["content"] for m in service._rebuild_conversation(session)], [pasted, "Lo revisamos"])
+
+    def test_history_over_token_budget_is_folded_into_session_summary(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        user = User.objects.create(whatsapp_number=FROM_PHONE)
+        session = Session.objects.create(user=user, company=company)
+        service = ConversationService(
+            context_store=MemoryContextStore(max_entries=10, max_bytes=100_000, ttl=60),
+            token_budget=200,
+            token_target=60
+        )
+        pasted = "Texto pegado muy largo sobre la avería de la caldera. " * 30
+
+        with mock.patch.object(service.openai_service, "summarize_conversation", return_value="Avería de caldera") as summarize, \
+                mock.patch.object(service.openai_service, "generate_response", return_value="De nada") as generate:
+            service.add_message(FROM_PHONE, pasted, session=session)
+            service.add_message(FROM_PHONE, "Entendido, lo revisamos.", is_from_user=False, session=session)
+            service.generate_response(FROM_PHONE, "Gracias", company=company, session=session)
+
+        self.assertEqual(summarize.call_args.args[0][0]["content"], pasted)
+        kwargs = generate.call_args.kwargs
+        self.assertEqual(kwargs["conversation_summary"], "Avería de caldera")
+        self.assertNotIn(pasted, [m["content"] for m in kwargs["context"]])
+        session.refresh_from_db()
+        self.assertEqual(session.context_summary, "Avería de caldera")
+        self.assertEqual(session.context_summary_message_count, 1)
+
+
+class AnswerCacheTests(TestCase):
+
+    def test_repeated_context_free_question_is_answered_from_cache(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        service = ConversationService(context_store=MemoryContextStore(max_entries=10, max_bytes=10_000, ttl=60))
+
+        def fake_generate(**kwargs):
+            kwargs["usage"].update({"prompt_tokens": 1500, "completion_tokens": 80, "model": "gpt-4o"})
+            return "Abrimos de 9 a 14"
+
+        with mock.patch.object(service.openai_service, "generate_response", side_effect=fake_generate) as generate:
+            first = service.generate_response("34600000001", "¿Cuál es el horario?", company=company)
+            second = service.generate_response("34600000002", "cual es el HORARIO", company=company)
+            other_language = service.generate_response("34600000003", "¿Cuál es el horario?", language_code="en", company=company)
+        usage_buffer.flush()
+
+        self.assertEqual(first, second)
+        self.assertEqual(other_language, "Abrimos de 9 a 14")
+        self.assertEqual(generate.call_count, 2)
+        record = OpenAIUsageRecord.objects.get(company=company, cached_request=True)
+        self.assertEqual((record.model, record.tokens_total, record.cost_total), ("gpt-4o", 1580, 0))
+
+    def test_questions_differing_in_negation_preposition_or_number_do_not_share_answers(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        cache = AnswerCacheService()
+        pairs = [
+            ("¿Abrís el sábado?", "¿No abrís el sábado?"),
+            ("precio con IVA", "precio sin IVA"),
+            ("¿Cuánto cuesta 1 hora?", "¿Cuánto cuesta 2 horas?"),
+            ("Do you deliver to the office on weekends?", "Don't you deliver to the office on weekends?"),
+        ]
+        for question, other in pairs:
+            cache.set(company, "es", question, f"Respuesta a {question}", model="gpt-4o")
+            self.assertNotEqual(normalize_question(question), normalize_question(other))
+            self.assertIsNone(cache.get(company, "es", other))
+        self.assertEqual(cache.get(company, "es", "abris los sabados")["answer"], "Respuesta a ¿Abrís el sábado?")
+
+
+@override_settings(OPENAI_MAX_RETRIES=1, OPENAI_RETRY_BACKOFF=0, OPENAI_CIRCUIT_FAILURE_THRESHOLD=2)
+class OpenAIClientTests(TestCase):
+
+    def test_open_circuit_answers_with_fallback_without_calling_openai(self):
+        client = mock.Mock()
+        client.chat.completions.create.side_effect = openai.APIConnectionError(
+            request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        )
+        service = OpenAIService()
+
+        with mock.patch.object(openai_client, "_breakers", {}), \
+                mock.patch.object(openai_client, "model_router", ModelRouter()), \
+                mock.patch.object(openai_client, "get_openai_client", return_value=client):
+            for _ in range(2):
+                self.assertTrue(service.generate_response("Hola").startswith(OpenAIService.ERROR_PREFIX))
+            calls = client.chat.completions.create.call_count
+            reply = service.generate_response("Hello", language_code="en")
+
+        # Cada petición fallida se reintenta una vez; con el circuito abierto ya no se llama
+        self.assertEqual(calls, 4)
+        self.assertEqual(client.chat.completions.create.call_count, calls)
+        self.assertEqual(reply, OpenAIService.FALLBACK_REPLIES["en"])
+
+    @override_settings(
+        OPENAI_MODEL_ROUTES={"chat": ["gpt-4o", "gpt-4o-mini"]},
+        OPENAI_TASK_LATENCY_SLO={"chat": 5},
+        OPENAI_ROUTER_MIN_SAMPLES=2,
+    )
+    def test_slow_primary_model_falls_back_and_usage_records_the_chosen_model(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        router = ModelRouter()
+        router.record("chat", "gpt-4o", 12.0)
+        router.record("chat", "gpt-4o", 9.0)
+        client = mock.Mock()
+        client.chat.completions.create.return_value = ChatCompletion.model_validate({
+            "id": "chatcmpl-1",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-4o-mini-2024-07-18",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Hola"}}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110},
+        })
+
+        with mock.patch.object(openai_client, "_breakers", {}), \
+                mock.patch.object(openai_client, "model_router", router), \
+                mock.patch.object(openai_client, "get_openai_client", return_value=client):
+            reply = OpenAIService().generate_response("Hola", company=company)
+        usage_buffer.flush()
+
+        self.assertEqual(reply, "Hola")
+        self.assertEqual(client.chat.completions.create.call_args.kwargs["model"], "gpt-4o-mini")
+        self.assertEqual(OpenAIUsageRecord.objects.get(company=company).model, "gpt-4o-mini")
+
+    @override_settings(OPENAI_MODEL_ROUTES={"chat": ["gpt-4o", "gpt-4o-mini"]}, OPENAI_MAX_RETRIES=3, OPENAI_DEADLINE=1)
+    def test_deadline_bounds_retries_and_fallback_models(self):
+        client = mock.Mock()
+        client.with_options.return_value = client
+        client.chat.completions.create.side_effect = openai.APITimeoutError(
+            request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        )
+
+        with mock.patch.object(openai_client, "_breakers", {}), \
+                mock.patch.object(openai_client, "model_router", ModelRouter()), \
+                mock.patch.object(openai_client, "get_openai_client", return_value=client), \
+                mock.patch.object(openai_client, "_retry_delay", return_value=5.0):
+            reply = OpenAIService().generate_response("Hola")
+
+        # Ninguna espera de 5 s cabe en el plazo de 1 s: un intento por modelo, con el tiempo que queda
+        self.assertEqual(reply, OpenAIService.FALLBACK_REPLIES["es"])
+        self.assertEqual(client.chat.completions.create.call_count, 2)
+        self.assertLessEqual(client.with_options.call_args.kwargs["timeout"], 1)
+
+    def test_unexpected_errors_do_not_count_as_successes(self):
+        with mock.patch.object(openai_client, "_breakers", {}), \
+                mock.patch.object(openai_client, "model_router", ModelRouter()), \
+                mock.patch.object(openai_client, "get_openai_client", return_value=mock.Mock()):
+            breaker = openai_client.get_circuit_breaker("chat", settings.OPENAI_MODEL)
+            breaker.record_failure()
+            with self.assertRaises(ValueError):
+                openai_client.call_openai("chat", mock.Mock(side_effect=ValueError("respuesta inesperada")))
+
+        self.assertEqual(breaker.stats(), {"state": "closed", "failures": 1})
+
+
+class UsageBufferTests(TestCase):
+
+    def test_records_are_written_in_one_bulk_insert_with_costs_from_the_pricing_table(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        buffer = UsageBuffer(max_size=3, flush_interval=60)
+
+        def add():
+            buffer.add(OpenAIUsageRecord(
+                company=company, model="gpt-4o-2024-08-06", tokens_input=1000, tokens_output=100, tokens_total=1100
+            ))
+
+        with self.assertNumQueries(0):
+            add()
+            add()
+        with CaptureQueriesContext(connection) as queries:
+            add()
+
+        self.assertEqual(buffer.pending(), 0)
+        inserts = [q for q in queries.captured_queries if q["sql"].startswith('INSERT INTO "chatbot_openaiusagerecord"')]
+        self.assertEqual(len(inserts), 1)
+        costs = set(OpenAIUsageRecord.objects.filter(company=company).values_list("cost_total", flat=True))
+        # Tarifa de gpt-4o: $5/M de entrada y $15/M de salida
+        self.assertEqual(costs, {Decimal("0.006500")})
+
+    def test_rollups_are_incremented_on_flush_and_rebuild_reproduces_them(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        buffer = UsageBuffer(max_size=100, flush_interval=60)
+        for model, cached in [("gpt-4o-mini", False), ("gpt-4o-mini", True), ("gpt-4o", False)]:
+            buffer.add(OpenAIUsageRecord(
+                company=company, model=model, tokens_input=1000, tokens_output=100, tokens_total=1100, cached_request=cached
+            ))
+        buffer.flush()
+        buffer.add(OpenAIUsageRecord(company=company, model="gpt-4o", tokens_input=1000, tokens_output=100, tokens_total=1100))
+        buffer.flush()
+
+        def snapshot():
+            daily = {
+                s.model: (s.total_requests, s.cached_requests, s.total_tokens, s.total_cost)
+                for s in OpenAIDailySummary.objects.filter(company=company)
+            }
+            monthly = OpenAIMonthlySummary.objects.get(company=company)
+            return daily, (monthly.total_requests, monthly.total_tokens, monthly.total_cost)
+
+        incremental = snapshot()
+        self.assertEqual(incremental[0]["gpt-4o"], (2, 0, 2200, Decimal("0.013000")))
+        self.assertEqual(incremental[0]["gpt-4o-mini"], (2, 1, 2200, Decimal("0.000210")))
+        self.assertEqual(incremental[1], (4, 4400, Decimal("0.013210")))
+
+        OpenAIDailySummary.objects.update(total_requests=0)
+        today = timezone.localdate()
+        usage_rollup_service.rebuild(today, today)
+        self.assertEqual(snapshot(), incremental)
+
+
+
+class UsageBufferFailureTests(TransactionTestCase):
+    """Con commit real: las claves ajenas de SQLite y PostgreSQL se comprueban al confirmar"""
+
+    def test_dangling_foreign_key_record_is_dropped_without_blocking_the_batch(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        buffer = UsageBuffer(max_size=100, flush_interval=60)
+        for session_id in [None, uuid.uuid4(), None]:
+            buffer.add(OpenAIUsageRecord(
+                company=company, session_id=session_id, model="gpt-4o", tokens_input=1000, tokens_output=100, tokens_total=1100
+            ))
+
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(buffer.pending(), 0)
+        self.assertEqual(OpenAIUsageRecord.objects.filter(company=company).count(), 2)
+        self.assertEqual(OpenAIDailySummary.objects.get(company=company).total_requests, 2)
+
+        buffer.add(OpenAIUsageRecord(company=company, model="gpt-4o", tokens_input=1000, tokens_output=100, tokens_total=1100))
+        self.assertEqual(buffer.flush(), 1)
+
+class OpenAIDashboardTests(TestCase):
+
+    def test_company_detail_and_summary_export_read_the_daily_rollup(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        for model in ["gpt-4o-mini", "gpt-4o-mini", "gpt-4o"]:
+            usage_buffer.add(OpenAIUsageRecord(company=company, model=model, tokens_input=1000, tokens_output=100, tokens_total=1100))
+        usage_buffer.flush()
+        staff = DjangoUser.objects.create_user("staff", password="x", is_staff=True)
+        self.client.force_login(staff)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("openai_company_detail", args=[company.id]), {"period": "month"})
+            export = self.client.get(reverse("openai_export_company", args=[company.id]), {"period": "month", "type": "summary"})
+
+        self.assertFalse([q for q in queries.captured_queries if "chatbot_openaiusagerecord" in q["sql"]])
+        self.assertEqual(response.context["stats"]["total_requests"], 3)
+        self.assertEqual([row["model"] for row in response.context["model_usage"]], ["gpt-4o", "gpt-4o-mini"])
+        lines = export.content.decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn("gpt-4o-mini,2,0,2000,200,2200", lines[2])
+
+    def test_usage_export_streams_any_range_as_csv_or_gzipped_ndjson(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        now = timezone.now()
+        for days_ago in [0, 40, 400]:
+            OpenAIUsageRecord.objects.create(
+                company=company, model="gpt-4o", tokens_input=1000, tokens_output=100, tokens_total=1100,
+                timestamp=now - timedelta(days=days_ago)
+            )
+        staff = DjangoUser.objects.create_user("staff", password="x", is_staff=True)
+        self.client.force_login(staff)
+        url = reverse("openai_export_company", args=[company.id])
+        start = (timezone.localdate() - timedelta(days=60)).isoformat()
+
+        response = self.client.get(url, {"start": start, "end": timezone.localdate().isoformat()})
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith("Fecha,Hora,Modelo"))
+
+        response = self.client.get(url, {"start": start, "format": "ndjson", "gzip": "1"})
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        records = [json.loads(line) for line in gzip.decompress(b"".join(response.streaming_content)).splitlines()]
+        self.assertEqual([(r["model"], r["tokens_total"], r["cost_total"]) for r in records], [("gpt-4o", 1100, "0.006500")] * 2)
+
+    async def test_usage_export_is_streamed_asynchronously_under_asgi(self):
+        company = await Company.objects.acreate(name="Empresa", phone_number="34900000001")
+        for _ in range(5):
+            await OpenAIUsageRecord.objects.acreate(company=company, model="gpt-4o", tokens_input=1000, tokens_output=100, tokens_total=1100)
+        staff = await DjangoUser.objects.acreate(username="staff", is_staff=True)
+        await self.async_client.aforce_login(staff)
+
+        with self.settings(USAGE_EXPORT_CHUNK_SIZE=2):
+            response = await self.async_client.get(reverse("openai_export_company", args=[company.id]), {"format": "ndjson", "gzip": "1"})
+            self.assertTrue(response.is_async)
+            content = b"".join([chunk async for chunk in response.streaming_content])
+
+        records = [json.loads(line) for line in gzip.decompress(content).splitlines()]
+        self.assertEqual([r["tokens_total"] for r in records], [1100] * 5)
+
+
+class DashboardSnapshotTests(TestCase):
+
+    def test_dashboard_is_served_from_the_latest_snapshot_in_one_query(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        usage_buffer.add(OpenAIUsageRecord(company=company, model="gpt-4o", tokens_input=1000, tokens_output=100, tokens_total=1100))
+        usage_buffer.flush()
+        service = DashboardSnapshotService()
+        first = service.refresh("openai_dashboard")
+        self.assertEqual(first.payload["total_tokens"], 1100)
+        self.assertEqual(first.payload["monthly_data"][-1]["tokens"], 1100)
+
+        usage_buffer.add(OpenAIUsageRecord(company=company, model="gpt-4o", tokens_input=1000, tokens_output=100, tokens_total=1100))
+        usage_buffer.flush()
+        with self.assertNumQueries(1):
+            self.assertEqual(service.get("openai_dashboard").version, first.version)
+
+        latest = service.refresh("openai_dashboard")
+        self.assertEqual((latest.version, latest.payload["total_tokens"]), (first.version + 1, 2200))
+
+        staff = DjangoUser.objects.create_user("staff", password="x", is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(reverse("openai_dashboard"))
+        self.assertEqual(response.context["total_tokens"], 2200)
+        self.assertContains(response, f"versión {latest.version}")
+
+
+@override_settings(ANALYSIS_BATCH_BACKEND="local")
+class AnalysisBatchTests(TestCase):
+
+    def test_closed_sessions_are_analyzed_in_a_batch_and_leads_notified_once(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        user = User.objects.create(whatsapp_number=FROM_PHONE)
+        session = Session.objects.create(user=user, company=company, ended_at=timezone.now())
+        for text, from_user in [("Hola", True), ("¿En qué puedo ayudarte?", False), ("¿Qué precio tiene la reforma?", True)]:
+            Message.objects.create(company=company, user=user, session=session, message_text=text, is_from_user=from_user)
+        service = AnalysisBatchService()
+
+        with mock.patch.object(service.analysis_service.email_service, "send_lead_notification", return_value=True) as email:
+            batches = service.submit_pending()
+            self.assertEqual(service.submit_pending(), [])
+            self.assertEqual(service.poll(), 1)
+            self.assertEqual(service.poll(), 0)
+
+        self.assertEqual(len(batches), 1)
+        session.refresh_from_db()
+        self.assertEqual(session.analysis_results["purchase_interest_level"], "medio")
+        email.assert_called_once()
+        batches[0].refresh_from_db()
+        self.assertEqual((batches[0].status, batches[0].analyzed_count, batches[0].lead_count), ("completed", 1, 1))
+
+
+class LanguageDetectionTests(TestCase):
+
+    def test_confident_texts_are_detected_locally_and_the_rest_asked_to_openai(self):
+        service = LanguageService()
+
+        with mock.patch.object(service, "detect_language_with_openai", return_value={"code": "eu", "name": "euskera"}) as openai_detect:
+            self.assertEqual(service.detect_language("Hola, necesito información sobre vuestros precios")["code"], "es")
+            self.assertEqual(service.detect_language("Bonjour, je voudrais réserver une table")["code"], "fr")
+            self.assertEqual(service.detect_language("Моё отопление не работает")["code"], "ru")
+            openai_detect.assert_not_called()
+
+            detected = service.detect_language("Kaixo")
+
+        openai_detect.assert_called_once_with("Kaixo")
+        self.assertEqual((detected["code"], detected["source"]), ("eu", "openai"))
+
+
+class SystemPromptCacheTests(TestCase):
+
+    def build_prompt(self, company):
+        company_info = CompanyService().get_company_info(company)
+        return OpenAIService()._build_messages("Hola", None, company_info, False, "es", company)[0]["content"]
+
+    def test_prompt_is_cached_until_company_content_changes(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        CompanyInfo.objects.create(company=company, title="Horario", content="De 9 a 14")
+        company.refresh_from_db()
+        self.build_prompt(company)
+
+        with self.assertNumQueries(0):
+            prompt = self.build_prompt(company)
+        self.assertIn("De 9 a 14", prompt)
+
+        TicketCategory.objects.create(company=company, name="Fontanería", prompt_instructions="Pide la dirección")
+        company.refresh_from_db()
+        self.assertIn("Fontanería", self.build_prompt(company))
+
+    def test_company_prompt_is_a_stable_prefix_across_languages(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        company_info = CompanyService().get_company_info(company)
+        service = OpenAIService()
+
+        spanish = service._build_messages("Hola", None, company_info, True, "es", company)
+        english = service._build_messages("Hello", None, company_info, False, "en", company)
+
+        self.assertEqual(spanish[0], english[0])
+        self.assertIn("'en'", english[1]["content"])
+
+    def test_cached_prompt_tokens_are_recorded_at_the_discounted_rate(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        response = ChatCompletion.model_validate({
+            "id": "chatcmpl-1",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Hola"}}],
+            "usage": {
+                "prompt_tokens": 2000,
+                "completion_tokens": 100,
+                "total_tokens": 2100,
+                "prompt_tokens_details": {"cached_tokens": 1024},
+            },
+        })
+
+        OpenAIService()._record_usage(response, [], "Hola", company, None)
+        usage_buffer.flush()
+
+        record = OpenAIUsageRecord.objects.get(company=company)
+        self.assertEqual(record.tokens_cached_input, 1024)
+        # 976 tokens a $0.15/M y 1024 cacheados a $0.075/M
+        self.assertEqual(record.cost_input, Decimal("0.000223"))
+
+    @override_settings(KNOWLEDGE_RETRIEVAL_MIN_TOKENS=50, KNOWLEDGE_RETRIEVAL_TOP_K=1)
+    def test_large_knowledge_base_sends_only_relevant_sections(self):
+        company = Company.objects.create(name="Empresa", phone_number="34900000001")
+        CompanyInfo.objects.create(company=company, title="Horarios", content="Abrimos de lunes a viernes de 9 a 14. " * 10)
+        CompanyInfo.objects.create(company=company, title="Precios", content="La revisión de la caldera cuesta 60 euros. " * 10)
+        company.refresh_from_db()
+        company_info = CompanyService().get_company_info(company)
+
+        messages = OpenAIService()._build_messages("¿Cuál es vuestro horario?", None, company_info, False, "es", company)
+
+        self.assertNotIn("60 euros", messages[0]["content"])
+        self.assertIn("Precios", messages[0]["content"])
+        self.assertIn("de 9 a 14", messages[2]["content"])
+        self.assertNotIn("60 euros", messages[2]["content"])
@@ -1,9 +1,11 @@
 from django.urls import path
 from . import views
+from .views_admin import context_store_stats
 from .views_dashboard import openai_dashboard_views  # Usaremos un nombre diferente para el módulo
 
 urlpatterns = [
     path('webhook', views.webhook, name='webhook'),
+    path('context-store/stats/', context_store_stats, name='context_store_stats'),
     
     # URLs para el dashboard de OpenAI
     path('openai-dashboard/', openai_dashboard_views.OpenAIDashboardView.as_view(), name='openai_dashboard'),
@@ -1,21 +1,31 @@
+import asyncio
 import json
 import logging
+from dataclasses import replace
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.http import HttpResponse
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.core.cache import cache as django_cache  # Renombrado para evitar confusiones
 
-from .services.whatsapp_service import WhatsAppService
+from .services.whatsapp_service import WhatsAppService, WebhookMessageEvent, WebhookStatusEvent
 from .services.conversation_service import ConversationService
 from .services.company_service import CompanyService
 from .services.session_service import SessionService
-from .models import Message, Session, PolicyVersion
+from .models import Session
 from .services.message_service import MessageService
 from .services.feedback_service import FeedbackService
 from .services.policy_service import PolicyService
 from .services.whisper_service import WhisperService
 from .services.language_service import LanguageService
+from .services.inbound_queue_service import InboundQueueService
+from .services.deduplication_service import DeduplicationService
+from .services.mailbox_lock_service import MailboxLockService
+from .services.async_clients import db_sync_to_async
+from .services.message_context import MessageContext
+from .services.delayed_task_service import DelayedTaskService
 
 # Inicializa los servicios
 company_service = CompanyService()
@@ -26,12 +36,19 @@ feedback_service = FeedbackService()
 policy_service = PolicyService()
 whisper_service = WhisperService()
 language_service = LanguageService()
+inbound_queue_service = InboundQueueService()
+deduplication_service = DeduplicationService()
+mailbox_lock_service = MailboxLockService()
+delayed_task_service = DelayedTaskService()
+
+# Segundos entre el cierre de la conversación y la solicitud de feedback
+FEEDBACK_REQUEST_DELAY = 2.0
 
 logger = logging.getLogger(__name__)
 
 @csrf_exempt
 @require_http_methods(["GET", "POST"])
-def webhook(request):
+async def webhook(request):
     if request.method == "GET":
         # Verificación del webhook
         mode = request.GET.get("hub.mode")
@@ -49,747 +66,773 @@ def webhook(request):
         
     elif request.method == "POST":
         try:
-            is_feedback_flow = False; # Variable para controlar el flujo de feedback
-            
-            # Obtener el cuerpo del webhook
             body = json.loads(request.body)
-            
-            # Inicializar servicio de WhatsApp por defecto
-            default_whatsapp = WhatsAppService()
-            
-            # PASO 1: Deduplicación temprana basada en ID de mensaje
+        except ValueError as e:
+            logger.error(f"Webhook con cuerpo JSON inválido: {e}")
+            return HttpResponse('OK', status=200)
+        
+        remote_addr = request.META.get('REMOTE_ADDR', None)
+        
+        if settings.INBOUND_QUEUE_ENABLED:
+            # Guardar el payload en la cola y responder inmediatamente a Meta.
+            # Los workers (manage.py run_inbound_workers) hacen el procesamiento.
             try:
-                # Extraer datos del cuerpo del webhook
-                entry = body.get('entry', [{}])[0]
-                change = entry.get('changes', [{}])[0]
-                value = change.get('value', {})
-                
-                # Verificar si es una actualización de estado
-                if 'statuses' in value:
-                    logger.info("Recibida actualización de estado, no un mensaje")
-                    return HttpResponse('OK', status=200)
-                
-                # Verificar si hay mensajes
-                messages = value.get('messages', [])
-                if not messages:
-                    logger.info("Webhook sin mensajes")
-                    return HttpResponse('OK', status=200)
-                    
-                # Verificar ID del primer mensaje
-                message_id = messages[0].get('id')
-                if message_id:
-                    cache_key = f"processed_message_{message_id}"
-                    if django_cache.get(cache_key):  # Usar django_cache aquí
-                        logger.warning(f"Mensaje duplicado con ID: {message_id}. Ignorando.")
-                        return HttpResponse('Duplicado ignorado', status=200)
-                    
-                    # Marcar como procesado
-                    django_cache.set(cache_key, True, 60 * 60 * 24)  # Y aquí también
+                await sync_to_async(inbound_queue_service.enqueue)(body, remote_addr=remote_addr)
             except Exception as e:
-                # Si hay error en esta parte, seguir con el procesamiento normal
-                logger.error(f"Error en deduplicación inicial: {e}")
-            
-            # PASO 2: Parsear el mensaje con el servicio WhatsApp
-            from_phone, message_text, message_id, metadata = default_whatsapp.parse_webhook_message(body)
-            
-            # Si metadata es None, es probable que sea una actualización de estado u otro tipo de webhook
-            if metadata is None:
-                return HttpResponse('OK', status=200)
+                # Sin persistencia no hay garantía de procesamiento: pedir a Meta que reintente
+                logger.error(f"Error encolando webhook: {e}", exc_info=True)
+                return HttpResponse('Error', status=500)
+            return HttpResponse('OK', status=200)
+        
+        # Procesamiento dentro de la petición (cola desactivada)
+        try:
+            await process_webhook_payload_async(body, remote_addr=remote_addr)
+        except Exception as e:
+            logger.error(f"Error processing webhook: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
             
-            # Obtener empresa, usuario y servicio WhatsApp usando el método centralizado
-            company, user, contact_name, whatsapp = company_service.get_company_user_and_whatsapp_service(
-                metadata, from_phone, default_whatsapp
+        return HttpResponse('OK', status=200)
+
+def process_webhook_payload(body, remote_addr=None):
+    """
+    Procesa un payload de webhook de WhatsApp (mensajes y actualizaciones de estado)
+    
+    Se ejecuta desde los workers de la cola de entrada o, si la cola está
+    desactivada, directamente dentro de la petición del webhook. Meta agrupa
+    varias entradas, cambios y mensajes en un mismo POST cuando hay carga,
+    así que se procesan todos los eventos del payload, no solo el primero.
+    
+    Args:
+        body (dict): Cuerpo del webhook ya parseado
+        remote_addr (str): IP de origen de la petición (opcional)
+        
+    Raises:
+        Exception: Si el procesamiento falla, para que el worker pueda reintentar
+    """
+    default_whatsapp = WhatsAppService()
+    
+    events = list(default_whatsapp.iter_webhook_events(body))
+    if not events:
+        logger.info("Webhook sin mensajes ni actualizaciones de estado")
+        return
+    
+    process_webhook_events(events, remote_addr=remote_addr, default_whatsapp=default_whatsapp)
+
+def process_webhook_events(events, remote_addr=None, default_whatsapp=None):
+    """
+    Procesa un lote de eventos de webhook
+    
+    La deduplicación de todo el lote se resuelve contra el almacén compartido
+    (DeduplicationService), y las empresas y usuarios del lote se cargan con una
+    consulta cada uno. Los mensajes se procesan en el orden del payload.
+    
+    Args:
+        events (list): WebhookMessageEvent y WebhookStatusEvent
+        remote_addr (str): IP de origen de la petición (opcional)
+        default_whatsapp (WhatsAppService): Servicio por defecto (opcional)
+        
+    Raises:
+        Exception: El primer error de procesamiento, tras procesar el resto del lote
+    """
+    default_whatsapp = default_whatsapp or WhatsAppService()
+    
+    message_events, companies, users = claim_webhook_events(events)
+    
+    errors = []
+    for event in message_events:
+        try:
+            # Un solo mensaje a la vez por conversación, también entre workers y nodos
+            with mailbox_lock_service.lock(event.conversation_key):
+                process_message_event(event, remote_addr, default_whatsapp, companies=companies, users=users)
+        except Exception as e:
+            release_failed_event(event, e)
+            errors.append(e)
+    
+    if errors:
+        raise errors[0]
+
+async def process_webhook_payload_async(body, remote_addr=None):
+    """
+    Versión asíncrona de process_webhook_payload
+    
+    Las conversaciones distintas del payload se procesan concurrentemente;
+    los mensajes de una misma conversación, en orden.
+    
+    Raises:
+        Exception: Si el procesamiento falla, para que el worker pueda reintentar
+    """
+    default_whatsapp = WhatsAppService()
+    
+    events = list(default_whatsapp.iter_webhook_events(body))
+    if not events:
+        logger.info("Webhook sin mensajes ni actualizaciones de estado")
+        return
+    
+    message_events, companies, users = await db_sync_to_async(claim_webhook_events)(events)
+    
+    conversations = {}
+    for event in message_events:
+        conversations.setdefault(event.conversation_key, []).append(event)
+    
+    async def process_conversation(conversation_events):
+        errors = []
+        for event in conversation_events:
+            try:
+                async with mailbox_lock_service.lock_async(event.conversation_key):
+                    await process_message_event_async(event, remote_addr, default_whatsapp, companies=companies, users=users)
+            except Exception as e:
+                await db_sync_to_async(release_failed_event)(event, e)
+                errors.append(e)
+        return errors
+    
+    results = await asyncio.gather(*(process_conversation(items) for items in conversations.values()))
+    errors = [error for result in results for error in result]
+    if errors:
+        raise errors[0]
+
+def claim_webhook_events(events):
+    """
+    Deduplica un lote de eventos y prepara los mensajes a procesar
+    
+    Args:
+        events (list): WebhookMessageEvent y WebhookStatusEvent
+        
+    Returns:
+        tuple: (message_events, companies, users) con los mensajes nuevos ya
+               agrupados en ráfagas y las empresas/usuarios precargados
+    """
+    message_events = [e for e in events if isinstance(e, WebhookMessageEvent)]
+    status_events = [e for e in events if isinstance(e, WebhookStatusEvent)]
+    
+    # Deduplicación de todo el lote (compartida entre workers)
+    new_message_ids = deduplication_service.claim_many(
+        [e.message_id for e in message_events], kind='message'
+    )
+    new_status_keys = deduplication_service.claim_many(
+        [f"{e.status_id}:{e.status}" for e in status_events if e.status_id], kind='status'
+    )
+    
+    # Las actualizaciones de estado solo se registran
+    for event in status_events:
+        if event.status_id and f"{event.status_id}:{event.status}" not in new_status_keys:
+            logger.warning(f"Estado duplicado ({event.status_id}:{event.status}). Ignorando.")
+            continue
+        logger.info(f"Actualización de estado '{event.status}' para mensaje {event.status_id} ({event.recipient_id})")
+    
+    duplicates = [e for e in message_events if e.message_id and e.message_id not in new_message_ids]
+    for event in duplicates:
+        logger.warning(f"Mensaje duplicado ({event.message_id}). Ignorando.")
+    
+    message_events = [e for e in message_events if not e.message_id or e.message_id in new_message_ids]
+    if not message_events:
+        return [], {}, {}
+    
+    # Resolver empresas y usuarios del lote de una vez
+    companies, users = company_service.prefetch_companies_and_users(message_events)
+    
+    # Unir ráfagas de textos seguidos de un mismo usuario en un solo turno
+    message_events = merge_message_bursts(message_events, companies)
+    
+    return message_events, companies, users
+
+def release_failed_event(event, error):
+    """
+    Registra el fallo de un mensaje y libera su deduplicación para el reintento
+    
+    Además del id del mensaje (o de los de la ráfaga), una imagen reclama su
+    media_id en image_stage ('image') y en handle_image_message ('media'):
+    si no se liberan, el reintento se descartaría como imagen duplicada.
+    """
+    logger.error(f"Error procesando mensaje {event.message_id} de {event.from_phone}: {error}", exc_info=error)
+    burst = event.metadata.get("burst") or [{"message_id": event.message_id}]
+    deduplication_service.release([item["message_id"] for item in burst], kind='message')
+    
+    media_id, _ = image_media(event.metadata)
+    if event.metadata.get("type") == "image" and media_id:
+        for kind in ('image', 'media'):
+            deduplication_service.release([f"{media_id}:{event.from_phone}"], kind=kind)
+
+def merge_message_bursts(events, companies):
+    """
+    Une los mensajes de texto consecutivos de una misma conversación
+    
+    Solo se aplica a empresas con message_debounce_seconds. El evento
+    resultante lleva el texto unido (una sola llamada a OpenAI y una sola
+    respuesta) y en metadata["burst"] los mensajes originales, que se
+    guardan uno a uno.
+    
+    Args:
+        events (list): WebhookMessageEvent en orden de llegada
+        companies (dict): Empresas precargadas por phone_number_id
+        
+    Returns:
+        list: Eventos tras unir las ráfagas
+    """
+    merged = []
+    for event in events:
+        last = merged[-1] if merged else None
+        company = companies.get(event.metadata.get("phone_number_id"))
+        
+        if (last and company and company.message_debounce_seconds
+                and last.conversation_key == event.conversation_key
+                and last.metadata.get("type") == "text" and event.metadata.get("type") == "text"
+                and last.message_text and event.message_text):
+            burst = last.metadata.get("burst") or [{"message_id": last.message_id, "text": last.message_text}]
+            burst = burst + [{"message_id": event.message_id, "text": event.message_text}]
+            merged[-1] = replace(
+                last,
+                message_text="\n".join(item["text"] for item in burst),
+                message_id=event.message_id,
+                metadata={**last.metadata, "burst": burst},
+                timestamp=event.timestamp
             )
+            logger.info(f"Ráfaga de {len(burst)} mensajes de {event.from_phone} unida en un solo turno")
+        else:
+            merged.append(event)
+    
+    return merged
 
-            # Verificar si se pudo obtener la empresa y usuario
-            if not company:
-                return HttpResponse('OK', status=200)
-                
-            if not user:
-                return HttpResponse('OK', status=200)
-            
-            # Obtener o crear la sesión activa
-            session = session_service.get_or_create_session(user, company)
-            
-            # PASO 3: Procesamiento específico según tipo de mensaje
-            message_type = metadata.get("type", "unknown")
-            
-            # Para imágenes, verificar duplicación específica
-            if message_type == "image":
-                media_id = None
-                
-                # Extraer media_id según la estructura
-                if "image" in metadata:
-                    media_id = metadata["image"].get("id")
-                    caption = metadata["image"].get("caption", "")
-                else:
-                    media_obj = metadata.get("media", {})
-                    media_id = media_obj.get("id") or metadata.get("media_id")
-                    caption = media_obj.get("caption", "") or metadata.get("caption", "")
-                
-                if media_id:
-                    # Verificar duplicación de imagen
-                    img_cache_key = f"processed_image_{media_id}_{from_phone}"
-                    if django_cache.get(img_cache_key):  # Usar django_cache aquí
-                        logger.warning(f"Imagen duplicada: {media_id}. Ignorando.")
-                        return HttpResponse('OK', status=200)
-                    
-                    # Marcar como procesada
-                    django_cache.set(img_cache_key, True, 60 * 60 * 24)  # Y aquí también
-            
-                    # Procesar imagen como potencial ticket
-                    response = conversation_service.handle_image_message(
-                        from_phone=from_phone,
-                        media_id=media_id,
-                        message_text=caption,
-                        company=company,
-                        session=session
-                    )
-                    
-                    # Enviar respuesta
-                    whatsapp.send_message(from_phone, response)
-                    
-                    # Guardar mensaje en BD
-                    Message.objects.create(
-                        company=company,
-                        session=session,
-                        user=user,
-                        message_text=caption or "[Imagen sin texto]",
-                        message_type="image",
-                        is_from_user=True
-                    )
-                    
-                    Message.objects.create(
-                        company=company,
-                        session=session,
-                        user=user,
-                        message_text=response,
-                        message_type="text",
-                        is_from_user=False
-                    )
-                    
-                    return HttpResponse('OK', status=200)
-            
-            # NUEVO: Segunda verificación en caso de que el ID se extraiga aquí
-            if message_id and not from_phone:
-                # Es probablemente una actualización de estado, verificar duplicado
-                cache_key = f"processed_status_{message_id}"
-                if django_cache.get(cache_key):  # Usar django_cache aquí
-                    logger.info(f"Actualización de estado duplicada: {message_id}")
-                    return HttpResponse('OK', status=200)
-                django_cache.set(cache_key, True, 60 * 60 * 6)  # Y aquí también
-            
-            # Verificar primero si es una respuesta de feedback
-            if message_text and is_feedback_response(message_text, from_phone):
-                handle_feedback_response(from_phone, message_text)
-                return HttpResponse('OK', status=200)
-            
-            # Verificar si es una actualización de estado o si no se pudo extraer información
-            if not from_phone or not message_text:
-                return HttpResponse('OK', status=200)
-            
-            if 'company' not in locals() or not company or 'user' not in locals() or not user:
-                # Obtener empresa, usuario y servicio WhatsApp usando el método centralizado
-                company, user, contact_name, whatsapp = company_service.get_company_user_and_whatsapp_service(
-                    metadata, from_phone, default_whatsapp
-                )
-                
-                # Verificar si se pudo obtener la empresa y usuario
-                if not company:
-                    return HttpResponse('OK', status=200)
-                    
-                if not user:
-                    return HttpResponse('OK', status=200)
-            
-            # Verificar si el usuario ya aceptó las políticas
-            # Primero, obtén la política activa
-            policy = PolicyVersion.objects.filter(active=True).first()
-
-            # Verificar si necesita aceptar o actualizar políticas
-            needs_acceptance = not user.policies_accepted
-            needs_update = False
-
-            if user.policies_accepted and policy:
-                # Ya tiene políticas aceptadas, pero verificar si hay una nueva versión
-                try:
-                    if user.policies_version != policy.version:
-                        # Comparar versiones semánticas
-                        user_version = [int(x) for x in user.policies_version.split(".")]
-                        policy_version = [int(x) for x in policy.version.split(".")]
-                        
-                        # Si el número principal de versión ha cambiado (1.x → 2.x)
-                        if policy_version[0] > user_version[0]:
-                            needs_update = True
-                            logger.info(f"Usuario {user.whatsapp_number} necesita actualizar política: {user.policies_version} → {policy.version}")
-                except (ValueError, IndexError, AttributeError) as e:
-                    logger.warning(f"Error comparando versiones: {e}")
-                    # En caso de error, ser conservadores y pedir actualización
-                    needs_update = True
+def process_message_event(event, remote_addr=None, default_whatsapp=None, companies=None, users=None):
+    """
+    Procesa un mensaje entrante de WhatsApp
+    
+    Args:
+        event (WebhookMessageEvent): Mensaje extraído del webhook
+        remote_addr (str): IP de origen de la petición (opcional)
+        default_whatsapp (WhatsAppService): Servicio por defecto (opcional)
+        companies (dict): Empresas precargadas por phone_number_id (opcional)
+        users (dict): Usuarios precargados por número de WhatsApp (opcional)
+    """
+    ctx = prepare_message_event(event, remote_addr, default_whatsapp, companies=companies, users=users)
+    if not ctx:
+        return
+    
+    # Generar respuesta con OpenAI
+    ai_response = conversation_service.generate_response(
+        user_id=ctx.from_phone,
+        message=ctx.message_text,
+        company_info=ctx.company_info,
+        language_code=ctx.user.language,
+        company=ctx.company,
+        session=ctx.session,
+        message_parts=burst_texts(ctx)
+    )
+    
+    log_ai_response(ctx, ai_response)
+    response = ctx.send(ai_response)
+    logger.info(f"WhatsApp API Response: {response}")
+    
+    finish_text_turn(ctx, ai_response)
 
-            # Procesar si necesita aceptar inicialmente o actualizar
-            if needs_acceptance or needs_update:
-                if user.waiting_policy_acceptance and metadata.get("type") == "interactive" and "button_id" in metadata:
-                    button_id = metadata.get("button_id")
-                    
-                    # Obtener la política activa
-                    active_policy = policy_service.get_active_policy()
-                    
-                    if button_id == "accept_policies":
-                        # El usuario aceptó las políticas
-                        policy_service.record_policy_acceptance(
-                            user, 
-                            active_policy or "1.0",  # Usar versión activa o "1.0" como fallback
-                            ip_address=request.META.get('REMOTE_ADDR', None)
-                        )
-                        
-                        # Si hay un mensaje pendiente, procesarlo ahora
-                        pending_message = user.pending_message_text
-                        if pending_message:
-                            # Resetear el mensaje pendiente
-                            user.pending_message_text = None
-                            user.save()
-                            
-                            # Procesar el mensaje como si fuera nuevo
-                            message_text = pending_message
-                            
-                            # Enviar mensaje de confirmación
-                            whatsapp.send_message(from_phone, 
-                                "¡Gracias por aceptar nuestras políticas! Ahora podemos ayudarte.")
-                            
-                        else:
-                            # No hay mensaje pendiente, enviar bienvenida
-                            whatsapp.send_message(from_phone, 
-                                f"¡Bienvenido/a a {company.name}! ¿En qué podemos ayudarte hoy?")
-                            
-                            # Terminar procesamiento
-                            return HttpResponse('OK', status=200)
-                            
-                    elif button_id == "reject_policies":
-                        # El usuario rechazó las políticas
-                        whatsapp.send_message(from_phone, 
-                            "Entendemos tu decisión. Para poder utilizar nuestro servicio es necesario aceptar las políticas de privacidad. " +
-                            "Si cambias de opinión, puedes escribirnos nuevamente.")
-                        
-                        # No procesar más mensajes
-                        user.waiting_policy_acceptance = False
-                        user.save()
-                        return HttpResponse('OK', status=200)
-                    
-                    if button_id == "view_full_policies":
-                        logger.info(f"Usuario {user.whatsapp_number} solicita ver políticas completas")
-                        
-                        # Obtener la política activa
-                        policy = PolicyVersion.objects.filter(active=True).first()
-                        if not policy:
-                            whatsapp.send_message(from_phone, "Lo sentimos, no se encontraron las políticas detalladas. Por favor, contacta con soporte.")
-                            return HttpResponse('OK', status=200)
-                            
-                        # Enviar políticas detalladas
-                        responses = whatsapp.send_full_policy_details(from_phone, policy)
-                        logger.info(f"Enviados {len(responses)} mensajes con detalles de políticas al usuario {user.whatsapp_number}")
-                        
-                        # No procesar más este mensaje
-                        return HttpResponse('OK', status=200)
-                        
-                else:
-                    # Primer mensaje o mensaje sin respuesta a políticas
-                    user.pending_message_text = message_text
-                    user.waiting_policy_acceptance = True
-                    user.save()
-                    
-                    # Mensaje apropiado según sea aceptación inicial o actualización
-                    if needs_update:
-                        header_text = f"Actualización de Políticas v{policy.version}"
-                        intro_text = f"Hemos actualizado nuestras políticas. Para continuar usando nuestro servicio, necesitas aceptar la nueva versión."
-                    else:
-                        header_text = "Políticas de Privacidad"
-                        intro_text = policy.description
-                    
-                    # Obtener la política activa
-                    policy = policy_service.get_active_policy()
-                    
-                    # Registrar lo que estamos utilizando
-                    if hasattr(policy, 'id'):
-                        logger.info(f"Usando política activa de la DB: ID={policy.id}, título={policy.title}, versión={policy.version}")
-                    else:
-                        logger.info(f"Usando política predeterminada: {policy.get('title')}, v{policy.get('version')}")
-                    
-                    # Enviar mensaje interactivo para aceptación de políticas
-                    response = whatsapp.send_policy_acceptance_message(from_phone, policy)
-                    
-                    # Si el usuario responde a este mensaje con "más detalles" o similar, podríamos
-                    # implementar el envío de políticas completas, pero por ahora es suficiente
-                    
-                    # No procesar más este mensaje
-                    return HttpResponse('OK', status=200)
-
-            # Verificar si es una nueva conversación - SIMPLIFICADO
-            is_new_conversation = False
-
-            # Si el usuario no tiene mensajes previos o es nuevo, es una nueva conversación
-            message_count = Message.objects.filter(user=user).count()
-            if message_count == 0:
-                logger.info(f"Usuario nuevo detectado: {from_phone}")
-                is_new_conversation = True
-
-            # Verificar si requiere selección de idioma (no tiene idioma Y no está esperando uno)
-            is_language_selection_needed = False
-            if (not hasattr(user, 'language') or not user.language):
-                # Solo si no está esperando selección de idioma
-                if not hasattr(user, 'waiting_for_language') or not user.waiting_for_language:
-                    logger.info(f"Usuario sin idioma configurado y no esperando: {from_phone}")
-                    is_language_selection_needed = True
-                else:
-                    logger.info(f"Usuario esperando selección de idioma: {from_phone}")
-
-            # Si el mensaje es tipo "text" (no botón interactivo) y es nueva conversación
-            if is_language_selection_needed and metadata.get("type") == "text":
-                logger.info(f"Enviando selector de idioma a {from_phone}")
-                
-                # Obtener o crear sesión
-                session = session_service.get_or_create_session(user, company)
-                
-                # Enviar mensaje de selección de idioma
-                response = whatsapp.send_language_selection_message(from_phone)
-                if not response:
-                    logger.error(f"Error enviando selector de idioma a {from_phone}")
-                
-                # Guardar mensaje entrante
-                Message.objects.create(
-                    company=company,
-                    session=session,
-                    user=user,
-                    message_text=message_text,
-                    message_type="text",
-                    is_from_user=True
-                )
-                
-                # Guardar mensaje de selección de idioma
-                Message.objects.create(
-                    company=company,
-                    session=session,
-                    user=user,
-                    message_text="[Mensaje de selección de idioma]",
-                    message_type="interactive",
-                    is_from_user=False
-                )
-                
-                return HttpResponse('OK', status=200)
+async def process_message_event_async(event, remote_addr=None, default_whatsapp=None, companies=None, users=None):
+    """
+    Versión asíncrona de process_message_event
+    
+    Las etapas previas (políticas, idioma, audio, imágenes...) se ejecutan
+    en un hilo; la llamada a OpenAI y el envío por WhatsApp, que son las
+    esperas largas, no bloquean el event loop.
+    """
+    ctx = await db_sync_to_async(prepare_message_event)(
+        event, remote_addr, default_whatsapp, companies=companies, users=users
+    )
+    if not ctx:
+        return
+    
+    ai_response = await conversation_service.generate_response_async(
+        user_id=ctx.from_phone,
+        message=ctx.message_text,
+        company_info=ctx.company_info,
+        language_code=ctx.user.language,
+        company=ctx.company,
+        session=ctx.session,
+        message_parts=burst_texts(ctx)
+    )
+    
+    log_ai_response(ctx, ai_response)
+    response = await ctx.whatsapp.send_message_async(ctx.from_phone, ai_response)
+    logger.info(f"WhatsApp API Response: {response}")
+    
+    await db_sync_to_async(finish_text_turn)(ctx, ai_response)
 
-            # Obtener o crear la sesión activa
-            if 'session' not in locals() or not session:
-                session = session_service.get_or_create_session(user, company)
+def log_ai_response(ctx, ai_response):
+    """Registra la respuesta que se va a enviar al usuario"""
+    try:
+        logger.info(f"Sending AI response to {ctx.from_phone}: {ai_response}")
+    except UnicodeEncodeError:
+        safe_response = ai_response.encode('ascii', 'replace').decode('ascii')
+        logger.info(f"Sending AI response to {ctx.from_phone}: {safe_response}")
 
-            # PROCESAR BOTONES DE IDIOMA
-            if metadata.get("type") == "interactive" and "button_id" in metadata:
-                button_id = metadata.get("button_id")
-                
-                # Si es un botón de selección de idioma
-                if button_id.startswith("lang_"):
-                    language_code = button_id.replace("lang_", "")
-                    logger.info(f"Usuario {from_phone} seleccionó detección automática de idioma")
-                    
-                    if language_code == "detect":
-                        logger.info(f"Usuario {from_phone} seleccionó detección automática de idioma")
-                        user.waiting_for_language = True
-                        user.save()  # Guardar explícitamente
-                        
-                        # Verificar que se guardó correctamente
-                        user.refresh_from_db()
-                        logger.info(f"Estado de waiting_for_language después de guardar: {user.waiting_for_language}")
-                        
-                        # Pedir que escriba en su idioma pero de forma más natural
-                        request_message = "Por favor, escribe tu pregunta o mensaje en tu idioma preferido y te responderé automáticamente en ese mismo idioma.\n\nPlease write your question or message in your preferred language and I'll respond automatically in that same language."
-                        whatsapp.send_message(from_phone, request_message)
-                        
-                        # Guardar interacción en BD
-                        Message.objects.create(
-                            company=company,
-                            session=session,
-                            user=user,
-                            message_text="[Seleccionó: Auto-detect]",
-                            message_type="interactive",
-                            is_from_user=True
-                        )
-                        
-                        Message.objects.create(
-                            company=company,
-                            session=session,
-                            user=user,
-                            message_text=request_message,
-                            message_type="text",
-                            is_from_user=False
-                        )       
-                        
-                        return HttpResponse('OK', status=200)         
-                    else:
-                        # Usuario seleccionó un idioma específico (es, en, etc.)
-                        user.language = language_code
-                        user.waiting_for_language = False
-                        user.save()
-                        
-                        logger.info(f"Idioma {language_code} establecido para usuario {from_phone}")
-                        
-                        # Guardar selección en la BD
-                        Message.objects.create(
-                            company=company,
-                            session=session, 
-                            user=user,
-                            message_text=f"[Seleccionó idioma: {language_code}]",
-                            message_type="interactive",
-                            is_from_user=True
-                        )
-                        
-                        # Enviar mensaje de bienvenida directamente
-                        company_info = company_service.get_company_info(company)
-                        
-                        # Generar mensaje de bienvenida del bot
-                        welcome_response = conversation_service.generate_response(
-                            user_id=from_phone,
-                            message="Hola", 
-                            company_info=company_info,
-                            language_code=language_code,
-                            is_first_message=True,
-                            company=company,
-                            session=session
-                        )
-                        
-                        # Enviar mensaje de bienvenida
-                        whatsapp.send_message(from_phone, welcome_response)
-                        
-                        # Guardar mensaje en BD
-                        Message.objects.create(
-                            company=company,
-                            session=session,
-                            user=user,
-                            message_text=welcome_response,
-                            message_type="text",
-                            is_from_user=False
-                        )
-                        
-                        return HttpResponse('OK', status=200)
-
-            # PROCESAR RESPUESTA DE DETECCIÓN DE IDIOMA
-            if hasattr(user, 'waiting_for_language') and user.waiting_for_language and metadata.get("type") == "text":
-                # Detectar idioma del texto enviado
-                detected_language = language_service.detect_language_with_openai(message_text)
-                
-                # Actualizar idioma del usuario
-                user.language = detected_language["code"]
-                user.waiting_for_language = False
-                user.save()
-                
-                logger.info(f"Idioma detectado para {from_phone}: {detected_language['name']} ({detected_language['code']})")
-                
-                # NO enviar confirmación de idioma detectado
-                # En su lugar, procesar directamente este mensaje como pregunta
-                
-                # Crear sesión si no existe
-                session = session_service.get_or_create_session(user, company)
-                
-                # Guardar mensaje entrante del usuario
-                Message.objects.create(
-                    company=company,
-                    session=session,
-                    user=user,
-                    message_text=message_text,
-                    message_type="text",
-                    is_from_user=True
-                )
-                
-                # Obtener información de la empresa
-                company_info = company_service.get_company_info(company)
-                
-                # Generar respuesta de la IA usando el idioma detectado
-                ai_response = conversation_service.generate_response(
-                    user_id=from_phone,
-                    message=message_text,
-                    company_info=company_info,
-                    language_code=user.language,
-                    company=company,
-                    session=session
-                )
-                
-                # Enviar respuesta
-                whatsapp.send_message(from_phone, ai_response)
-                
-                # Guardar respuesta en BD
-                Message.objects.create(
-                    company=company,
-                    session=session,
-                    user=user,
-                    message_text=ai_response,
-                    message_type="text",
-                    is_from_user=False
-                )
-                
-                return HttpResponse('OK', status=200)
+def finish_text_turn(ctx, ai_response):
+    """
+    Guarda la respuesta de la IA y comprueba si la conversación ha terminado
+    
+    Args:
+        ctx (MessageContext): Contexto devuelto por prepare_message_event
+        ai_response (str): Respuesta enviada al usuario
+    """
+    # Guardar la respuesta de la IA
+    try:
+        outgoing_message = ctx.save_message(ai_response, is_from_user=False)
+        logger.info(f"Mensaje saliente guardado: {outgoing_message.id}")
+    except Exception as e:
+        logger.error(f"Error al guardar mensaje saliente: {e}")
+    
+    # Verificar cierre de sesión por respuesta de IA
+    ai_farewell_phrases = ['chat finalizado', 'conversación finalizada', 'sesión finalizada', 
+                        'ha sido un placer atenderte', 'gracias por contactarnos']
 
-            # MOSTRAR SELECCIÓN DE IDIOMA PARA CONVERSACIONES NUEVAS
-            if is_new_conversation:
-                # Enviar mensaje de selección de idioma
-                whatsapp.send_language_selection_message(from_phone)
-                
-                # Guardar mensaje entrante inicial
-                Message.objects.create(
-                    company=company,
-                    session=session,
-                    user=user,
-                    message_text=message_text,
-                    message_type=metadata.get("type", "text"),
-                    is_from_user=True
-                )
-                
-                # Guardar mensaje de selección de idioma
-                Message.objects.create(
-                    company=company,
-                    session=session,
-                    user=user,
-                    message_text="[Mensaje de selección de idioma]",
-                    message_type="interactive",
-                    is_from_user=False
-                )
+    if any(phrase in ai_response.lower() for phrase in ai_farewell_phrases):
+        # La IA indicó que la conversación ha terminado
+        session_service.end_session_for_user(ctx.user, ctx.company)
+        logger.info(f"Sesión finalizada por respuesta de cierre de la IA: {ctx.from_phone}")
+        
+        if not ctx.session.feedback_requested:
+            # Enviar solicitud de feedback con delay (tarea persistente, una por sesión)
+            delayed_task_service.schedule(
+                'feedback_request',
+                {'session_id': str(ctx.session.id), 'phone_number': ctx.from_phone},
+                delay=FEEDBACK_REQUEST_DELAY,
+                idempotency_key=f"feedback_request:{ctx.session.id}"
+            )
+        
+    # Verificar cierre de sesión por mensaje del usuario
+    elif any(phrase in ctx.message_text.lower() for phrase in ['adios', 'adiós', 'chau', 'hasta luego', 
+                                                            'bye', 'nos vemos', 'gracias por todo', 
+                                                            'hasta pronto', 'me despido', 'finalizar', 
+                                                            'terminar']):
+        session_service.end_session_for_user(ctx.user, ctx.company)
+        logger.info(f"Sesión finalizada por despedida del usuario: {ctx.from_phone}")
+
+# Resultado de una etapa que ya ha completado el mensaje
+HANDLED = object()
+
+def prepare_message_event(event, remote_addr=None, default_whatsapp=None, companies=None, users=None):
+    """
+    Ejecuta las etapas del pipeline de un mensaje hasta pedir respuesta a OpenAI
+    
+    Cada etapa de MESSAGE_STAGES recibe el contexto compartido y devuelve
+    None para pasar a la siguiente, HANDLED si ya completó el mensaje
+    (políticas, idioma, audio, imágenes, feedback) o el propio contexto
+    si el mensaje necesita respuesta de la IA.
+    
+    Args:
+        event (WebhookMessageEvent): Mensaje extraído del webhook
+        remote_addr (str): IP de origen de la petición (opcional)
+        default_whatsapp (WhatsAppService): Servicio por defecto (opcional)
+        companies (dict): Empresas precargadas por phone_number_id (opcional)
+        users (dict): Usuarios precargados por número de WhatsApp (opcional)
+        
+    Returns:
+        MessageContext: El contexto pendiente de respuesta, o None si ya se completó
+    """
+    ctx = MessageContext(event, remote_addr, default_whatsapp, companies=companies, users=users)
+    
+    # Obtener empresa, usuario y servicio WhatsApp usando el método centralizado
+    if not ctx.resolve():
+        return None
+    
+    for stage in MESSAGE_STAGES:
+        result = stage(ctx)
+        if result is HANDLED:
+            return None
+        if result is not None:
+            return result
+    return None
+
+def image_media(metadata):
+    """
+    media_id y pie de foto de un mensaje de imagen
+    
+    Returns:
+        tuple: (media_id, caption); media_id es None si el mensaje no lo trae
+    """
+    # Extraer media_id según la estructura
+    if "image" in metadata:
+        return metadata["image"].get("id"), metadata["image"].get("caption", "")
+    media_obj = metadata.get("media", {})
+    media_id = media_obj.get("id") or metadata.get("media_id")
+    caption = media_obj.get("caption", "") or metadata.get("caption", "")
+    return media_id, caption
+
+def image_stage(ctx):
+    """Imágenes: se procesan como posibles tickets"""
+    if ctx.message_type != "image":
+        return None
+    
+    media_id, caption = image_media(ctx.metadata)
+    
+    if not media_id:
+        return None
+    
+    # Verificar duplicación de imagen (y marcarla como procesada)
+    if not deduplication_service.claim(f"{media_id}:{ctx.from_phone}", kind='image'):
+        logger.warning(f"Imagen duplicada: {media_id}. Ignorando.")
+        return HANDLED
+    
+    # Procesar imagen como potencial ticket
+    response = conversation_service.handle_image_message(
+        from_phone=ctx.from_phone,
+        media_id=media_id,
+        message_text=caption,
+        company=ctx.company,
+        session=ctx.session
+    )
+    
+    # Enviar respuesta
+    ctx.send(response)
+    
+    # Guardar mensaje en BD
+    ctx.save_message(caption or "[Imagen sin texto]", is_from_user=True, message_type="image")
+    ctx.save_message(response, is_from_user=False)
+    
+    return HANDLED
+
+def feedback_reply_stage(ctx):
+    """Respuestas escritas a una solicitud de feedback (o el comentario pedido)"""
+    if ctx.message_text and is_feedback_response(ctx.message_text, ctx.from_phone):
+        handle_feedback_response(ctx.from_phone, ctx.message_text)
+        return HANDLED
+    
+    # Verificar si es una actualización de estado o si no se pudo extraer información
+    if not ctx.from_phone or not ctx.message_text:
+        return HANDLED
+    
+    return None
+
+def policy_gate_stage(ctx):
+    """Aceptación (o actualización) de las políticas de privacidad"""
+    user = ctx.user
+    policy = ctx.policy
+    
+    # Verificar si necesita aceptar o actualizar políticas
+    needs_acceptance = not user.policies_accepted
+    needs_update = False
+
+    if user.policies_accepted and policy:
+        # Ya tiene políticas aceptadas, pero verificar si hay una nueva versión
+        try:
+            if user.policies_version != policy.version:
+                # Comparar versiones semánticas
+                user_version = [int(x) for x in user.policies_version.split(".")]
+                policy_version = [int(x) for x in policy.version.split(".")]
                 
-                return HttpResponse('OK', status=200)
+                # Si el número principal de versión ha cambiado (1.x → 2.x)
+                if policy_version[0] > user_version[0]:
+                    needs_update = True
+                    logger.info(f"Usuario {user.whatsapp_number} necesita actualizar política: {user.policies_version} → {policy.version}")
+        except (ValueError, IndexError, AttributeError) as e:
+            logger.warning(f"Error comparando versiones: {e}")
+            # En caso de error, ser conservadores y pedir actualización
+            needs_update = True
 
-            # Registrar la interacción y crear/obtener sesión
-            company_service.record_user_company_interaction(user, company)
-            session = session_service.get_or_create_session(user, company)
+    if not (needs_acceptance or needs_update):
+        return None
+    
+    if user.waiting_policy_acceptance and ctx.message_type == "interactive" and ctx.button_id:
+        button_id = ctx.button_id
+        
+        if button_id == "accept_policies":
+            # El usuario aceptó las políticas (versión activa o "1.0" como fallback)
+            policy_service.record_policy_acceptance(
+                user, 
+                policy or "1.0",
+                ip_address=ctx.remote_addr
+            )
+            
+            # Si hay un mensaje pendiente, procesarlo ahora
+            pending_message = user.pending_message_text
+            if pending_message:
+                # Resetear el mensaje pendiente
+                user.pending_message_text = None
+                user.save(update_fields=['pending_message_text'])
+                
+                # Procesar el mensaje como si fuera nuevo
+                ctx.message_text = pending_message
+                
+                # Enviar mensaje de confirmación
+                ctx.send("¡Gracias por aceptar nuestras políticas! Ahora podemos ayudarte.")
+                return None
             
-            if not session:
-                logger.error(f"No se pudo crear/obtener sesión para {user.whatsapp_number}")
-                return HttpResponse('OK', status=200)
+            # No hay mensaje pendiente, enviar bienvenida
+            ctx.send(f"¡Bienvenido/a a {ctx.company.name}! ¿En qué podemos ayudarte hoy?")
+            return HANDLED
+                
+        if button_id == "reject_policies":
+            # El usuario rechazó las políticas
+            ctx.send(
+                "Entendemos tu decisión. Para poder utilizar nuestro servicio es necesario aceptar las políticas de privacidad. " +
+                "Si cambias de opinión, puedes escribirnos nuevamente.")
             
-            # Detectar primero el tipo de mensaje para aplicar flujo específico
-            message_type = metadata.get("type")
+            # No procesar más mensajes
+            user.waiting_policy_acceptance = False
+            user.save(update_fields=['waiting_policy_acceptance'])
+            return HANDLED
+        
+        if button_id == "view_full_policies":
+            logger.info(f"Usuario {user.whatsapp_number} solicita ver políticas completas")
+            
+            if not policy:
+                ctx.send("Lo sentimos, no se encontraron las políticas detalladas. Por favor, contacta con soporte.")
+                return HANDLED
+                
+            # Enviar políticas detalladas
+            responses = ctx.whatsapp.send_full_policy_details(ctx.from_phone, policy)
+            logger.info(f"Enviados {len(responses)} mensajes con detalles de políticas al usuario {user.whatsapp_number}")
+            return HANDLED
+        
+        # Otro botón mientras se espera la aceptación: continuar con el flujo
+        return None
+    
+    # Primer mensaje o mensaje sin respuesta a políticas
+    user.pending_message_text = ctx.message_text
+    user.waiting_policy_acceptance = True
+    user.save(update_fields=['pending_message_text', 'waiting_policy_acceptance'])
+    
+    if policy:
+        logger.info(f"Usando política activa de la DB: ID={policy.id}, título={policy.title}, versión={policy.version}")
+    else:
+        logger.info("Sin política activa, usando textos predeterminados")
+    
+    # Enviar mensaje interactivo para aceptación de políticas
+    ctx.whatsapp.send_policy_acceptance_message(ctx.from_phone, policy or {})
+    return HANDLED
 
-            # Manejar primero los mensajes de audio ya que tienen un flujo especial
-            if message_type == "audio":
-                # Procesar mensaje de audio
-                audio_id = metadata.get("audio_id")
-                
-                if not audio_id:
-                    logger.error("Mensaje de audio recibido sin ID")
-                    return HttpResponse('OK', status=200)
-                
-                # Crear sesión para el usuario
-                session = session_service.get_or_create_session(user, company)
-                
-                # Crear mensaje inicial (se actualizará después con la transcripción)
-                message = Message.objects.create(
-                    company=company,
-                    session=session,
-                    user=user,
-                    message_text="[Procesando mensaje de audio...]",
-                    message_type="audio",
-                    is_from_user=True
-                )
-                
-                # Notificar al usuario que estamos procesando
-                whatsapp.send_message(
-                    from_phone, 
-                    "Estoy procesando tu mensaje de voz, dame un momento..."
-                )
-                
-                # Procesar el audio (descargar y transcribir)
-                result = whisper_service.process_whatsapp_audio(message, audio_id, company)
-                
-                if result["success"]:
-                    # Transcripción exitosa
-                    transcription = result["transcription"]
-                    logger.info(f"Audio transcrito: {transcription[:100]}...")
-                    
-                    # Procesar el texto transcrito para obtener respuesta
-                    # IMPORTANTE: Corregimos los argumentos para coincidir con la firma del método
-                    ai_response = conversation_service.generate_response(
-                        user_id=from_phone,
-                        message=transcription,
-                        company_info=company_service.get_company_info(company),
-                        language_code=user.language,
-                        company=company,
-                        session=session,
-                    )
-                    
-                    # Crear mensaje de respuesta
-                    response_message = Message.objects.create(
-                        company=company,
-                        session=session,
-                        user=user,
-                        message_text=ai_response,
-                        message_type="text",
-                        is_from_user=False
-                    )
-                    
-                    # Enviar respuesta al usuario
-                    whatsapp.send_message(from_phone, ai_response)
-                    
-                else:
-                    # Error en la transcripción
-                    error_msg = "Lo siento, no pude entender tu mensaje de voz. ¿Podrías intentar de nuevo o enviar un mensaje de texto?"
-                    whatsapp.send_message(from_phone, error_msg)
-                    logger.error(f"Error procesando audio: {result.get('error', 'Unknown error')}")
-                
-                return HttpResponse('OK', status=200)
+def language_gate_stage(ctx):
+    """Selección o detección del idioma del usuario"""
+    user = ctx.user
+    from_phone = ctx.from_phone
+    
+    # Se evalúa antes de guardar ningún mensaje de este turno
+    is_new_conversation = ctx.is_new_conversation
+    if is_new_conversation:
+        logger.info(f"Usuario nuevo detectado: {from_phone}")
 
-            # PROCESAMIENTO DE MENSAJES INTERACTIVOS (BOTONES)
-            if metadata.get("type") == "interactive" and "button_id" in metadata:
-                button_id = metadata.get("button_id")
-                
-                # Procesar botones de feedback
-                if button_id in ["positive", "negative", "comment"]:
-                    is_feedback_flow = True
-                    # Buscar la última sesión finalizada para feedback
-                    
-                    from datetime import timedelta
-                    
-                    recent_time = timezone.now() - timedelta(hours=48)
-                    recent_session = Session.objects.filter(
-                        user=user,
-                        company=company,
-                        ended_at__isnull=False,
-                        ended_at__gt=recent_time,
-                        feedback_requested=True
-                    ).order_by('-ended_at').first()
-                    
-                    if not recent_session:
-                        # No hay sesión reciente para feedback
-                        whatsapp.send_message(from_phone, "No encontramos una sesión reciente para valorar. Gracias por tu interés.")
-                        return HttpResponse('OK', status=200)
-                    
-                    if button_id == "positive":
-                        # Feedback positivo
-                        feedback_service.process_feedback_response(recent_session, user, company, 'positive')
-                        whatsapp.send_message(from_phone, "¡Gracias por tu valoración positiva! Nos alegra saber que fue una buena experiencia.")
-                        
-                    elif button_id == "negative":
-                        # Feedback negativo
-                        feedback_service.process_feedback_response(recent_session, user, company, 'negative')
-                        whatsapp.send_message(from_phone, "Lamentamos que tu experiencia no fuera satisfactoria. Trabajaremos para mejorar nuestro servicio.")
-                        
-                    if button_id == "comment":
-                        # Usuario quiere dejar un comentario
-                        whatsapp.send_message(from_phone, "Por favor, cuéntanos tu experiencia o sugerencia para mejorar nuestro servicio:")
-                        
-                        # Marcar que estamos esperando un comentario
-                        from django.core.cache import cache
-                        cache_key = f"waiting_feedback_comment_{from_phone}"
-                        django_cache.set(cache_key, recent_session.id, 60*30)  # Esperar comentario por 30 minutos
-                    
-                    return HttpResponse('OK', status=200)
-                
-            # PROCESAMIENTO DE MENSAJES REGULARES
-            if not is_feedback_flow:
-                # Guardar el mensaje entrante
-                try:
-                    incoming_message = Message.objects.create(
-                        company=company,
-                        session=session,
-                        user=user,
-                        message_text=message_text,
-                        is_from_user=True
-                    )
-                    logger.info(f"Mensaje entrante guardado: {incoming_message.id}")
-                except Exception as e:
-                    logger.error(f"Error al guardar mensaje entrante: {e}")
-                
-                # Obtener información de la empresa para OpenAI
-                company_info = company_service.get_company_info(company)
-                
-                # Registrar el mensaje recibido
-                try:
-                    logger.info(f"Received message from {from_phone} ({contact_name}): {message_text}")
-                except UnicodeEncodeError:
-                    safe_name = contact_name.encode('ascii', 'replace').decode('ascii') if contact_name else None
-                    safe_message = message_text.encode('ascii', 'replace').decode('ascii') if message_text else None
-                    logger.info(f"Received message from {from_phone} ({safe_name}): {safe_message}")
-                
-                # Generar respuesta con OpenAI
-                ai_response = conversation_service.generate_response(
-                    user_id=from_phone,
-                    message=message_text,
-                    company_info=company_info,
-                    language_code=user.language,
-                    company=company,
-                    session=session
-                )
-                
-                # Enviar respuesta al usuario
-                try:
-                    logger.info(f"Sending AI response to {from_phone}: {ai_response}")
-                except UnicodeEncodeError:
-                    safe_response = ai_response.encode('ascii', 'replace').decode('ascii')
-                    logger.info(f"Sending AI response to {from_phone}: {safe_response}")
-                    
-                response = whatsapp.send_message(from_phone, ai_response)
-                logger.info(f"WhatsApp API Response: {response}")
-                
-                # Guardar la respuesta de la IA
-                try:
-                    outgoing_message = Message.objects.create(
-                        company=company,
-                        session=session,
-                        user=user,
-                        message_text=ai_response,
-                        is_from_user=False
-                    )
-                    logger.info(f"Mensaje saliente guardado: {outgoing_message.id}")
-                except Exception as e:
-                    logger.error(f"Error al guardar mensaje saliente: {e}")
-                
-                # Verificar cierre de sesión por respuesta de IA
-                ai_farewell_phrases = ['chat finalizado', 'conversación finalizada', 'sesión finalizada', 
-                                    'ha sido un placer atenderte', 'gracias por contactarnos']
-
-                if any(phrase in ai_response.lower() for phrase in ai_farewell_phrases):
-                    # La IA indicó que la conversación ha terminado
-                    session_service.end_session_for_user(user, company)
-                    logger.info(f"Sesión finalizada por respuesta de cierre de la IA: {from_phone}")
-                    
-                    if not session.feedback_requested:
-                        # Enviar solicitud de feedback con delay
-                        from threading import Timer
-                        Timer(2.0, send_delayed_feedback_request, args=[from_phone, session.id]).start()
-                    
-                # Verificar cierre de sesión por mensaje del usuario
-                elif any(phrase in message_text.lower() for phrase in ['adios', 'adiós', 'chau', 'hasta luego', 
-                                                                    'bye', 'nos vemos', 'gracias por todo', 
-                                                                    'hasta pronto', 'me despido', 'finalizar', 
-                                                                    'terminar']):
-                    session_service.end_session_for_user(user, company)
-                    logger.info(f"Sesión finalizada por despedida del usuario: {from_phone}")
-            
-            return HttpResponse('OK', status=200)
+    # Verificar si requiere selección de idioma (no tiene idioma Y no está esperando uno)
+    if not user.language and not user.waiting_for_language and ctx.message_type == "text":
+        logger.info(f"Enviando selector de idioma a {from_phone}")
+        
+        # Enviar mensaje de selección de idioma
+        response = ctx.whatsapp.send_language_selection_message(from_phone)
+        if not response:
+            logger.error(f"Error enviando selector de idioma a {from_phone}")
+        
+        ctx.save_message(ctx.message_text, is_from_user=True)
+        ctx.save_message("[Mensaje de selección de idioma]", is_from_user=False, message_type="interactive")
+        return HANDLED
+
+    # PROCESAR BOTONES DE IDIOMA
+    if ctx.message_type == "interactive" and ctx.button_id and ctx.button_id.startswith("lang_"):
+        language_code = ctx.button_id.replace("lang_", "")
+        
+        if language_code == "detect":
+            logger.info(f"Usuario {from_phone} seleccionó detección automática de idioma")
+            user.waiting_for_language = True
+            user.save(update_fields=['waiting_for_language'])
             
-        except Exception as e:
-            logger.error(f"Error processing webhook: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+            # Pedir que escriba en su idioma pero de forma más natural
+            request_message = "Por favor, escribe tu pregunta o mensaje en tu idioma preferido y te responderé automáticamente en ese mismo idioma.\n\nPlease write your question or message in your preferred language and I'll respond automatically in that same language."
+            ctx.send(request_message)
             
-        return HttpResponse('OK', status=200)
+            ctx.save_message("[Seleccionó: Auto-detect]", is_from_user=True, message_type="interactive")
+            ctx.save_message(request_message, is_from_user=False)
+            return HANDLED
+        
+        # Usuario seleccionó un idioma específico (es, en, etc.)
+        user.language = language_code
+        user.waiting_for_language = False
+        user.save(update_fields=['language', 'waiting_for_language'])
+        
+        logger.info(f"Idioma {language_code} establecido para usuario {from_phone}")
+        
+        ctx.save_message(f"[Seleccionó idioma: {language_code}]", is_from_user=True, message_type="interactive")
+        
+        # Generar mensaje de bienvenida del bot
+        welcome_response = conversation_service.generate_response(
+            user_id=from_phone,
+            message="Hola", 
+            company_info=ctx.company_info,
+            language_code=language_code,
+            is_first_message=True,
+            company=ctx.company,
+            session=ctx.session
+        )
+        
+        ctx.send(welcome_response)
+        ctx.save_message(welcome_response, is_from_user=False)
+        return HANDLED
 
-# Función para enviar feedback con delay
-def send_delayed_feedback_request(phone_number, session_id):
-    try:
-        session = Session.objects.get(id=session_id)
+    # PROCESAR RESPUESTA DE DETECCIÓN DE IDIOMA
+    if user.waiting_for_language and ctx.message_type == "text":
+        # Detectar idioma del texto enviado
+        detected_language = language_service.detect_language(ctx.message_text)
         
-        if session.feedback_requested:
-            logger.info(f"Feedback ya solicitado para sesión {session.id}, no se enviará nuevamente.")
-            return
+        # Actualizar idioma del usuario
+        user.language = detected_language["code"]
+        user.waiting_for_language = False
+        user.save(update_fields=['language', 'waiting_for_language'])
         
-        company = session.company
+        logger.info(f"Idioma detectado para {from_phone}: {detected_language['name']} ({detected_language['code']})")
         
-        # Crear servicio de WhatsApp usando credenciales de la empresa
-        whatsapp = WhatsAppService(
-            api_token=company.whatsapp_api_token,
-            phone_number_id=company.whatsapp_phone_number_id
+        # NO enviar confirmación de idioma detectado: procesar directamente
+        # este mensaje como pregunta
+        ctx.save_message(ctx.message_text, is_from_user=True)
+        
+        ai_response = conversation_service.generate_response(
+            user_id=from_phone,
+            message=ctx.message_text,
+            company_info=ctx.company_info,
+            language_code=user.language,
+            company=ctx.company,
+            session=ctx.session
         )
         
-        # Enviar solicitud de feedback
-        feedback_service.send_feedback_request(whatsapp, phone_number, session)
+        ctx.send(ai_response)
+        ctx.save_message(ai_response, is_from_user=False)
+        return HANDLED
+
+    # MOSTRAR SELECCIÓN DE IDIOMA PARA CONVERSACIONES NUEVAS
+    if is_new_conversation:
+        ctx.whatsapp.send_language_selection_message(from_phone)
         
-    except Exception as e:
-        logger.error(f"Error al enviar feedback con delay: {e}")
+        ctx.save_message(ctx.message_text, is_from_user=True, message_type=ctx.message_type or "text")
+        ctx.save_message("[Mensaje de selección de idioma]", is_from_user=False, message_type="interactive")
+        return HANDLED
+
+    # Registrar la interacción
+    company_service.record_user_company_interaction(user, ctx.company)
+    
+    if not ctx.session:
+        logger.error(f"No se pudo crear/obtener sesión para {user.whatsapp_number}")
+        return HANDLED
+    
+    return None
+
+def audio_stage(ctx):
+    """Mensajes de voz: se transcriben y se responden como texto"""
+    if ctx.message_type != "audio":
+        return None
+    
+    audio_id = ctx.metadata.get("audio_id")
+    if not audio_id:
+        logger.error("Mensaje de audio recibido sin ID")
+        return HANDLED
+    
+    # Crear mensaje inicial (se actualizará después con la transcripción)
+    message = ctx.save_message("[Procesando mensaje de audio...]", is_from_user=True, message_type="audio")
+    
+    # Notificar al usuario que estamos procesando
+    ctx.send("Estoy procesando tu mensaje de voz, dame un momento...")
+    
+    # Procesar el audio (descargar y transcribir)
+    result = whisper_service.process_whatsapp_audio(message, audio_id, ctx.company)
+    
+    if result["success"]:
+        # Transcripción exitosa
+        transcription = result["transcription"]
+        logger.info(f"Audio transcrito: {transcription[:100]}...")
         
+        # Procesar el texto transcrito para obtener respuesta
+        ai_response = conversation_service.generate_response(
+            user_id=ctx.from_phone,
+            message=transcription,
+            company_info=ctx.company_info,
+            language_code=ctx.user.language,
+            company=ctx.company,
+            session=ctx.session,
+        )
+        
+        ctx.save_message(ai_response, is_from_user=False)
+        ctx.send(ai_response)
+        
+    else:
+        # Error en la transcripción
+        error_msg = "Lo siento, no pude entender tu mensaje de voz. ¿Podrías intentar de nuevo o enviar un mensaje de texto?"
+        ctx.send(error_msg)
+        logger.error(f"Error procesando audio: {result.get('error', 'Unknown error')}")
+    
+    return HANDLED
+
+def feedback_button_stage(ctx):
+    """Botones de valoración enviados al cerrar una sesión"""
+    if ctx.message_type != "interactive" or ctx.button_id not in ["positive", "negative", "comment"]:
+        return None
+    
+    from datetime import timedelta
+    
+    # Buscar la última sesión finalizada para feedback
+    recent_time = timezone.now() - timedelta(hours=48)
+    recent_session = Session.objects.filter(
+        user=ctx.user,
+        company=ctx.company,
+        ended_at__isnull=False,
+        ended_at__gt=recent_time,
+        feedback_requested=True
+    ).order_by('-ended_at').first()
+    
+    if not recent_session:
+        # No hay sesión reciente para feedback
+        ctx.send("No encontramos una sesión reciente para valorar. Gracias por tu interés.")
+        return HANDLED
+    
+    if ctx.button_id == "positive":
+        feedback_service.process_feedback_response(recent_session, ctx.user, ctx.company, 'positive')
+        ctx.send("¡Gracias por tu valoración positiva! Nos alegra saber que fue una buena experiencia.")
+        
+    elif ctx.button_id == "negative":
+        feedback_service.process_feedback_response(recent_session, ctx.user, ctx.company, 'negative')
+        ctx.send("Lamentamos que tu experiencia no fuera satisfactoria. Trabajaremos para mejorar nuestro servicio.")
+        
+    elif ctx.button_id == "comment":
+        # Usuario quiere dejar un comentario
+        ctx.send("Por favor, cuéntanos tu experiencia o sugerencia para mejorar nuestro servicio:")
+        
+        # Marcar que estamos esperando un comentario
+        cache_key = f"waiting_feedback_comment_{ctx.from_phone}"
+        django_cache.set(cache_key, recent_session.id, 60*30)  # Esperar comentario por 30 minutos
+    
+    return HANDLED
+
+def burst_texts(ctx):
+    """Textos originales de una ráfaga unida por merge_message_bursts (o None)"""
+    return [item["text"] for item in ctx.metadata.get("burst", [])] or None
+
+def text_stage(ctx):
+    """Mensajes normales: se guardan y se devuelven para responder con la IA"""
+    # Guardar el mensaje entrante (cada mensaje de una ráfaga por separado)
+    for burst_text in burst_texts(ctx) or [ctx.message_text]:
+        try:
+            incoming_message = ctx.save_message(burst_text, is_from_user=True)
+            logger.info(f"Mensaje entrante guardado: {incoming_message.id}")
+        except Exception as e:
+            logger.error(f"Error al guardar mensaje entrante: {e}")
+    
+    # Registrar el mensaje recibido
+    try:
+        logger.info(f"Received message from {ctx.from_phone} ({ctx.contact_name}): {ctx.message_text}")
+    except UnicodeEncodeError:
+        safe_name = ctx.contact_name.encode('ascii', 'replace').decode('ascii') if ctx.contact_name else None
+        safe_message = ctx.message_text.encode('ascii', 'replace').decode('ascii') if ctx.message_text else None
+        logger.info(f"Received message from {ctx.from_phone} ({safe_name}): {safe_message}")
+    
+    # Resolver aquí la información de la empresa: la ruta asíncrona la usa
+    # desde el event loop, donde no se pueden hacer consultas
+    ctx.company_info
+
+    # La generación de la respuesta y el envío los completa quien llama
+    return ctx
+
+# Orden del pipeline: la primera etapa que completa el mensaje lo termina
+MESSAGE_STAGES = [
+    image_stage,
+    feedback_reply_stage,
+    policy_gate_stage,
+    language_gate_stage,
+    audio_stage,
+    feedback_button_stage,
+    text_stage,
+]
+
 def is_feedback_response(message, phone_number=None):
     """
     Determina si un mensaje es una respuesta a una solicitud de feedback
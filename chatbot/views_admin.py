@@ -95,4 +95,10 @@ def reply_to_ticket(request, ticket_id):
         'ticket': ticket,
         'status_choices': Ticket.STATUS_CHOICES,
         'comments': ticket.comments.all().order_by('-created_at')[:10],
-    })
\ No newline at end of file
+    })
+@staff_member_required
+def context_store_stats(request):
+    """Indicadores del almacén de historiales de conversación de este proceso"""
+    from django.http import JsonResponse
+    from .services.context_store import get_context_store
+    return JsonResponse(get_context_store().stats())
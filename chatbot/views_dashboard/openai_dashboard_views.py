@@ -1,148 +1,65 @@
 import csv
-from datetime import datetime, timedelta
+from datetime import date, timedelta
 import json
 
 from django.views.generic import TemplateView, View
 from django.contrib.admin.views.decorators import staff_member_required
 from django.utils.decorators import method_decorator
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib import messages
+from django.core.handlers.asgi import ASGIRequest
 from django.utils import timezone
-from django.db.models import Sum, Count, Avg
 
-from ..models import Company, OpenAIUsageRecord, OpenAIMonthlySummary
+from ..models import Company, OpenAIDailySummary
+from ..services.dashboard_snapshot_service import DashboardSnapshotService
 from ..services.openai_metrics_service import OpenAIMetricsService
+from ..services.usage_export_service import EXPORT_FORMATS, UsageExportService
+
+def resolve_period(period, today):
+    """
+    Fechas del selector de período del detalle de empresa y de la exportación
+    
+    Returns:
+        tuple: (inicio, fin, título, nombre para ficheros)
+    """
+    if period == 'month':
+        start_date = today.replace(day=1)
+        title = f"mes actual ({start_date.strftime('%d/%m/%Y')} - {today.strftime('%d/%m/%Y')})"
+        return start_date, today, title, f"mes_actual_{today.strftime('%Y%m')}"
+    if period == 'previous_month':
+        end_date = today.replace(day=1) - timedelta(days=1)
+        start_date = end_date.replace(day=1)
+        title = f"mes anterior ({start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')})"
+        return start_date, end_date, title, f"mes_anterior_{end_date.strftime('%Y%m')}"
+    return today - timedelta(days=29), today, "últimos 30 días", "ultimos_30_dias"
 
 @method_decorator(staff_member_required, name='dispatch')
 class OpenAIDashboardView(TemplateView):
-    """Vista principal del dashboard de OpenAI"""
+    """Vista principal del dashboard de OpenAI (servida desde su instantánea)"""
     template_name = 'chatbot/openai_dashboard/dashboard.html'
     
+    def get(self, request, *args, **kwargs):
+        # Regenerar la instantánea a petición
+        if request.GET.get('refresh'):
+            DashboardSnapshotService().refresh('openai_dashboard')
+            return redirect('openai_dashboard')
+        return super().get(request, *args, **kwargs)
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
-        # Obtener resúmenes del mes actual
-        today = timezone.now().date()
-        current_month = today.month
-        current_year = today.year
-        
-        # Calcular mes anterior
-        prev_month = current_month - 1
-        prev_year = current_year
-        if prev_month == 0:
-            prev_month = 12
-            prev_year -= 1
-        
-        # Obtener resúmenes del mes actual
-        current_summaries = OpenAIMonthlySummary.objects.filter(
-            year=current_year, 
-            month=current_month
-        ).select_related('company')
+        service = DashboardSnapshotService()
+        snapshot = service.get('openai_dashboard')
         
-        # Obtener resúmenes del mes anterior
-        prev_summaries = OpenAIMonthlySummary.objects.filter(
-            year=prev_year, 
-            month=prev_month
-        ).select_related('company')
-        
-        # Crear diccionario para acceso rápido a los datos del mes anterior
-        prev_data = {s.company_id: s for s in prev_summaries}
-        
-        # Preparar datos para la plantilla
-        companies_data = []
-        total_current_tokens = 0
-        total_current_cost = 0
-        
-        for summary in current_summaries:
-            # Obtener datos del mes anterior para esta empresa
-            prev_summary = prev_data.get(summary.company_id)
-            
-            # Calcular variación
-            token_change = 0
-            cost_change = 0
-            
-            if prev_summary:
-                if prev_summary.total_tokens > 0:
-                    token_change = ((summary.total_tokens - prev_summary.total_tokens) / prev_summary.total_tokens) * 100
-                
-                if prev_summary.total_cost > 0:
-                    cost_change = ((summary.total_cost - prev_summary.total_cost) / prev_summary.total_cost) * 100
-            
-            # Agregar a la lista
-            companies_data.append({
-                'company': summary.company,
-                'total_tokens': summary.total_tokens,
-                'total_cost': summary.total_cost,
-                'token_change': token_change,
-                'cost_change': cost_change
-            })
-            
-            # Actualizar totales
-            total_current_tokens += summary.total_tokens
-            total_current_cost += summary.total_cost
-            
-        # Ordenar por coste descendente
-        companies_data.sort(key=lambda x: x['total_cost'], reverse=True)
-        
-        # Añadir empresas sin resumen (aquellas que aún no han generado datos este mes)
-        companies_without_summary = Company.objects.exclude(
-            id__in=[s.company_id for s in current_summaries]
-        ).filter(active=True)
-        
-        for company in companies_without_summary:
-            companies_data.append({
-                'company': company,
-                'total_tokens': 0,
-                'total_cost': 0,
-                'token_change': 0,
-                'cost_change': 0
-            })
-            
+        context.update(snapshot.payload)
         context.update({
-            'companies_data': companies_data,
-            'current_month': today.strftime("%B %Y"),
-            'total_tokens': total_current_tokens,
-            'total_cost': total_current_cost,
-            'monthly_data': self.get_monthly_trend_data()
+            'monthly_data': json.dumps(snapshot.payload['monthly_data']),
+            'snapshot': snapshot,
+            'snapshot_stale': service.is_stale(snapshot),
         })
         
         return context
-        
-    def get_monthly_trend_data(self):
-        """Obtiene datos de tendencia mensual para gráficos"""
-        # Obtener totales por mes para los últimos 12 meses
-        today = timezone.now().date()
-        
-        # Preparar array de 12 meses hacia atrás
-        months_data = []
-        for i in range(11, -1, -1):  # 11 meses atrás hasta actual
-            # Calcular el mes/año
-            month = today.month - i
-            year = today.year
-            
-            while month <= 0:
-                month += 12
-                year -= 1
-                
-            # Obtener datos agregados para este mes
-            month_summary = OpenAIMonthlySummary.objects.filter(
-                year=year,
-                month=month
-            ).aggregate(
-                tokens=Sum('total_tokens'),
-                cost=Sum('total_cost')
-            )
-            
-            # Añadir a la lista
-            months_data.append({
-                'month': f"{month}/{year}",
-                'month_name': datetime(year, month, 1).strftime("%b %Y"),
-                'tokens': month_summary['tokens'] or 0,
-                'cost': float(month_summary['cost'] or 0)
-            })
-            
-        return months_data
 
 @method_decorator(staff_member_required, name='dispatch')
 class CompanyDetailView(TemplateView):
@@ -158,31 +75,12 @@ class CompanyDetailView(TemplateView):
         
         # Determinar período
         period = self.request.GET.get('period', '30days')
-        
-        today = timezone.now().date()
-        if period == '30days':
-            start_date = today - timedelta(days=29)
-            title_period = "últimos 30 días"
-            end_date = today
-        elif period == 'month':
-            start_date = today.replace(day=1)
-            title_period = f"mes actual ({start_date.strftime('%d/%m/%Y')} - {today.strftime('%d/%m/%Y')})"
-            end_date = today
-        elif period == 'previous_month':
-            last_month_end = today.replace(day=1) - timedelta(days=1)
-            start_date = last_month_end.replace(day=1)
-            end_date = last_month_end
-            title_period = f"mes anterior ({start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')})"
-        else:
-            start_date = today - timedelta(days=29)
-            title_period = "últimos 30 días"
-            end_date = today
+        start_date, end_date, title_period, _ = resolve_period(period, timezone.localdate())
             
-        # Obtener estadísticas
+        # Estadísticas, gráficos y desglose por modelo: todo desde los resúmenes diarios
         stats = metrics_service.get_company_usage(company, start_date, end_date)
-        
-        # Obtener datos para gráficos
-        chart_data = metrics_service.get_daily_usage_data(company, days=30)
+        chart_data = metrics_service.get_daily_usage_data(company, start_date=start_date, end_date=end_date)
+        model_usage = metrics_service.get_model_usage(company, start_date, end_date)
         
         # Preparar datos para gráficos
         chart_labels = [item['date'].strftime("%d/%m") for item in chart_data]
@@ -197,6 +95,7 @@ class CompanyDetailView(TemplateView):
             'chart_labels': json.dumps(chart_labels),
             'chart_tokens': json.dumps(chart_tokens),
             'chart_costs': json.dumps(chart_costs),
+            'model_usage': model_usage,
         })
         
         return context
@@ -211,6 +110,7 @@ class UpdateMonthlySummaryView(View):
             now = timezone.now()
             
             metrics_service.generate_monthly_summary(year=now.year, month=now.month)
+            DashboardSnapshotService().refresh('openai_dashboard')
             
             messages.success(request, "Resúmenes mensuales actualizados correctamente")
         except Exception as e:
@@ -220,7 +120,13 @@ class UpdateMonthlySummaryView(View):
 
 @method_decorator(staff_member_required, name='dispatch')
 class ExportCompanyDataView(View):
-    """Vista para exportar datos de una empresa"""
+    """
+    Vista para exportar datos de una empresa
+    
+    Parámetros: period (selector del detalle) o start/end (AAAA-MM-DD) para
+    cualquier rango; format=csv|ndjson; gzip=1 para comprimir; type=summary
+    para el resumen diario en lugar de los registros.
+    """
     
     def get(self, request, company_id):
         try:
@@ -228,60 +134,70 @@ class ExportCompanyDataView(View):
             
             # Determinar período
             period = request.GET.get('period', '30days')
-            today = timezone.now().date()
-            
-            if period == '30days':
-                start_date = today - timedelta(days=29)
-                period_name = "ultimos_30_dias"
-                end_date = today
-            elif period == 'month':
-                start_date = today.replace(day=1)
-                period_name = f"mes_actual_{today.strftime('%Y%m')}"
-                end_date = today
-            elif period == 'previous_month':
-                last_month_end = today.replace(day=1) - timedelta(days=1)
-                start_date = last_month_end.replace(day=1)
-                end_date = last_month_end
-                period_name = f"mes_anterior_{last_month_end.strftime('%Y%m')}"
-            else:
-                start_date = today - timedelta(days=29)
-                period_name = "ultimos_30_dias"
-                end_date = today
-            
-            # Obtener registros
-            records = OpenAIUsageRecord.objects.filter(
-                company=company,
-                timestamp__date__range=(start_date, end_date)
-            ).order_by('timestamp')
-            
-            # Crear respuesta CSV
-            response = HttpResponse(content_type='text/csv')
-            filename = f"openai_usage_{company.name.replace(' ', '_')}_{period_name}.csv"
+            start_date, end_date, _, period_name = resolve_period(period, timezone.localdate())
+            if request.GET.get('start') or request.GET.get('end'):
+                start_date = date.fromisoformat(request.GET['start']) if request.GET.get('start') else start_date
+                end_date = date.fromisoformat(request.GET['end']) if request.GET.get('end') else end_date
+                if start_date > end_date:
+                    raise ValueError("la fecha inicial es posterior a la final")
+                period_name = f"{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}"
+            
+            if request.GET.get('type') == 'summary':
+                return self.export_summary(company, start_date, end_date, period_name)
+            
+            export_format = request.GET.get('format', 'csv')
+            if export_format not in EXPORT_FORMATS:
+                raise ValueError(f"formato no soportado: {export_format}")
+            compress = request.GET.get('gzip') == '1'
+            
+            # Respuesta en streaming: los registros se leen y escriben por bloques.
+            # Con ASGI el contenido tiene que ser asíncrono o Django lo acumula entero
+            service = UsageExportService(company, start_date, end_date)
+            stream = service.astream if isinstance(request, ASGIRequest) else service.stream
+            filename = f"openai_usage_{company.name.replace(' ', '_')}_{period_name}.{export_format}"
+            if compress:
+                filename += '.gz'
+            response = StreamingHttpResponse(
+                stream(export_format, compress=compress),
+                content_type='application/gzip' if compress else EXPORT_FORMATS[export_format]
+            )
             response['Content-Disposition'] = f'attachment; filename="{filename}"'
-            
-            writer = csv.writer(response)
-            writer.writerow([
-                'Fecha', 'Hora', 'Modelo', 'Tokens Entrada', 'Tokens Salida', 
-                'Total Tokens', 'Cacheado', 'Coste Entrada ($)', 'Coste Salida ($)', 
-                'Coste Total ($)'
-            ])
-            
-            for record in records:
-                writer.writerow([
-                    record.timestamp.strftime('%Y-%m-%d'),
-                    record.timestamp.strftime('%H:%M:%S'),
-                    record.model,
-                    record.tokens_input,
-                    record.tokens_output,
-                    record.tokens_total,
-                    'Sí' if record.cached_request else 'No',
-                    record.cost_input,
-                    record.cost_output,
-                    record.cost_total
-                ])
-                
             return response
             
         except Exception as e:
             messages.error(request, f"Error al exportar datos: {e}")
-            return redirect('openai_dashboard')
\ No newline at end of file
+            return redirect('openai_dashboard')
+    
+    def export_summary(self, company, start_date, end_date, period_name):
+        """CSV con un resumen por día y modelo (desde OpenAIDailySummary, sin leer los registros)"""
+        summaries = OpenAIDailySummary.objects.filter(
+            company=company,
+            date__range=(start_date, end_date)
+        ).order_by('date', 'model')
+        
+        response = HttpResponse(content_type='text/csv')
+        filename = f"openai_resumen_{company.name.replace(' ', '_')}_{period_name}.csv"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        
+        writer = csv.writer(response)
+        writer.writerow([
+            'Fecha', 'Modelo', 'Solicitudes', 'Solicitudes Cacheadas', 'Tokens Entrada', 'Tokens Salida',
+            'Total Tokens', 'Tokens Entrada Cacheados', 'Coste Entrada ($)', 'Coste Salida ($)', 'Coste Total ($)'
+        ])
+        
+        for summary in summaries:
+            writer.writerow([
+                summary.date.strftime('%Y-%m-%d'),
+                summary.model,
+                summary.total_requests,
+                summary.cached_requests,
+                summary.total_tokens_input,
+                summary.total_tokens_output,
+                summary.total_tokens,
+                summary.total_tokens_cached_input,
+                summary.total_cost_input,
+                summary.total_cost_output,
+                summary.total_cost
+            ])
+            
+        return response
@@ -58,7 +58,7 @@ SCHEDULER_CONFIG = {
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',  # Añadido para servir estáticos
+    'chatbot.middleware.AsyncWhiteNoiseMiddleware',  # WhiteNoise para servir estáticos (compatible con ASGI)
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -108,6 +108,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'w2w_chatbotia.wsgi.application'
+ASGI_APPLICATION = 'w2w_chatbotia.asgi.application'
 
 DATABASE_URL = os.getenv('DATABASE_URL')
 
@@ -182,10 +183,150 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
 OPENAI_MODEL_ANALYSIS = os.getenv('OPENAI_MODEL_ANALYSIS', 'gpt-4o-mini')
 
+# Cliente OpenAI compartido: timeouts por tarea (segundos), reintentos con jitter y circuit breaker
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '20'))  # tareas sin timeout propio (chat, resúmenes)
+OPENAI_TASK_TIMEOUTS = {
+    'language': float(os.getenv('OPENAI_TIMEOUT_LANGUAGE', '8')),
+    'vision': float(os.getenv('OPENAI_TIMEOUT_VISION', '45')),
+    'audio': float(os.getenv('OPENAI_TIMEOUT_AUDIO', '60')),
+    'analysis': float(os.getenv('OPENAI_TIMEOUT_ANALYSIS', '60')),
+}
+# Plazo total de una llamada (reintentos y modelos alternativos incluidos); al agotarse se responde
+# con el mensaje de contingencia en lugar de seguir esperando
+OPENAI_DEADLINE = float(os.getenv('OPENAI_DEADLINE', '30'))  # tareas sin plazo propio (chat, resúmenes)
+OPENAI_TASK_DEADLINES = {
+    'language': float(os.getenv('OPENAI_DEADLINE_LANGUAGE', '10')),
+    'vision': float(os.getenv('OPENAI_DEADLINE_VISION', '60')),
+    'audio': float(os.getenv('OPENAI_DEADLINE_AUDIO', '90')),
+    'analysis': float(os.getenv('OPENAI_DEADLINE_ANALYSIS', '120')),
+}
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '50'))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '2'))
+OPENAI_RETRY_BACKOFF = float(os.getenv('OPENAI_RETRY_BACKOFF', '0.5'))  # segundos, se duplica en cada intento
+OPENAI_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('OPENAI_CIRCUIT_FAILURE_THRESHOLD', '5'))  # fallos seguidos para abrir
+OPENAI_CIRCUIT_RESET_TIMEOUT = int(os.getenv('OPENAI_CIRCUIT_RESET_TIMEOUT', '30'))  # segundos abierto antes de probar
+
+# Modelos por tarea (ver chatbot/services/model_router.py): el primero es el principal y los
+# siguientes las alternativas si supera el SLO de latencia o falla. Listas separadas por comas.
+def _model_list(name, *default):
+    value = os.getenv(name)
+    return [model.strip() for model in value.split(',') if model.strip()] if value else list(default)
+
+OPENAI_MODEL_FALLBACK = os.getenv('OPENAI_MODEL_FALLBACK', 'gpt-4o-mini')
+OPENAI_MODEL_ROUTES = {
+    'chat': _model_list('OPENAI_MODELS_CHAT', OPENAI_MODEL, OPENAI_MODEL_FALLBACK),
+    'summary': _model_list('OPENAI_MODELS_SUMMARY', 'gpt-4o-mini'),
+    'context': _model_list('OPENAI_MODELS_CONTEXT', 'gpt-4o-mini'),
+    'language': _model_list('OPENAI_MODELS_LANGUAGE', 'gpt-4o-mini'),
+    'categorization': _model_list('OPENAI_MODELS_CATEGORIZATION', 'gpt-4o-mini'),
+    'analysis': _model_list('OPENAI_MODELS_ANALYSIS', OPENAI_MODEL_ANALYSIS),
+    'vision': _model_list('OPENAI_MODELS_VISION', 'gpt-4o', 'gpt-4o-mini'),
+    'audio': _model_list('OPENAI_MODELS_AUDIO', 'whisper-1'),
+}
+OPENAI_LATENCY_SLO = float(os.getenv('OPENAI_LATENCY_SLO', '10'))  # p90 en segundos (tareas sin SLO propio)
+OPENAI_TASK_LATENCY_SLO = {
+    'chat': float(os.getenv('OPENAI_LATENCY_SLO_CHAT', '8')),
+    'language': float(os.getenv('OPENAI_LATENCY_SLO_LANGUAGE', '3')),
+    'vision': float(os.getenv('OPENAI_LATENCY_SLO_VISION', '25')),
+    'audio': float(os.getenv('OPENAI_LATENCY_SLO_AUDIO', '30')),
+    'analysis': float(os.getenv('OPENAI_LATENCY_SLO_ANALYSIS', '30')),
+}
+OPENAI_ROUTER_WINDOW = int(os.getenv('OPENAI_ROUTER_WINDOW', '300'))  # segundos de historial por modelo
+OPENAI_ROUTER_MIN_SAMPLES = int(os.getenv('OPENAI_ROUTER_MIN_SAMPLES', '5'))  # llamadas mínimas para juzgar un modelo
+OPENAI_ROUTER_MAX_ERROR_RATE = float(os.getenv('OPENAI_ROUTER_MAX_ERROR_RATE', '0.3'))
+
+# Registro de uso de OpenAI en segundo plano: se acumula y se guarda con bulk_create
+USAGE_BUFFER_ENABLED = os.getenv('USAGE_BUFFER_ENABLED', 'True') == 'True'
+USAGE_BUFFER_MAX_SIZE = int(os.getenv('USAGE_BUFFER_MAX_SIZE', '50'))  # registros pendientes que fuerzan el guardado
+USAGE_BUFFER_FLUSH_INTERVAL = float(os.getenv('USAGE_BUFFER_FLUSH_INTERVAL', '5'))  # segundos máximos sin guardar
+# Días completos que la conciliación nocturna recalcula en los resúmenes de uso
+OPENAI_ROLLUP_RECONCILE_DAYS = int(os.getenv('OPENAI_ROLLUP_RECONCILE_DAYS', '2'))
+
+# Instantáneas precalculadas de los dashboards (dashboard de OpenAI, estadísticas de leads)
+DASHBOARD_SNAPSHOT_REFRESH_MINUTES = int(os.getenv('DASHBOARD_SNAPSHOT_REFRESH_MINUTES', '15'))
+DASHBOARD_SNAPSHOT_KEEP_VERSIONS = int(os.getenv('DASHBOARD_SNAPSHOT_KEEP_VERSIONS', '5'))  # versiones que se conservan por página
+
+# Exportación de registros de uso: filas leídas y escritas por bloque
+USAGE_EXPORT_CHUNK_SIZE = int(os.getenv('USAGE_EXPORT_CHUNK_SIZE', '2000'))
+
+# Detección de idioma local (n-gramas); por debajo de la confianza mínima se pregunta a OpenAI
+LANGUAGE_DETECTION_LOCAL_ENABLED = os.getenv('LANGUAGE_DETECTION_LOCAL_ENABLED', 'True') == 'True'
+LANGUAGE_DETECTION_MIN_CONFIDENCE = float(os.getenv('LANGUAGE_DETECTION_MIN_CONFIDENCE', '0.8'))
+
 # WhatsApp API settings
 WHATSAPP_API_TOKEN = os.getenv('WHATSAPP_API_TOKEN')
 WHATSAPP_PHONE_NUMBER_ID = os.getenv('WHATSAPP_PHONE_NUMBER_ID')
 WHATSAPP_VERIFY_TOKEN = os.getenv('WHATSAPP_VERIFY_TOKEN')
+WHATSAPP_GRAPH_API_URL = os.getenv('WHATSAPP_GRAPH_API_URL', 'https://graph.facebook.com/v22.0')
+
+# Cola de webhooks entrantes (el webhook solo encola; los workers procesan)
+INBOUND_QUEUE_ENABLED = os.getenv('INBOUND_QUEUE_ENABLED', 'True') == 'True'
+INBOUND_QUEUE_WORKERS = int(os.getenv('INBOUND_QUEUE_WORKERS', '4'))
+INBOUND_QUEUE_VISIBILITY_TIMEOUT = int(os.getenv('INBOUND_QUEUE_VISIBILITY_TIMEOUT', '300'))  # segundos
+INBOUND_QUEUE_MAX_ATTEMPTS = int(os.getenv('INBOUND_QUEUE_MAX_ATTEMPTS', '5'))
+INBOUND_QUEUE_RETRY_BACKOFF = int(os.getenv('INBOUND_QUEUE_RETRY_BACKOFF', '10'))  # segundos, se duplica en cada intento
+INBOUND_QUEUE_ASYNC_CONCURRENCY = int(os.getenv('INBOUND_QUEUE_ASYNC_CONCURRENCY', '200'))  # eventos en curso en modo --async
+INBOUND_QUEUE_MAX_MERGE = int(os.getenv('INBOUND_QUEUE_MAX_MERGE', '20'))  # eventos de una conversación procesados juntos
+
+# Agrupación de ráfagas de mensajes (la ventana se configura por empresa)
+MESSAGE_DEBOUNCE_MAX_WAIT = int(os.getenv('MESSAGE_DEBOUNCE_MAX_WAIT', '15'))  # segundos máximos de retención de una ráfaga
+
+# Clientes HTTP asíncronos compartidos (Graph API)
+ASYNC_HTTP_TIMEOUT = float(os.getenv('ASYNC_HTTP_TIMEOUT', '30'))  # segundos
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv('ASYNC_HTTP_MAX_CONNECTIONS', '100'))
+
+# Lock por conversación ('auto' usa advisory locks en PostgreSQL y la caché en el resto)
+MAILBOX_LOCK_BACKEND = os.getenv('MAILBOX_LOCK_BACKEND', 'auto')
+MAILBOX_LOCK_TIMEOUT = int(os.getenv('MAILBOX_LOCK_TIMEOUT', '60'))  # segundos de espera máxima
+
+# Deduplicación de mensajes entre workers ('database', 'cache' o ruta a una clase)
+DEDUP_BACKEND = os.getenv('DEDUP_BACKEND', 'database')
+DEDUP_TTL_HOURS = int(os.getenv('DEDUP_TTL_HOURS', '24'))
+DEDUP_BLOOM_CAPACITY = int(os.getenv('DEDUP_BLOOM_CAPACITY', '100000'))
+DEDUP_BLOOM_ERROR_RATE = float(os.getenv('DEDUP_BLOOM_ERROR_RATE', '0.01'))
+
+# Historial de conversación para OpenAI (memory: LRU por proceso, comprobado contra la tabla Message
+# antes de usarlo | cache: caché de Django compartida)
+CONTEXT_STORE_BACKEND = os.getenv('CONTEXT_STORE_BACKEND', 'memory')
+CONTEXT_STORE_CACHE = os.getenv('CONTEXT_STORE_CACHE', 'default')  # alias de CACHES para el backend 'cache'
+CONTEXT_STORE_MAX_ENTRIES = int(os.getenv('CONTEXT_STORE_MAX_ENTRIES', '2000'))
+CONTEXT_STORE_MAX_BYTES = int(os.getenv('CONTEXT_STORE_MAX_BYTES', str(32 * 1024 * 1024)))
+CONTEXT_STORE_TTL = int(os.getenv('CONTEXT_STORE_TTL', '3600'))  # segundos sin uso antes de expirar
+
+# Presupuesto de tokens del historial (sin el prompt de sistema). Al superarlo se
+# recorta hasta CONTEXT_TOKEN_TARGET y lo descartado pasa al resumen de la sesión.
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+CONTEXT_TOKEN_TARGET = int(os.getenv('CONTEXT_TOKEN_TARGET', '1800'))
+CONTEXT_SUMMARY_ENABLED = os.getenv('CONTEXT_SUMMARY_ENABLED', 'True') == 'True'
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv('CONTEXT_SUMMARY_MAX_TOKENS', '300'))
+
+# Prompts de sistema e información de empresa compilados (clave con Company.knowledge_version)
+SYSTEM_PROMPT_CACHE = os.getenv('SYSTEM_PROMPT_CACHE', 'default')  # alias de CACHES
+SYSTEM_PROMPT_CACHE_TTL = int(os.getenv('SYSTEM_PROMPT_CACHE_TTL', str(24 * 3600)))  # segundos
+
+# Selección de secciones relevantes (BM25) cuando la información de la empresa supera este tamaño
+KNOWLEDGE_RETRIEVAL_MIN_TOKENS = int(os.getenv('KNOWLEDGE_RETRIEVAL_MIN_TOKENS', '4000'))
+KNOWLEDGE_RETRIEVAL_TOP_K = int(os.getenv('KNOWLEDGE_RETRIEVAL_TOP_K', '4'))
+
+# Caché de respuestas para preguntas sin contexto (clave: pregunta normalizada, idioma y versión de contenido)
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'True') == 'True'
+ANSWER_CACHE = os.getenv('ANSWER_CACHE', 'default')  # alias de CACHES
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', str(6 * 3600)))  # segundos
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', '0.8'))  # Jaccard mínimo entre preguntas
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '200'))  # preguntas por empresa e idioma
+
+# Tareas diferidas persistentes (manage.py run_delayed_tasks o el scheduler)
+DELAYED_TASK_POLL_SECONDS = int(os.getenv('DELAYED_TASK_POLL_SECONDS', '5'))  # intervalo del job del scheduler
+DELAYED_TASK_VISIBILITY_TIMEOUT = int(os.getenv('DELAYED_TASK_VISIBILITY_TIMEOUT', '120'))  # segundos
+DELAYED_TASK_MAX_ATTEMPTS = int(os.getenv('DELAYED_TASK_MAX_ATTEMPTS', '5'))
+DELAYED_TASK_RETRY_BACKOFF = int(os.getenv('DELAYED_TASK_RETRY_BACKOFF', '10'))  # segundos, se duplica en cada intento
+
+# Análisis nocturno de conversaciones por lotes (Batch API); con False se analiza al cerrar cada sesión
+ANALYSIS_BATCH_ENABLED = os.getenv('ANALYSIS_BATCH_ENABLED', 'True') == 'True'
+ANALYSIS_BATCH_BACKEND = os.getenv('ANALYSIS_BATCH_BACKEND', 'openai')  # openai, local (pruebas) o ruta de una clase
+ANALYSIS_BATCH_MAX_SESSIONS = int(os.getenv('ANALYSIS_BATCH_MAX_SESSIONS', '5000'))  # sesiones por lote
+ANALYSIS_BATCH_LOOKBACK_DAYS = int(os.getenv('ANALYSIS_BATCH_LOOKBACK_DAYS', '7'))  # antigüedad máxima de las sesiones
+ANALYSIS_BATCH_POLL_MINUTES = int(os.getenv('ANALYSIS_BATCH_POLL_MINUTES', '15'))  # intervalo de consulta de lotes
 
 # SendGrid API settings
 SENDGRID_API_KEY = os.getenv('SENDGRID_API_KEY', '')